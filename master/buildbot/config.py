@@ -83,9 +83,13 @@ class MasterConfig(object):
         self.prioritizeBuilders = None
         self.slavePortnum = None
         self.remoteCallTimeout = 5 # timeout in seconds
+        self.buildRequestDistributorBatchSize = 1
+        self.buildLoaderThreads = 4
+        self.buildLoaderReadAhead = 8
         self.multiMaster = False
         self.debugPassword = None
         self.manhole = None
+        self.masterNotifications = None
         self.realTimeServer = ''
         self.analytics_code = None
         self.gzip = True
@@ -126,13 +130,14 @@ class MasterConfig(object):
         "change_source", "codebaseGenerator", "changeCacheSize", "changeHorizon",
         'db', "db_poll_interval", "db_url", "debugPassword", "eventHorizon",
         "logCompressionLimit", "logCompressionMethod", "logHorizon",
-        "logMaxSize", "logMaxTailSize", "manhole", "mergeRequests", "metrics",
-        "multiMaster", "prioritizeBuilders", "projects", "projectName", "projectURL",
+        "logMaxSize", "logMaxTailSize", "manhole", "masterNotifications",
+        "mergeRequests", "metrics", "multiMaster", "prioritizeBuilders", "projects", "projectName", "projectURL",
         "properties", "revlink", "schedulers", "slavePortnum", "slaves",
         "status", "title", "titleURL", "user_managers", "validation", "realTimeServer",
         "analytics_code", "gzip", "autobahn_push", "lastBuildCacheDays",
         "requireLogin", "globalFactory", "slave_debug_url", "slaveManagerUrl",
-        "cleanUpPeriod", "buildRequestsDays", "remoteCallTimeout"
+        "cleanUpPeriod", "buildRequestsDays", "remoteCallTimeout",
+        "buildRequestDistributorBatchSize", "buildLoaderThreads", "buildLoaderReadAhead",
     ])
 
     @classmethod
@@ -330,6 +335,18 @@ class MasterConfig(object):
 
         copy_int_param('remoteCallTimeout')
 
+        copy_int_param('buildRequestDistributorBatchSize')
+        if self.buildRequestDistributorBatchSize < 1:
+            error("c['buildRequestDistributorBatchSize'] must be at least 1")
+
+        copy_int_param('buildLoaderThreads')
+        if self.buildLoaderThreads < 1:
+            error("c['buildLoaderThreads'] must be at least 1")
+
+        copy_int_param('buildLoaderReadAhead')
+        if self.buildLoaderReadAhead < 1:
+            error("c['buildLoaderReadAhead'] must be at least 1")
+
         if 'multiMaster' in config_dict:
             self.multiMaster = config_dict["multiMaster"]
 
@@ -356,6 +373,14 @@ class MasterConfig(object):
             # that will fail if pycrypto isn't installed
             self.manhole = config_dict['manhole']
 
+        if 'masterNotifications' in config_dict:
+            from buildbot.process.notifications import NotificationTransport
+            transport = config_dict['masterNotifications']
+            if transport is not None and not isinstance(transport, NotificationTransport):
+                error("c['masterNotifications'] must be a NotificationTransport instance")
+            else:
+                self.masterNotifications = transport
+
         if 'revlink' in config_dict:
             revlink = config_dict['revlink']
             if not callable(revlink):
@@ -380,7 +405,8 @@ class MasterConfig(object):
     def load_db(self, filename, config_dict):
         if 'db' in config_dict:
             db = config_dict['db']
-            if set(db.keys()) > set(['db_url', 'db_poll_interval']):
+            if set(db.keys()) - set(['db_url', 'db_poll_interval',
+                                     'db_slow_query_threshold']):
                 error("unrecognized keys in c['db']")
             self.db.update(db)
         if 'db_url' in config_dict:
@@ -398,6 +424,11 @@ class MasterConfig(object):
         else:
             self.db['db_poll_interval'] = db_poll_interval
 
+        db_slow_query_threshold = self.db.get('db_slow_query_threshold')
+        if db_slow_query_threshold is not None and \
+                    not isinstance(db_slow_query_threshold, (int, float)):
+            error("c['db']['db_slow_query_threshold'] must be a number")
+
     def load_metrics(self, filename, config_dict):
         # we don't try to validate metrics keys
         if 'metrics' in config_dict:
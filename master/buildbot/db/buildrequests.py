@@ -18,9 +18,10 @@ import sqlalchemy as sa
 from sqlalchemy import or_
 from sqlalchemy import func
 from datetime import datetime, timedelta
-from twisted.internet import reactor, defer
+from twisted.internet import reactor
 from twisted.python import log
 from buildbot.db import base
+from buildbot.db.sourcestamps import getMergeKey
 from buildbot.util import json
 from buildbot.util import epoch2datetime, datetime2epoch
 from buildbot.status.results import RESUME, CANCELED
@@ -224,6 +225,33 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
 
         return self.db.pool.do(thd)
 
+    def getUnclaimedBuildRequests(self, greater_than=None):
+        """
+        Return the id, buildset and builder of the unclaimed build requests,
+        in the order of their ids, only those with an id greater than
+        C{greater_than} if it is given.
+        """
+        def thd(conn):
+            reqs_tbl = self.db.model.buildrequests
+            claims_tbl = self.db.model.buildrequest_claims
+
+            q = sa.select([reqs_tbl.c.id, reqs_tbl.c.buildsetid, reqs_tbl.c.buildername],
+                          from_obj=reqs_tbl.outerjoin(claims_tbl,
+                                                      reqs_tbl.c.id == claims_tbl.c.brid),
+                          whereclause=((claims_tbl.c.claimed_at == None) &
+                                       (reqs_tbl.c.complete == 0)))
+            if greater_than is not None:
+                q = q.where(reqs_tbl.c.id > greater_than)
+            q = q.order_by(sa.asc(reqs_tbl.c.id))
+
+            res = conn.execute(q)
+            rv = [dict(brid=row.id, buildsetid=row.buildsetid, buildername=row.buildername)
+                  for row in res.fetchall()]
+            res.close()
+            return rv
+
+        return self.db.pool.do(thd)
+
     def getTotalBuildsInTheLastDay(self):
         def thd(conn):
             reqs_tbl = self.db.model.buildrequests
@@ -314,7 +342,7 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
 
     @with_master_objectid
     def getBuildRequestsInQueue(self, queue, buildername=None, sourcestamps=None,
-                                mergebrids=None, startbrid=None,
+                                mergebrids=None, startbrid=None, brids=None,
                                 order=True, _master_objectid=None):
         """
         Finds the buildrequests that are in queue waiting to be process
@@ -326,8 +354,10 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
         @param sourcestamps: filter the results by sourcestamps
         @param mergebrids: fetch buildrequest that has been merged with brids
         @param startbrid: filter pending builds that belong to same build chain
+        @param brids: fetch only the given buildrequests, if they are still in the queue
         @param order: order the resutls by higher priority and oldest submitted time
-        this can be skipped when applying filters to check request that can be merged.
+        this can be skipped when applying filters to check request that can be merged,
+        the results are then ordered by id.
 
         @returns: a build request dictionary or empty list
         """
@@ -396,11 +426,32 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
 
             if order:
                 buildersqueue = buildersqueue.order_by(sa.desc(reqs_tbl.c.priority), sa.asc(reqs_tbl.c.submitted_at))
+            else:
+                # cheap on the primary key, and the rows do not come back in
+                # the order of whichever index the database happens to pick
+                buildersqueue = buildersqueue.order_by(reqs_tbl.c.id)
+
+            def fetchRows():
+                if brids is None:
+                    # TODO: for performance we may need to limit the result
+                    res = conn.execute(buildersqueue)
+                    rows = res.fetchall()
+                    res.close()
+                    return rows
 
-            # TODO: for performance we may need to limit the result
-            res = conn.execute(buildersqueue)
+                # we'll need to batch the brids into groups of 100, so that the
+                # parameter lists supported by the DBAPI aren't exhausted
+                rows = []
+                iterator = iter(brids)
+                batch = list(itertools.islice(iterator, 100))
+                while len(batch) > 0:
+                    res = conn.execute(buildersqueue.where(reqs_tbl.c.id.in_(batch)))
+                    rows.extend(res.fetchall())
+                    res.close()
+                    batch = list(itertools.islice(iterator, 100))
+                return rows
 
-            rows = res.fetchall()
+            rows = fetchRows()
             rv = []
 
             def getSelectedSlave(row):
@@ -418,7 +469,6 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
                                    slavepool=row.slavepool,
                                    startbrid=row.startbrid))
 
-            res.close()
             return rv
 
         return self.db.pool.do(thd)
@@ -428,34 +478,16 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
                                                   sourcestamps_tbl,
                                                   sourcestampsets_tbl,
                                                   buildsets_tbl):
+            # buildsets with exactly the same codebases, branches and revisions
+            # share the merge key, which is indexed
+            merge_key = getMergeKey([(ss['b_codebase'], ss['b_branch'], ss['b_revision'])
+                                     for ss in sourcestamps])
 
-            clauses = []
-
-            # check sourcestampset has same number of row in the sourcestamps table
-            stmt = sa.select([sourcestamps_tbl.c.sourcestampsetid]) \
-                .where(sourcestamps_tbl.c.sourcestampsetid == sourcestampsets_tbl.c.id) \
-                .group_by(sourcestamps_tbl.c.sourcestampsetid) \
-                .having(sa.func.count(sourcestamps_tbl.c.id) == len(sourcestamps))
+            stmt = sa.select(columns=[buildsets_tbl.c.id]) \
+                .where(buildsets_tbl.c.merge_key == merge_key) \
+                .where(buildsets_tbl.c.sourcestampsetid != sourcestamps[0]['b_sourcestampsetid'])
 
-            clauses.append(sourcestampsets_tbl.c.id == stmt)
-            clauses.append(sourcestampsets_tbl.c.id != sourcestamps[0]['b_sourcestampsetid'])
-
-            # check that sourcestampset match all revisions x codebases
-            for ss in sourcestamps:
-                stmt_temp = sa.select([sourcestamps_tbl.c.sourcestampsetid]) \
-                    .where(sourcestamps_tbl.c.sourcestampsetid == sourcestampsets_tbl.c.id) \
-                    .where(sourcestamps_tbl.c.codebase == ss['b_codebase']) \
-                    .where(sourcestamps_tbl.c.revision == ss['b_revision']) \
-                    .where(sourcestamps_tbl.c.branch == ss['b_branch'])
-                clauses.append(sourcestampsets_tbl.c.id == stmt_temp)
-
-            stmt2 = sa.select(columns=[sourcestampsets_tbl.c.id]) \
-                .where(sa.and_(*clauses))
-
-            stmt3 = sa.select(columns=[buildsets_tbl.c.id]) \
-                .where(buildsets_tbl.c.sourcestampsetid.in_(stmt2))
-
-            return stmt3
+            return stmt
 
     def getBuildRequestBySourcestamps(self, buildername=None, sourcestamps=None):
         def thd(conn):
@@ -756,6 +788,52 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
 
         return self.db.pool.do(thd)
 
+    @with_master_objectid
+    def claimBuildRequestGroups(self, groups, claimed_at=None, _reactor=reactor,
+                                _master_objectid=None):
+        """
+        Claims several groups of pending build requests in a single transaction,
+        each group is a list of brids where the first one is the request that will
+        be built and the rest are merged into it (see L{mergePendingBuildRequests}).
+
+        Either all the groups are claimed or none of them, raising
+        L{AlreadyClaimedError} if any request was already claimed.
+        """
+        def thd(conn):
+            transaction = conn.begin()
+            buildrequests_tbl = self.db.model.buildrequests
+            claims_tbl = self.db.model.buildrequest_claims
+            claimed_at_value = self.getClaimedAtValue(_reactor, claimed_at)
+
+            try:
+                conn.execute(claims_tbl.insert(), [dict(brid=brid, objectid=_master_objectid,
+                                                        claimed_at=claimed_at_value)
+                                                   for brids in groups for brid in brids])
+            except (sa.exc.IntegrityError, sa.exc.ProgrammingError):
+                transaction.rollback()
+                raise AlreadyClaimedError
+
+            try:
+                for brids in groups:
+                    # we'll need to batch the brids into groups of 100, so that the
+                    # parameter lists supported by the DBAPI aren't exhausted
+                    iterator = iter(brids[1:])
+                    batch = list(itertools.islice(iterator, 100))
+                    while len(batch) > 0:
+                        stmt = buildrequests_tbl.update() \
+                            .where(sa.or_(buildrequests_tbl.c.id.in_(batch),
+                                          buildrequests_tbl.c.mergebrid.in_(batch))) \
+                            .values(mergebrid=brids[0])
+                        conn.execute(stmt)
+                        batch = list(itertools.islice(iterator, 100))
+            except:
+                transaction.rollback()
+                raise
+
+            transaction.commit()
+
+        return self.db.pool.do(thd)
+
     def getBuildRequestTriggered(self, triggeredbybrid, buildername):
         def thd(conn):
             buildrequests_tbl = self.db.model.buildrequests
@@ -811,6 +889,33 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
 
         return self.db.pool.do(thd)
 
+    def getBuildRequestsByIds(self, brids):
+        def thd(conn):
+            buildrequests_tbl = self.db.model.buildrequests
+            buildrequests = {}
+
+            # split the brids into batches, so as not to overflow the
+            # parameter lists of the database interface
+            remaining = sorted(set(brids))
+            while remaining:
+                batch, remaining = remaining[:100], remaining[100:]
+                stmt_br = sa.select([buildrequests_tbl]) \
+                    .where(buildrequests_tbl.c.id.in_(batch))
+
+                res = conn.execute(stmt_br)
+                for row in res.fetchall():
+                    submitted_at = mkdt(row.submitted_at)
+                    complete_at = mkdt(row.complete_at)
+                    buildrequests[row.id] = dict(brid=row.id, buildsetid=row.buildsetid,
+                                                 buildername=row.buildername, priority=row.priority,
+                                                 complete=bool(row.complete), results=row.results,
+                                                 submitted_at=submitted_at, complete_at=complete_at,
+                                                 artifactbrid=row.artifactbrid)
+                res.close()
+            return buildrequests
+
+        return self.db.pool.do(thd)
+
     def getBuildRequestsTriggeredBy(self, triggeredbybrid, buildername):
         def thd(conn):
             buildrequests_tbl = self.db.model.buildrequests
@@ -1271,77 +1376,6 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
         d.addCallback(log_nonzero_count)
         return d
 
-    def pruneBuildRequests(self, buildRequestsDays):
-        if not buildRequestsDays:
-            return defer.succeed(None)
-
-        def thd(conn):
-            if self.db.pool.engine.dialect.name != 'mysql':
-                # sqlite doesnt have integrity constraints, we should check if this approach works on postgre
-                log.msg("pruneBuildRequests is not yet supported for %s" % self.db.pool.engine.dialect.name)
-                return
-
-            try:
-                buildrequests_tbl = self.db.model.buildrequests
-                buildsets_tbl = self.db.model.buildsets
-                sourcestampsets_tbl = self.db.model.sourcestampsets
-
-                prune_period = datetime.now().date() - timedelta(buildRequestsDays)
-                prune_period_epoch = datetime2epoch(datetime(prune_period.year, prune_period.month, prune_period.day))
-
-                transaction = conn.begin()
-
-                stmt_brids = sa.select([buildrequests_tbl.c.id])\
-                    .where(buildrequests_tbl.c.submitted_at <= prune_period_epoch).limit(100000)
-
-                res = conn.execute(stmt_brids)
-                brids = [r.id for r in res]
-
-                if not brids:
-                    return
-
-                log.msg("Prune %d buildrequests" % len(brids))
-
-                iterator = iter(brids)
-                batch = list(itertools.islice(iterator, 100))
-
-                while len(batch) > 0:
-                    stmt_bsids = sa.select(
-                            [buildsets_tbl.c.id],
-                            from_obj=buildsets_tbl.join(
-                                    buildrequests_tbl, buildsets_tbl.c.id == buildrequests_tbl.c.buildsetid))\
-                        .where(buildrequests_tbl.c.id.in_(batch))\
-                        .group_by(buildsets_tbl.c.id)
-
-                    res = conn.execute(stmt_bsids)
-                    bsids = [r.id for r in res]
-
-                    stmt_ssids = sa.select(
-                            [sourcestampsets_tbl.c.id],
-                            from_obj=sourcestampsets_tbl.join(
-                                    buildsets_tbl,
-                                    buildsets_tbl.c.sourcestampsetid == sourcestampsets_tbl.c.id))\
-                        .where(buildrequests_tbl.c.id.in_(bsids))\
-                        .group_by(sourcestampsets_tbl.c.id)
-
-                    res = conn.execute(stmt_ssids)
-                    ssids = [r.id for r in res]
-
-                    # Cascade delete to related tables
-                    conn.execute(sourcestampsets_tbl.delete((sourcestampsets_tbl.c.id.in_(ssids))))
-                    conn.execute(buildsets_tbl.delete((buildsets_tbl.c.id.in_(bsids))))
-                    conn.execute(buildrequests_tbl.delete((buildrequests_tbl.c.id.in_(batch))))
-                    batch = list(itertools.islice(iterator, 100))
-
-            except Exception:
-                transaction.rollback()
-                log.msg(Failure(), "Could not pruneBuildRequests")
-                return
-
-            transaction.commit()
-
-        return self.db.pool.do(thd)
-
     def _brdictFromRow(self, row, master_objectid):
         claimed = mine = False
         claimed_at = None
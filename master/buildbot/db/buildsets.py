@@ -17,10 +17,12 @@
 Support for buildsets in the database
 """
 
+import itertools
 import sqlalchemy as sa
 from twisted.internet import reactor
 from buildbot.util import json
 from buildbot.db import base
+from buildbot.db.sourcestamps import getMergeKey
 from buildbot.util import epoch2datetime, datetime2epoch
 from buildbot.process.buildrequest import Priority
 
@@ -51,52 +53,58 @@ class BuildsetsConnectorComponent(base.DBConnectorComponent):
             function is not thread-safe and assumes it runs inside a lock)
         :return:
         """
-        if brDictsToMerge is None:
-            brDictsToMerge = {}
+        d = self.addBuildsets(sourcestampsetid,
+                [dict(reason=reason, properties=properties,
+                      builderNames=builderNames,
+                      external_idstring=external_idstring,
+                      brDictsToMerge=brDictsToMerge)],
+                triggeredbybrid=triggeredbybrid, _reactor=_reactor,
+                _master_objectid=_master_objectid)
+        d.addCallback(lambda results: results[0])
+        return d
+
+    def addBuildsets(self, sourcestampsetid, buildsets, triggeredbybrid=None,
+                     _reactor=reactor, _master_objectid=None):
+        """
+        Add several buildsets for the same sourcestamp set in a single
+        transaction.
 
+        :param sourcestampsetid:
+        :param list(dict) buildsets:
+            One dictionary per buildset, with the keys `reason`, `properties`
+            and `builderNames`, and optionally `external_idstring` and
+            `brDictsToMerge`, as for `addBuildset`.
+        :param triggeredbybrid:
+        :return:
+            List of (bsid, brids), in the order of `buildsets`
+        """
         def thd(conn):
-            priority = Priority.Default
             buildsets_tbl = self.db.model.buildsets
+            bs_props_tbl = self.db.model.buildset_properties
+            br_tbl = self.db.model.buildrequests
             submitted_at = _reactor.seconds()
 
-            reason_val = self.truncateColumn(buildsets_tbl.c.reason, reason)
-            self.check_length(buildsets_tbl.c.reason, reason_val)
-            self.check_length(buildsets_tbl.c.external_idstring,
-                    external_idstring)
+            reasons = []
+            for bs in buildsets:
+                reason_val = self.truncateColumn(buildsets_tbl.c.reason,
+                                                 bs['reason'])
+                self.check_length(buildsets_tbl.c.reason, reason_val)
+                reasons.append(reason_val)
+                self.check_length(buildsets_tbl.c.external_idstring,
+                        bs.get('external_idstring'))
+                for buildername in bs['builderNames']:
+                    self.check_length(br_tbl.c.buildername, buildername)
+                for k in (bs['properties'] or {}):
+                    self.check_length(bs_props_tbl.c.property_name, k)
 
             transaction = conn.begin()
 
-            # insert the buildset itself
-            r = conn.execute(buildsets_tbl.insert(), dict(
-                sourcestampsetid=sourcestampsetid, submitted_at=submitted_at,
-                reason=reason_val, complete=0, complete_at=None, results=-1,
-                external_idstring=external_idstring))
-            bsid = r.inserted_primary_key[0]
-
-            # add any properties
-            if properties:
-                bs_props_tbl = self.db.model.buildset_properties
-                if 'priority' in properties:
-                    priority_property = properties.get('priority')[0]
-                    priority = priority_property if priority_property \
-                                                    and int(priority_property) > 0 else Priority.Default
-
-                inserts = [
-                    dict(buildsetid=bsid, property_name=k,
-                         property_value=json.dumps([v,s]))
-                    for k,(v,s) in properties.iteritems() ]
-                for i in inserts:
-                    self.check_length(bs_props_tbl.c.property_name,
-                                      i['property_name'])
-
-                conn.execute(bs_props_tbl.insert(), inserts)
-
-            # and finish with a build request for each builder.  Note that
-            # sqlalchemy and the Python DBAPI do not provide a way to recover
-            # inserted IDs from a multi-row insert, so this is done one row at
-            # a time.
-            brids = {}
-            br_tbl = self.db.model.buildrequests
+            # the merge key is used to find buildsets with the same sourcestamps
+            ss_tbl = self.db.model.sourcestamps
+            q = sa.select([ss_tbl.c.codebase, ss_tbl.c.branch, ss_tbl.c.revision]) \
+                .where(ss_tbl.c.sourcestampsetid == sourcestampsetid)
+            merge_key = getMergeKey([tuple(row) for row in conn.execute(q).fetchall()])
+
             startbrid = triggeredbybrid
             if triggeredbybrid is not None:
                 q = sa.select([br_tbl.c.triggeredbybrid, br_tbl.c.startbrid]) \
@@ -107,62 +115,108 @@ class BuildsetsConnectorComponent(base.DBConnectorComponent):
                 if row and (row.startbrid is not None):
                     startbrid = row.startbrid
 
-            ins = br_tbl.insert()
-            for buildername in builderNames:
-                self.check_length(br_tbl.c.buildername, buildername)
-
-                # If this builder is being merged, figure out what to merge into
-                mergeBrDict = brDictsToMerge.get(buildername, None)
-                if mergeBrDict:
-                    # Set our merge target
-                    mergebrid = brDictsToMerge[buildername]['brid']
-
-                    # And reuse artifacts. `artifactbrid` and `mergebrid` will almost
-                    # always be the same, except for cases where we are merging against
-                    # a build that reused previous artifacts
-                    artifactbrid = brDictsToMerge[buildername]['artifactbrid'] or mergebrid
-                else:
-                    mergebrid = artifactbrid = None
-
-                # Add the buildrequest to the database
-                res = conn.execute(ins,
-                                   dict(buildsetid=bsid, buildername=buildername, priority=priority,
-                                        complete=0, results=-1,
-                                        submitted_at=submitted_at, complete_at=None,
-                                        triggeredbybrid=triggeredbybrid, startbrid=startbrid,
-                                        mergebrid=mergebrid, artifactbrid=artifactbrid))
-                brids[buildername] = res.inserted_primary_key[0]
+            # insert the buildsets themselves; sqlalchemy and the Python DBAPI
+            # do not provide a way to recover inserted IDs from a multi-row
+            # insert, so this is done one row at a time.
+            bsids = []
+            props_inserts = []
+            br_inserts = []
+            for bs, reason_val in zip(buildsets, reasons):
+                r = conn.execute(buildsets_tbl.insert(), dict(
+                    sourcestampsetid=sourcestampsetid, submitted_at=submitted_at,
+                    reason=reason_val, complete=0, complete_at=None, results=-1,
+                    external_idstring=bs.get('external_idstring'),
+                    merge_key=merge_key))
+                bsid = r.inserted_primary_key[0]
+                bsids.append(bsid)
+
+                # collect any properties
+                priority = Priority.Default
+                properties = bs['properties']
+                if properties:
+                    if 'priority' in properties:
+                        priority_property = properties.get('priority')[0]
+                        priority = priority_property if priority_property \
+                                                        and int(priority_property) > 0 else Priority.Default
+
+                    props_inserts.extend(
+                        dict(buildsetid=bsid, property_name=k,
+                             property_value=json.dumps([v,s]))
+                        for k,(v,s) in properties.iteritems())
+
+                # and a build request for each builder
+                brDictsToMerge = bs.get('brDictsToMerge') or {}
+                for buildername in bs['builderNames']:
+                    # If this builder is being merged, figure out what to merge into
+                    mergeBrDict = brDictsToMerge.get(buildername, None)
+                    if mergeBrDict:
+                        # Set our merge target
+                        mergebrid = mergeBrDict['brid']
+
+                        # And reuse artifacts. `artifactbrid` and `mergebrid` will almost
+                        # always be the same, except for cases where we are merging against
+                        # a build that reused previous artifacts
+                        artifactbrid = mergeBrDict['artifactbrid'] or mergebrid
+                    else:
+                        mergebrid = artifactbrid = None
+
+                    br_inserts.append(
+                        dict(buildsetid=bsid, buildername=buildername, priority=priority,
+                             complete=0, results=-1,
+                             submitted_at=submitted_at, complete_at=None,
+                             triggeredbybrid=triggeredbybrid, startbrid=startbrid,
+                             mergebrid=mergebrid, artifactbrid=artifactbrid))
+
+            # Check if we have anything, because SQLAlchemy breaks if you try
+            # inserting an empty list of values
+            if props_inserts:
+                conn.execute(bs_props_tbl.insert(), props_inserts)
+
+            # the build requests are inserted all at once, and their IDs read
+            # back by buildset, in batches of 100 so that the parameter lists
+            # supported by the DBAPI aren't exhausted
+            brids = dict((bsid, {}) for bsid in bsids)
+            if br_inserts:
+                conn.execute(br_tbl.insert(), br_inserts)
+
+                iterator = iter(bsids)
+                batch = list(itertools.islice(iterator, 100))
+                while len(batch) > 0:
+                    q = sa.select([br_tbl.c.id, br_tbl.c.buildsetid,
+                                   br_tbl.c.buildername]) \
+                        .where(br_tbl.c.buildsetid.in_(batch))
+                    for row in conn.execute(q).fetchall():
+                        brids[row.buildsetid][row.buildername] = row.id
+                    batch = list(itertools.islice(iterator, 100))
 
             # Do the rest of the merge process for merged builds
-            # Check if we have anything, because SQLAlchemy breaks if you try inserting an empty
-            # list of values
-            if brDictsToMerge:
-                current_time = _reactor.seconds()
-
-                # Register breq as claimed
-                q = self.db.model.buildrequest_claims.insert()
-                conn.execute(q, [dict(brid=brids[buildername], objectid=_master_objectid,
-                                      claimed_at=current_time)
-                                 for (buildername, _mergeBrDict) in brDictsToMerge.iteritems()])
-
-                # If we are merging against a running request, register a build for this breq
-                # Again, check if there are merge target with build numbers, otherwise SQLAlchemy
-                # will break when inserting empty list of values
-                brDictsWithBuilds = {
-                    buildername: mergeBrDict
-                    for (buildername, mergeBrDict) in brDictsToMerge.iteritems()
-                    if mergeBrDict['build_number']
-                }
-                if brDictsWithBuilds:
-                    q = self.db.model.builds.insert()
-                    conn.execute(q, [dict(number=mergeBrDict['build_number'], brid=brids[buildername],
-                                          start_time=current_time, finish_time=None)
-                                     for (buildername, mergeBrDict) in brDictsWithBuilds.iteritems()
-                                 ])
+            current_time = _reactor.seconds()
+            claims_inserts = []
+            builds_inserts = []
+            for bsid, bs in zip(bsids, buildsets):
+                for (buildername, mergeBrDict) in (bs.get('brDictsToMerge') or {}).iteritems():
+                    # Register breq as claimed
+                    claims_inserts.append(
+                        dict(brid=brids[bsid][buildername], objectid=_master_objectid,
+                             claimed_at=current_time))
+
+                    # If we are merging against a running request, register a
+                    # build for this breq
+                    if mergeBrDict['build_number']:
+                        builds_inserts.append(
+                            dict(number=mergeBrDict['build_number'],
+                                 brid=brids[bsid][buildername],
+                                 start_time=current_time, finish_time=None))
+
+            if claims_inserts:
+                conn.execute(self.db.model.buildrequest_claims.insert(),
+                             claims_inserts)
+            if builds_inserts:
+                conn.execute(self.db.model.builds.insert(), builds_inserts)
 
             transaction.commit()
 
-            return (bsid, brids)
+            return [ (bsid, brids[bsid]) for bsid in bsids ]
         return self.db.pool.do(thd)
 
     def completeBuildset(self, bsid, results, complete_at=None,
@@ -226,6 +280,43 @@ class BuildsetsConnectorComponent(base.DBConnectorComponent):
 
         return self.db.pool.do(thd)
 
+    def getBuildsetsCompletion(self, bsids):
+        def thd(conn):
+            bs_tbl = self.db.model.buildsets
+            reqs_tbl = self.db.model.buildrequests
+
+            completion = {}
+            # we'll need to batch the bsids into groups of 100, so that the
+            # parameter lists supported by the DBAPI aren't exhausted
+            iterator = iter(bsids)
+            batch = list(itertools.islice(iterator, 100))
+            while len(batch) > 0:
+                q = sa.select([bs_tbl.c.id, bs_tbl.c.complete,
+                               reqs_tbl.c.complete, reqs_tbl.c.results],
+                              from_obj=[bs_tbl.outerjoin(reqs_tbl,
+                                    reqs_tbl.c.buildsetid == bs_tbl.c.id)],
+                              use_labels=True) \
+                    .where(bs_tbl.c.id.in_(batch))
+                res = conn.execute(q)
+                for row in res.fetchall():
+                    bsid = row[0]
+                    if bsid not in completion:
+                        completion[bsid] = dict(bsid=bsid,
+                                                complete=bool(row[1]),
+                                                requests_complete=True,
+                                                results=[])
+                    # a buildset without build requests has no request row
+                    if row[2] is None:
+                        continue
+                    if row[2]:
+                        completion[bsid]['results'].append(row[3])
+                    else:
+                        completion[bsid]['requests_complete'] = False
+                res.close()
+                batch = list(itertools.islice(iterator, 100))
+            return completion
+        return self.db.pool.do(thd)
+
     def getBuildsets(self, complete=None):
         def thd(conn):
             bs_tbl = self.db.model.buildsets
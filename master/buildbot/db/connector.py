@@ -20,7 +20,7 @@ from twisted.application import internet, service
 from buildbot import config
 from buildbot.db import enginestrategy
 from buildbot.db import pool, model, changes, schedulers, sourcestamps, sourcestampsets
-from buildbot.db import state, buildsets, buildrequests, builds, users, mastersconfig
+from buildbot.db import state, buildsets, buildrequests, builds, users, mastersconfig, pruning
 
 class DatabaseNotReadyError(Exception):
     pass
@@ -72,15 +72,15 @@ class DBConnector(config.ReconfigurableServiceMixin, service.MultiService):
         self.builds = builds.BuildsConnectorComponent(self)
         self.users = users.UsersConnectorComponent(self)
         self.mastersconfig = mastersconfig.MastersConfigConnectorComponent(self)
+        self.pruning = pruning.PruningConnectorComponent(self)
 
     def setUpCleanUp(self):
         cleanUpPeriod = self.master.config.cleanUpPeriod
 
         if cleanUpPeriod and cleanUpPeriod > 0:
-            pruneBuildRequests = self.pool.engine.dialect.name == 'mysql'
             self.cleanup_timer = internet.TimerService(
                     cleanUpPeriod,
-                    self._doCleanup, pruneBuildRequests)
+                    self._doCleanup)
 
             self.cleanup_timer.setServiceParent(self)
 
@@ -93,6 +93,7 @@ class DBConnector(config.ReconfigurableServiceMixin, service.MultiService):
         self._engine = enginestrategy.create_engine(db_url,
                                 basedir=self.basedir)
         self.pool = pool.DBThreadPool(self._engine, verbose=verbose)
+        self.configurePool(self.master.config)
         self.setUpCleanUp()
 
         # make sure the db is up to date, unless specifically asked not to
@@ -113,12 +114,17 @@ class DBConnector(config.ReconfigurableServiceMixin, service.MultiService):
     def reconfigService(self, new_config):
         # double-check -- the master ensures this in config checks
         assert self.configured_url == new_config.db['db_url']
+        self.configurePool(new_config)
 
         return config.ReconfigurableServiceMixin.reconfigService(self,
                                                             new_config)
 
+    def configurePool(self, new_config):
+        if self.pool is not None and 'db_slow_query_threshold' in new_config.db:
+            self.pool.slow_query_threshold = new_config.db['db_slow_query_threshold']
+
     @defer.inlineCallbacks
-    def _doCleanup(self, pruneBuildRequests):
+    def _doCleanup(self):
         """
         Perform any periodic database cleanup tasks.
 
@@ -130,5 +136,4 @@ class DBConnector(config.ReconfigurableServiceMixin, service.MultiService):
         log.msg("Running db clean up jobs")
         yield self.changes.pruneChanges(self.master.config.changeHorizon)
 
-        if pruneBuildRequests:
-            yield self.buildrequests.pruneBuildRequests(self.master.config.buildRequestsDays)
+        yield self.pruning.pruneBuildRequests(self.master.config.buildRequestsDays)
@@ -0,0 +1,44 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+from buildbot.db.sourcestamps import updateMergeKeys
+
+def upgrade(migrate_engine):
+    metadata = sa.MetaData()
+    metadata.bind = migrate_engine
+
+    buildsets = sa.Table('buildsets', metadata, autoload=True)
+    sourcestamps = sa.Table('sourcestamps', metadata, autoload=True)
+
+    merge_key = sa.Column('merge_key', sa.String(40))
+    merge_key.create(buildsets)
+
+    # compute the merge key of the existing buildsets, a few sets at a time
+    last_setid = -1
+    while True:
+        q = sa.select([buildsets.c.sourcestampsetid]) \
+            .where(buildsets.c.sourcestampsetid > last_setid) \
+            .group_by(buildsets.c.sourcestampsetid) \
+            .order_by(buildsets.c.sourcestampsetid) \
+            .limit(1000)
+        sourcestampsetids = [row.sourcestampsetid for row in migrate_engine.execute(q).fetchall()]
+        if not sourcestampsetids:
+            break
+
+        updateMergeKeys(migrate_engine, buildsets, sourcestamps, sourcestampsetids)
+        last_setid = sourcestampsetids[-1]
+
+    sa.Index('buildsets_merge_key', buildsets.c.merge_key).create()
@@ -0,0 +1,39 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+
+def upgrade(migrate_engine):
+    metadata = sa.MetaData()
+    metadata.bind = migrate_engine
+
+    buildrequests = sa.Table('buildrequests', metadata, autoload=True)
+    builds = sa.Table('builds', metadata, autoload=True)
+
+    # getBuildRequestsInQueue: the pending requests, of every builder or of
+    # one, by priority and submission time
+    sa.Index('buildrequests_queue', buildrequests.c.complete,
+             buildrequests.c.mergebrid, buildrequests.c.buildername,
+             buildrequests.c.priority, buildrequests.c.submitted_at).create()
+
+    # getLastBuildsNumbers: the requests completed by a builder; they are
+    # grouped by id, which ends every index, so complete_at must not come
+    # before it
+    sa.Index('buildrequests_builder_complete', buildrequests.c.buildername,
+             buildrequests.c.complete, buildrequests.c.mergebrid).create()
+
+    # and their finished builds, without reading the builds table
+    sa.Index('builds_brid_finish_time_number', builds.c.brid,
+             builds.c.finish_time, builds.c.number).create()
@@ -139,7 +139,11 @@ class Model(base.DBConnectorComponent):
 
         # buildset belongs to all sourcestamps with setid
         sa.Column('sourcestampsetid', sa.Integer,
-            sa.ForeignKey('sourcestampsets.id'))
+            sa.ForeignKey('sourcestampsets.id')),
+
+        # hash of the codebases, branches and revisions of the sourcestamps,
+        # see buildbot.db.sourcestamps.getMergeKey
+        sa.Column('merge_key', sa.String(40)),
     )
 
     # changes
@@ -392,6 +396,7 @@ class Model(base.DBConnectorComponent):
     sa.Index('builds_brid', builds.c.brid)
     sa.Index('buildsets_complete', buildsets.c.complete)
     sa.Index('buildsets_submitted_at', buildsets.c.submitted_at)
+    sa.Index('buildsets_merge_key', buildsets.c.merge_key)
     sa.Index('buildset_properties_buildsetid',
             buildset_properties.c.buildsetid)
     sa.Index('changes_branch', changes.c.branch)
@@ -425,6 +430,13 @@ class Model(base.DBConnectorComponent):
     sa.Index('buildrequests_triggeredbybrid', buildrequests.c.triggeredbybrid, unique=False)
     sa.Index('buildrequests_mergebrid', buildrequests.c.mergebrid, unique=False)
     sa.Index('buildrequests_startbrid', buildrequests.c.startbrid, unique=False)
+    sa.Index('buildrequests_queue', buildrequests.c.complete,
+             buildrequests.c.mergebrid, buildrequests.c.buildername,
+             buildrequests.c.priority, buildrequests.c.submitted_at)
+    sa.Index('buildrequests_builder_complete', buildrequests.c.buildername,
+             buildrequests.c.complete, buildrequests.c.mergebrid)
+    sa.Index('builds_brid_finish_time_number', builds.c.brid,
+             builds.c.finish_time, builds.c.number)
     sa.Index('builds_slavename', builds.c.slavename, unique=False)
     sa.Index('user_properties_uid', user_props.c.uid, unique=False)
     sa.Index('user_props_attrs', user_props.c.prop_type, user_props.c.prop_data)
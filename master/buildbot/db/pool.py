@@ -13,11 +13,13 @@
 #
 # Copyright Buildbot Team Members
 
+import sys
 import time
 import traceback
 import inspect
 import shutil
 import os
+import threading
 import sqlalchemy as sa
 import tempfile
 from buildbot.process import metrics
@@ -82,6 +84,12 @@ class DBThreadPool(threadpool.ThreadPool):
 
     running = False
 
+    # queries running for longer than this many seconds are logged along with
+    # their SQL; None disables the log.  Set from c['db']['db_slow_query_threshold']
+    slow_query_threshold = 10
+    # the statements logged for a slow query
+    MAX_LOGGED_STATEMENTS = 20
+
     # Some versions of SQLite incorrectly cache metadata about which tables are
     # and are not present on a per-connection basis.  This cache can be flushed
     # by querying the sqlite_master table.  We currently assume all versions of
@@ -112,6 +120,12 @@ class DBThreadPool(threadpool.ThreadPool):
                         maxthreads=pool_size,
                         name='DBThreadPool')
         self.engine = engine
+        # queries queued or running, for the saturation metrics
+        self.pending = 0
+        # the statements of the current query of each thread, for the slow
+        # query log
+        self._local = threading.local()
+        sa.event.listen(engine, 'before_cursor_execute', self._recordStatement)
         if engine.dialect.name == 'sqlite':
             vers = self.get_sqlite_version()
             if vers < (3,7):
@@ -165,7 +179,17 @@ class DBThreadPool(threadpool.ThreadPool):
     BACKOFF_START = 1.0
     BACKOFF_MULT = 1.05
     MAX_OPERATIONALERROR_TIME = 3600*24 # one day
-    def __thd(self, with_engine, callable, args, kwargs):
+    def __thd(self, with_engine, callable, args, kwargs, stats):
+        stats['started'] = time.time()
+        if self.slow_query_threshold is not None:
+            self._local.statements = stats['statements'] = []
+        try:
+            return self.__retry(with_engine, callable, args, kwargs, stats)
+        finally:
+            self._local.statements = None
+            stats['finished'] = time.time()
+
+    def __retry(self, with_engine, callable, args, kwargs, stats):
         # try to call callable(arg, *args, **kwargs) repeatedly until no
         # OperationalErrors occur, where arg is either the engine (with_engine)
         # or a connection (not with_engine)
@@ -196,6 +220,7 @@ class DBThreadPool(threadpool.ThreadPool):
                         if elapsed > self.MAX_OPERATIONALERROR_TIME:
                             raise
 
+                        stats['retries'] += 1
                         metrics.MetricCountEvent.log(
                                 "DBThreadPool.retry-on-OperationalError")
                         log.msg("automatically retrying query after "
@@ -216,12 +241,49 @@ class DBThreadPool(threadpool.ThreadPool):
         return rv
 
     def do(self, callable, *args, **kwargs):
-        return threads.deferToThreadPool(reactor, self,
-                self.__thd, False, callable, args, kwargs)
+        return self._do(False, callable, args, kwargs)
 
     def do_with_engine(self, callable, *args, **kwargs):
-        return threads.deferToThreadPool(reactor, self,
-                self.__thd, True, callable, args, kwargs)
+        return self._do(True, callable, args, kwargs)
+
+    def _do(self, with_engine, callable, args, kwargs):
+        # name the query after the connector method calling do(), past the
+        # timed_do_fn wrappers
+        caller = sys._getframe(2)
+        while caller.f_globals.get('__name__') == __name__:
+            caller = caller.f_back
+        query = "%s.%s" % (caller.f_globals.get('__name__', '').rsplit('.', 1)[-1],
+                           caller.f_code.co_name)
+        stats = dict(queued=time.time(), started=None, finished=None,
+                     retries=0, statements=None)
+        self.pending += 1
+        d = threads.deferToThreadPool(reactor, self,
+                self.__thd, with_engine, callable, args, kwargs, stats)
+        d.addBoth(self._queryFinished, query, stats, self.pending)
+        return d
+
+    def _queryFinished(self, result, query, stats, pending):
+        self.pending -= 1
+        if stats['started'] is None:
+            # the pool stopped before running it
+            return result
+        wait = stats['started'] - stats['queued']
+        elapsed = stats['finished'] - stats['started']
+        metrics.MetricDBQueryEvent.log(query, wait, elapsed,
+                                       retries=stats['retries'],
+                                       pending=pending, threads=self.max)
+        if self.slow_query_threshold is not None \
+                and elapsed >= self.slow_query_threshold:
+            log.msg("DBThreadPool: slow query %s ran for %.3fs, after waiting "
+                    "%.3fs for a thread:\n%s" %
+                    (query, elapsed, wait, "\n".join(stats['statements'] or [])))
+        return result
+
+    def _recordStatement(self, conn, cursor, statement, parameters, context,
+                         executemany):
+        statements = getattr(self._local, 'statements', None)
+        if statements is not None and len(statements) < self.MAX_LOGGED_STATEMENTS:
+            statements.append(statement)
 
     def detect_bug1810(self):
         # detect buggy SQLite implementations; call only for a known-sqlite
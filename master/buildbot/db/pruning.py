@@ -0,0 +1,234 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import itertools
+import sqlalchemy as sa
+from twisted.internet import reactor, defer, task
+from twisted.python import log
+from twisted.python.failure import Failure
+from buildbot.db import base
+
+def _batches(ids, size=100):
+    # we'll need to batch the ids into groups of 100, so that the parameter
+    # lists supported by the DBAPI aren't exhausted
+    iterator = iter(ids)
+    batch = list(itertools.islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, size))
+
+class PruningConnectorComponent(base.DBConnectorComponent):
+    # Deletes old buildsets, together with their build requests, claims,
+    # builds, properties and sourcestamps, and cleans up rows left orphaned by
+    # earlier versions of the pruning.
+    #
+    # The work is split in short, independent transactions, each one walking
+    # a keyset cursor that is saved in object_state, so that a restarted
+    # master continues where the previous run stopped.  Nothing here depends
+    # on the database enforcing (or cascading) foreign keys.
+
+    # number of rows considered in each transaction
+    batchSize = 100
+
+    # pause between two transactions, in seconds, so that the claims and the
+    # other queries of the master get a chance to use the pool
+    batchInterval = 0.5
+
+    @defer.inlineCallbacks
+    def pruneBuildRequests(self, buildRequestsDays, _reactor=reactor):
+        """
+        Called periodically by DBConnector, this method deletes the buildsets
+        submitted more than C{buildRequestsDays} days ago, and everything
+        that belongs to them.
+        """
+        if not buildRequestsDays:
+            return
+
+        prune_before = _reactor.seconds() - buildRequestsDays * 24 * 60 * 60
+
+        try:
+            objectid = yield self.db.state.getObjectId('pruning',
+                                    'buildbot.db.pruning.PruningConnectorComponent')
+
+            max_bsid = yield self.db.pool.do(self._getMaxBuildsetIdThd, prune_before)
+            if max_bsid is not None:
+                count = yield self._runBatches(objectid, 'last_buildsetid', _reactor,
+                                               self._pruneBuildsetsThd, max_bsid)
+                if count:
+                    log.msg("Pruned %d buildrequests" % count)
+
+            for name, thd in (('last_claim_brid', self._pruneOrphanedClaimsThd),
+                              ('last_property_buildsetid', self._pruneOrphanedPropertiesThd),
+                              ('last_sourcestampid', self._pruneOrphanedSourceStampsThd)):
+                count = yield self._runBatches(objectid, name, _reactor, thd)
+                if count:
+                    log.msg("Pruned %d orphaned rows (%s)" % (count, name))
+        except Exception:
+            log.err(Failure(), "Could not pruneBuildRequests")
+
+    @defer.inlineCallbacks
+    def _runBatches(self, objectid, name, _reactor, thd, *args):
+        # call thd(conn, last_id, *args) until it has nothing left to do,
+        # storing the cursor it returns after every transaction
+        last_id = yield self.db.state.getState(objectid, name, 0)
+        total = 0
+        while True:
+            res = yield self.db.pool.do(thd, last_id, *args)
+            if res is None:
+                break
+            last_id, count = res
+            total += count
+            yield self.db.state.setState(objectid, name, last_id)
+            if self.batchInterval:
+                yield task.deferLater(_reactor, self.batchInterval, lambda : None)
+        defer.returnValue(total)
+
+    def _getMaxBuildsetIdThd(self, conn, prune_before):
+        # buildset ids grow with their submission time, so everything up to
+        # this id can go; the rest of the walk only needs the primary key
+        buildsets_tbl = self.db.model.buildsets
+        q = sa.select([sa.func.max(buildsets_tbl.c.id)])\
+            .where(buildsets_tbl.c.submitted_at <= prune_before)
+        return conn.execute(q).scalar()
+
+    def _pruneBuildsetsThd(self, conn, last_bsid, max_bsid):
+        buildsets_tbl = self.db.model.buildsets
+        buildrequests_tbl = self.db.model.buildrequests
+        claims_tbl = self.db.model.buildrequest_claims
+        builds_tbl = self.db.model.builds
+        properties_tbl = self.db.model.buildset_properties
+
+        q = sa.select([buildsets_tbl.c.id, buildsets_tbl.c.sourcestampsetid])\
+            .where(buildsets_tbl.c.id > last_bsid)\
+            .where(buildsets_tbl.c.id <= max_bsid)\
+            .order_by(buildsets_tbl.c.id)\
+            .limit(self.batchSize)
+        rows = conn.execute(q).fetchall()
+        if not rows:
+            return None
+
+        bsids = [r.id for r in rows]
+        setids = set(r.sourcestampsetid for r in rows if r.sourcestampsetid is not None)
+
+        transaction = conn.begin()
+        try:
+            q = sa.select([buildrequests_tbl.c.id])\
+                .where(buildrequests_tbl.c.buildsetid.in_(bsids))
+            brids = [r.id for r in conn.execute(q)]
+
+            for batch in _batches(brids):
+                # other requests may still point at these ones
+                for col in (buildrequests_tbl.c.artifactbrid, buildrequests_tbl.c.triggeredbybrid,
+                            buildrequests_tbl.c.mergebrid, buildrequests_tbl.c.startbrid):
+                    conn.execute(buildrequests_tbl.update(col.in_(batch)), {col.name: None})
+                conn.execute(claims_tbl.delete(claims_tbl.c.brid.in_(batch)))
+                conn.execute(builds_tbl.delete(builds_tbl.c.brid.in_(batch)))
+
+            for batch in _batches(brids):
+                conn.execute(buildrequests_tbl.delete(buildrequests_tbl.c.id.in_(batch)))
+
+            conn.execute(properties_tbl.delete(properties_tbl.c.buildsetid.in_(bsids)))
+            conn.execute(buildsets_tbl.delete(buildsets_tbl.c.id.in_(bsids)))
+
+            # a sourcestamp set may be shared with buildsets that are kept
+            if setids:
+                q = sa.select([buildsets_tbl.c.sourcestampsetid])\
+                    .where(buildsets_tbl.c.sourcestampsetid.in_(setids))\
+                    .distinct()
+                setids -= set(r.sourcestampsetid for r in conn.execute(q))
+
+            if setids:
+                self._deleteSourceStampsThd(conn,
+                        self.db.model.sourcestamps.c.sourcestampsetid.in_(setids))
+                sourcestampsets_tbl = self.db.model.sourcestampsets
+                conn.execute(sourcestampsets_tbl.delete(sourcestampsets_tbl.c.id.in_(setids)))
+        except:
+            transaction.rollback()
+            raise
+
+        transaction.commit()
+        return bsids[-1], len(brids)
+
+    def _deleteSourceStampsThd(self, conn, whereclause):
+        sourcestamps_tbl = self.db.model.sourcestamps
+        changes_tbl = self.db.model.sourcestamp_changes
+        patches_tbl = self.db.model.patches
+
+        q = sa.select([sourcestamps_tbl.c.id, sourcestamps_tbl.c.patchid])\
+            .where(whereclause)
+        rows = conn.execute(q).fetchall()
+        for batch in _batches(rows):
+            ssids = [r.id for r in batch]
+            patchids = [r.patchid for r in batch if r.patchid is not None]
+            conn.execute(changes_tbl.delete(changes_tbl.c.sourcestampid.in_(ssids)))
+            conn.execute(sourcestamps_tbl.delete(sourcestamps_tbl.c.id.in_(ssids)))
+            if patchids:
+                conn.execute(patches_tbl.delete(patches_tbl.c.id.in_(patchids)))
+
+    def _findOrphansThd(self, conn, key_col, ref_col, parent_col, last_key):
+        # walk the next rows of key_col's table, returning the last key seen
+        # and the keys whose ref_col points at a row that does not exist
+        q = sa.select([key_col, parent_col],
+                      from_obj=key_col.table.outerjoin(parent_col.table,
+                                                       ref_col == parent_col))\
+            .where(key_col > last_key)\
+            .where(ref_col != None)\
+            .order_by(key_col)\
+            .limit(self.batchSize)
+        if key_col is ref_col:
+            q = q.distinct()
+        rows = conn.execute(q).fetchall()
+        if not rows:
+            return None, []
+        return rows[-1][0], [r[0] for r in rows if r[1] is None]
+
+    def _pruneOrphanedClaimsThd(self, conn, last_brid):
+        claims_tbl = self.db.model.buildrequest_claims
+        last_brid, orphans = self._findOrphansThd(conn,
+                claims_tbl.c.brid, claims_tbl.c.brid,
+                self.db.model.buildrequests.c.id, last_brid)
+        if last_brid is None:
+            return None
+        if orphans:
+            conn.execute(claims_tbl.delete(claims_tbl.c.brid.in_(orphans)))
+        return last_brid, len(orphans)
+
+    def _pruneOrphanedPropertiesThd(self, conn, last_bsid):
+        properties_tbl = self.db.model.buildset_properties
+        last_bsid, orphans = self._findOrphansThd(conn,
+                properties_tbl.c.buildsetid, properties_tbl.c.buildsetid,
+                self.db.model.buildsets.c.id, last_bsid)
+        if last_bsid is None:
+            return None
+        if orphans:
+            conn.execute(properties_tbl.delete(properties_tbl.c.buildsetid.in_(orphans)))
+        return last_bsid, len(orphans)
+
+    def _pruneOrphanedSourceStampsThd(self, conn, last_ssid):
+        sourcestamps_tbl = self.db.model.sourcestamps
+        last_ssid, orphans = self._findOrphansThd(conn,
+                sourcestamps_tbl.c.id, sourcestamps_tbl.c.sourcestampsetid,
+                self.db.model.sourcestampsets.c.id, last_ssid)
+        if last_ssid is None:
+            return None
+        if orphans:
+            transaction = conn.begin()
+            try:
+                self._deleteSourceStampsThd(conn, sourcestamps_tbl.c.id.in_(orphans))
+            except:
+                transaction.rollback()
+                raise
+            transaction.commit()
+        return last_ssid, len(orphans)
@@ -14,10 +14,13 @@
 # Copyright Buildbot Team Members
 
 import base64
+import hashlib
+import itertools
 import sqlalchemy as sa
 from twisted.internet import defer
 from twisted.python import log
 from buildbot.db import base
+from buildbot.util import json
 from buildbot.status.results import SUCCESS, FAILURE
 
 class SsDict(dict):
@@ -26,6 +29,40 @@ class SsDict(dict):
 class SsList(list):
     pass
 
+def getMergeKey(sourcestamps):
+    """
+    Returns the merge key of a sourcestamp set, two buildsets with the same
+    key have exactly the same codebases, branches and revisions.
+
+    @param sourcestamps: list of (codebase, branch, revision) tuples
+    """
+    normalized = sorted([codebase, branch, revision]
+                        for codebase, branch, revision in sourcestamps)
+    return hashlib.sha1(json.dumps(normalized)).hexdigest()
+
+def updateMergeKeys(conn, buildsets_tbl, sourcestamps_tbl, sourcestampsetids):
+    """
+    Recomputes the merge key of the buildsets using C{sourcestampsetids}.
+    """
+    # we'll need to batch the ids into groups of 100, so that the
+    # parameter lists supported by the DBAPI aren't exhausted
+    iterator = iter(sorted(set(sourcestampsetids)))
+    batch = list(itertools.islice(iterator, 100))
+    while batch:
+        q = sa.select([sourcestamps_tbl.c.sourcestampsetid, sourcestamps_tbl.c.codebase,
+                       sourcestamps_tbl.c.branch, sourcestamps_tbl.c.revision]) \
+            .where(sourcestamps_tbl.c.sourcestampsetid.in_(batch))
+        sourcestamps = dict((setid, []) for setid in batch)
+        for row in conn.execute(q).fetchall():
+            sourcestamps[row.sourcestampsetid].append((row.codebase, row.branch, row.revision))
+
+        stmt = buildsets_tbl.update() \
+            .where(buildsets_tbl.c.sourcestampsetid == sa.bindparam('b_sourcestampsetid')) \
+            .values(merge_key=sa.bindparam('b_merge_key'))
+        conn.execute(stmt, [dict(b_sourcestampsetid=setid, b_merge_key=getMergeKey(sslist))
+                            for setid, sslist in sourcestamps.iteritems()])
+        batch = list(itertools.islice(iterator, 100))
+
 class SourceStampsConnectorComponent(base.DBConnectorComponent):
     # Documentation is in developer/database.rst
 
@@ -89,6 +126,10 @@ class SourceStampsConnectorComponent(base.DBConnectorComponent):
                     .values(revision=sa.bindparam('b_revision'))
                 res = conn.execute(stmt, sourcestamps)
 
+                # the revisions are part of the buildsets merge key
+                updateMergeKeys(conn, self.db.model.buildsets, sourcestamps_tbl,
+                                          [ss['b_sourcestampsetid'] for ss in sourcestamps])
+
                 return  res.rowcount
         return self.db.pool.do(thd)
 
@@ -742,7 +742,7 @@ class IStatusLog(Interface):
         log has already finished, this deferred will fire right away. The
         callback is given this IStatusLog instance as an argument."""
 
-    def subscribe(receiver, catchup):
+    def subscribe(receiver, catchup, batched=False):
         """Register an IStatusReceiver to receive chunks (with logChunk) as
         data is added to the Log. If you use this, you will also want to use
         waitUntilFinished to find out when the listener can be retired.
@@ -758,7 +758,11 @@ class IStatusLog(Interface):
         a lot of data. There is no way to throttle this data. If the receiver
         is planning on sending the data on to somewhere else, over a narrow
         connection, you can get a throttleable subscription by using
-        C{subscribeConsumer} instead."""
+        C{subscribeConsumer} instead.
+
+        If 'batched' is True, the receiver's logChunks(build, step, log,
+        chunks) method is called instead, with a list of (channel, text)
+        tuples holding the text added to the Log over a short period."""
 
     def unsubscribe(receiver):
         """Remove a receiver previously registered with subscribe(). Attempts
@@ -1219,6 +1223,18 @@ class ITriggerableScheduler(Interface):
         """Trigger a build with the given source stamp and properties.
         """
 
+class IBulkTriggerableScheduler(ITriggerableScheduler):
+    """
+    A triggerable scheduler that can add several buildsets at once.
+    """
+
+    def triggerMany(sourcestamps, set_props_list, triggeredbybrid=None,
+                    reason=None):
+        """Trigger a build for each of the properties of set_props_list,
+        with the given source stamps, adding all the buildsets at once.
+        Returns a list of Deferreds, one for each buildset, like trigger.
+        """
+
 class IBuildStepFactory(Interface):
     def buildStep():
         """
@@ -37,6 +37,7 @@ from buildbot.db import connector
 from buildbot.schedulers.manager import SchedulerManager
 from buildbot.process.botmaster import BotMaster
 from buildbot.process import debug
+from buildbot.process import notifications
 from buildbot.process import metrics
 from buildbot.process import cache
 from buildbot.process.users import users
@@ -68,6 +69,10 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
     # database poll operation.
     WARNING_UNCLAIMED_COUNT = 10000
 
+    # frequency with which to poll all the unclaimed build requests, rather
+    # than only the new ones, to notice requests that were unclaimed again
+    UNCLAIMED_RECONCILE_INTERVAL = 5*60
+
     def __init__(self, basedir, configFileName="master.cfg", umask=None):
         service.MultiService.__init__(self)
         self.setName("buildmaster")
@@ -114,6 +119,13 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         self._complete_buildset_subs = \
                 subscription.SubscriptionPoint("buildset_completion")
 
+        # ids of the changes delivered as soon as they were added, that the
+        # database polling must skip
+        self._notified_changeids = set()
+
+        # ids of the buildsets whose completion the database polling checks
+        self._watched_buildsets = set()
+
         # local cache for this master's object ID
         self._object_id = None
 
@@ -149,6 +161,9 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         self.debug = debug.DebugServices(self)
         self.debug.setServiceParent(self)
 
+        self.bus = notifications.NotificationBus(self)
+        self.bus.setServiceParent(self)
+
         self.status = Status(self)
         self.status.setServiceParent(self)
 
@@ -560,13 +575,39 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         def notify(change):
             msg = u"added change %s to database" % change
             log.msg(msg.encode('utf-8', 'replace'))
-            # only deliver messages immediately if we're not polling
-            if not self.config.db['db_poll_interval']:
-                self._change_subs.deliver(change)
+            # only deliver messages immediately if we're not polling, or if
+            # the other masters are notified too
+            if not self.config.db['db_poll_interval'] or self.bus.active:
+                self._deliverChange(change)
+                self.bus.publish('change', changeid=change.number)
             return change
         d.addCallback(notify)
         return d
 
+    def _deliverChange(self, change):
+        if self.config.db['db_poll_interval']:
+            self._notified_changeids.add(change.number)
+        self._change_subs.deliver(change)
+
+    @defer.inlineCallbacks
+    def changeNotified(self, changeid):
+        """
+        Deliver the change C{changeid}, added by another master, unless it was
+        already delivered.
+        """
+        if changeid in self._notified_changeids:
+            return
+        if self._last_processed_change is not None and \
+                changeid <= self._last_processed_change:
+            return
+        if self.config.db['db_poll_interval']:
+            self._notified_changeids.add(changeid)
+
+        chdict = yield self.db.changes.getChange(changeid)
+        if chdict:
+            change = yield changes.Change.fromChdict(self, chdict)
+            self._change_subs.deliver(change)
+
     def subscribeToChanges(self, callback):
         """
         Request that C{callback} be called with each Change object added to the
@@ -586,18 +627,43 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         """
         d = self.buildrequest_merger.addBuildset(**kwargs)
         def notify((bsid,brids)):
-            log.msg("added buildset %d to database" % bsid)
-            # note that buildset additions are only reported on this master
-            self._new_buildset_subs.deliver(bsid=bsid, **kwargs)
-            # only deliver messages immediately if we're not polling
-            if not self.config.db['db_poll_interval']:
-                for bn, brid in brids.iteritems():
-                    self.buildRequestAdded(bsid=bsid, brid=brid,
-                                           buildername=bn)
+            self._buildsetAdded(bsid, brids, kwargs)
             return (bsid,brids)
         d.addCallback(notify)
         return d
 
+    def addBuildsets(self, sourcestampsetid, buildsets, triggeredbybrid=None):
+        """
+        Add several buildsets of the same sourcestamp set to the buildmaster
+        in a single transaction, and act on them.  Interface is identical to
+        L{buildbot.db.buildsets.BuildsetConnectorComponent.addBuildsets},
+        including returning a Deferred.
+        """
+        d = self.buildrequest_merger.addBuildsets(
+                sourcestampsetid=sourcestampsetid, buildsets=buildsets,
+                triggeredbybrid=triggeredbybrid)
+        def notify(results):
+            for (bsid, brids), bs in zip(results, buildsets):
+                kwargs = dict(sourcestampsetid=sourcestampsetid,
+                              triggeredbybrid=triggeredbybrid,
+                              external_idstring=None)
+                kwargs.update(bs)
+                self._buildsetAdded(bsid, brids, kwargs)
+            return results
+        d.addCallback(notify)
+        return d
+
+    def _buildsetAdded(self, bsid, brids, kwargs):
+        log.msg("added buildset %d to database" % bsid)
+        # note that buildset additions are only reported on this master
+        self._new_buildset_subs.deliver(bsid=bsid, **kwargs)
+        # only deliver messages immediately if we're not polling, or if
+        # the other masters are notified too
+        if not self.config.db['db_poll_interval'] or self.bus.active:
+            for bn, brid in brids.iteritems():
+                self.buildRequestAdded(bsid=bsid, brid=brid,
+                                       buildername=bn)
+
     def subscribeToBuildsets(self, callback):
         """
         Request that C{callback(bsid=bsid, ssid=ssid, reason=reason,
@@ -612,7 +678,6 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         """
         return self._new_buildset_subs.subscribe(callback)
 
-    @defer.inlineCallbacks
     def maybeBuildsetComplete(self, bsid):
         """
         Instructs the master to check whether the buildset is complete,
@@ -621,30 +686,39 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         Note that buildset completions are only reported on the master
         on which the last build request completes.
         """
-        brdicts = yield self.db.buildrequests.getBuildRequests(
-            bsid=bsid, complete=False)
+        return self.maybeBuildsetsComplete([bsid])
 
-        # if there are incomplete buildrequests, bail out
-        if brdicts:
-            return
+    @defer.inlineCallbacks
+    def maybeBuildsetsComplete(self, bsids):
+        """
+        Like L{maybeBuildsetComplete}, for several buildsets at once, with a
+        single database query for all of them.
+        """
+        completion = yield self.db.buildsets.getBuildsetsCompletion(bsids)
 
-        brdicts = yield self.db.buildrequests.getBuildRequests(bsid=bsid)
+        for bsid in bsids:
+            # if the buildset is gone or has incomplete buildrequests, skip it
+            bs = completion.get(bsid)
+            if not bs or not bs['requests_complete']:
+                continue
 
-        # figure out the overall results of the buildset
-        cumulative_results = SUCCESS
-        for brdict in brdicts:
-            if brdict['results'] not in (SUCCESS, WARNINGS, NOT_REBUILT):
-                cumulative_results = FAILURE
+            # figure out the overall results of the buildset
+            cumulative_results = SUCCESS
+            for results in bs['results']:
+                if results not in (SUCCESS, WARNINGS, NOT_REBUILT):
+                    cumulative_results = FAILURE
 
-        # mark it as completed in the database
-        bs = yield self.db.buildsets.getBuildset(bsid)
-        if not bs['complete']:
-            yield self.db.buildsets.completeBuildset(bsid, cumulative_results)        
+            # mark it as completed in the database
+            if not bs['complete']:
+                yield self.db.buildsets.completeBuildset(bsid,
+                                                         cumulative_results)
+                self.bus.publish('buildsetComplete', bsid=bsid)
 
-        # and deliver to any listeners
-        self._buildsetComplete(bsid, cumulative_results)
+            # and deliver to any listeners
+            self._buildsetComplete(bsid, cumulative_results)
 
     def _buildsetComplete(self, bsid, results):
+        self._watched_buildsets.discard(bsid)
         self._complete_buildset_subs.deliver(bsid, results)
 
     def subscribeToBuildsetCompletions(self, callback):
@@ -656,6 +730,18 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         """
         return self._complete_buildset_subs.subscribe(callback)
 
+    def watchBuildsetCompletion(self, bsid):
+        """
+        Request that the database polling check whether the buildset is
+        complete, as it may complete on another master, until its completion
+        is delivered or L{unwatchBuildsetCompletion} is called.  The watched
+        buildsets are all checked with a single query.
+        """
+        self._watched_buildsets.add(bsid)
+
+    def unwatchBuildsetCompletion(self, bsid):
+        self._watched_buildsets.discard(bsid)
+
     def buildRequestAdded(self, bsid, brid, buildername):
         """
         Notifies the master that a build request is available to be claimed;
@@ -666,6 +752,14 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         @param brid: buildrequest ID
         @param buildername: builder named by the build request
         """
+        self.deliverBuildRequestAdded(bsid, brid, buildername)
+        self.bus.publish('buildrequestAdded', bsid=bsid, brid=brid,
+                         buildername=buildername)
+
+    def deliverBuildRequestAdded(self, bsid, brid, buildername):
+        """
+        Like L{buildRequestAdded}, but without notifying the other masters.
+        """
         self._new_buildrequest_subs.deliver(
                 dict(bsid=bsid, brid=brid, buildername=buildername))
 
@@ -679,6 +773,14 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         @param brid: buildrequest ID
         @param buildername: builder named by the build request
         """
+        self.deliverBuildRequestRemoved(bsid, brid, buildername)
+        self.bus.publish('buildrequestRemoved', bsid=bsid, brid=brid,
+                         buildername=buildername)
+
+    def deliverBuildRequestRemoved(self, bsid, brid, buildername):
+        """
+        Like L{buildRequestRemoved}, but without notifying the other masters.
+        """
         self._cancelled_buildrequest_subs.deliver(
                 dict(bsid=bsid, brid=brid, buildername=buildername))
 
@@ -717,6 +819,8 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
                 "while polling changes"),
             self.pollDatabaseBuildRequests().addErrback(log.err,
                 "while polling build requests"),
+            self.pollDatabaseBuildsets().addErrback(log.err,
+                "while polling buildsets"),
             # also unclaim
         ])
         return d
@@ -761,10 +865,15 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         chdicts = yield self.db.changes.getChangesGreaterThan(self._last_processed_change)
         if chdicts:
             for chdict in chdicts:
+                # skip the changes delivered when they were notified
+                if chdict['changeid'] in self._notified_changeids:
+                    continue
                 change = yield changes.Change.fromChdict(self, chdict)
                 self._change_subs.deliver(change)
 
             self._last_processed_change = chdicts[-1]['changeid']
+            self._notified_changeids = set(changeid for changeid in self._notified_changeids
+                                           if changeid > self._last_processed_change)
             need_setState = True
 
         # write back the updated state, if it's changed
@@ -774,6 +883,8 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         timer.stop()
 
     _last_unclaimed_brids_set = None
+    _last_unclaimed_brid = None
+    _last_unclaimed_reconcile = 0
     _last_claim_cleanup = 0
     @defer.inlineCallbacks
     def pollDatabaseBuildRequests(self):
@@ -790,12 +901,20 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
             yield self.db.buildrequests.unclaimExpiredRequests(unclaimed_age)
 
             self._last_claim_cleanup = reactor.seconds()
+            # the expired requests are only found by a full poll
+            self._last_unclaimed_reconcile = 0
 
         # _last_unclaimed_brids_set tracks the state of unclaimed build
         # requests; whenever it sees a build request which was not claimed on
         # the last poll, it notifies the subscribers.  It only tracks that
         # state within the master instance, though; on startup, it notifies for
         # all unclaimed requests in the database.
+        #
+        # Fetching all the unclaimed requests on every poll is expensive with
+        # a long queue, so in between the full polls of every
+        # UNCLAIMED_RECONCILE_INTERVAL, only the requests with an id greater
+        # than _last_unclaimed_brid are fetched.  Requests unclaimed again, or
+        # committed out of order by another master, wait for the full poll.
 
         last_unclaimed = self._last_unclaimed_brids_set or set()
         if len(last_unclaimed) > self.WARNING_UNCLAIMED_COUNT:
@@ -803,22 +922,57 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
                     "producing builds for which no builder is running?"
                     % len(last_unclaimed))
 
-        # get the current set of unclaimed buildrequests
-        now_unclaimed_brdicts = \
-            yield self.db.buildrequests.getBuildRequests(claimed=False)
-        now_unclaimed = set([ brd['brid'] for brd in now_unclaimed_brdicts ])
-
-        # and store that for next time
-        self._last_unclaimed_brids_set = now_unclaimed
-
-        # see what's new, and notify if anything is
-        new_unclaimed = now_unclaimed - last_unclaimed
-        if new_unclaimed:
-            brdicts = dict((brd['brid'], brd) for brd in now_unclaimed_brdicts)
-            for brid in new_unclaimed:
-                brd = brdicts[brid]
-                self.buildRequestAdded(brd['buildsetid'], brd['brid'],
-                                       brd['buildername'])
+        since_last_reconcile = reactor.seconds() - self._last_unclaimed_reconcile
+        if self._last_unclaimed_brid is None or \
+                since_last_reconcile >= self.UNCLAIMED_RECONCILE_INTERVAL:
+            now_unclaimed_brdicts = \
+                yield self.db.buildrequests.getUnclaimedBuildRequests()
+            now_unclaimed = set([ brd['brid'] for brd in now_unclaimed_brdicts ])
+            new_unclaimed_brdicts = [ brd for brd in now_unclaimed_brdicts
+                                      if brd['brid'] not in last_unclaimed ]
+
+            # and store that for next time
+            self._last_unclaimed_brids_set = now_unclaimed
+            self._last_unclaimed_reconcile = reactor.seconds()
+            metrics.MetricCountEvent.log(
+                    "BuildMaster.pollDatabaseBuildRequests() reconciliations")
+        else:
+            now_unclaimed_brdicts = \
+                yield self.db.buildrequests.getUnclaimedBuildRequests(
+                        greater_than=self._last_unclaimed_brid)
+            new_unclaimed_brdicts = now_unclaimed_brdicts
+            last_unclaimed.update(brd['brid'] for brd in now_unclaimed_brdicts)
+            self._last_unclaimed_brids_set = last_unclaimed
+
+        metrics.MetricCountEvent.log(
+                "BuildMaster.pollDatabaseBuildRequests() rows",
+                len(now_unclaimed_brdicts))
+
+        # the requests are ordered by id
+        if now_unclaimed_brdicts:
+            self._last_unclaimed_brid = max(self._last_unclaimed_brid,
+                                            now_unclaimed_brdicts[-1]['brid'])
+        elif self._last_unclaimed_brid is None:
+            self._last_unclaimed_brid = 0
+
+        # notify about what's new; every master polls, so there is no need
+        # to tell the others
+        for brd in new_unclaimed_brdicts:
+            self.deliverBuildRequestAdded(brd['buildsetid'], brd['brid'],
+                                          brd['buildername'])
+        timer.stop()
+
+    @defer.inlineCallbacks
+    def pollDatabaseBuildsets(self):
+        # the buildsets watched by the Triggerable schedulers may complete on
+        # another master; check all of them in one query, rather than one
+        # query per buildset and scheduler
+        if not self._watched_buildsets:
+            return
+
+        timer = metrics.Timer("BuildMaster.pollDatabaseBuildsets()")
+        timer.start()
+        yield self.maybeBuildsetsComplete(sorted(self._watched_buildsets))
         timer.stop()
 
     ## state maintenance (private)
@@ -609,10 +609,11 @@ class Builder(config.ReconfigurableServiceMixin,
         defer.returnValue(d)
 
     @defer.inlineCallbacks
-    def finishBuildRequestsFailed(self, failure, msg, brids):
+    def finishBuildRequestsFailed(self, failure, msg, brids, requests=None):
         log.err(failure, msg)
         log.msg("Katana will retry buildrequests with ids %s" % brids)
         yield self.master.db.buildrequests.unclaimBuildRequests(brids, results=BEGINNING)
+        self._notifyBuildRequestsAdded(requests or [])
 
     def finishBuildRequests(self, brids, requests, build, bids=None, mergedbrids=None):
 
@@ -642,7 +643,8 @@ class Builder(config.ReconfigurableServiceMixin,
             d.addCallback(lambda _: self._maybeBuildsetsComplete(requests, results=results))
             # nothing in particular to do with this deferred, so just log it if
             # it fails..
-            d.addErrback(self.finishBuildRequestsFailed, 'while marking build requests as completed', brids)
+            d.addErrback(self.finishBuildRequestsFailed, 'while marking build requests as completed', brids,
+                         requests=requests)
         return d
 
 
@@ -659,8 +661,14 @@ class Builder(config.ReconfigurableServiceMixin,
     def _resubmit_buildreqs(self, out=None, requests=None):
         brids = [br.id for br in requests]
         yield self.master.db.buildrequests.unclaimBuildRequests(brids, results=BEGINNING)
+        self._notifyBuildRequestsAdded(requests)
         defer.returnValue(out)
 
+    def _notifyBuildRequestsAdded(self, requests):
+        # the requests are back in the queue
+        for br in requests:
+            self.master.buildRequestAdded(br.bsid, br.id, self.name)
+
     def setExpectations(self, progress):
         """Mark the build as successful and update expectations for the next
         build. Only call this when the build did not fail in any way that
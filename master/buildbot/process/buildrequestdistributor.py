@@ -17,11 +17,12 @@ import json
 
 from twisted.python import log
 from twisted.python.failure import Failure
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.application import service
 
 from buildbot.process import metrics
 from buildbot.process.buildrequest import BuildRequest
+from buildbot.process.buildrequestqueue import BuildRequestQueue
 from buildbot.status.results import RESUME, BEGINNING
 from buildbot.db.buildrequests import AlreadyClaimedError, UnsupportedQueueError, Queue
 from buildbot.process.builder import Slavepool
@@ -373,17 +374,83 @@ class BasicBuildChooser(BuildChooserBase):
 
 class KatanaBuildChooser(BasicBuildChooser):
 
+    # the queue index is reloaded from the db when it is older than this, as a
+    # safety net for changes that were not notified to this master
+    BUILD_REQUEST_QUEUE_MAX_AGE = 10*60
+
     def __init__(self, builders, master):
         # By default katana  merges Requests
         self.bldr = None
         self.master = master
         self.initializeBreqCache()
         self.builders = builders
+        self.buildRequestQueues = {Queue.unclaimed: BuildRequestQueue(),
+                                   Queue.resume: BuildRequestQueue()}
         self.initializeBuildRequestQueue()
+        self.startBatch()
 
     def initializeBuildRequestQueue(self):
-        self.unclaimedBrdicts = None
-        self.resumeBrdicts = None
+        """
+        Drops the queue index, it will be reloaded from the db the next time a queue is read.
+        """
+        for buildRequestQueue in self.buildRequestQueues.itervalues():
+            buildRequestQueue.clear()
+        self.addedBrids = {Queue.unclaimed: set(), Queue.resume: set()}
+        self.buildRequestQueuesLoadedAt = None
+
+    def refreshBuildRequestQueue(self, _reactor=reactor):
+        """
+        Starts a new pass over the queues: requests that were put aside after
+        failing to start are retried, and the index is reloaded if it is too old.
+        """
+        loadedAt = self.buildRequestQueuesLoadedAt
+        if loadedAt is not None and _reactor.seconds() - loadedAt > self.BUILD_REQUEST_QUEUE_MAX_AGE:
+            self.initializeBuildRequestQueue()
+            return
+
+        for buildRequestQueue in self.buildRequestQueues.itervalues():
+            buildRequestQueue.unpark()
+
+    def buildRequestAdded(self, brid):
+        """
+        A build request was added to (or returned to) one of the queues,
+        it will be fetched the next time the queues are read.
+        """
+        for addedBrids in self.addedBrids.itervalues():
+            addedBrids.add(brid)
+
+    def buildRequestRemoved(self, brid):
+        for queue, buildRequestQueue in self.buildRequestQueues.iteritems():
+            buildRequestQueue.remove(brid)
+            self.addedBrids[queue].discard(brid)
+
+    def startBatch(self):
+        """
+        Starts selecting a batch of builds that will be claimed and started
+        together, the slaves and requests selected are reserved until L{finishBatch}
+        so they are not selected twice.
+        """
+        self.reservedSlaves = set()
+        self.batchedBrids = set()
+
+    def reserveBuild(self, slavebuilder, breqs):
+        # slaves are reserved as a whole, a slave that can run several builds at
+        # once will get the next one in the following batch
+        self.reservedSlaves.add(slavebuilder.slave)
+        self.batchedBrids.update(br.id for br in breqs)
+        self.removeBuildRequests(breqs)
+
+    def finishBatch(self):
+        self.startBatch()
+
+    def getAvailableSlaves(self, bldr, slavepool):
+        return [sb for sb in bldr.getAvailableSlavesToProcessBuildRequests(slavepool=slavepool)
+                if sb.slave not in self.reservedSlaves]
+
+    def selectedSlaveIsAvailable(self, bldr, slavename):
+        slavebuilder = bldr.getSlaveBuilder(slavename=slavename)
+        return slavebuilder is not None and slavebuilder.isAvailable() \
+            and slavebuilder.slave not in self.reservedSlaves
 
     def setupNextBuildRequest(self, bldr, breq):
         self.bldr = bldr
@@ -419,15 +486,21 @@ class KatanaBuildChooser(BasicBuildChooser):
         else:
             yield self.master.db.buildrequests.claimBuildRequests(brids)
 
+    @defer.inlineCallbacks
+    def claimBuildRequestGroups(self, breqsGroups):
+        groups = [[br.id for br in breqs] for breqs in breqsGroups]
+        yield self.master.db.buildrequests.claimBuildRequestGroups(groups)
+        for brids in groups:
+            if len(brids) > 1:
+                log.msg("merge pending buildrequest %s with %s " % (brids[0], brids[1:]))
+
     def removeBuildRequest(self, breq):
         # reset the checkMerges in case the breq still in the master cache
         breq.checkMerges = True
         breq.retries = 0
         breq.hasBeenMerged = False
-        if self.unclaimedBrdicts and breq.brdict and breq.brdict in self.unclaimedBrdicts:
-            self.unclaimedBrdicts.remove(breq.brdict)
-        if self.resumeBrdicts and breq.brdict and breq.brdict in self.resumeBrdicts:
-            self.resumeBrdicts.remove(breq.brdict)
+        for buildRequestQueue in self.buildRequestQueues.itervalues():
+            buildRequestQueue.remove(breq.id)
         self.breqCache.remove(breq.id)
 
     def removeBuildRequests(self, breqs):
@@ -443,7 +516,10 @@ class KatanaBuildChooser(BasicBuildChooser):
         if self.nextBreq.retries > 4:
             msg = "Katana failed to process buildrequest.id %s after %d retries, " \
                   "Katana will retry after the queue is proccessed " % (self.nextBreq.id, self.nextBreq.retries)
+            queues = [q for q in self.buildRequestQueues.itervalues() if self.nextBreq.id in q]
             self.removeBuildRequest(self.nextBreq)
+            for buildRequestQueue in queues:
+                buildRequestQueue.park(self.nextBreq.brdict)
         log.msg(msg)
 
     @defer.inlineCallbacks
@@ -458,19 +534,32 @@ class KatanaBuildChooser(BasicBuildChooser):
         defer.returnValue(breq)
 
     @defer.inlineCallbacks
-    def _getBuildRequestsQueue(self, queue):
-        if queue == Queue.unclaimed:
-            if self.unclaimedBrdicts is None:
-                self.unclaimedBrdicts = yield self.master.db.buildrequests\
-                    .getBuildRequestsInQueue(queue=queue)
-            defer.returnValue(self.unclaimedBrdicts)
-            return
+    def _getBuildRequestsQueue(self, queue, _reactor=reactor):
+        """
+        Returns the index of the requests in C{queue}, the db is only queried
+        when the index was dropped or to fetch requests notified since the last read.
+        """
+        if queue not in self.buildRequestQueues:
+            raise UnsupportedQueueError
+
+        buildRequestQueue = self.buildRequestQueues[queue]
 
-        if queue == Queue.resume:
-            if self.resumeBrdicts is None:
-                self.resumeBrdicts = yield self.master.db.buildrequests\
-                    .getBuildRequestsInQueue(queue=queue)
-            defer.returnValue(self.resumeBrdicts)
+        if not buildRequestQueue.loaded:
+            self.addedBrids[queue].clear()
+            brdicts = yield self.master.db.buildrequests.getBuildRequestsInQueue(queue=queue)
+            buildRequestQueue.load(brdicts)
+            if self.buildRequestQueuesLoadedAt is None:
+                self.buildRequestQueuesLoadedAt = _reactor.seconds()
+
+        elif self.addedBrids[queue]:
+            brids, self.addedBrids[queue] = self.addedBrids[queue], set()
+            brdicts = yield self.master.db.buildrequests.getBuildRequestsInQueue(queue=queue,
+                                                                                 brids=sorted(brids),
+                                                                                 order=False)
+            for brdict in brdicts:
+                buildRequestQueue.add(brdict)
+
+        defer.returnValue(buildRequestQueue)
 
     # Katana's gets the next priority builder from the DB instead of keeping a local list
     @defer.inlineCallbacks
@@ -486,28 +575,31 @@ class KatanaBuildChooser(BasicBuildChooser):
         it will select only builds pending to be resume
         @returns: a build request dictionary or None via Deferred
         """
-        unavailableBuilderNames = []
+        unavailableBuilderNames = set()
         builderSlavepool = {}
 
-        # TODO: For performance reasons we may need to limit the searches but  we need to load test it first
         buildrequestQueue = yield self._getBuildRequestsQueue(queue)
 
         log.msg("getNextPriorityBuilder found %d buildrequests in the '%s' Queue" % (len(buildrequestQueue), queue))
 
-        for br in buildrequestQueue:
+        # requests are walked in priority order, skipping the builders that can't start builds
+        for br in buildrequestQueue.iterByPriority(skipBuilderNames=unavailableBuilderNames):
             buildername = br['buildername']
 
+            # already selected in the current batch
+            if br['brid'] in self.batchedBrids:
+                continue
+
             bldr = self.builders.get(buildername)
 
             if not bldr:
                 log.msg("BuildRequest %d uses unknown builder %s" % (br['brid'], buildername))
+                unavailableBuilderNames.add(buildername)
                 continue
 
             if not bldr.config:
                 log.msg("BuildRequest %d uses builder %s with no configuration" % (br['brid'], buildername))
-                continue
-
-            if buildername in unavailableBuilderNames and not bldr.building and br['startbrid'] is None:
+                unavailableBuilderNames.add(buildername)
                 continue
 
             breq = yield self._getBuildRequestForBrdict(br)
@@ -527,10 +619,10 @@ class KatanaBuildChooser(BasicBuildChooser):
             slavepool = getSlavepool()
 
             if buildername not in builderSlavepool:
-                builderSlavepool[buildername] = bldr.getAvailableSlavesToProcessBuildRequests(slavepool=slavepool)
+                builderSlavepool[buildername] = self.getAvailableSlaves(bldr, slavepool)
 
             if not builderSlavepool[buildername]:
-                unavailableBuilderNames.append(buildername)
+                unavailableBuilderNames.add(buildername)
                 log.msg("No idle slaves found in '%s' list to process buildrequest.id %d for builder %s"
                         % (slavepool, br['brid'], buildername))
 
@@ -546,7 +638,7 @@ class KatanaBuildChooser(BasicBuildChooser):
                                                          and br['slavepool'] != Slavepool.startSlavenames
 
             if buildRequestShouldUseSelectedSlave or resumingBuildRequestShouldUseSelectedSlave:
-                if bldr.slaveIsAvailable(slavename=br["selected_slave"]):
+                if self.selectedSlaveIsAvailable(bldr, br["selected_slave"]):
                     defer.returnValue(breq)
                     return
 
@@ -647,8 +739,9 @@ class KatanaBuildChooser(BasicBuildChooser):
 
         for brdict in brdicts:
             req = yield self._getBuildRequestForBrdict(brdict)
-            canMerge = self.mergeRequestsFn(self.bldr, breq, req)
-            if canMerge and req.id != breq.id:
+            if req.id == breq.id or req.id in self.batchedBrids:
+                continue
+            if self.mergeRequestsFn(self.bldr, breq, req):
                 mergedRequests.append(req)
 
         mergeRequestsLog['elapsedmergeRequestsFn'] = time.time() - mergeRequestsFnStart
@@ -1142,9 +1235,28 @@ class KatanaBuildRequestDistributor(service.Service):
         self.check_new_builds = True
         self.check_resume_builds = True
         self.katanaBuildChooser = self.createBuildChooser(builders=self.botmaster.builders, master=self.master)
+        self.buildrequest_sub = None
+        self.cancelled_buildrequest_sub = None
+
+    def startService(self):
+        # keep the chooser's queue index up to date
+        def buildRequestAdded(notif):
+            self.katanaBuildChooser.buildRequestAdded(notif['brid'])
+
+        def buildRequestRemoved(notif):
+            self.katanaBuildChooser.buildRequestRemoved(notif['brid'])
+
+        self.buildrequest_sub = self.master.subscribeToBuildRequests(buildRequestAdded)
+        self.cancelled_buildrequest_sub = self.master.subscribeToCancelledBuildRequests(buildRequestRemoved)
+        service.Service.startService(self)
 
     @defer.inlineCallbacks
     def stopService(self):
+        for sub in (self.buildrequest_sub, self.cancelled_buildrequest_sub):
+            if sub:
+                sub.unsubscribe()
+        self.buildrequest_sub = self.cancelled_buildrequest_sub = None
+
         # Lots of stuff happens asynchronously here, so we need to let it all
         # quiesce.  First, let the parent stopService succeed between
         # activities; then the loop will stop calling itself, since
@@ -1191,7 +1303,7 @@ class KatanaBuildRequestDistributor(service.Service):
     def _checkBuildRequests(self):
         self.check_new_builds = True
         self.check_resume_builds = True
-        self.katanaBuildChooser.initializeBuildRequestQueue()
+        self.katanaBuildChooser.refreshBuildRequestQueue()
 
     @defer.inlineCallbacks
     def _selectNextBuildRequest(self, queue, asyncFunc):
@@ -1244,9 +1356,13 @@ class KatanaBuildRequestDistributor(service.Service):
 
             # continue checking new builds if we have pending builders
             if self.check_new_builds:
-                nextBuilder = yield self._selectNextBuildRequest(queue=Queue.unclaimed,
-                                                                 asyncFunc=self._maybeStartBuildsOnBuilder)
-                self.check_new_builds = nextBuilder is not None
+                batchSize = self.master.config.buildRequestDistributorBatchSize
+                if batchSize > 1:
+                    self.check_new_builds = yield self._maybeStartBuildsBatch(batchSize)
+                else:
+                    nextBuilder = yield self._selectNextBuildRequest(queue=Queue.unclaimed,
+                                                                     asyncFunc=self._maybeStartBuildsOnBuilder)
+                    self.check_new_builds = nextBuilder is not None
 
             # continue checking resume builds if we have pending builders to resume
             if  self.check_resume_builds:
@@ -1292,6 +1408,8 @@ class KatanaBuildRequestDistributor(service.Service):
         brids = [br.id for br in breqs]
         log.msg("Could not resume builds {}. Exception message: {}. Requeueing.".format(brids, e.value))
         yield self.master.db.buildrequests.updateBuildRequests(brids, results=RESUME)
+        for brid in brids:
+            self.katanaBuildChooser.buildRequestAdded(brid)
         self.botmaster.maybeStartBuildsForBuilder(builderName)
 
     @defer.inlineCallbacks
@@ -1314,11 +1432,95 @@ class KatanaBuildRequestDistributor(service.Service):
         self.logResumeOrStartBuildStatus(msg, slave, breqs)
         defer.returnValue(True)
 
+    @defer.inlineCallbacks
+    def _maybeStartBuildsBatch(self, batchSize):
+        """
+        Selects up to C{batchSize} (slave, buildrequests) pairs from the unclaimed
+        queue, claims all of them in a single transaction and then starts the builds.
+
+        @returns: True via Deferred if there may be more build requests to start
+        """
+        timer = timerLogStart(msg="_maybeStartBuildsBatch starting batchSize %d" % batchSize,
+                              function_name="KatanaBuildRequestDistributor._maybeStartBuildsBatch()")
+        chooser = self.katanaBuildChooser
+        batch = []
+        pending = True
+
+        chooser.startBatch()
+        try:
+            while len(batch) < batchSize:
+                breq = yield chooser.getNextPriorityBuilder(queue=Queue.unclaimed)
+                if breq is None:
+                    pending = False
+                    break
+
+                try:
+                    slave, breqs = yield chooser.chooseNextBuild()
+                except Exception:
+                    chooser.initializeBuildRequestQueue()
+                    log.err(Failure(), "from _maybeStartBuildsBatch for builder '%s'" % breq.buildername)
+                    break
+
+                if not slave or not breqs:
+                    chooser.retryBuildRequest()
+                    continue
+
+                batch.append((chooser.bldr, slave, breqs))
+                chooser.reserveBuild(slave, breqs)
+
+            claimed = yield self._claimBuildRequestsBatch(batch)
+
+            # the slaves are marked as busy by maybeStartBuild, before it yields
+            for bldr, slave, breqs in claimed:
+                buildDefered = bldr.maybeStartBuild(slave, breqs)
+                buildDefered.addErrback(self._requeue, breqs, bldr.name)
+                self.logResumeOrStartBuildStatus("_maybeStartBuildsBatch is starting build", slave, breqs)
+        finally:
+            chooser.finishBatch()
+
+        timerLogFinished(msg="_maybeStartBuildsBatch finished selected %d started %d"
+                             % (len(batch), len(claimed)), timer=timer)
+        defer.returnValue(pending)
+
+    @defer.inlineCallbacks
+    def _claimBuildRequestsBatch(self, batch):
+        if not batch:
+            defer.returnValue([])
+            return
+
+        try:
+            yield self.katanaBuildChooser.claimBuildRequestGroups([breqs for _, _, breqs in batch])
+        except AlreadyClaimedError:
+            # another master claimed some of them, claim the rest one build at a time
+            log.msg("_maybeStartBuildsBatch some buildrequests were already claimed, claiming them one by one")
+            self.katanaBuildChooser.initializeBuildRequestQueue()
+        except Exception:
+            self.katanaBuildChooser.initializeBuildRequestQueue()
+            log.err(Failure(), "while claiming a batch of %d builds" % len(batch))
+            defer.returnValue([])
+            return
+        else:
+            defer.returnValue(batch)
+            return
+
+        claimed = []
+        for bldr, slave, breqs in batch:
+            try:
+                yield self.katanaBuildChooser.claimBuildRequests(breqs)
+                claimed.append((bldr, slave, breqs))
+            except Exception:
+                log.err(Failure(), "while claiming buildrequests %s for builder '%s'"
+                        % ([br.id for br in breqs], bldr.name))
+
+        defer.returnValue(claimed)
+
     @defer.inlineCallbacks
     def _requeue(self, e, breqs, builderName):
         brids = [br.id for br in breqs]
         log.msg("Could not start builds {}. Exception message: {}. Requeueing.".format(brids, e.value))
         yield self.master.db.buildrequests.unclaimBuildRequests(brids)
+        for brid in brids:
+            self.katanaBuildChooser.buildRequestAdded(brid)
         self.botmaster.maybeStartBuildsForBuilder(builderName)
 
     def createBuildChooser(self, builders, master):
@@ -38,7 +38,6 @@ class BuildRequestMerger(config.ReconfigurableServiceMixin, service.Service):
             for brid in build_request_ids
         ]
 
-    @defer.inlineCallbacks
     def addBuildset(self,
                     sourcestampsetid,
                     reason,
@@ -57,124 +56,164 @@ class BuildRequestMerger(config.ReconfigurableServiceMixin, service.Service):
         ..seealso:: buildsets.addBuildset
             For parameter details
         """
-        builderNames = sorted(builderNames)
+        d = self.addBuildsets(sourcestampsetid,
+                              [dict(reason=reason,
+                                    properties=properties,
+                                    builderNames=builderNames,
+                                    external_idstring=external_idstring)],
+                              triggeredbybrid=triggeredbybrid,
+                              _reactor=_reactor)
+        d.addCallback(lambda results: results[0])
+        return d
+
+    @defer.inlineCallbacks
+    def addBuildsets(self,
+                     sourcestampsetid,
+                     buildsets,
+                     triggeredbybrid=None,
+                     _reactor=reactor):
+        """
+        Wrapper around buildsets.addBuildsets that does merging before
+        buildrequests hit the db, for several buildsets of the same
+        sourcestamp set added in a single transaction.
 
+        The buildrequests to merge into are only looked up once per builder.
+
+        ..seealso:: buildsets.addBuildsets
+            For parameter details
+        """
         start = time.time()
-        buildsetLog = {
-            'name': 'addBuildset',
-            'description':
-            'Log merges within a chain while adding new buildsets',
-            'sourcestampsetid': sourcestampsetid,
-            'builderNames': builderNames,
-        }
-        # For every builderName in this buildset, check which ones can be merged
-        brDictsToMerge = {}
+        buildsets = [dict(bs, builderNames=sorted(bs['builderNames']))
+                     for bs in buildsets]
+        buildsetLogs = []
 
         # Don't read sourcestamp information yet, since we might not need it
         sourcestamps = None
 
-        for builderName in builderNames:
-            builderMergeStart = time.time()
-
-            if 'selected_slave' in properties:
-                # Never merge if a build request has a selected_slave
-                # This might happen when a user wants to test the same build in different
-                # slaves to look for instabilities
-                mergeBrDict = None
-            else:
-                # Look for a builder that matches the configured properties
-                mergeProperties = self.master.botmaster.builders[
-                    builderName].config.mergeProperties
-
-                # And sourcestamps (only need to read them once)
-                if sourcestamps is None:
-                    sourcestamps = yield self.master.db.sourcestamps.getSimpleSourceStamps(
-                        sourcestampsetid)
-
-                mergeBrDict = yield self._getMergeBrDict(
-                    builderName, sourcestamps, properties, mergeProperties)
-
-            # If we found one, add it to our merge map
-            if mergeBrDict:
-                brDictsToMerge[builderName] = mergeBrDict
-
-            buildsetLog[builderName] = {
-                'elapsed': time.time() - builderMergeStart,
-                'mergeBrid':
-                brDictsToMerge.get(builderName, {}).get('brid', None)
+        # Merge candidates of each builder, shared by all the buildsets
+        candidates = {}
+
+        for bs in buildsets:
+            properties = bs['properties']
+            buildsetLog = {
+                'name': 'addBuildset',
+                'description':
+                'Log merges within a chain while adding new buildsets',
+                'sourcestampsetid': sourcestampsetid,
+                'builderNames': bs['builderNames'],
             }
-
-        buildsetLog['elapsed_merge'] = time.time() - start
-
-        # Finally add the buildset passing the map of `brDictsToMerge`
+            # For every builderName in this buildset, check which ones can be merged
+            brDictsToMerge = bs['brDictsToMerge'] = {}
+
+            for builderName in bs['builderNames']:
+                builderMergeStart = time.time()
+
+                if 'selected_slave' in properties:
+                    # Never merge if a build request has a selected_slave
+                    # This might happen when a user wants to test the same build in different
+                    # slaves to look for instabilities
+                    mergeBrDict = None
+                else:
+                    # Look for a builder that matches the configured properties
+                    mergeProperties = self.master.botmaster.builders[
+                        builderName].config.mergeProperties
+
+                    # And sourcestamps (only need to read them once)
+                    if sourcestamps is None:
+                        sourcestamps = yield self.master.db.sourcestamps.getSimpleSourceStamps(
+                            sourcestampsetid)
+
+                    if builderName not in candidates:
+                        candidates[builderName] = yield self._getMergeCandidates(
+                            builderName, sourcestamps)
+
+                    mergeBrDict = yield self._getMergeBrDict(
+                        candidates[builderName], properties, mergeProperties)
+
+                # If we found one, add it to our merge map
+                if mergeBrDict:
+                    brDictsToMerge[builderName] = mergeBrDict
+
+                buildsetLog[builderName] = {
+                    'elapsed': time.time() - builderMergeStart,
+                    'mergeBrid':
+                    brDictsToMerge.get(builderName, {}).get('brid', None)
+                }
+
+            buildsetLog['elapsed_merge'] = time.time() - start
+            buildsetLogs.append(buildsetLog)
+
+        # Finally add the buildsets passing their maps of `brDictsToMerge`
         # This method will make sure that all new breqs will enter the db
         # marked as merged, and will not run.
         _master_objectid = yield self.master.getObjectId()
 
-        # Create a lock on every build we can merge into.
+        # Create a lock on every build we can merge into, always acquired in
+        # the same order.
         acquiring_locks_start = time.time()
-        build_merging_locks = {
-            builderName : self.getMergingLocks([brDict['brid']])[0]
-            for builderName, brDict in brDictsToMerge.iteritems()
-        }
-        for builderName, lock in build_merging_locks.iteritems():
-            yield lock.acquire()
-            buildsetLog[builderName]['elapsed_acquiring_lock'] = \
-                time.time() - acquiring_locks_start
-        buildsetLog['elapsed_acquiring_locks'] = time.time() - acquiring_locks_start
+        mergebrids = sorted(set(brDict['brid']
+                                for bs in buildsets
+                                for brDict in bs['brDictsToMerge'].itervalues()))
+        build_merging_locks = dict(zip(mergebrids,
+                                       self.getMergingLocks(mergebrids)))
+        for brid in mergebrids:
+            yield build_merging_locks[brid].acquire()
+        for bs, buildsetLog in zip(buildsets, buildsetLogs):
+            for builderName in bs['brDictsToMerge']:
+                buildsetLog[builderName]['elapsed_acquiring_lock'] = \
+                    time.time() - acquiring_locks_start
+            buildsetLog['elapsed_acquiring_locks'] = time.time() - acquiring_locks_start
         using_locks_start = time.time()
 
-        # Some builds might have finished before we locked into them, so release those.
-        finishedBrDicts = yield self.master.db.buildrequests.getBuildRequests(
-            brids=[brDict['brid'] for brDict in brDictsToMerge.values()],
-            complete=True)
-        for brDict in finishedBrDicts:
-            brDictsToMerge.pop(brDict['buildername'])
-            build_merging_locks.pop(brDict['buildername']).release()
-
-        # Add buildset
         try:
-            result = yield self.master.db.buildsets.addBuildset(
+            # Some builds might have finished before we locked into them, so release those.
+            if mergebrids:
+                finishedBrDicts = yield self.master.db.buildrequests.getBuildRequests(
+                    brids=mergebrids,
+                    complete=True)
+                finishedBrids = set(brDict['brid'] for brDict in finishedBrDicts)
+                for bs in buildsets:
+                    for builderName, brDict in bs['brDictsToMerge'].items():
+                        if brDict['brid'] in finishedBrids:
+                            del bs['brDictsToMerge'][builderName]
+                for brid in finishedBrids:
+                    build_merging_locks.pop(brid).release()
+
+            # Add buildsets
+            results = yield self.master.db.buildsets.addBuildsets(
                 sourcestampsetid=sourcestampsetid,
-                reason=reason,
-                properties=properties,
+                buildsets=buildsets,
                 triggeredbybrid=triggeredbybrid,
-                builderNames=builderNames,
-                brDictsToMerge=brDictsToMerge,
-                external_idstring=external_idstring,
                 _reactor=_reactor,
                 _master_objectid=_master_objectid)
         finally:
             for lock in build_merging_locks.itervalues():
                 lock.release()
-            buildsetLog['elapsed_using_locks'] = time.time() - using_locks_start
+            for buildsetLog in buildsetLogs:
+                buildsetLog['elapsed_using_locks'] = time.time() - using_locks_start
 
         # Log more ids
-        (bsid, brids) = result
-        buildsetLog['buildsetid'] = bsid
-        for builderName, brid in brids.iteritems():
-            buildsetLog[builderName]['brid'] = brid
-        buildsetLog['elapsed_total'] = time.time() - start
-        log.msg(json.dumps(buildsetLog))
-
-        defer.returnValue(result)
+        for (bsid, brids), buildsetLog in zip(results, buildsetLogs):
+            buildsetLog['buildsetid'] = bsid
+            for builderName, brid in brids.iteritems():
+                buildsetLog[builderName]['brid'] = brid
+            buildsetLog['elapsed_total'] = time.time() - start
+            log.msg(json.dumps(buildsetLog))
 
+        defer.returnValue(results)
 
     @defer.inlineCallbacks
-    def _getMergeBrDict(self, builderName, sourcestamps, properties,
-                        mergeProperties):
+    def _getMergeCandidates(self, builderName, sourcestamps):
         """
-        Looks for a buildrequest we can merge into.
-
-        It must match `builderName`, `sourcestamps` and all properties defined
-        in `mergeProperties`.
+        Looks for the buildrequests of `builderName` matching `sourcestamps`
+        that could be merged into.
 
         This will only merge against builds that have already been claimed
         and are currently running (unfinished builds).
 
-        :return BrDict or None:
-            Buildrequest dictionary for a request that can be merged into.
-            `None` if no match was found.
+        :return (list(BrDict), dict):
+            The buildrequests, sorted by id, and the properties of their
+            buildsets.
         """
         matchingBrDicts = yield self.master.db.buildrequests.getBuildRequests(
             buildername=builderName,
@@ -187,14 +226,32 @@ class BuildRequestMerger(config.ReconfigurableServiceMixin, service.Service):
         otherProperties = yield self._getBuildsetsProperties(
             [brdict['buildsetid'] for brdict in matchingBrDicts])
 
-        # Check if relevant properties match
         # Sort list of build requests to ensure we always merge against smallest id possible
-        for brdict in sorted(matchingBrDicts, key=lambda b: int(b['brid'])):
+        defer.returnValue((sorted(matchingBrDicts, key=lambda b: int(b['brid'])),
+                           otherProperties))
+
+    @defer.inlineCallbacks
+    def _getMergeBrDict(self, candidates, properties, mergeProperties):
+        """
+        Looks for a buildrequest we can merge into.
+
+        It must be one of the `candidates` found by `_getMergeCandidates`, and
+        match all properties defined in `mergeProperties`.
+
+        :return BrDict or None:
+            Buildrequest dictionary for a request that can be merged into.
+            `None` if no match was found.
+        """
+        matchingBrDicts, otherProperties = candidates
+
+        # Check if relevant properties match
+        for brdict in matchingBrDicts:
             if self._propertiesMatch(properties,
                                      otherProperties[brdict['buildsetid']],
                                      mergeProperties):
 
                 # If they match, fetch the build number and merge against this buildrequest
+                brdict = brdict.copy()
                 brdict[
                     'build_number'] = yield self.master.db.builds.getBuildNumberForRequest(
                         brdict['brid'])
@@ -0,0 +1,196 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import heapq
+
+from buildbot.util import datetime2epoch
+
+
+class BuildRequestQueue(object):
+    """
+    Master-resident index of the build requests waiting in one of Katana's
+    queues (see L{buildbot.db.buildrequests.Queue}).
+
+    Requests are kept in one heap per builder, ordered by higher priority,
+    then oldest submitted time, then lowest id, which is the same ordering
+    used by C{getBuildRequestsInQueue}.  Removal is lazy: the heap entry is
+    marked as removed and dropped when it reaches the top of its heap or when
+    the index is compacted.
+
+    The brdicts stored are the ones returned by C{getBuildRequestsInQueue}.
+    """
+
+    # compact the heaps once there are at least this many removed entries
+    # and they outnumber the live entries
+    COMPACT_THRESHOLD = 1000
+
+    def __init__(self):
+        self.loaded = False
+        # bumped whenever heap positions change, so iterators can notice
+        self.version = 0
+        self._heaps = {}
+        self._entries = {}
+        self._parked = {}
+        self._removed = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, brid):
+        return brid in self._entries
+
+    def get(self, brid):
+        entry = self._entries.get(brid)
+        if entry is not None:
+            return entry[-1]
+        return None
+
+    @staticmethod
+    def _sortKey(brdict):
+        submitted_at = brdict['submitted_at']
+        if submitted_at is not None and not isinstance(submitted_at, (int, long, float)):
+            submitted_at = datetime2epoch(submitted_at)
+        return (-(brdict['priority'] or 0), submitted_at, brdict['brid'])
+
+    def load(self, brdicts):
+        """
+        Replace the content of the index with C{brdicts}.
+        """
+        self.clear()
+        for brdict in brdicts:
+            entry = [self._sortKey(brdict), brdict]
+            self._entries[brdict['brid']] = entry
+            self._heaps.setdefault(brdict['buildername'], []).append(entry)
+
+        for heap in self._heaps.itervalues():
+            heapq.heapify(heap)
+
+        self.loaded = True
+
+    def clear(self):
+        self.loaded = False
+        self.version += 1
+        self._heaps = {}
+        self._entries = {}
+        self._parked = {}
+        self._removed = 0
+
+    def add(self, brdict):
+        brid = brdict['brid']
+        self.remove(brid)
+        self._parked.pop(brid, None)
+
+        entry = [self._sortKey(brdict), brdict]
+        self._entries[brid] = entry
+        heapq.heappush(self._heaps.setdefault(brdict['buildername'], []), entry)
+        self.version += 1
+
+    def remove(self, brid):
+        self._parked.pop(brid, None)
+        entry = self._entries.pop(brid, None)
+        if entry is None:
+            return None
+
+        brdict = entry[-1]
+        entry[-1] = None
+        self._removed += 1
+
+        heap = self._heaps.get(brdict['buildername'])
+        while heap and heap[0][-1] is None:
+            heapq.heappop(heap)
+            self._removed -= 1
+            self.version += 1
+
+        if heap is not None and not heap:
+            del self._heaps[brdict['buildername']]
+
+        if self._removed >= self.COMPACT_THRESHOLD and self._removed > len(self._entries):
+            self._compact()
+
+        return brdict
+
+    def park(self, brdict):
+        """
+        Keep a request out of the queue until L{unpark} is called, used when a
+        request keeps failing and should be retried after the queue is
+        processed.
+        """
+        self.remove(brdict['brid'])
+        self._parked[brdict['brid']] = brdict
+
+    def unpark(self):
+        parked, self._parked = self._parked, {}
+        for brdict in parked.itervalues():
+            self.add(brdict)
+
+    def _compact(self):
+        for name in self._heaps.keys():
+            heap = [entry for entry in self._heaps[name] if entry[-1] is not None]
+            if heap:
+                heapq.heapify(heap)
+                self._heaps[name] = heap
+            else:
+                del self._heaps[name]
+        self._removed = 0
+        self.version += 1
+
+    def peek(self, buildername):
+        """
+        Returns the brdict at the head of C{buildername}'s queue or None.
+        """
+        heap = self._heaps.get(buildername)
+        if heap:
+            return heap[0][-1]
+        return None
+
+    def iterByPriority(self, skipBuilderNames=None):
+        """
+        Yields the brdicts of all the builders in priority order, without
+        modifying the queue.  Walking the first k requests costs O(k log k)
+        plus one step per builder, regardless of the size of the queue.
+
+        Builders added to C{skipBuilderNames} while iterating are pruned, none
+        of their remaining requests will be yielded.  If the queue is modified
+        while iterating, the walk is restarted skipping the requests that were
+        already yielded.
+        """
+        if skipBuilderNames is None:
+            skipBuilderNames = set()
+        seen = set()
+
+        while True:
+            version = self.version
+            frontier = [(heap[0][0], name, 0) for name, heap in self._heaps.iteritems() if heap]
+            heapq.heapify(frontier)
+
+            while frontier and version == self.version:
+                _, name, idx = heapq.heappop(frontier)
+                if name in skipBuilderNames:
+                    continue
+
+                heap = self._heaps[name]
+                for child in (2 * idx + 1, 2 * idx + 2):
+                    if child < len(heap):
+                        heapq.heappush(frontier, (heap[child][0], name, child))
+
+                brdict = heap[idx][-1]
+                if brdict is None or brdict['brid'] in seen:
+                    continue
+
+                seen.add(brdict['brid'])
+                yield brdict
+
+            if version == self.version:
+                return
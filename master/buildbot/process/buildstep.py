@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 import re
+import zlib
 
 from zope.interface import implements
 from twisted.internet import defer, error
@@ -114,6 +115,7 @@ class RemoteCommand(pb.Referenceable):
         # We will get a single remote_complete when it finishes.
         # We should fire self.deferred when the command is done.
         self._setManifest()
+        self._setUpdateOptions()
 
         d = self.remote.callRemote("startCommand", self, self.commandID,
                                    self.remote_command, self.args)
@@ -125,6 +127,12 @@ class RemoteCommand(pb.Referenceable):
         elif isinstance(self.args, dict):
             self.args['manifest'] = self.step.manifest
 
+    def _setUpdateOptions(self):
+        # slaves that know about it send large updates zlib-compressed, see
+        # _decompressUpdate; older slaves ignore the argument
+        if isinstance(self.args, dict):
+            self.args['compressUpdates'] = True
+
     def _finished(self, failure=None):
         if not self.active:
             defer.succeed(None)
@@ -187,6 +195,8 @@ class RemoteCommand(pb.Referenceable):
             #log.msg("update[%d]:" % num)
             try:
                 if self.active and not self.ignore_updates:
+                    if 'compressed' in update:
+                        update = self._decompressUpdate(update)
                     self.remoteUpdate(update)
             except:
                 # log failure, terminate build, let slave retire the update
@@ -197,6 +207,21 @@ class RemoteCommand(pb.Referenceable):
                 max_updatenum = num
         return max_updatenum
 
+    def _decompressUpdate(self, update):
+        """
+        Turn an update whose output was compressed by the slave, like
+        C{{'compressed': {'stdout': data}}} or
+        C{{'compressed': {'log': (logname, data)}}}, back into a plain update.
+        """
+        update = dict(update)
+        for k, v in update.pop('compressed').items():
+            if k == 'log':
+                logname, data = v
+                update[k] = (logname, zlib.decompress(data))
+            else:
+                update[k] = zlib.decompress(v)
+        return update
+
     def remote_complete(self, failure=None):
         """
         Called by the slave's L{buildbot.slave.bot.SlaveBuilder} to
@@ -933,6 +958,15 @@ class OutputProgressObserver(LogObserver):
         self.length += len(text)
         self.step.setProgress(self.name, self.length)
 
+    def setLog(self, loog):
+        assert interfaces.IStatusLog.providedBy(loog)
+        # progress only needs the total, so take the chunks in batches
+        loog.subscribe(self, True, batched=True)
+
+    def logChunks(self, build, step, log, chunks):
+        self.length += sum([len(text) for channel, text in chunks])
+        self.step.setProgress(self.name, self.length)
+
 class LoggingBuildStep(BuildStep):
 
     progressMetrics = ('output',)
@@ -33,6 +33,7 @@ Basic architecture:
           \/
     MetricWatcher
 """
+from bisect import bisect_left
 from collections import deque
 
 from twisted.python import log
@@ -66,6 +67,19 @@ class MetricTimeEvent(MetricEvent):
         self.timer = timer
         self.elapsed = elapsed
 
+class MetricDBQueryEvent(MetricEvent):
+    def __init__(self, query, wait, elapsed, retries=0, pending=0, threads=0):
+        # query is the connector method, like 'buildrequests.getBuildRequests';
+        # wait is the time spent waiting for a thread, elapsed the time spent
+        # running the query, pending the number of queries in the pool when
+        # it was queued
+        self.query = query
+        self.wait = wait
+        self.elapsed = elapsed
+        self.retries = retries
+        self.pending = pending
+        self.threads = threads
+
 ALARM_OK, ALARM_WARN, ALARM_CRIT = range(3)
 ALARM_TEXT = ["OK", "WARN", "CRIT"]
 
@@ -154,6 +168,42 @@ class AveragingFiniteList(FiniteList):
 
         return self.average
 
+class Histogram(object):
+    """
+    Count durations in buckets of growing bounds, in seconds, along with
+    their number, total and maximum.
+    """
+    BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+              1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.buckets[bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    @property
+    def average(self):
+        if not self.count:
+            return 0
+        return self.total / self.count
+
+    def asDict(self):
+        buckets = {}
+        for bound, count in zip(self.BOUNDS, self.buckets):
+            if count:
+                buckets['<=%g' % bound] = count
+        if self.buckets[-1]:
+            buckets['>%g' % self.BOUNDS[-1]] = self.buckets[-1]
+        return dict(count=self.count, average=self.average, max=self.max,
+                    buckets=buckets)
+
 class MetricHandler(object):
     def __init__(self, metrics):
         self.metrics = metrics
@@ -241,6 +291,61 @@ class MetricTimeHandler(MetricHandler):
             retval[timer] = self.get(timer)
         return dict(timers=retval)
 
+class MetricDBQueryHandler(MetricHandler):
+    _queries = None
+    def reset(self):
+        self._queries = {}
+        self.threads = 0
+        self.pending = 0
+        self.maxPending = 0
+        self.saturated = 0
+
+    def handle(self, eventDict, metric):
+        if metric.query not in self._queries:
+            self._queries[metric.query] = dict(count=0, retries=0,
+                                               wait=Histogram(),
+                                               execute=Histogram())
+        query = self._queries[metric.query]
+        query['count'] += 1
+        query['retries'] += metric.retries
+        query['wait'].add(metric.wait)
+        query['execute'].add(metric.elapsed)
+
+        self.threads = metric.threads
+        self.pending = metric.pending
+        self.maxPending = max(self.maxPending, metric.pending)
+        if metric.pending > metric.threads:
+            self.saturated += 1
+
+    def keys(self):
+        return self._queries.keys()
+
+    def get(self, query):
+        return self._queries[query]
+
+    def report(self):
+        retval = []
+        for name in sorted(self.keys()):
+            query = self.get(name)
+            retval.append("DB query %s: %i queries, %i retries, "
+                          "%.3g waiting, %.3g running (max %.3g)" %
+                          (name, query['count'], query['retries'],
+                           query['wait'].average, query['execute'].average,
+                           query['execute'].max))
+        return "\n".join(retval)
+
+    def asDict(self):
+        queries = {}
+        for name in sorted(self.keys()):
+            query = self.get(name)
+            queries[name] = dict(count=query['count'],
+                                 retries=query['retries'],
+                                 wait=query['wait'].asDict(),
+                                 execute=query['execute'].asDict())
+        return dict(db=dict(threads=self.threads, pending=self.pending,
+                            max_pending=self.maxPending,
+                            saturated=self.saturated, queries=queries))
+
 class MetricAlarmHandler(MetricHandler):
     _alarms = None
     def reset(self):
@@ -387,6 +492,7 @@ class MetricLogObserver(config.ReconfigurableServiceMixin,
         self.registerHandler(MetricCountEvent, MetricCountHandler(self))
         self.registerHandler(MetricTimeEvent, MetricTimeHandler(self))
         self.registerHandler(MetricAlarmEvent, MetricAlarmHandler(self))
+        self.registerHandler(MetricDBQueryEvent, MetricDBQueryHandler(self))
 
         # Make sure our changes poller is behaving
         self.getHandler(MetricTimeEvent).addWatcher(PollerWatcher(self))
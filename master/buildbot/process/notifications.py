@@ -0,0 +1,243 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from twisted.python import log
+from twisted.internet import defer, reactor
+from twisted.application import service
+from twisted.cred import credentials
+from buildbot import config, util
+from buildbot.pbutil import NewCredPerspective, ReconnectingPBClientFactory
+
+class NotificationBus(config.ReconfigurableServiceMixin, service.MultiService):
+    """
+    I tell the other masters of the cluster about the changes, build requests
+    and buildset completions of this master, through the transport configured
+    in C{c['masterNotifications']}, and deliver theirs to the subscribers of
+    this master.
+
+    Notifications may be lost or duplicated, so the database polling of the
+    masters still runs, only to catch up on lost notifications.
+    """
+
+    def __init__(self, master):
+        service.MultiService.__init__(self)
+        self.setName('notification_bus')
+        self.master = master
+        self.transport = None
+
+    @property
+    def active(self):
+        return self.transport is not None
+
+    @defer.inlineCallbacks
+    def reconfigService(self, new_config):
+        if new_config.masterNotifications != self.transport:
+            if self.transport:
+                yield defer.maybeDeferred(lambda :
+                        self.transport.disownServiceParent())
+                self.transport.bus = None
+                self.transport = None
+
+            if new_config.masterNotifications:
+                self.transport = new_config.masterNotifications
+                self.transport.bus = self
+                self.transport.setServiceParent(self)
+
+        yield config.ReconfigurableServiceMixin.reconfigService(self,
+                                                    new_config)
+
+    def publish(self, event, **kwargs):
+        """
+        Tell the other masters about C{event}; this never fails, as the
+        database polling catches up on lost notifications.
+        """
+        if not self.transport:
+            return defer.succeed(None)
+        d = defer.maybeDeferred(self.transport.publish, event, kwargs)
+        d.addErrback(log.err, "while notifying the other masters of %s" % event)
+        return d
+
+    def notificationReceived(self, event, kwargs):
+        try:
+            if event == 'change':
+                d = self.master.changeNotified(kwargs['changeid'])
+                d.addErrback(log.err, "while delivering change %s" % kwargs['changeid'])
+            elif event == 'buildrequestAdded':
+                self.master.deliverBuildRequestAdded(**kwargs)
+            elif event == 'buildrequestRemoved':
+                self.master.deliverBuildRequestRemoved(**kwargs)
+            elif event == 'buildsetComplete':
+                # do not trust the sender: check the completion and the
+                # results in the database
+                d = self.master.maybeBuildsetsComplete([kwargs['bsid']])
+                d.addErrback(log.err, "while checking buildset %s" % kwargs['bsid'])
+            else:
+                # sent by a newer master
+                log.msg("ignoring unknown notification %r" % (event,))
+        except Exception:
+            log.err(None, "while delivering notification %r" % (event,))
+
+
+class NotificationTransport(util.ComparableMixin, service.Service):
+    """
+    Base class of the transports carrying notifications between masters.
+    Subclasses implement C{publish} and call C{notificationReceived} with the
+    notifications of the other masters.
+    """
+
+    bus = None
+
+    def publish(self, event, kwargs):
+        """
+        Send C{event} and its C{kwargs}, a dictionary of simple values, to the
+        other masters, and return a Deferred.
+        """
+        raise NotImplementedError
+
+    def notificationReceived(self, event, kwargs):
+        if self.bus:
+            self.bus.notificationReceived(event, kwargs)
+
+
+class LocalNotificationTransport(NotificationTransport):
+    """
+    A transport between the masters of a single process, sharing the same
+    C{channel}; mostly useful for tests.
+    """
+
+    compare_attrs = ['channel']
+
+    _channels = {}
+
+    def __init__(self, channel='masters'):
+        self.channel = channel
+
+    def startService(self):
+        NotificationTransport.startService(self)
+        self._channels.setdefault(self.channel, []).append(self)
+
+    def stopService(self):
+        transports = self._channels[self.channel]
+        transports.remove(self)
+        if not transports:
+            del self._channels[self.channel]
+        return NotificationTransport.stopService(self)
+
+    def publish(self, event, kwargs):
+        for transport in list(self._channels.get(self.channel, [])):
+            if transport is not self:
+                transport.notificationReceived(event, dict(kwargs))
+        return defer.succeed(None)
+
+
+class NotificationPerspective(NewCredPerspective):
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def perspective_notify(self, event, kwargs):
+        self.transport.notificationReceived(event, kwargs)
+
+
+class PeerFactory(ReconnectingPBClientFactory):
+    """
+    I keep a connection to the notification port of another master.
+    """
+
+    maxDelay = 60
+
+    def __init__(self, peer):
+        ReconnectingPBClientFactory.__init__(self)
+        self.peer = peer
+        self.perspective = None
+
+    def gotPerspective(self, perspective):
+        log.msg("connected to master %s for notifications" % self.peer)
+        self.perspective = perspective
+        perspective.notifyOnDisconnect(self._disconnected)
+
+    def _disconnected(self, perspective):
+        if self.perspective is perspective:
+            self.perspective = None
+
+
+class PBNotificationTransport(NotificationTransport):
+    """
+    A transport between masters over Perspective Broker: every master listens
+    on C{port}, possibly the slave port, and connects to the C{peers}, a list
+    of C{'host:port'} strings naming the other masters.  The C{user} and
+    C{passwd} must be the same on every master; there is no default password.
+
+    A notification published while a peer is not connected is not sent to
+    it.
+    """
+
+    compare_attrs = ['port', 'peers', 'user', 'passwd']
+
+    def __init__(self, port, peers, user='masters', passwd=None):
+        self.port = port
+        self.peers = list(peers)
+        self.user = user
+        self.passwd = passwd
+        self.registration = None
+        self.factories = []
+        self.connectors = []
+
+        if not passwd:
+            config.error("PBNotificationTransport requires a passwd")
+        for peer in self.peers:
+            if ':' not in peer:
+                config.error("PBNotificationTransport peers must be "
+                             "'host:port' strings, not %r" % (peer,))
+
+    def startService(self):
+        NotificationTransport.startService(self)
+        factory = lambda mind, user : NotificationPerspective(self)
+        self.registration = self.bus.master.pbmanager.register(
+                self.port, self.user, self.passwd, factory)
+
+        for peer in self.peers:
+            host, port = peer.rsplit(':', 1)
+            f = PeerFactory(peer)
+            f.startLogin(credentials.UsernamePassword(self.user, self.passwd))
+            self.factories.append(f)
+            self.connectors.append(reactor.connectTCP(host, int(port), f))
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        for f in self.factories:
+            f.stopTrying()
+        for connector in self.connectors:
+            connector.disconnect()
+        self.factories = []
+        self.connectors = []
+
+        if self.registration:
+            yield self.registration.unregister()
+            self.registration = None
+
+        yield defer.maybeDeferred(NotificationTransport.stopService, self)
+
+    def publish(self, event, kwargs):
+        dl = []
+        for f in self.factories:
+            if f.perspective is None:
+                continue
+            d = f.perspective.callRemote('notify', event, kwargs)
+            d.addErrback(lambda failure, peer=f.peer :
+                    log.msg("could not notify master %s of %s: %s"
+                            % (peer, event, failure.getErrorMessage())))
+            dl.append(d)
+        return defer.DeferredList(dl)
@@ -400,6 +400,53 @@ class BaseScheduler(service.MultiService, ComparableMixin, StateMixin, ScheduleO
             if builderNames is None:
                 builderNames = self.builderNames
 
+        new_setid = yield self._addSourceStampSetForDetails(sourcestamps)
+
+        rv = yield self.addBuildsetForSourceStamp(
+                                setid=new_setid, reason=reason,
+                                properties=properties,
+                                triggeredbybrid=triggeredbybrid,
+                                builderNames=builderNames)
+
+        defer.returnValue(rv)
+
+    @defer.inlineCallbacks
+    def addBuildsetsForSourceStampSetDetails(self, reason, sourcestamps,
+                                             propertiesList, triggeredbybrid=None,
+                                             builderNames=None):
+        """
+        Like L{addBuildsetForSourceStampSetDetails}, but add a buildset for
+        each of the properties objects of C{propertiesList}, all sharing a
+        single sourcestamp set and added in a single transaction.
+
+        @returns: list of (buildset ID, buildrequest IDs) via Deferred, in the
+            order of C{propertiesList}
+        """
+        if not builderNames:
+            builderNames = self.builderNames
+
+        new_setid = yield self._addSourceStampSetForDetails(sourcestamps)
+
+        buildsets = []
+        for properties in propertiesList:
+            # combine properties
+            if properties:
+                properties.updateFromProperties(self.properties)
+            else:
+                properties = self.properties
+
+            buildsets.append(dict(reason=reason,
+                                  properties=properties.asDict(),
+                                  builderNames=builderNames,
+                                  external_idstring=None))
+
+        rv = yield self.master.addBuildsets(sourcestampsetid=new_setid,
+                                            buildsets=buildsets,
+                                            triggeredbybrid=triggeredbybrid)
+        defer.returnValue(rv)
+
+    @defer.inlineCallbacks
+    def _addSourceStampSetForDetails(self, sourcestamps):
         if sourcestamps is None:
             sourcestamps = {}
 
@@ -432,13 +479,7 @@ class BaseScheduler(service.MultiService, ComparableMixin, StateMixin, ScheduleO
                         patch_comment=ss.get('patch_comment', None),
                         sourcestampsetid=new_setid)
 
-        rv = yield self.addBuildsetForSourceStamp(
-                                setid=new_setid, reason=reason,
-                                properties=properties,
-                                triggeredbybrid=triggeredbybrid,
-                                builderNames=builderNames)
-
-        defer.returnValue(rv)
+        defer.returnValue(new_setid)
 
 
     @defer.inlineCallbacks
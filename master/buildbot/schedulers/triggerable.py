@@ -16,8 +16,8 @@
 from zope.interface import implements
 
 from twisted.python import failure
-from twisted.internet import defer, task
-from buildbot.interfaces import ITriggerableScheduler
+from twisted.internet import defer
+from buildbot.interfaces import IBulkTriggerableScheduler
 from buildbot.schedulers import base
 from buildbot.process.properties import Properties
 from twisted.python import log
@@ -27,7 +27,7 @@ class TriggerableSchedulerStopped(StandardError):
     pass
 
 class Triggerable(base.BaseScheduler):
-    implements(ITriggerableScheduler)
+    implements(IBulkTriggerableScheduler)
 
     compare_attrs = base.BaseScheduler.compare_attrs
 
@@ -37,8 +37,6 @@ class Triggerable(base.BaseScheduler):
         self._waiters = {}
         self._bsc_subscription = None
         self.trigger_reason = "Triggerable(%s)" % name
-        # loop for polling the db
-        self.db_loop = None
 
     def updateReason(self, reason):
         self.reason = self.trigger_reason
@@ -52,13 +50,7 @@ class Triggerable(base.BaseScheduler):
     def trigger(self, sourcestamps = None, set_props=None, triggeredbybrid=None, reason=None):
         """Trigger this scheduler with the optional given list of sourcestamps
         Returns a deferred that will fire when the buildset is finished."""
-        # properties for this buildset are composed of our own properties,
-        # potentially overridden by anything from the triggering build
-        props = Properties()
-        props.updateFromProperties(self.properties)
-        if set_props:
-            props.updateFromProperties(set_props)
-
+        props = self._triggerProperties(set_props)
         self.updateReason(reason)
 
         # note that this does not use the buildset subscriptions mechanism, as
@@ -69,25 +61,58 @@ class Triggerable(base.BaseScheduler):
         def setup_waiter((bsid,brids)):
             d = defer.Deferred()
             self._waiters[bsid] = (d, brids)
+            # in multimaster mode, the buildset may complete on another
+            # master; the master polls for all the watched buildsets at once
+            self.master.watchBuildsetCompletion(bsid)
             self._updateWaiters()
             return d
         d.addCallback(setup_waiter)
         return d
 
+    def triggerMany(self, sourcestamps=None, set_props_list=(),
+                    triggeredbybrid=None, reason=None):
+        """Trigger this scheduler once for each of the properties of
+        C{set_props_list}, adding all the buildsets in a single transaction
+        and with a single sourcestamp set.  Returns a list of deferreds, one
+        for each buildset, that will fire when the buildset is finished."""
+        props_list = [ self._triggerProperties(set_props)
+                       for set_props in set_props_list ]
+        self.updateReason(reason)
+
+        waiters = [ defer.Deferred() for _ in props_list ]
+        d = self.addBuildsetsForSourceStampSetDetails(self.reason,
+                                sourcestamps, props_list, triggeredbybrid)
+        def setup_waiters(results):
+            for (bsid, brids), waiter in zip(results, waiters):
+                self._waiters[bsid] = (waiter, brids)
+                self.master.watchBuildsetCompletion(bsid)
+            self._updateWaiters()
+        def fail(f):
+            for waiter in waiters:
+                waiter.errback(f)
+        d.addCallbacks(setup_waiters, fail)
+        return waiters
+
+    def _triggerProperties(self, set_props):
+        # properties for this buildset are composed of our own properties,
+        # potentially overridden by anything from the triggering build
+        props = Properties()
+        props.updateFromProperties(self.properties)
+        if set_props:
+            props.updateFromProperties(set_props)
+        return props
+
     def stopService(self):
         # cancel any outstanding subscription
         if self._bsc_subscription:
             self._bsc_subscription.unsubscribe()
             self._bsc_subscription = None
 
-        if self.db_loop:
-            self.db_loop.stop()
-            self.db_loop = None
-
         # and errback any outstanding deferreds
         if self._waiters:
             msg = 'Triggerable scheduler stopped before build was complete'
-            for d, brids in self._waiters.values():
+            for bsid, (d, brids) in self._waiters.items():
+                self.master.unwatchBuildsetCompletion(bsid)
                 d.errback(failure.Failure(TriggerableSchedulerStopped(msg)))
             self._waiters = {}
 
@@ -103,22 +128,6 @@ class Triggerable(base.BaseScheduler):
             self._bsc_subscription.unsubscribe()
             self._bsc_subscription = None
 
-        if self._waiters and (not self.db_loop or not self.db_loop.running):
-            if (self.master.configured_poll_interval):
-                self.db_loop = task.LoopingCall(self.pollDatabaseBuildSets)
-                self.db_loop.start(self.master.configured_poll_interval)
-        elif not self._waiters and self.db_loop:
-                if self.db_loop.running:
-                    self.db_loop.stop()
-                self.db_loop = None
-
-    # poll database for buildset completion
-    # when running buildbot in multimaster mode
-    @defer.inlineCallbacks
-    def pollDatabaseBuildSets(self):
-        for bsid in self._waiters.keys():
-            yield self.master.maybeBuildsetComplete(bsid)
-
     def _buildsetComplete(self, bsid, result):
         if bsid not in self._waiters:
             return
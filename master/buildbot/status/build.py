@@ -16,11 +16,10 @@
 from __future__ import with_statement
 
 import os, shutil, re
-from cPickle import dump
 from zope.interface import implements
-from twisted.python import log, runtime, components
+from twisted.python import log, components
 from twisted.persisted import styles
-from twisted.internet import reactor, defer, threads
+from twisted.internet import reactor, defer
 from buildbot import interfaces, util, sourcestamp
 from buildbot.process import properties
 from buildbot.process.buildtag import BuildTag
@@ -528,7 +527,7 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
         self.finished = util.now() if self.finished is None else self.finished
         self.setText(["Build Canceled"])
         self.buildFinished()
-        self.saveYourself()
+        return self.saveYourself()
 
     def retryResume(self):
         failure = "Failed to resume build %s # %d while loading steps, will retry" % (self.builder.name, self.number)
@@ -545,31 +544,25 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
         self.setResults(MERGED)
         self.finished = util.now()
         self.setText(["Build has been merged with: %s" % url['text']])
-        yield threads.deferToThread(self.saveYourself)
+        yield self.saveYourself()
 
     def saveYourself(self):
         filename = os.path.join(self.builder.basedir, "%d" % self.number)
         if os.path.isdir(filename):
             # leftover from 0.5.0, which stored builds in directories
             shutil.rmtree(filename, ignore_errors=True)
-        tmpfilename = filename + ".tmp"
-
-        try:
-            with open(tmpfilename, "wb") as f:
-                dump(self, f, -1)
-            if runtime.platformType  == 'win32':
-                # windows cannot rename a file on top of an existing one, so
-                # fall back to delete-first. There are ways this can fail and
-                # lose the builder's history, so we avoid using it in the
-                # general (non-windows) case
-                if os.path.exists(filename):
-                    os.unlink(filename)
-
-            os.rename(tmpfilename, filename)
-        except:
-            log.msg("unable to save build %s-#%d" % (self.builder.name,
-                                                     self.number))
-            log.err()
+
+        # the pickle is written in the background, see StatusWriter
+        finished = self.isFinished()
+        d = self.builder.getStatusWriter().save(filename, self)
+        def saved(ok):
+            if not ok:
+                log.msg("unable to save build %s-#%d" % (self.builder.name,
+                                                         self.number))
+            elif finished:
+                self.builder.buildIndex.addBuild(self)
+        d.addCallback(saved)
+        return d
 
     def currentStepDict(self, dict):
         if self.getCurrentStep():
@@ -16,20 +16,22 @@
 from __future__ import with_statement
 
 
-import os, re, itertools
-from cPickle import load, dump
+import os, re, itertools, collections
+from cPickle import load
 import datetime
 from buildbot.interfaces import IStatusReceiver
-from twisted.internet import defer, threads
+from twisted.internet import defer, threads, reactor
 
 from zope.interface import implements
-from twisted.python import log, runtime
+from twisted.python import log
 from twisted.persisted import styles
 from buildbot import interfaces, util
 from buildbot.util.lru import LRUCache
 from buildbot.status.event import Event
 from buildbot.status.build import BuildStatus
 from buildbot.status.buildrequest import BuildRequestStatus
+from buildbot.status.buildindex import BuildIndex, getEntryBranches, foundCodebasesInEntry
+from buildbot.status.writer import StatusWriter
 
 # user modules expect these symbols to be present here
 from buildbot.status.results import SUCCESS, WARNINGS, FAILURE, SKIPPED
@@ -71,6 +73,51 @@ def getCacheKey(project, codebases):
     return output
 
 
+class BuildPrefetcher(object):
+    """
+    I load the builds C{buildnumbers} of a builder, keeping up to C{window}
+    of them loading ahead of the consumer, and hand them out in order.
+
+    If C{stopped} is given, it is a Deferred firing (or failing) once the
+    builds are not needed anymore, e.g. C{request.notifyFinish()}; I then
+    stop handing out and loading builds.
+    """
+
+    def __init__(self, builder_status, buildnumbers, window, stopped=None):
+        self.builder_status = builder_status
+        self.buildnumbers = iter(buildnumbers)
+        self.window = window
+        self.loading = collections.deque()
+        self.stopped = False
+        if stopped is not None:
+            stopped.addBoth(self.stop)
+        self._fill()
+
+    def _fill(self):
+        while not self.stopped and len(self.loading) < self.window:
+            try:
+                buildnumber = self.buildnumbers.next()
+            except StopIteration:
+                return
+            self.loading.append(self.builder_status.deferToThread(buildnumber))
+
+    def next(self):
+        """Return a Deferred firing with the next build (or None if it is not
+        available), or None once all builds were handed out or I am
+        stopped."""
+        if self.stopped or not self.loading:
+            return None
+        d = self.loading.popleft()
+        self._fill()
+        return d
+
+    def stop(self, _=None):
+        # builds that are still loading end up in the build cache
+        self.stopped = True
+        while self.loading:
+            self.loading.popleft().addErrback(log.err, "while prefetching builds")
+
+
 class BuilderStatus(styles.Versioned):
     """I handle status information for a single process.build.Builder object.
     That object sends status changes to me (frequently as Events), and I
@@ -121,6 +168,7 @@ class BuilderStatus(styles.Versioned):
         self.nextBuild = None
         self.watchers = []
         self.buildCache = LRUCache(self.cacheMiss)
+        self.buildIndex = BuildIndex(self)
         self.reason = None
         self.unavailable_build_numbers = set()
         self.latestBuildCache = {}
@@ -151,6 +199,7 @@ class BuilderStatus(styles.Versioned):
         d = styles.Versioned.__getstate__(self)
         d['watchers'] = []
         del d['buildCache']
+        self.deleteKey('buildIndex', d)
         for b in self.currentBuilds:
             b.saveYourself()
             # TODO: push a 'hey, build was interrupted' event
@@ -174,6 +223,7 @@ class BuilderStatus(styles.Versioned):
         # upgradeToVersion1 and such will be called after this finishes.
         styles.Versioned.__setstate__(self, d)
         self.buildCache = LRUCache(self.cacheMiss)
+        self.buildIndex = BuildIndex(self)
         self.currentBuilds = []
         self.watchers = []
         self.slavenames = []
@@ -223,21 +273,21 @@ class BuilderStatus(styles.Versioned):
                     # BuildStatus.saveYourself will mark it as interrupted.
                     b.saveYourself()
 
+        # the pickle is written in the background, see StatusWriter
         filename = os.path.join(self.basedir, "builder")
-        tmpfilename = filename + ".tmp"
+        d = self.getStatusWriter().save(filename, self)
+        def saved(ok):
+            if not ok:
+                log.msg("unable to save builder %s" % self.name)
+        d.addCallback(saved)
+        return d
 
-        try:
-            with open(tmpfilename, "wb") as f:
-                dump(self, f, -1)
-            if runtime.platformType  == 'win32':
-                # windows cannot rename a file on top of an existing one
-                if os.path.exists(filename):
-                    os.unlink(filename)
-
-            os.rename(tmpfilename, filename)
-        except:
-            log.msg("unable to save builder %s" % self.name)
-            log.err()
+    def getStatusWriter(self):
+        statusWriter = getattr(self.status, 'statusWriter', None)
+        if statusWriter is None:
+            # not started, so it saves synchronously
+            return StatusWriter()
+        return statusWriter
 
     # build cache management
 
@@ -257,6 +307,12 @@ class BuilderStatus(styles.Versioned):
             return None
 
         filename = self.makeBuildFilename(number)
+
+        # not written yet
+        build = self.getStatusWriter().getPending(filename)
+        if build is not None:
+            return build
+
         try:
             if not os.path.exists(filename):
                 if number < self.nextBuildNumber:
@@ -334,6 +390,8 @@ class BuilderStatus(styles.Versioned):
         if earliest_build == 0:
             return
 
+        self.buildIndex.prune(earliest_build)
+
         # skim the directory and delete anything that shouldn't be there anymore
         build_re = re.compile(r"^([0-9]+)$")
         build_log_re = re.compile(r"^([0-9]+)-.*$")
@@ -497,6 +555,20 @@ class BuilderStatus(styles.Versioned):
         return set([ ss.branch
             for ss in build.getSourceStamps() ])
 
+    def getBuildIndexEntry(self, number):
+        """Return the build index entry of the finished build C{number}, or
+        None if there is no such finished build.  Builds that are not indexed
+        yet, e.g. those saved by an older version, are loaded once and added
+        to the index."""
+        entry = self.buildIndex.get(number)
+        if entry is not None:
+            return entry
+
+        build = self.getBuild(number)
+        if build is None or not build.isFinished():
+            return None
+        return self.buildIndex.addBuild(build)
+
     @defer.inlineCallbacks
     def generateBuildNumbers(self, codebases={}, branches=[], results=None, num_builds=1):
         sourcestamps = [{'b_branch': b} for b in branches if b is not None] if branches else []
@@ -558,9 +630,16 @@ class BuilderStatus(styles.Versioned):
 
         return build
 
+    def getBuildLoaderPool(self):
+        pool = getattr(self.status, 'buildLoaderPool', None)
+        if pool is None:
+            return reactor.getThreadPool()
+        return pool
+
     def loadBuildFromThread(self, buildnumber):
         if buildnumber not in self.loadingBuilds:
-            d = threads.deferToThread(self.getBuild, buildnumber)
+            d = threads.deferToThreadPool(reactor, self.getBuildLoaderPool(),
+                                          self.getBuild, buildnumber)
             d.addCallback(self.buildLoaded, buildnumber=buildnumber)
             self.loadingBuilds[buildnumber] = {'defer': d, 'access': 1, 'build': None}
             return
@@ -579,11 +658,23 @@ class BuilderStatus(styles.Versioned):
         build = self.getLoadedBuildFromThread(buildnumber)
         defer.returnValue(build)
 
+    def prefetchBuilds(self, buildnumbers, stopped=None, num_builds=None):
+        window = self.master.config.buildLoaderReadAhead
+        if num_builds:
+            # don't load more builds than we are expected to return, e.g.
+            # when looking for the latest build
+            window = min(window, num_builds)
+        return BuildPrefetcher(self, buildnumbers, window=window, stopped=stopped)
+
     @defer.inlineCallbacks
-    def getFinishedBuildsByNumbers(self, buildnumbers=[], results=None):
+    def getFinishedBuildsByNumbers(self, buildnumbers=[], results=None, stopped=None):
         finishedBuilds = []
-        for bn in buildnumbers:
-            build = yield self.deferToThread(bn)
+        prefetcher = self.prefetchBuilds(buildnumbers, stopped)
+        while True:
+            d = prefetcher.next()
+            if d is None:
+                break
+            build = yield d
 
             if build:
                 if results is not None and build.getResults() not in results:
@@ -598,7 +689,8 @@ class BuilderStatus(styles.Versioned):
     def generateFinishedBuildsAsync(self, branches=[], codebases={},
                                num_builds=None,
                                results=None,
-                               useCache=False):
+                               useCache=False,
+                               stopped=None):
 
         build = None
         finishedBuilds = []
@@ -616,8 +708,12 @@ class BuilderStatus(styles.Versioned):
 
         buildNumbers = yield self.generateBuildNumbers(codebases, branches, results, num_builds)
 
-        for bn in buildNumbers:
-            build = yield self.deferToThread(bn)
+        prefetcher = self.prefetchBuilds(buildNumbers, stopped, num_builds)
+        while True:
+            d = prefetcher.next()
+            if d is None:
+                break
+            build = yield d
 
             if build is None:
                 continue
@@ -629,6 +725,7 @@ class BuilderStatus(styles.Versioned):
             finishedBuilds.append(build)
 
             if num_builds == 1:
+                prefetcher.stop()
                 break
 
         if key and useCache and num_builds == 1:
@@ -663,28 +760,30 @@ class BuilderStatus(styles.Versioned):
                 break
             if Nb > max_search:
                 break
-            build = self.getBuild(-Nb)
-            if build is None:
-                continue
+            number = self.nextBuildNumber - Nb
             if max_buildnum is not None:
-                if build.getNumber() > max_buildnum:
+                if number > max_buildnum:
                     continue
-            if not build.isFinished():
+            # filter on the build index, and only load the builds we return
+            entry = self.getBuildIndexEntry(number)
+            if entry is None:
                 continue
             if finished_before is not None:
-                start, end = build.getTimes()
-                if end >= finished_before:
+                if entry['finished'] >= finished_before:
                     continue
             # if we were asked to filter on branches, and none of the
             # sourcestamps match, skip this build
             if len(codebases) > 0:
-                if not self.foundCodebasesInBuild(build, codebases):
+                if not foundCodebasesInEntry(entry, codebases):
                     continue
-            elif branches and not branches & self._getBuildBranches(build):
+            elif branches and not branches & getEntryBranches(entry):
                 continue
             if results is not None:
-                if build.getResults() not in results:
+                if entry['results'] not in results:
                     continue
+            build = self.getBuild(number)
+            if build is None or not build.isFinished():
+                continue
             if filter_fn is not None:
                 if not filter_fn(build):
                     continue
@@ -705,7 +804,8 @@ class BuilderStatus(styles.Versioned):
 
     def cancelBuildFromThread(self, build):
         if build.number not in self.cancelBuilds:
-            d = threads.deferToThread(build.cancelYourself)
+            # the build pickle is written in the background
+            d = defer.maybeDeferred(build.cancelYourself)
             d.addCallback(self.buildCanceled, build.number)
             self.cancelBuilds[build.number] = {'defer': d, 'access': 1}
             return
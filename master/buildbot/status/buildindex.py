@@ -0,0 +1,142 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from __future__ import with_statement
+
+import os
+import threading
+from twisted.python import log, runtime
+from buildbot.util import json
+
+class BuildIndex(object):
+    """
+    I keep a summary of the finished builds of one builder (number, results,
+    times, slave and sourcestamps), so that builds can be listed and
+    filtered without unpickling them.
+
+    The summaries live in an append-only file next to the build pickles, one
+    JSON object per line; when a build is saved again, its new line replaces
+    the previous one.  The file is read the first time it is needed, and
+    rewritten when old builds are pruned.
+
+    I am used from the reactor thread and from the threads loading and
+    saving builds, so all access goes through a lock.
+    """
+
+    filename = "buildindex"
+
+    def __init__(self, builder_status):
+        self.builder_status = builder_status
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def getFilename(self):
+        if self.builder_status.basedir is None:
+            return None
+        return os.path.join(self.builder_status.basedir, self.filename)
+
+    @staticmethod
+    def makeEntry(build):
+        start, finished = build.getTimes()
+        return dict(number=build.number,
+                    results=build.getResults(),
+                    start=start,
+                    finished=finished,
+                    slavename=build.getSlavename(),
+                    sourcestamps=[[ss.codebase, ss.branch, ss.revision]
+                                  for ss in build.getSourceStamps()])
+
+    def _load(self):
+        if self.entries is not None:
+            return
+
+        self.entries = {}
+        filename = self.getFilename()
+        if filename is None or not os.path.exists(filename):
+            return
+
+        try:
+            with open(filename, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # most likely a line cut short by a crash
+                        continue
+                    self.entries[entry['number']] = entry
+        except IOError:
+            log.msg("unable to read the build index of builder %s" % self.builder_status.name)
+            log.err()
+
+    def get(self, number):
+        with self.lock:
+            self._load()
+            return self.entries.get(number)
+
+    def addBuild(self, build):
+        entry = self.makeEntry(build)
+        with self.lock:
+            self._load()
+            if self.entries.get(build.number) == entry:
+                return entry
+            self.entries[build.number] = entry
+
+            filename = self.getFilename()
+            if filename is None:
+                return entry
+            try:
+                with open(filename, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+            except IOError:
+                log.msg("unable to add build %s-#%d to the build index" % (self.builder_status.name,
+                                                                          build.number))
+                log.err()
+        return entry
+
+    def prune(self, earliest_build):
+        with self.lock:
+            self._load()
+            numbers = [n for n in self.entries if n < earliest_build]
+            if not numbers:
+                return
+            for n in numbers:
+                del self.entries[n]
+
+            filename = self.getFilename()
+            if filename is None:
+                return
+            tmpfilename = filename + ".tmp"
+            try:
+                with open(tmpfilename, "w") as f:
+                    for n in sorted(self.entries):
+                        f.write(json.dumps(self.entries[n]) + "\n")
+                if runtime.platformType  == 'win32':
+                    # windows cannot rename a file on top of an existing one
+                    if os.path.exists(filename):
+                        os.unlink(filename)
+                os.rename(tmpfilename, filename)
+            except:
+                log.msg("unable to save the build index of builder %s" % self.builder_status.name)
+                log.err()
+
+def getEntryBranches(entry):
+    return set([branch for codebase, branch, revision in entry['sourcestamps']])
+
+def foundCodebasesInEntry(entry, codebases):
+    # the index counterpart of BuilderStatus.foundCodebasesInBuild
+    sourcestamps = entry['sourcestamps']
+    found = [ss for ss in sourcestamps
+             if ss[0] in codebases and ss[1] == codebases[ss[0]]]
+    return len(found) == len(sourcestamps)
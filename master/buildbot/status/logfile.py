@@ -14,6 +14,9 @@
 # Copyright Buildbot Team Members
 
 import os
+import struct
+import zlib
+from collections import deque
 from cStringIO import StringIO
 from bz2 import BZ2File
 from gzip import GzipFile
@@ -32,6 +35,37 @@ STDERR = interfaces.LOG_CHANNEL_STDERR
 HEADER = interfaces.LOG_CHANNEL_HEADER
 ChunkTypes = ["stdout", "stderr", "build-log-header"]
 
+# A record of the chunk index kept next to each logfile: the offset of the
+# chunk text in the uncompressed log, the offset of the compressed block
+# holding it (-1 when the log is not compressed in blocks), the offset in the
+# uncompressed log where that block starts, the length of the text, its
+# number of newlines and its channel.
+ChunkIndexRecord = struct.Struct("!qqqIIB")
+
+def _readGzipMember(f, offset):
+    # decompress the single gzip member starting at offset
+    f.seek(offset)
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = []
+    while not d.unused_data:
+        compressed = f.read(64*1024)
+        if not compressed:
+            break
+        data.append(d.decompress(compressed))
+    return "".join(data)
+
+def _sliceLines(text, skip, count):
+    # skip the first skip lines of text and return the next count lines
+    start = 0
+    for _ in xrange(skip):
+        start = text.index('\n', start) + 1
+    end = start
+    for _ in xrange(count):
+        end = text.find('\n', end) + 1
+        if end == 0:
+            return text[start:]
+    return text[start:end]
+
 class LogFileScanner(netstrings.NetstringParser):
     def __init__(self, chunk_cb, channels=[]):
         self.chunk_cb = chunk_cb
@@ -200,8 +234,21 @@ class LogFile:
     logMaxTailSize = None
     maxLengthExceeded = False
     runEntries = [] # provided so old pickled builds will getChunks() ok
+    # the chunk index while the log is written; once finished, it is read
+    # from the index file (old logs have none)
+    chunkIndex = None
+    # uncompressed size of the independently compressed blocks of gz logs
+    compressionBlockSize = 1024*1024
     entries = None
     BUFFERSIZE = 2048
+    # buffering of the file being written, which is flushed at most every
+    # flushInterval seconds while the log grows
+    writeBufferSize = 64*1024
+    flushInterval = 1
+    lastFlush = 0
+    # batched watchers get the chunks added over that many seconds in a
+    # single logChunks call
+    watcherBatchDelay = 0.2
     filename = None # relative to the Builder's basedir
     openfile = None
 
@@ -230,11 +277,17 @@ class LogFile:
         dirname = os.path.dirname(fn)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
-        self.openfile = open(fn, "w+")
+        self.openfile = open(fn, "w+", self.writeBufferSize)
         self.runEntries = []
         self.watchers = []
+        self.batchedWatchers = []
         self.finishedWatchers = []
-        self.tailBuffer = []
+        self.tailBuffer = deque()
+        self.chunkIndex = []
+        self.timestamp = (None, None)
+        # the chunks waiting to be sent to the batched watchers
+        self.watcherChunks = []
+        self.watcherFlush = None
 
     def setTimestampsMode(self, prepend_timestamps):
         """
@@ -254,6 +307,14 @@ class LogFile:
         """
         return os.path.join(self.step.build.builder.basedir, self.filename)
 
+    def getIndexFilename(self):
+        """
+        Get the filename of the chunk index of this log file.
+
+        @returns: filename
+        """
+        return self.getFilename() + ".idx"
+
     def hasContents(self):
         """
         Return true if this logfile's contents are available.  For a newly
@@ -405,6 +466,142 @@ class LogFile:
             else:
                 yield leftover
 
+    def getChunkIndex(self):
+        """
+        Return the chunk index of this log, a list of L{ChunkIndexRecord}
+        tuples in file order, or None if the log has no index.
+        """
+        if self.chunkIndex is not None:
+            return self.chunkIndex
+        try:
+            with open(self.getIndexFilename(), "rb") as f:
+                data = f.read()
+        except IOError:
+            return None
+        size = ChunkIndexRecord.size
+        return [ChunkIndexRecord.unpack_from(data, i)
+                for i in xrange(0, len(data) - len(data) % size, size)]
+
+    def _saveChunkIndex(self, records):
+        filename = self.getIndexFilename()
+        tmpfilename = filename + ".tmp"
+        try:
+            with open(tmpfilename, "wb") as f:
+                f.write("".join([ChunkIndexRecord.pack(*r) for r in records]))
+            if runtime.platformType  == 'win32':
+                # windows cannot rename a file on top of an existing one
+                if os.path.exists(filename):
+                    os.unlink(filename)
+            os.rename(tmpfilename, filename)
+        except:
+            log.msg("unable to save the chunk index of %s" % self.getFilename())
+            log.err()
+
+    def _getIndexedChunks(self, channels):
+        # return (size, newlines, index record, text) for each chunk of the
+        # given channels, or None if there is no index to use; the entries
+        # that are not merged yet come last, with their text
+        records = self.getChunkIndex()
+        if records is None:
+            return None
+        chunks = [(r[3], r[4], r, None) for r in records
+                  if not channels or r[5] in channels]
+        if self.runEntries and (not channels or self.runEntries[0][0] in channels):
+            text = "".join([c[1] for c in self.runEntries])
+            chunks.append((len(text), text.count('\n'), None, text))
+        return chunks
+
+    def _readChunks(self, chunks):
+        # read the text of the given chunks; every compressed block is
+        # decompressed at most once
+        texts = []
+        f = None
+        blockoffset = None
+        for size, lines, record, text in chunks:
+            if record is None:
+                texts.append(text)
+                continue
+            pos, offset, blockpos = record[:3]
+            if offset < 0:
+                if f is None:
+                    f = self.getFile()
+                f.seek(pos)
+                texts.append(f.read(size))
+                continue
+            if f is None:
+                f = open(self.getFilename() + ".gz", "rb")
+            if offset != blockoffset:
+                block = _readGzipMember(f, offset)
+                blockoffset = offset
+            texts.append(block[pos - blockpos:pos - blockpos + size])
+        return texts
+
+    def getLines(self, first=0, last=None, channels=[STDOUT, STDERR]):
+        """
+        Return the lines C{first} to C{last} (excluded) of the text of the
+        given channels (all of them if empty), joined together.  Negative
+        values count from the end, so C{getLines(-100)} is the tail of the
+        log.  When the log has a chunk index, only the chunks holding those
+        lines are read.
+
+        @returns: string
+        """
+        chunks = self._getIndexedChunks(channels)
+        if chunks is None:
+            lines = StringIO("".join(self.getChunks(channels, onlyText=True))).readlines()
+            return "".join(lines[first:last])
+
+        chunks = [c for c in chunks if c[0]]
+        if not chunks:
+            return ""
+        total = sum([c[1] for c in chunks])
+        if not self._readChunks(chunks[-1:])[0].endswith('\n'):
+            total += 1
+        first, last, _ = slice(first, last).indices(total)
+        if first >= last:
+            return ""
+
+        # the text starts after the first-th newline, and ends with the
+        # last-th one (or at the end of the log)
+        newlines = 0
+        begin = end = None
+        for i, c in enumerate(chunks):
+            if begin is None and newlines + c[1] >= first:
+                begin, skip = i, first - newlines
+            if newlines + c[1] >= last:
+                end = i
+                break
+            newlines += c[1]
+        text = "".join(self._readChunks(chunks[begin:None if end is None else end + 1]))
+        return _sliceLines(text, skip, last - first)
+
+    def getBytes(self, start=0, end=None, channels=[STDOUT, STDERR]):
+        """
+        Return the bytes C{start} to C{end} (excluded) of the text of the
+        given channels (all of them if empty), with negative values counting
+        from the end.  When the log has a chunk index, only the chunks
+        holding those bytes are read.
+
+        @returns: string
+        """
+        chunks = self._getIndexedChunks(channels)
+        if chunks is None:
+            return "".join(self.getChunks(channels, onlyText=True))[start:end]
+
+        start, end, _ = slice(start, end).indices(sum([c[0] for c in chunks]))
+        offset = 0
+        wanted = []
+        for c in chunks:
+            if offset + c[0] > start and offset < end:
+                if not wanted:
+                    skip = start - offset
+                wanted.append(c)
+            offset += c[0]
+        if not wanted:
+            return ""
+        text = "".join(self._readChunks(wanted))
+        return text[skip:skip + end - start]
+
     def readlines(self):
         """Return an iterator that produces newline-terminated lines,
         excluding header chunks."""
@@ -412,19 +609,68 @@ class LogFile:
         io = StringIO(alltext)
         return io.readlines()
 
-    def subscribe(self, receiver, catchup):
+    def subscribe(self, receiver, catchup, batched=False):
+        """
+        Send the text added to this log to C{receiver}.  If C{batched} is
+        true, the receiver gets the text added over C{watcherBatchDelay}
+        seconds in a single C{logChunks} call instead of one C{logChunk} call
+        per chunk.
+        """
         if self.finished:
             return
+        if batched:
+            # the chunks held for the batched watchers are part of the catchup
+            self._flushWatcherChunks()
+            self.batchedWatchers.append(receiver)
+            if catchup:
+                receiver.logChunks(self.step.build, self.step, self,
+                                   list(self.getChunks()))
+            return
         self.watchers.append(receiver)
         if catchup:
             for channel, text in self.getChunks():
-                # TODO: add logChunks(), to send over everything at once?
                 receiver.logChunk(self.step.build, self.step, self,
                                   channel, text)
 
     def unsubscribe(self, receiver):
         if receiver in self.watchers:
             self.watchers.remove(receiver)
+        if receiver in self.batchedWatchers:
+            self.batchedWatchers.remove(receiver)
+
+    def _notifyWatchers(self, channel, text):
+        for w in self.watchers:
+            w.logChunk(self.step.build, self.step, self, channel, text)
+        if not self.batchedWatchers:
+            return
+        if self.watcherChunks and self.watcherChunks[-1][0] == channel:
+            self.watcherChunks[-1][1].append(text)
+        else:
+            self.watcherChunks.append((channel, [text]))
+        if self.watcherFlush is None:
+            self.watcherFlush = reactor.callLater(self.watcherBatchDelay,
+                                                  self._flushWatcherChunks)
+
+    def _flushWatcherChunks(self):
+        if self.watcherFlush is not None:
+            if self.watcherFlush.active():
+                self.watcherFlush.cancel()
+            self.watcherFlush = None
+        if not self.watcherChunks:
+            return
+        chunks = [(channel, "".join(texts)) for channel, texts in self.watcherChunks]
+        self.watcherChunks = []
+        for w in self.batchedWatchers:
+            w.logChunks(self.step.build, self.step, self, chunks)
+
+    def _timestampLines(self, text):
+        # the timestamp only changes every second, so it is formatted once
+        # for all the lines added within that second
+        now = int(time.time())
+        if self.timestamp[0] != now:
+            self.timestamp = (now, "[%s]   " % time.strftime('%X'))
+        stamp = self.timestamp[1]
+        return stamp + ("\n" + stamp).join(text.strip().split('\n')) + "\n"
 
     def subscribeConsumer(self, consumer):
         p = LogFileProducer(self, consumer)
@@ -442,13 +688,23 @@ class LogFile:
         assert channel < 10, "channel number must be a single decimal digit"
         f = self.openfile
         f.seek(0, 2)
+        pos = f.tell()
+        data = []
         offset = 0
         while offset < len(text):
             size = min(len(text)-offset, self.chunkSize)
-            f.write("%d:%d" % (1 + size, channel))
-            f.write(text[offset:offset+size])
-            f.write(",")
+            header = "%d:%d" % (1 + size, channel)
+            pos += len(header)
+            self.chunkIndex.append((pos, -1, 0, size,
+                                    text.count('\n', offset, offset+size), channel))
+            data.extend((header, text[offset:offset+size], ","))
+            pos += size + 1
             offset += size
+        f.write("".join(data))
+        now = time.time()
+        if now - self.lastFlush >= self.flushInterval:
+            f.flush()
+            self.lastFlush = now
         self.runEntries = []
         self.runLength = 0
 
@@ -472,18 +728,12 @@ class LogFile:
             text = text.encode('utf-8')
 
         if self.prepend_timestamps:
-            lines = text.strip().split('\n')
-            timetext = ""
-            for l in lines:
-                timetext +=  "[%s]   %s\n" % (time.strftime('%X'), l)
-
-            text = timetext
+            text = self._timestampLines(text)
         # notify watchers first, before the chunk gets munged, so that they get
         # a complete picture of the actual log output
         # TODO: is this right, or should the watchers get a picture of the chunks?
-        if not _no_watchers:
-            for w in self.watchers:
-                w.logChunk(self.step.build, self.step, self, channel, text)
+        if not _no_watchers and (self.watchers or self.batchedWatchers):
+            self._notifyWatchers(channel, text)
 
         if channel != HEADER:
             # Truncate the log if it's more than logMaxSize bytes
@@ -513,7 +763,7 @@ class LogFile:
                         self.tailLength += len(text)
                         while self.tailLength > logMaxTailSize:
                             # Drop some stuff off the beginning of the buffer
-                            c,t = self.tailBuffer.pop(0)
+                            c,t = self.tailBuffer.popleft()
                             n = len(t)
                             self.tailLength -= n
                             assert self.tailLength >= 0
@@ -565,11 +815,11 @@ class LogFile:
             tmp = self.runEntries
             self.runEntries = [(HEADER, msg)]
             self._merge()
-            self.runEntries = self.tailBuffer
+            self.runEntries = list(self.tailBuffer)
             self._merge()
             self.runEntries = tmp
             self._merge()
-            self.tailBuffer = []
+            self.tailBuffer = deque()
 
         if self.openfile:
             # we don't do an explicit close, because there might be readers
@@ -577,12 +827,17 @@ class LogFile:
             # filehandle will be released and automatically closed.
             self.openfile.flush()
             self.openfile = None
+        if self.chunkIndex is not None:
+            self._saveChunkIndex(self.chunkIndex)
+            self.chunkIndex = None
         self.finished = True
+        self._flushWatcherChunks()
         watchers = self.finishedWatchers
         self.finishedWatchers = []
         for w in watchers:
             w.callback(self)
         self.watchers = []
+        self.batchedWatchers = []
 
 
     def compressLog(self):
@@ -597,6 +852,10 @@ class LogFile:
 
         def _compressLog():
             infile = self.getFile()
+            if logCompressionMethod == "gz":
+                records = self.getChunkIndex()
+                if records is not None and self._indexCoversFile(records, infile):
+                    return self._compressLogInBlocks(infile, compressed, records)
             if logCompressionMethod == "bz2":
                 cf = BZ2File(compressed, 'w')
             elif logCompressionMethod == "gz":
@@ -610,7 +869,7 @@ class LogFile:
             cf.close()
         d = threads.deferToThread(_compressLog)
 
-        def _renameCompressedLog(rv):
+        def _renameCompressedLog(records):
             if logCompressionMethod == "bz2":
                 filename = self.getFilename() + '.bz2'
             else:
@@ -624,6 +883,13 @@ class LogFile:
                     os.unlink(filename)
             if not os.path.exists(filename):
                 os.rename(compressed, filename)
+                if records is not None:
+                    self._saveChunkIndex(records)
+                elif (logCompressionMethod == "gz" and
+                      os.path.exists(self.getIndexFilename())):
+                    # the gz file is a single stream, and the offsets of
+                    # an index would only be usable through a full scan
+                    _tryremove(self.getIndexFilename(), 1, 5)
             _tryremove(self.getFilename(), 1, 5)
         d.addCallback(_renameCompressedLog)
 
@@ -636,6 +902,46 @@ class LogFile:
         return d
 
 
+    def _indexCoversFile(self, records, f):
+        # check that the index describes every byte of the file, which is
+        # not the case if something else wrote to it
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(0)
+        end = 0
+        for r in records:
+            if r[0] != end + len("%d:%d" % (1 + r[3], r[5])):
+                return False
+            end = r[0] + r[3] + 1
+        return end == size
+
+    def _compressLogInBlocks(self, infile, compressed, records):
+        # write the log as a series of gzip members, each one holding whole
+        # chunks, and return the index records pointing into them; gzip
+        # readers see the concatenated members as a single file
+        out = open(compressed, "wb")
+        newRecords = []
+        i = 0
+        blockpos = 0
+        while i < len(records):
+            j = i
+            end = blockpos
+            while j < len(records) and (j == i or end - blockpos < self.compressionBlockSize):
+                end = records[j][0] + records[j][3] + 1
+                j += 1
+            infile.seek(blockpos)
+            data = infile.read(end - blockpos)
+            offset = out.tell()
+            cf = GzipFile(fileobj=out, mode='wb')
+            cf.write(data)
+            cf.close()
+            newRecords.extend([(r[0], offset, blockpos) + tuple(r[3:])
+                               for r in records[i:j]])
+            blockpos = end
+            i = j
+        out.close()
+        return newRecords
+
     # persistence stuff
     def deleteKey(self, key, d):
         if d.has_key(key):
@@ -644,11 +950,15 @@ class LogFile:
     def deleteKeys(self, d):
         self.deleteKey('step', d)  # filled in upon unpickling
         self.deleteKey('watchers', d)
+        self.deleteKey('batchedWatchers', d)
         self.deleteKey('finishedWatchers', d)
         self.deleteKey('master', d)
         d['entries'] = []  # let 0.6.4 tolerate the saved log. TODO: really?
         self.deleteKey('finished', d)
         self.deleteKey('openfile', d)
+        self.deleteKey('chunkIndex', d)
+        self.deleteKey('watcherChunks', d)
+        self.deleteKey('watcherFlush', d)
 
     def __getstate__(self):
         d = self.__dict__.copy()
@@ -17,7 +17,7 @@ from __future__ import with_statement
 
 import os, urllib
 from cPickle import load
-from twisted.python import log
+from twisted.python import log, threadpool
 from twisted.persisted import styles
 from twisted.internet import defer
 from twisted.application import service
@@ -27,7 +27,7 @@ from buildbot.status.web.base import getCodebasesArg, _revlinkcfg
 from buildbot.util import bbcollections
 from buildbot.util.eventual import eventually
 from buildbot.changes import changes
-from buildbot.status import buildset, builder, buildrequest
+from buildbot.status import buildset, builder, buildrequest, writer
 from buildbot.status.results import RETRY
 from datetime import datetime, timedelta
 
@@ -52,6 +52,11 @@ class Status(config.ReconfigurableServiceMixin, service.MultiService):
         self._change_sub = None
         self.rev_url_func = None
         self.total_builds_lastday = {}
+        # threads loading build pickles for the web status, see
+        # BuilderStatus.loadBuildFromThread
+        self.buildLoaderPool = None
+        # saves the build and builder pickles in the background
+        self.statusWriter = writer.StatusWriter()
 
     # service management
 
@@ -73,6 +78,12 @@ class Status(config.ReconfigurableServiceMixin, service.MultiService):
             self.master.subscribeToChanges(
                 self.changeAdded)
 
+        self.buildLoaderPool = threadpool.ThreadPool(
+                minthreads=0, maxthreads=self.master.config.buildLoaderThreads,
+                name='buildLoader')
+        self.buildLoaderPool.start()
+        self.statusWriter.start()
+
         return service.MultiService.startService(self)
 
     @defer.inlineCallbacks
@@ -95,6 +106,9 @@ class Status(config.ReconfigurableServiceMixin, service.MultiService):
             sr.master = self.master
             sr.setServiceParent(self)
 
+        if self.buildLoaderPool is not None:
+            self.buildLoaderPool.adjustPoolsize(maxthreads=new_config.buildLoaderThreads)
+
         # reconfig any newly-added change sources, as well as existing
         yield config.ReconfigurableServiceMixin.reconfigService(self,
                                                             new_config)
@@ -112,8 +126,14 @@ class Status(config.ReconfigurableServiceMixin, service.MultiService):
         if self._change_sub:
             self._change_sub.unsubscribe()
             self._change_sub = None
+        if self.buildLoaderPool is not None:
+            self.buildLoaderPool.stop()
+            self.buildLoaderPool = None
 
-        return service.MultiService.stopService(self)
+        d = defer.maybeDeferred(service.MultiService.stopService, self)
+        # write the pending pickles; later saves are synchronous
+        d.addCallback(lambda _ : self.statusWriter.stop())
+        return d
 
     # clean shutdown
 
@@ -359,7 +379,7 @@ class Status(config.ReconfigurableServiceMixin, service.MultiService):
         defer.returnValue(self.total_builds_lastday[lastday])
 
     @defer.inlineCallbacks
-    def generateFinishedBuildsAsync(self, num_builds=15, results=None, slavename=None):
+    def generateFinishedBuildsAsync(self, num_builds=15, results=None, slavename=None, stopped=None):
         #TODO: support filter by RETRY result
         results_filter = [r for r in results if r is not None and r != RETRY] if results else []
         lastBuilds = yield self.master.db.builds.getLastsBuildsNumbersBySlave(slavename, results_filter, num_builds)
@@ -373,7 +393,8 @@ class Status(config.ReconfigurableServiceMixin, service.MultiService):
         for bn in builder_names:
             b = self.getBuilder(bn)
             finished_builds = yield b.getFinishedBuildsByNumbers(buildnumbers=lastBuilds[bn],
-                                                                 results=results)
+                                                                 results=results,
+                                                                 stopped=stopped)
             all_builds.extend(finished_builds)
 
         sorted_builds = sorted(all_builds, key=lambda build: build.finished, reverse=True)
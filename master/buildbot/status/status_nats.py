@@ -18,17 +18,151 @@
 
 ."""
 
-from buildbot import config
-import pynats
 import json
+import urlparse
+
+from buildbot import config
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols import basic
+from twisted.python import log
 
 from buildbot.status.status_queue import QueuedStatusPush
 
 
+class NatsError(Exception):
+    pass
+
+
+class NatsProtocol(basic.LineReceiver):
+    """
+    A publish-only client of the NATS text protocol.
+
+    Publications are written as they come, and each batch is followed by a
+    PING; the server answers PINGs in order, once it has processed
+    everything sent before them, so the PONG acknowledges the batch.
+    """
+
+    delimiter = "\r\n"
+    # NATS servers default to 1MB
+    maxPayload = 2 ** 20
+    pongTimeout = 30
+
+    def __init__(self):
+        self.ready = False
+        self.pongs = []
+
+    def lineReceived(self, line):
+        op, _, args = line.partition(" ")
+        op = op.upper()
+        if op == "INFO":
+            self.infoReceived(json.loads(args))
+        elif op == "PING":
+            self.sendLine("PONG")
+        elif op == "PONG":
+            if self.pongs:
+                d, timeout = self.pongs.pop(0)
+                timeout.cancel()
+                d.callback(None)
+        elif op == "-ERR":
+            log.msg("NATS server %s returned an error: %s" % (self.factory.serverUrl, args))
+            self.transport.loseConnection()
+
+    def infoReceived(self, info):
+        self.maxPayload = info.get("max_payload", self.maxPayload)
+        options = dict(verbose=False, pedantic=False, name="katana")
+        if self.factory.user:
+            options.update(user=self.factory.user, **{"pass": self.factory.password})
+        self.sendLine("CONNECT %s" % json.dumps(options, separators=(',', ':')))
+        self.ready = True
+        self.factory.protocolReady(self)
+
+    def publish(self, data):
+        """
+        Write C{data}, a series of PUB messages, and return a Deferred firing
+        once the server has processed them.
+        """
+        d = defer.Deferred()
+        timeout = self.factory.reactor.callLater(self.pongTimeout, self._pongTimedOut)
+        self.pongs.append((d, timeout))
+        self.transport.write(data + "PING\r\n")
+        return d
+
+    def _pongTimedOut(self):
+        log.msg("NATS server %s did not answer, disconnecting" % self.factory.serverUrl)
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.ready = False
+        pongs, self.pongs = self.pongs, []
+        for d, timeout in pongs:
+            if timeout.active():
+                timeout.cancel()
+            d.errback(NatsError("connection to %s lost" % self.factory.serverUrl))
+        self.factory.protocolLost(self)
+
+
+class NatsClientFactory(protocol.ReconnectingClientFactory):
+    """
+    I keep one connection to the NATS server, reconnecting with an
+    exponential backoff when it drops, and hand it to whoever waits for it.
+    """
+
+    protocol = NatsProtocol
+    maxDelay = 60
+    connectTimeout = 10
+
+    def __init__(self, serverUrl, _reactor=reactor):
+        url = urlparse.urlparse(serverUrl)
+        self.serverUrl = serverUrl
+        self.host = url.hostname
+        self.port = url.port or 4222
+        self.user = url.username
+        self.password = url.password
+        self.reactor = _reactor
+        self.client = None
+        self.waiters = []
+
+    def connect(self):
+        self.reactor.connectTCP(self.host, self.port, self, timeout=self.connectTimeout)
+
+    def disconnect(self):
+        self.stopTrying()
+        if self.client is not None:
+            self.client.transport.loseConnection()
+
+    def getClient(self):
+        """
+        Return a Deferred firing with a connected L{NatsProtocol}, or failing
+        if there is none after C{connectTimeout} seconds.
+        """
+        if self.client is not None and self.client.ready:
+            return defer.succeed(self.client)
+
+        d = defer.Deferred()
+        def timedOut():
+            self.waiters.remove((d, timeout))
+            d.errback(NatsError("not connected to %s" % self.serverUrl))
+        timeout = self.reactor.callLater(self.connectTimeout, timedOut)
+        self.waiters.append((d, timeout))
+        return d
+
+    def protocolReady(self, client):
+        self.resetDelay()
+        self.client = client
+        waiters, self.waiters = self.waiters, []
+        for d, timeout in waiters:
+            timeout.cancel()
+            d.callback(client)
+
+    def protocolLost(self, client):
+        if self.client is client:
+            self.client = None
+
+
 class NatsStatusPush(QueuedStatusPush):
     """Event streamer to a Nats server."""
 
-    def __init__(self, serverUrl, subject="katana", **kwargs):
+    def __init__(self, serverUrl, subject="katana", _reactor=reactor, **kwargs):
         """
         @serverUrl: The Nats server to be used to push events notifications to.
         @subject: The subject to use when publishing data
@@ -39,22 +173,39 @@ class NatsStatusPush(QueuedStatusPush):
         # Parameters.
         self.serverUrl = serverUrl
         self.subject = subject
-        self.client = None
+        self.factory = NatsClientFactory(serverUrl, _reactor=_reactor)
 
         # Use the unbounded method.
         QueuedStatusPush.__init__(self, **kwargs)
 
-    def pushData(self, _, items):
-        try:
-            if self.client is None:
-                self.client = pynats.Connection(self.serverUrl, verbose=True)
-                self.client.connect()
+    def startService(self):
+        self.factory.connect()
+        QueuedStatusPush.startService(self)
 
-            for item in items:
-                json_str = json.dumps(item, separators=(',', ':'))
-                self.client.publish('%s.%s' % (self.subject, item.get('event', 'unknown')), json_str)
+    def stopService(self):
+        d = QueuedStatusPush.stopService(self)
+        d.addBoth(lambda _: self.factory.disconnect())
+        return d
 
-            return True, None
-        except pynats.connection.SocketError as e:
-            self.client = None
-            return False, e
+    def formatPackets(self, encoded, items):
+        # the PUB messages, ready to be written as they are
+        maxPayload = self.factory.client.maxPayload if self.factory.client else NatsProtocol.maxPayload
+        messages = []
+        for data, item in zip(encoded, items):
+            if len(data) > maxPayload:
+                log.msg("ERROR: packet %s was dropped, too large for NATS: %d > %d" %
+                        (item.get('id'), len(data), maxPayload))
+                continue
+            subject = '%s.%s' % (self.subject, item.get('event', 'unknown'))
+            messages.append("PUB %s %d\r\n%s\r\n" % (subject, len(data), data))
+        return "".join(messages)
+
+    @defer.inlineCallbacks
+    def pushData(self, packets, items):
+        try:
+            client = yield self.factory.getClient()
+            if packets:
+                yield client.publish(packets)
+        except NatsError as e:
+            defer.returnValue((False, e))
+        defer.returnValue((True, None))
@@ -33,6 +33,7 @@ import datetime
 import os
 import urllib
 import urlparse
+from collections import OrderedDict
 
 try:
     import simplejson as json
@@ -45,11 +46,46 @@ from buildbot.status.base import StatusReceiverMultiService
 from buildbot.status.persistent_queue import DiskQueue, IndexedQueue, \
         MemoryQueue, PersistentQueue
 from buildbot.status.web.status_json import FilterOut
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from twisted.python import log
 from twisted.web import client
 
 
+def _buildKey(build):
+    return (build.getBuilder().getName(), build.getNumber())
+
+def _stepKey(step):
+    return _buildKey(step.getBuild()) + (step.getName(),)
+
+def _buildKeyOf(objs):
+    # subclasses may push the builder name and build number instead of the
+    # build
+    if 'build' in objs:
+        return _buildKey(objs['build'])
+    if 'builderName' in objs and 'number' in objs:
+        return (objs['builderName'], objs['number'])
+    return None
+
+def _stepKeyOf(objs):
+    if 'step' in objs:
+        return _stepKey(objs['step'])
+    return None
+
+# The frequent events that only report the latest state of a build or a
+# step, and how to tell which build or step they are about.  Within the
+# coalescing window, such an event replaces the previous one of the same
+# type for the same build or step; the events whose build or step cannot
+# be told are not coalesced.
+COALESCED_EVENTS = {
+    'buildETAUpdate': _buildKeyOf,
+    'stepTextChanged': _stepKeyOf,
+    'stepText2Changed': _stepKeyOf,
+    'stepETAUpdate': _stepKeyOf,
+    'logStarted': _stepKeyOf,
+    'logFinished': _stepKeyOf,
+}
+
+
 
 class StatusPush(StatusReceiverMultiService):
     """Event streamer to a abstract channel.
@@ -61,7 +97,8 @@ class StatusPush(StatusReceiverMultiService):
     """
 
     def __init__(self, serverPushCb, queue=None, path=None, filter=True,
-                 bufferDelay=1, retryDelay=5, blackList=None):
+                 bufferDelay=1, retryDelay=5, blackList=None, coalesceDelay=1,
+                 statsInterval=None):
         """
         @serverPushCb: callback to be used. It receives 'self' as parameter. It
         should call self.queueNextServerPush() when it's done to queue the next
@@ -77,6 +114,11 @@ class StatusPush(StatusReceiverMultiService):
         @retryDelay: amount of time between retries when no items were pushed on
         last serverPushCb call.
         @blackList: events that shouldn't be sent.
+        @coalesceDelay: amount of time the frequent updates of a build or a
+        step (ETA, text and log events) are held, so that newer ones replace
+        them instead of being queued as well. 0 queues every event.
+        @statsInterval: when set, log the rate of each event type every
+        statsInterval seconds.
         """
         StatusReceiverMultiService.__init__(self)
 
@@ -100,10 +142,18 @@ class StatusPush(StatusReceiverMultiService):
             return serverPushCb(self)
         self.serverPushCb = hookPushCb
         self.blackList = blackList
+        self.coalesceDelay = coalesceDelay
+        self.statsInterval = statsInterval
 
         # Other defaults.
         # IDelayedCall object that represents the next queued push.
         self.task = None
+        # the coalesced events waiting to be queued, and the IDelayedCall
+        # queueing them
+        self.pending = OrderedDict()
+        self.coalesceTask = None
+        self.statsLoop = None
+        self.resetEventStats()
         self.stopped = False
         self.lastIndex = -1
         self.state = {}
@@ -127,6 +177,9 @@ class StatusPush(StatusReceiverMultiService):
         self.status = self.parent.getStatus()
         self.status.subscribe(self)
         self.initialPush()
+        if self.statsInterval:
+            self.statsLoop = task.LoopingCall(self.logEventRates)
+            self.statsLoop.start(self.statsInterval, now=False)
 
     def wasLastPushSuccessful(self):
         """Returns if the "virtual pointer" in the queue advanced."""
@@ -192,6 +245,9 @@ class StatusPush(StatusReceiverMultiService):
 
     def stopService(self):
         """Shutting down."""
+        if self.statsLoop and self.statsLoop.running:
+            self.statsLoop.stop()
+        self.flushPending()
         self.finalPush()
         self.stopped = True
         if (self.task and self.task.active()):
@@ -225,6 +281,79 @@ class StatusPush(StatusReceiverMultiService):
         """
         if self.blackList and event in self.blackList:
             return
+        self.countEvent(event, 'received')
+
+        getKey = COALESCED_EVENTS.get(event)
+        key = None
+        if getKey and self.coalesceDelay and not self.stopped:
+            key = getKey(objs)
+        if key is not None:
+            key = (event,) + key
+            if key in self.pending:
+                self.countEvent(event, 'coalesced')
+            self.pending[key] = objs
+            if self.coalesceTask is None:
+                self.coalesceTask = reactor.callLater(self.coalesceDelay,
+                                                      self.flushPending)
+            return
+
+        # the updates of a finished step or build are stale now
+        if self.pending:
+            if event == 'stepFinished':
+                key = _stepKeyOf(objs)
+            elif event == 'buildFinished':
+                key = _buildKeyOf(objs)
+            if key is not None:
+                self.dropPending(key)
+
+        return self.queueEvent(event, objs)
+
+    def flushPending(self):
+        """Queue the coalesced events."""
+        if self.coalesceTask is not None:
+            if self.coalesceTask.active():
+                self.coalesceTask.cancel()
+            self.coalesceTask = None
+        pending, self.pending = self.pending, OrderedDict()
+        for key, objs in pending.iteritems():
+            self.queueEvent(key[0], objs)
+
+    def dropPending(self, key):
+        """Drop the coalesced events of the build or step C{key}."""
+        for pendingKey in self.pending.keys():
+            if pendingKey[1:len(key) + 1] == key:
+                self.countEvent(pendingKey[0], 'dropped')
+                del self.pending[pendingKey]
+
+    def resetEventStats(self):
+        self.eventStats = {}
+        self.eventStatsStarted = reactor.seconds()
+
+    def countEvent(self, event, what):
+        stats = self.eventStats.setdefault(event,
+                dict(received=0, coalesced=0, dropped=0, queued=0))
+        stats[what] += 1
+
+    def getEventRates(self):
+        """Return, for each event type, how many events per second were
+        received, coalesced, dropped as stale and queued since the stats were
+        last reset."""
+        elapsed = max(reactor.seconds() - self.eventStatsStarted, 1)
+        return dict((event, dict((what, count / float(elapsed))
+                                 for what, count in stats.iteritems()))
+                    for event, stats in self.eventStats.iteritems())
+
+    def logEventRates(self):
+        rates = self.getEventRates()
+        self.resetEventStats()
+        for event in sorted(rates):
+            log.msg("%s: %s events/s: %s" % (self.__class__.__name__, event,
+                    ", ".join("%s %.2f" % (what, rate)
+                              for what, rate in sorted(rates[event].iteritems()))))
+
+    def queueEvent(self, event, objs):
+        """Generate the packet of an event and queue it."""
+        self.countEvent(event, 'queued')
         # First, generate the packet.
         packet = {}
         packet['id'] = self.state['next_id']
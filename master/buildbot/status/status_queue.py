@@ -21,6 +21,7 @@
 from buildbot.status.status_push import StatusPush
 from buildbot.status.persistent_queue import DiskQueue, MemoryQueue, PersistentQueue
 
+from twisted.internet import defer
 from twisted.python import log
 import json
 
@@ -43,6 +44,8 @@ class QueuedStatusPush(StatusPush):
         self.chunkSize = chunkSize
         self.lastPushWasSuccessful = True
         self.maxPushSize = maxPushSize
+        # the Deferred of the push waiting for the server, if any
+        self.pushing = None
 
         if maxDiskItems != 0:
             # The queue directory is determined by the server url.
@@ -63,8 +66,14 @@ class QueuedStatusPush(StatusPush):
     def wasLastPushSuccessful(self):
         return self.lastPushWasSuccessful
 
-    def formatPackets(self, packets):
-        return packets
+    def encodeItem(self, item):
+        if self.debug:
+            return json.dumps(item, indent=2, sort_keys=True)
+        return json.dumps(item, separators=(',', ':'))
+
+    def formatPackets(self, encoded, items):
+        """Build the data to push from the encoded items."""
+        return "[%s]" % ",".join(encoded)
 
     def popChunk(self):
         """Pops items from the pending list.
@@ -83,12 +92,9 @@ class QueuedStatusPush(StatusPush):
                     newitems.append(item.asDict())
                 else:
                     newitems.append(item)
-            if self.debug:
-                packets = json.dumps(newitems, indent=2, sort_keys=True)
-            else:
-                packets = json.dumps(newitems, separators=(',', ':'))
-
-            data = self.formatPackets(packets)
+            # every item is encoded once, whatever formatPackets does with it
+            encoded = [self.encodeItem(item) for item in newitems]
+            data = self.formatPackets(encoded, newitems)
 
             if not self.maxPushSize or len(data) < self.maxPushSize:
                 return data, items
@@ -105,6 +111,11 @@ class QueuedStatusPush(StatusPush):
 
     def _pushData(self):
         """Do the PUSH to the server."""
+        if self.pushing is not None:
+            # Keep the events in order, the next push is queued once this
+            # one is done.
+            return self.pushing
+
         (packets, items) = self.popChunk()
 
         def Success():
@@ -126,9 +137,18 @@ class QueuedStatusPush(StatusPush):
             self.lastPushWasSuccessful = False
             return self.queueNextServerPush()
 
-        # Trigger the PUSH
-        result, reason = self.pushData(packets, items)
-        if result:
-            Success()
-        else:
-            Failure(reason)
+        def Pushed((result, reason)):
+            self.pushing = None
+            if result:
+                return Success()
+            else:
+                return Failure(reason)
+
+        def PushFailed(reason):
+            self.pushing = None
+            return Failure(reason)
+
+        # Trigger the PUSH, which may be asynchronous
+        self.pushing = d = defer.maybeDeferred(self.pushData, packets, items)
+        d.addCallbacks(Pushed, PushFailed)
+        return d
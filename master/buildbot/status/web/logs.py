@@ -17,7 +17,7 @@
 from zope.interface import implements
 from twisted.python import components
 from twisted.spread import pb
-from twisted.web import server
+from twisted.web import server, http
 from twisted.web.resource import Resource, NoResource
 
 from buildbot import interfaces, version
@@ -30,6 +30,11 @@ from buildbot.status.web.jsontestresults import JSONTestResource
 
 import re
 
+def _parseRange(value):
+    # "start:end", either side may be empty or negative
+    start, end = value.split(":", 1)
+    return (int(start) if start else 0), (int(end) if end else None)
+
 class ChunkConsumer:
     implements(interfaces.IStatusLogConsumer)
 
@@ -115,6 +120,31 @@ class TextLog(Resource, ContextMixin):
         else:
             return self.chunk_template.module.chunks(html_entries)
 
+    def getText(self, req):
+        # ?tail=N, ?lines=A:B and ?bytes=A:B select part of the log, which
+        # is read through its chunk index instead of in full; a malformed
+        # selection is refused rather than answered with the whole log
+        log = self.original
+        channels = [] if self.withHeaders else [logfile.STDOUT, logfile.STDERR]
+        try:
+            if "tail" in req.args:
+                tail = int(req.args["tail"][0])
+                if tail < 0:
+                    raise ValueError("negative tail")
+                if not tail:
+                    return ""
+                return log.getLines(-tail, channels=channels)
+            if "lines" in req.args:
+                start, end = _parseRange(req.args["lines"][0])
+                return log.getLines(start, end, channels=channels)
+            if "bytes" in req.args:
+                start, end = _parseRange(req.args["bytes"][0])
+                return log.getBytes(start, end, channels=channels)
+        except ValueError:
+            req.setResponseCode(http.BAD_REQUEST)
+            return "invalid tail, lines or bytes argument\n"
+        return log.getTextWithHeaders() if self.withHeaders else log.getText()
+
     def render_HEAD(self, req):
         self._setContentType(req)
 
@@ -137,12 +167,12 @@ class TextLog(Resource, ContextMixin):
             base_name = self.original.step.getName() + "_" + self.original.getName() + with_headers
             base_name = re.sub(r'[\W]', '_', base_name) + ".log"
             req.setHeader("Content-Disposition", "attachment; filename =\"" + base_name + "\"")
-            return self.original.getTextWithHeaders() if self.withHeaders else self.original.getText()
+            return self.getText(req)
 
         # Or open in new window
         if self.newWindow:
             req.setHeader("Content-Disposition", "inline")
-            return self.original.getTextWithHeaders() if self.withHeaders else self.original.getText()
+            return self.getText(req)
 
         # Else render the logs template
         
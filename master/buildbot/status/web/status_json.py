@@ -17,12 +17,15 @@
 """Simple JSON exporter."""
 
 import datetime
+import hashlib
 import re
+import weakref
 from twisted.python import log
 
-from twisted.internet import defer
-from twisted.web import html, resource, server
+from twisted.internet import defer, reactor
+from twisted.web import html, http, resource, server
 
+from buildbot.status.base import StatusReceiverBase
 from buildbot.status.buildrequest import BuildRequestStatus
 from buildbot.status.web.base import HtmlResource, path_to_root, map_branches, getCodebasesArg, \
     getRequestCharset, getResultsArg, getCodebases, path_to_comparison
@@ -166,6 +169,115 @@ def getSlaveName(slave_status):
     return slave_status.getName() if slave_status else None
 
 
+class JsonResponseCache(StatusReceiverBase):
+    """
+    I keep the rendered responses of the L{JsonResource}s which cache them,
+    keyed by the host, path and arguments of the request.
+
+    Every status event changing builders, builds, slaves or the queue drops
+    all the responses.  Some data, like step progress or the build requests
+    of other masters, changes without an event here, so responses are also
+    dropped once C{maxAge} seconds old.
+    """
+
+    maxAge = 5
+    maxEntries = 1000
+
+    def __init__(self, status, _reactor=reactor):
+        self.reactor = _reactor
+        self.entries = {}
+        # bumped on every invalidation, so that a response computed while an
+        # event came is not cached
+        self.generation = 0
+        status.subscribe(self)
+
+    def getKey(self, request):
+        args = tuple(sorted((k, tuple(v)) for k, v in request.args.iteritems()))
+        return (request.getHeader('host'), request.path, args)
+
+    def get(self, key):
+        """
+        Return the (data, etag) cached for C{key}, or None
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        data, etag, expires = entry
+        if expires <= self.reactor.seconds():
+            del self.entries[key]
+            return None
+        return data, etag
+
+    def put(self, key, data, etag, generation):
+        if generation != self.generation or len(self.entries) >= self.maxEntries:
+            return
+        self.entries[key] = (data, etag, self.reactor.seconds() + self.maxAge)
+
+    def invalidate(self):
+        self.generation += 1
+        self.entries = {}
+
+    def builderAdded(self, builderName, builder, **kwargs):
+        self.invalidate()
+        # get the build events of the builder
+        return self
+
+    def builderRemoved(self, builderName):
+        self.invalidate()
+
+    def builderChangedState(self, builderName, state):
+        self.invalidate()
+
+    def buildStarted(self, builderName, build):
+        self.invalidate()
+
+    def buildFinished(self, builderName, build, results):
+        self.invalidate()
+
+    def requestSubmitted(self, request):
+        self.invalidate()
+
+    def requestCancelled(self, builder, request):
+        self.invalidate()
+
+    def buildsetSubmitted(self, buildset):
+        self.invalidate()
+
+    def slaveConnected(self, slaveName):
+        self.invalidate()
+
+    def slaveDisconnected(self, slaveName):
+        self.invalidate()
+
+    def slavePaused(self, slavename, url, user):
+        self.invalidate()
+
+    def slaveUnpaused(self, slavename, url, user):
+        self.invalidate()
+
+_responseCaches = weakref.WeakKeyDictionary()
+
+def getJsonResponseCache(status):
+    if status not in _responseCaches:
+        _responseCaches[status] = JsonResponseCache(status)
+    return _responseCaches[status]
+
+
+class _SelectRequest(object):
+    """
+    The request as seen by one of the children picked with select=, with its
+    own prepath and postpath.
+    """
+
+    def __init__(self, request, prepath, postpath):
+        self._request = request
+        self.prepath = prepath
+        self.postpath = postpath
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+
 class JsonResource(resource.Resource):
     """Base class for json data."""
 
@@ -174,6 +286,11 @@ class JsonResource(resource.Resource):
     help = None
     pageTitle = None
     level = 0
+    # keep the rendered responses in the L{JsonResponseCache}, for resources
+    # polled by many clients
+    cacheResponses = False
+    # how many of the children picked with select= are rendered at once
+    maxConcurrentSelects = 10
 
     def __init__(self, status):
         """Adds transparent lazy-child initialization."""
@@ -210,12 +327,31 @@ class JsonResource(resource.Resource):
 
     def render_GET(self, request):
         """Renders a HTTP GET at the http request level."""
-        d = defer.maybeDeferred(lambda: self.content(request))
-
-        def handle(data):
-            if isinstance(data, unicode):
-                data = data.encode("utf-8")
+        cache = cached = None
+        if self.cacheResponses:
+            cache = getJsonResponseCache(self.status)
+            key = cache.getKey(request)
+            generation = cache.generation
+            cached = cache.get(key)
+
+        if cached is not None:
+            d = defer.succeed(cached)
+        else:
+            d = defer.maybeDeferred(lambda: self.content(request))
+
+            def encode(data):
+                if isinstance(data, unicode):
+                    data = data.encode("utf-8")
+                etag = '"%s"' % hashlib.sha1(data).hexdigest()
+                if cache is not None:
+                    cache.put(key, data, etag, generation)
+                return data, etag
+            d.addCallback(encode)
+
+        def handle(result):
+            data, etag = result
             request.setHeader("Access-Control-Allow-Origin", "*")
+            request.setHeader("ETag", etag)
             if RequestArgToBool(request, 'as_text', False):
                 request.setHeader("content-type", 'text/plain')
             else:
@@ -227,13 +363,18 @@ class JsonResource(resource.Resource):
                 request.setHeader("Expires",
                                   expires.strftime("%a, %d %b %Y %H:%M:%S GMT"))
                 request.setHeader("Pragma", "no-cache")
+            ifNoneMatch = request.getHeader("if-none-match") or ''
+            if etag in [t.strip() for t in ifNoneMatch.split(',')]:
+                request.setResponseCode(http.NOT_MODIFIED)
+                return ''
             return data
 
         d.addCallback(handle)
 
         def ok(data):
             try:
-                request.write(data)
+                if data:
+                    request.write(data)
                 request.finish()
             except RuntimeError:
                 log.msg("Connection from {0} lost".format(request.client.host))
@@ -264,34 +405,37 @@ class JsonResource(resource.Resource):
             select = [s.strip('/') for s in select]
             select.sort(cmp=lambda x, y: cmp(x.count('/'), y.count('/')),
                         reverse=True)
+            # Find every selected child first, then render the distinct ones
+            # concurrently, each with its own view of the request path
+            selected = []
+            paths = []
+            children = {}
             for item in select:
                 # Start back at root.
                 node = data
                 # Implementation similar to twisted.web.resource.getChildForRequest
                 # but with a hacked up request.
                 child = self
-                prepath = request.prepath[:]
-                postpath = request.postpath[:]
-                request.postpath = filter(None, item.split('/'))
-                while request.postpath and not child.isLeaf:
-                    pathElement = request.postpath.pop(0)
+                path = tuple(filter(None, item.split('/')))
+                subrequest = _SelectRequest(request, request.prepath[:], list(path))
+                while subrequest.postpath and not child.isLeaf:
+                    pathElement = subrequest.postpath.pop(0)
                     node[pathElement] = {}
                     node = node[pathElement]
-                    request.prepath.append(pathElement)
-                    child = child.getChildWithDefault(pathElement, request)
-
-                # some asDict methods return a Deferred, so handle that
-                # properly
-                if hasattr(child, 'asDict'):
-                    child_dict = yield defer.maybeDeferred(lambda: child.asDict(request))
-                else:
-                    child_dict = {
-                        'error': 'Not available',
-                    }
-                node.update(child_dict)
-
-                request.prepath = prepath
-                request.postpath = postpath
+                    subrequest.prepath.append(pathElement)
+                    child = child.getChildWithDefault(pathElement, subrequest)
+                selected.append((node, path))
+                if path not in children:
+                    paths.append(path)
+                    children[path] = (child, subrequest)
+
+            semaphore = defer.DeferredSemaphore(self.maxConcurrentSelects)
+            dicts = yield defer.gatherResults(
+                [semaphore.run(self._selectedAsDict, *children[p]) for p in paths],
+                consumeErrors=True).addErrback(lambda f: f.value.subFailure)
+            dicts = dict(zip(paths, dicts))
+            for node, path in selected:
+                node.update(dicts[path])
         else:
             data = yield defer.maybeDeferred(lambda: self.asDict(request))
 
@@ -308,6 +452,15 @@ class JsonResource(resource.Resource):
                 data = '%s(%s);' % (callback, data)
         defer.returnValue(data)
 
+    def _selectedAsDict(self, child, request):
+        # some asDict methods return a Deferred, so handle that
+        # properly
+        if hasattr(child, 'asDict'):
+            return defer.maybeDeferred(child.asDict, request)
+        return defer.succeed({
+            'error': 'Not available',
+        })
+
     @defer.inlineCallbacks
     def asDict(self, request):
         """Generates the json dictionary.
@@ -437,6 +590,7 @@ class BuilderJsonResource(JsonResource):
     help = """Describe a single builder.
 """
     pageTitle = 'Builder'
+    cacheResponses = True
 
     def __init__(self, status, builder_status):
         JsonResource.__init__(self, status)
@@ -463,6 +617,7 @@ class BuildersJsonResource(JsonResource):
     help = """List of all the builders defined on a master.
 """
     pageTitle = 'Builders'
+    cacheResponses = True
 
     def __init__(self, status):
         JsonResource.__init__(self, status)
@@ -605,7 +760,8 @@ class PastBuildsJsonResource(JsonResource):
             builds = yield self.builder_status.generateFinishedBuildsAsync(branches=map_branches(branches),
                                                                            codebases=codebases,
                                                                            results=results,
-                                                                           num_builds=self.number)
+                                                                           num_builds=self.number,
+                                                                           stopped=request.notifyFinish())
 
             defer.returnValue([b.asDict(request,
                                         include_artifacts=True,
@@ -617,7 +773,8 @@ class PastBuildsJsonResource(JsonResource):
         if self.slave_status is not None:
             slavename = self.slave_status.getName()
             builds = yield self.status.generateFinishedBuildsAsync(num_builds=self.number, results=results,
-                                                                   slavename=slavename)
+                                                                   slavename=slavename,
+                                                                   stopped=request.notifyFinish())
 
             defer.returnValue([rb.asDict(request=request, include_steps=False) for rb in builds])
             return
@@ -781,6 +938,7 @@ class ProjectsJsonResource(JsonResource):
     help = """List the registered projects.
 """
     pageTitle = 'Projects'
+    cacheResponses = True
 
     def __init__(self, status):
         JsonResource.__init__(self, status)
@@ -827,6 +985,7 @@ class LatestRevisionResource(JsonResource):
 class SingleProjectJsonResource(LatestRevisionResource):
     help = """Describe a project in katana"""
     pageTitle = 'Project'
+    cacheResponses = True
 
     def __init__(self, status, project_status):
         LatestRevisionResource.__init__(self, status, project_status)
@@ -871,6 +1030,7 @@ class SingleProjectBuilderJsonResource(LatestRevisionResource):
     Returns  a single builder for a project JSON with
     latestBuild info
     """
+    cacheResponses = True
 
     def __init__(self, status, builder, latest_rev=False):
         projects = status.getProjects()
@@ -1055,6 +1215,7 @@ class SlaveJsonResource(JsonResource):
     help = """Describe a slave.
 """
     pageTitle = 'Slave'
+    cacheResponses = True
 
     def __init__(self, status, slave_status):
         JsonResource.__init__(self, status)
@@ -1103,6 +1264,7 @@ class SlavesJsonResource(JsonResource):
     help = """List the registered slaves.
 """
     pageTitle = 'Slaves'
+    cacheResponses = True
 
     def __init__(self, status):
         JsonResource.__init__(self, status)
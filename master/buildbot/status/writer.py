@@ -0,0 +1,205 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from __future__ import with_statement
+
+import os
+import time
+import tempfile
+from cPickle import dumps
+from twisted.python import log, runtime, threadpool, threadable
+from twisted.internet import reactor, defer, threads
+from buildbot.process import metrics
+
+def writePickle(filename, data):
+    """
+    Write the pickled C{data} to C{filename}, through a temporary file renamed
+    over it, so that a crash never leaves a truncated pickle behind.  The
+    temporary file is unique, as the synchronous saves of other threads may
+    write the same file as the worker thread.
+    """
+    dirname, basename = os.path.split(filename)
+    fd, tmpfilename = tempfile.mkstemp(prefix=basename + ".", suffix=".tmp",
+                                       dir=dirname)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        if runtime.platformType  == 'win32':
+            # windows cannot rename a file on top of an existing one, so
+            # fall back to delete-first. There are ways this can fail and
+            # lose the builder's history, so we avoid using it in the
+            # general (non-windows) case
+            if os.path.exists(filename):
+                os.unlink(filename)
+        os.rename(tmpfilename, filename)
+    except:
+        if os.path.exists(tmpfilename):
+            os.unlink(tmpfilename)
+        raise
+
+class StatusWriter(object):
+    """
+    I save the pickles of the build and builder status objects from a worker
+    thread.
+
+    The saves of an object are coalesced for C{delay} seconds, then the object
+    is pickled on the reactor thread, as it is not safe to walk it from
+    another thread, and the pickle is written by the worker thread.  Until it
+    is written, L{getPending} returns the object, so that it is not loaded
+    from an outdated pickle.
+
+    Before L{start} and after L{stop}, which writes all the pending saves, and
+    from other threads than the reactor's, the saves are synchronous.
+    """
+
+    delay = 1
+
+    def __init__(self, _reactor=reactor):
+        self._reactor = _reactor
+        self.pool = None
+        self._thread = None
+        self._timer = None
+        # filename -> (obj, [deferreds]), waiting for the delay
+        self._pending = {}
+        # filename -> [obj, number of writes], pickled and being written
+        self._writing = {}
+        self._writes = set()
+
+    def start(self):
+        # the reactor thread; the saves from other threads are synchronous
+        self._thread = threadable.getThreadID()
+        # a single thread, so that the pickles of an object are written in
+        # the order they were taken
+        self.pool = threadpool.ThreadPool(minthreads=0, maxthreads=1,
+                                          name='statusWriter')
+        self.pool.start()
+
+    @defer.inlineCallbacks
+    def stop(self):
+        if self.pool is None:
+            return
+        while self._pending or self._writes:
+            self.flush()
+            yield defer.DeferredList(list(self._writes))
+        self.pool.stop()
+        self.pool = None
+
+    def save(self, filename, obj):
+        """
+        Save C{obj} to C{filename}; returns a Deferred that fires when it is
+        written, with True, or False if it could not be.
+        """
+        if self.pool is None or threadable.getThreadID() != self._thread:
+            return defer.succeed(self._writeNow(filename, obj))
+
+        d = defer.Deferred()
+        waiters = [d]
+        if filename in self._pending:
+            metrics.MetricCountEvent.log("StatusWriter.coalesced")
+            waiters = self._pending[filename][1] + waiters
+        # the latest object is saved
+        self._pending[filename] = (obj, waiters)
+        self._logPending()
+
+        if self._timer is None:
+            self._timer = self._reactor.callLater(self.delay, self.flush)
+        return d
+
+    def getPending(self, filename):
+        """
+        Return the object waiting to be saved to C{filename}, or None.
+        """
+        pending = self._pending.get(filename)
+        if pending is not None:
+            return pending[0]
+        writing = self._writing.get(filename)
+        if writing is not None:
+            return writing[0]
+        return None
+
+    def flush(self):
+        """
+        Pickle the pending objects now, and queue them for writing.
+        """
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+
+        pending, self._pending = self._pending, {}
+        snapshots = []
+        for filename, (obj, waiters) in pending.iteritems():
+            try:
+                data = dumps(obj, -1)
+            except:
+                log.msg("unable to pickle %s" % filename)
+                log.err()
+                for d in waiters:
+                    d.callback(False)
+                continue
+            writing = self._writing.setdefault(filename, [obj, 0])
+            writing[0] = obj
+            writing[1] += 1
+            snapshots.append((filename, obj, data, waiters))
+
+        if not snapshots:
+            self._logPending()
+            return
+
+        d = threads.deferToThreadPool(self._reactor, self.pool,
+                                      self._writeSnapshots, snapshots)
+        d.addCallback(self._written, snapshots)
+        d.addErrback(log.err, "while writing status pickles")
+        self._writes.add(d)
+        d.addBoth(lambda _ : self._writes.discard(d))
+
+    def _writeSnapshots(self, snapshots):
+        # in the worker thread
+        results = []
+        for filename, _, data, _ in snapshots:
+            start = time.time()
+            try:
+                writePickle(filename, data)
+                results.append((True, time.time() - start))
+            except:
+                log.msg("unable to save %s" % filename)
+                log.err()
+                results.append((False, time.time() - start))
+        return results
+
+    def _written(self, results, snapshots):
+        for (filename, obj, _, waiters), (saved, elapsed) in zip(snapshots, results):
+            metrics.MetricTimeEvent.log("StatusWriter.write()", elapsed)
+            # unless it is written again
+            writing = self._writing[filename]
+            writing[1] -= 1
+            if not writing[1]:
+                del self._writing[filename]
+            for d in waiters:
+                d.callback(saved)
+        self._logPending()
+
+    def _writeNow(self, filename, obj):
+        try:
+            writePickle(filename, dumps(obj, -1))
+            return True
+        except:
+            log.msg("unable to save %s" % filename)
+            log.err()
+            return False
+
+    def _logPending(self):
+        metrics.MetricCountEvent.log("StatusWriter.pending",
+                len(self._pending) + len(self._writing), absolute=True)
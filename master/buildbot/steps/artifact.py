@@ -4,7 +4,8 @@ from buildbot.process.buildstep import LoggingBuildStep, SUCCESS, SKIPPED, FAILU
 from twisted.internet import defer
 from buildbot.steps.shell import ShellCommand
 import re
-from buildbot.util import epoch2datetime
+from buildbot.util import epoch2datetime, now
+from buildbot import config
 from buildbot.util import safeTranslate
 from buildbot.process import properties
 from buildbot.process.slavebuilder import IDLE, BUILDING
@@ -386,6 +387,28 @@ def mkDir(step, dir):
 def getRemoteLocation(artifactServer, artifactServerDir, artifactPath, artifact):
     return artifactServer + ":" + artifactServerDir + "/" + artifactPath + "/" + artifact.replace(" ", r"\ ")
 
+def useArtifactCache(step):
+    # the cache runs rsync itself, which is only done on non-Windows slaves
+    return (step.artifactCacheSize is not None
+            and step.slaveVersion("downloadArtifact") is not None
+            and not _isWindowsSlave(step))
+
+# artifactCacheHardlinks=True hard links the artifact files into the workdir
+# instead of copying them from the cache: it is faster, but a build modifying
+# them in place silently corrupts the cached artifact for the later builds
+def downloadArtifactCommand(step, workdir, key, origin, destination):
+    from buildbot.process import buildstep
+    args = {
+        'workdir': workdir,
+        'key': key,
+        'source': origin,
+        'destination': destination,
+        'port': step.artifactServerPort,
+        'maxCacheSize': step.artifactCacheSize,
+        'hardlink': step.artifactCacheHardlinks,
+        }
+    return buildstep.RemoteCommand('downloadArtifact', args)
+
 class UploadArtifact(ShellCommand):
 
     name = "Upload Artifact(s)"
@@ -445,7 +468,8 @@ class DownloadArtifact(ShellCommand):
     descriptionDone="Artifact(s) downloaded."
 
     def __init__(self, artifactBuilderName=None, artifact=None, artifactDirectory=None, artifactDestination=None,
-                 artifactServer=None, artifactServerDir=None, artifactServerPort=None, usePowerShell=True, **kwargs):
+                 artifactServer=None, artifactServerDir=None, artifactServerPort=None, usePowerShell=True,
+                 artifactCacheSize=None, artifactCacheHardlinks=False, **kwargs):
         self.artifactBuilderName = artifactBuilderName
         self.artifact = artifact
         self.artifactDirectory = artifactDirectory
@@ -455,6 +479,8 @@ class DownloadArtifact(ShellCommand):
         self.artifactDestination = artifactDestination or artifact
         self.master = None
         self.usePowerShell = usePowerShell
+        self.artifactCacheSize = artifactCacheSize
+        self.artifactCacheHardlinks = artifactCacheHardlinks
         name = "Download Artifact for '%s'" % artifactBuilderName
         description = "Downloading artifact '%s'..." % artifactBuilderName
         descriptionDone="Downloaded '%s'." % artifactBuilderName
@@ -481,6 +507,12 @@ class DownloadArtifact(ShellCommand):
 
         remotelocation = getRemoteLocation(self.artifactServer, self.artifactServerDir, artifactPath, self.artifact)
 
+        if useArtifactCache(self):
+            key = [self.artifactBuilderName, br['brid'], artifactPath + "/" + self.artifact]
+            cmd = downloadArtifactCommand(self, self.getWorkdir(), key, remotelocation, self.artifactDestination)
+            self.startCommand(cmd)
+            return
+
         command = rsyncWithRetry(self, remotelocation, self.artifactDestination, self.artifactServerPort)
 
         self.setCommand(command)
@@ -508,6 +540,9 @@ class DownloadArtifactsFromChildren(LoggingBuildStep, CompositeStepMixin):
                  artifactDirectory=None,
                  artifact=None,
                  usePowerShell=True,
+                 maxConcurrentDownloads=1,
+                 artifactCacheSize=None,
+                 artifactCacheHardlinks=False,
                  **kwargs):
         self.workdir = workdir
         self.artifact = artifact
@@ -519,6 +554,13 @@ class DownloadArtifactsFromChildren(LoggingBuildStep, CompositeStepMixin):
         self.artifactDestination = artifactDestination
         self.master = None
         self.usePowerShell = usePowerShell
+        if maxConcurrentDownloads < 1:
+            config.error("maxConcurrentDownloads must be at least 1")
+        self.maxConcurrentDownloads = maxConcurrentDownloads
+        self.artifactCacheSize = artifactCacheSize
+        self.artifactCacheHardlinks = artifactCacheHardlinks
+        self.downloadFailed = False
+        self.runningCommands = []
         LoggingBuildStep.__init__(self, **kwargs)
 
     @defer.inlineCallbacks
@@ -532,28 +574,60 @@ class DownloadArtifactsFromChildren(LoggingBuildStep, CompositeStepMixin):
         buildRequetsIdsWithArtifacts = self._getBuildRequestIdsWithArtifacts(partitionRequests)
         self.partitionCount = len(buildRequetsIdsWithArtifacts)
         self.step_status.setText(["Downloading artifacts from %d triggered partitions" % self.partitionCount])
-        artifactsMap = {}
         self.build.setProperty("artifactsMap", {})
-        for brid in buildRequetsIdsWithArtifacts:
-            buildRequest = yield self.master.db.buildrequests.getBuildRequestById(brid)
+        buildRequests = yield self.master.db.buildrequests.getBuildRequestsByIds(buildRequetsIdsWithArtifacts)
 
-            localdir = self._getLocalDir(brid)
-            command = mkDir(self, localdir)
-            yield self._docmd(command)
+        # up to maxConcurrentDownloads partitions are downloaded at the same
+        # time; once one of them failed, the ones already started are let
+        # finish, and the others are not started
+        artifactsMap = {}
+        semaphore = defer.DeferredSemaphore(self.maxConcurrentDownloads)
+        downloads = [semaphore.run(self._downloadPartition, buildRequests[brid], artifactsMap)
+                     for brid in buildRequetsIdsWithArtifacts]
+        results = yield defer.DeferredList(downloads, consumeErrors=True)
+        for success, result in results:
+            if not success:
+                result.raiseException()
+
+        self.build.setProperty('artifactsMap', artifactsMap, 'DownloadArtifactsFromChildren')
+        self.finished(SUCCESS)
+
+    @defer.inlineCallbacks
+    def _downloadPartition(self, buildRequest, artifactsMap):
+        if self.downloadFailed or self.stopped:
+            return
 
+        start = now()
+        brid = buildRequest['brid']
+        try:
+            localdir = self._getLocalDir(brid)
             artifactPath = self._getArtifactPath(buildRequest)
             remotelocation = self._getRemoteLocation(artifactPath)
 
-            rsync = rsyncWithRetry(self, remotelocation, localdir, self.artifactServerPort)
-            yield self._docmd(rsync)
-
-            if self.artifact:
-                artifactsMap[localdir] = artifactPath + '/' + self.artifact
+            if useArtifactCache(self):
+                # the trailing slash makes the slave put a single file
+                # artifact into localdir, like rsync does below
+                key = [self.artifactBuilderName, brid, artifactPath + '/' + (self.artifact or '')]
+                cmd = downloadArtifactCommand(self, self.workdir, key, remotelocation, localdir + '/')
+                yield self._runRemoteCommand(cmd)
             else:
-                artifactsMap[localdir] = artifactPath + '/'
-
-        self.build.setProperty('artifactsMap', artifactsMap, 'DownloadArtifactsFromChildren')
-        self.finished(SUCCESS)
+                command = mkDir(self, localdir)
+                yield self._docmd(command)
+
+                rsync = rsyncWithRetry(self, remotelocation, localdir, self.artifactServerPort)
+                yield self._docmd(rsync)
+        except:
+            self.downloadFailed = True
+            self.stdio_log.addHeader("Downloading artifacts of build request %d failed after %.1f seconds\n"
+                                     % (brid, now() - start))
+            raise
+
+        if self.artifact:
+            artifactsMap[localdir] = artifactPath + '/' + self.artifact
+        else:
+            artifactsMap[localdir] = artifactPath + '/'
+        self.stdio_log.addHeader("Downloaded artifacts of build request %d in %.1f seconds\n"
+                                 % (brid, now() - start))
 
     def finished(self, results):
         if results == SUCCESS:
@@ -593,8 +667,17 @@ class DownloadArtifactsFromChildren(LoggingBuildStep, CompositeStepMixin):
         cmd = buildstep.RemoteShellCommand(self.workdir,
                 command, collectStdout=False,
                 collectStderr=True)
+        return self._runRemoteCommand(cmd)
+
+    def _runRemoteCommand(self, cmd):
+        from buildbot.process import buildstep
         cmd.useLog(self.stdio_log, False)
+        self.runningCommands.append(cmd)
         d = self.runCommand(cmd)
+        @d.addBoth
+        def commandDone(res):
+            self.runningCommands.remove(cmd)
+            return res
         def evaluateCommand(cmd):
             if cmd.didFail():
                 raise buildstep.BuildStepFailed()
@@ -603,6 +686,14 @@ class DownloadArtifactsFromChildren(LoggingBuildStep, CompositeStepMixin):
         d.addCallback(lambda _: evaluateCommand(cmd))
         return d
 
+    def interrupt(self, reason):
+        # LoggingBuildStep only knows about the last command started
+        LoggingBuildStep.interrupt(self, reason)
+        for cmd in self.runningCommands:
+            if cmd is not self.cmd:
+                d = cmd.interrupt(reason)
+                d.addErrback(log.err, 'while interrupting command')
+
     @staticmethod
     def _getBuildRequestIdsWithArtifacts(buildrequests):
         ids = []
@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 from buildbot import config
+from buildbot.interfaces import IBulkTriggerableScheduler
 from buildbot.process.buildstep import LoggingBuildStep
 from buildbot.steps.trigger import Trigger
 from buildbot.process.properties import Properties
@@ -37,13 +38,18 @@ class PartitionTrigger(Trigger):
         sourceStampForTrigger = self.prepareSourcestampListForTrigger()
 
         for sch in triggered_schedulers:
-            partitions = self.partitionFunction(self, sch)
-            partitionCount = 0
-            for partition in partitions:
-                propertiesToSetForPartition = self._createPartitionTriggerProperties(partition)
-                dl.append(sch.trigger(sourceStampForTrigger, set_props=propertiesToSetForPartition,
+            partitions = list(self.partitionFunction(self, sch))
+            partitionCount = len(partitions)
+            propertiesToSetForPartitions = [self._createPartitionTriggerProperties(partition)
+                                            for partition in partitions]
+            if partitionCount and IBulkTriggerableScheduler.providedBy(sch):
+                # add the buildsets of all the partitions at once
+                dl.extend(sch.triggerMany(sourceStampForTrigger, set_props_list=propertiesToSetForPartitions,
                     triggeredbybrid=triggeredByBuildRequestId, reason=self.build.build_status.getReason()))
-                partitionCount += 1
+            else:
+                for propertiesToSetForPartition in propertiesToSetForPartitions:
+                    dl.append(sch.trigger(sourceStampForTrigger, set_props=propertiesToSetForPartition,
+                        triggeredbybrid=triggeredByBuildRequestId, reason=self.build.build_status.getReason()))
             if partitionCount == 0: # No partition triggered, so trigger the scheduler normally
                 propertiesToSet = self.createTriggerProperties()
                 dl.append(sch.trigger(sourceStampForTrigger, set_props=propertiesToSet,
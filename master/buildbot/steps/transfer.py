@@ -16,7 +16,7 @@
 from __future__ import with_statement
 
 
-import os.path, tarfile, tempfile
+import os.path, tarfile, tempfile, threading, Queue
 try:
     from cStringIO import StringIO
     assert StringIO
@@ -24,6 +24,8 @@ except ImportError:
     from StringIO import StringIO
 from twisted.spread import pb
 from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.internet import defer, reactor
 from buildbot.process import buildstep
 from buildbot.process.buildstep import BuildStep
 from buildbot.process.buildstep import SUCCESS, FAILURE, SKIPPED
@@ -171,6 +173,146 @@ class _DirectoryWriter(_FileWriter):
         os.remove(self.tarname)
 
 
+class _DirectoryStreamWriter(pb.Referenceable):
+    """
+    Unpack the archive of a DirectoryUpload while it arrives, instead of
+    writing it to a temporary file first.
+
+    A thread reads the blocks through a tarfile stream and extracts the
+    members one after the other.  Each remote_write returns once the thread
+    took its block, so only the blocks the slave keeps in flight are ever
+    held in memory.
+    """
+
+    def __init__(self, destroot, maxsize, compress, _reactor=reactor):
+        self.destroot = destroot
+        self.remaining = maxsize
+        self.compress = compress
+        self._reactor = _reactor
+        self.blocks = Queue.Queue()
+        self.thread = None
+        self.cancelled = False
+        # set once the thread is done, with None or the Failure it ended with
+        self.finished = False
+        self.failure = None
+        self.waiting = []
+        # only used from the thread
+        self.current = ''
+        self.offset = 0
+        self.eof = False
+
+    def _startThread(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._unpack,
+                                           name="unpack %s" % self.destroot)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def remote_write(self, data):
+        """
+        Called from remote slave to hand over the next block of the archive,
+        within boundaries of L{maxsize}
+        """
+        if self.failure is not None:
+            self.failure.raiseException()
+        if self.finished:
+            # the end of the archive was reached, this is only padding
+            return None
+
+        if self.remaining is not None:
+            data = data[:self.remaining]
+            self.remaining -= len(data)
+        if not data:
+            return None
+
+        self._startThread()
+        d = defer.Deferred()
+        self.blocks.put((data, d))
+        return d
+
+    def remote_unpack(self):
+        """
+        Called by remote slave to state that no more data will be transfered;
+        the returned Deferred fires once the archive is unpacked
+        """
+        self._startThread()
+        self.blocks.put(None)
+        if self.finished:
+            if self.failure is not None:
+                return defer.fail(self.failure)
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    def cancel(self):
+        # unclean shutdown: stop the thread, leaving what was unpacked so far
+        if self.thread is not None and not self.finished:
+            self.cancelled = True
+            self.blocks.put(None)
+
+    def read(self, size):
+        """
+        Called by the archive, in the thread, for the next C{size} bytes
+        """
+        while self.offset >= len(self.current):
+            if self.eof:
+                return ''
+            block = self.blocks.get()
+            if block is None:
+                if self.cancelled:
+                    raise IOError("upload to %s was cancelled" % self.destroot)
+                self.eof = True
+                return ''
+            self.current, d = block
+            self.offset = 0
+            self._reactor.callFromThread(d.callback, None)
+
+        data = self.current[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def _unpack(self):
+        if self.compress == 'bz2':
+            mode = 'r|bz2'
+        elif self.compress == 'gz':
+            mode = 'r|gz'
+        else:
+            mode = 'r|'
+
+        try:
+            archive = tarfile.open(mode=mode, fileobj=self)
+            archive.extractall(path=self.destroot)
+            archive.close()
+        except:
+            self._reactor.callFromThread(self._unpacked, Failure())
+        else:
+            self._reactor.callFromThread(self._unpacked, None)
+
+    def _unpacked(self, failure):
+        self.finished = True
+        self.failure = failure
+
+        # the slave is not kept waiting for blocks nobody will read
+        while True:
+            try:
+                block = self.blocks.get_nowait()
+            except Queue.Empty:
+                break
+            if block is not None:
+                if failure is not None:
+                    block[1].errback(failure)
+                else:
+                    block[1].callback(None)
+
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            if failure is not None:
+                d.errback(failure)
+            else:
+                d.callback(None)
+
+
 def makeStatusRemoteCommand(step, remote_command, args):
     self = buildstep.RemoteCommand(remote_command, args,  decodeRC={None:SUCCESS, 0:SUCCESS})
     callback = lambda arg: step.step_status.addLog('stdio')
@@ -193,6 +335,14 @@ class _TransferBuildStep(BuildStep):
         if self.workdir is None:
             self.workdir = workdir
 
+    def _addWindowArgs(self, command, args):
+        # slaves that know about pipelined transfers keep up to 'window'
+        # blocks in flight and grow them up to 'maxblocksize'; older ones
+        # get one block of 'blocksize' at a time
+        if self.window > 1 and not self.slaveVersionIsOlderThan(command, "2.17"):
+            args['window'] = self.window
+            args['maxblocksize'] = self.maxblocksize
+
     def _getWorkdir(self):
         if self.workdir is None:
             workdir = self.DEFAULT_WORKDIR
@@ -226,7 +376,7 @@ class FileUpload(_TransferBuildStep):
 
     def __init__(self, slavesrc, masterdest,
                  workdir=None, maxsize=None, blocksize=16*1024, mode=None,
-                 keepstamp=False, url=None,
+                 keepstamp=False, url=None, window=8, maxblocksize=256*1024,
                  **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
 
@@ -235,6 +385,8 @@ class FileUpload(_TransferBuildStep):
         self.workdir = workdir
         self.maxsize = maxsize
         self.blocksize = blocksize
+        self.window = window
+        self.maxblocksize = maxblocksize
         if not isinstance(mode, (int, type(None))):
             config.error(
                 'mode must be an integer or None')
@@ -280,6 +432,7 @@ class FileUpload(_TransferBuildStep):
             'blocksize': self.blocksize,
             'keepstamp': self.keepstamp,
             }
+        self._addWindowArgs('uploadFile', args)
 
         self.cmd = makeStatusRemoteCommand(self, 'uploadFile', args)
         d = self.runCommand(self.cmd)
@@ -298,7 +451,8 @@ class DirectoryUpload(_TransferBuildStep):
 
     def __init__(self, slavesrc, masterdest,
                  workdir=None, maxsize=None, blocksize=16*1024,
-                 compress=None, url=None, **buildstep_kwargs):
+                 compress=None, url=None, window=8, maxblocksize=256*1024,
+                 stream=True, **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
 
         self.slavesrc = slavesrc
@@ -306,11 +460,14 @@ class DirectoryUpload(_TransferBuildStep):
         self.workdir = workdir
         self.maxsize = maxsize
         self.blocksize = blocksize
+        self.window = window
+        self.maxblocksize = maxblocksize
         if compress not in (None, 'gz', 'bz2'):
             config.error(
                 "'compress' must be one of None, 'gz', or 'bz2'")
         self.compress = compress
         self.url = url
+        self.stream = stream
 
     def start(self):
         version = self.slaveVersion("uploadDirectory")
@@ -334,7 +491,10 @@ class DirectoryUpload(_TransferBuildStep):
             self.addURL(os.path.basename(masterdest), self.url)
         
         # we use maxsize to limit the amount of data on both sides
-        dirWriter = _DirectoryWriter(masterdest, self.maxsize, self.compress, 0600)
+        if self.stream:
+            dirWriter = _DirectoryStreamWriter(masterdest, self.maxsize, self.compress)
+        else:
+            dirWriter = _DirectoryWriter(masterdest, self.maxsize, self.compress, 0600)
 
         # default arguments
         args = {
@@ -345,12 +505,16 @@ class DirectoryUpload(_TransferBuildStep):
             'blocksize': self.blocksize,
             'compress': self.compress
             }
+        self._addWindowArgs('uploadDirectory', args)
 
         self.cmd = makeStatusRemoteCommand(self, 'uploadDirectory', args)
         d = self.runCommand(self.cmd)
-        @d.addErrback
+        @d.addBoth
         def cancel(res):
-            dirWriter.cancel()
+            # a slave failing the upload does not call remote_unpack, so the
+            # unpacking thread would wait for the next block forever
+            if isinstance(res, Failure) or self.cmd.didFail():
+                dirWriter.cancel()
             return res
         d.addCallback(self.finished).addErrback(self.failed)
 
@@ -407,7 +571,7 @@ class FileDownload(_TransferBuildStep):
 
     def __init__(self, mastersrc, slavedest,
                  workdir=None, maxsize=None, blocksize=16*1024, mode=None,
-                 **buildstep_kwargs):
+                 window=8, maxblocksize=256*1024, **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
 
         self.mastersrc = mastersrc
@@ -415,6 +579,8 @@ class FileDownload(_TransferBuildStep):
         self.workdir = workdir
         self.maxsize = maxsize
         self.blocksize = blocksize
+        self.window = window
+        self.maxblocksize = maxblocksize
         if not isinstance(mode, (int, type(None))):
             config.error(
                 'mode must be an integer or None')
@@ -458,6 +624,7 @@ class FileDownload(_TransferBuildStep):
             'workdir': self._getWorkdir(),
             'mode': self.mode,
             }
+        self._addWindowArgs('downloadFile', args)
 
         self.cmd = makeStatusRemoteCommand(self, 'downloadFile', args)
         d = self.runCommand(self.cmd)
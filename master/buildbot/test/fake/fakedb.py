@@ -696,6 +696,17 @@ class FakeBuildsetsComponent(FakeDBComponent):
         return defer.succeed((bsid,
             dict([ (br.buildername, br.id) for br in br_rows ])))
 
+    def addBuildsets(self, sourcestampsetid, buildsets, triggeredbybrid=None,
+                     _reactor=reactor):
+        results = []
+        for bs in buildsets:
+            d = self.addBuildset(sourcestampsetid, bs['reason'],
+                    bs['properties'], triggeredbybrid=triggeredbybrid,
+                    builderNames=bs['builderNames'],
+                    external_idstring=bs.get('external_idstring'))
+            d.addCallback(results.append)
+        return defer.succeed(results)
+
     def completeBuildset(self, bsid, results, complete_at=None,
             _reactor=reactor):
         self.buildsets[bsid]['results'] = results
@@ -717,6 +728,22 @@ class FakeBuildsetsComponent(FakeDBComponent):
                 buildsets[row['id']] = self._row2dict(row)
         return defer.succeed(buildsets)
 
+    def getBuildsetsCompletion(self, bsids):
+        completion = {}
+        for bsid in bsids:
+            if bsid in self.buildsets:
+                completion[bsid] = dict(bsid=bsid,
+                        complete=bool(self.buildsets[bsid]['complete']),
+                        requests_complete=True, results=[])
+        for br in self.db.buildrequests.reqs.itervalues():
+            if br.buildsetid not in completion:
+                continue
+            if br.complete:
+                completion[br.buildsetid]['results'].append(br.results)
+            else:
+                completion[br.buildsetid]['requests_complete'] = False
+        return defer.succeed(completion)
+
     def getBuildsets(self, complete=None):
         rv = []
         for bs in self.buildsets.itervalues():
@@ -997,8 +1024,19 @@ class FakeBuildRequestsComponent(FakeDBComponent):
 
         return defer.succeed(rv)
 
-    def getBuildRequestsInQueue(self, queue=None):
-        return self.getBuildRequests(complete=False, claimed=False)
+    def getUnclaimedBuildRequests(self, greater_than=None):
+        rv = [dict(brid=br.id, buildsetid=br.buildsetid, buildername=br.buildername)
+              for br in self.reqs.itervalues()
+              if not br.complete and br.id not in self.claims
+              and (greater_than is None or br.id > greater_than)]
+        rv.sort(key=lambda br: br['brid'])
+        return defer.succeed(rv)
+
+    def getBuildRequestsInQueue(self, queue=None, brids=None):
+        d = self.getBuildRequests(complete=False, claimed=False)
+        if brids is not None:
+            d.addCallback(lambda brdicts: [br for br in brdicts if br['brid'] in brids])
+        return d
 
     def getBuildRequestInQueue(self, buildername=None, sourcestamps=None, sorted=True, limit=None):
         return self.getBuildRequests(buildername=buildername, complete=False, claimed=False)
@@ -1110,6 +1148,10 @@ class FakeBuildRequestsComponent(FakeDBComponent):
     def getBuildRequestById(self, id):
         return self._brdictFromRow(self.reqs[id])
 
+    def getBuildRequestsByIds(self, brids):
+        return defer.succeed(dict((brid, self._brdictFromRow(self.reqs[brid]))
+                                  for brid in brids if brid in self.reqs))
+
     def reusePreviousBuild(self, requests, artifactbrid):
         return defer.succeed(None)
 
@@ -1129,6 +1171,9 @@ class FakeBuildRequestsComponent(FakeDBComponent):
                                                   objectid=self.MASTER_ID, claimed_at=claimed_at)
         return defer.succeed(None)
 
+    def claimBuildRequestGroups(self, groups, claimed_at=None):
+        brids = [brid for group in groups for brid in group]
+        return self.claimBuildRequests(brids, claimed_at=claimed_at)
 
     def mergeBuildingRequest(self, requests, brids, number, queue):
         if queue == Queue.unclaimed:
@@ -150,6 +150,9 @@ class FakeMaster(object):
     def subscribeToBuildRequests(self, callback):
         pass
 
+    def subscribeToCancelledBuildRequests(self, callback):
+        pass
+
     # work around http://code.google.com/p/mock/issues/detail?id=105
     def _get_child_mock(self, **kw):
         return mock.Mock(**kw)
@@ -157,6 +160,18 @@ class FakeMaster(object):
     def maybeBuildsetComplete(self, bsid):
         pass
 
+    def maybeBuildsetsComplete(self, bsids):
+        pass
+
+    def watchBuildsetCompletion(self, bsid):
+        pass
+
+    def unwatchBuildsetCompletion(self, bsid):
+        pass
+
+    def buildRequestAdded(self, bsid, brid, buildername):
+        pass
+
     def buildRequestRemoved(self, bsid, brid, buildername):
         pass
 
@@ -25,7 +25,7 @@ from twisted.trial import unittest
 from twisted.application import service
 from twisted.internet import defer
 from buildbot import config, buildslave, interfaces, revlinks, locks
-from buildbot.process import properties, factory
+from buildbot.process import properties, factory, notifications
 from buildbot.test.util import dirs, compat
 from buildbot.test.util.config import ConfigErrorsMixin
 from buildbot.changes import base as changes_base
@@ -50,6 +50,10 @@ global_defaults = dict(
     multiMaster=False,
     debugPassword=None,
     manhole=None,
+    masterNotifications=None,
+    buildRequestDistributorBatchSize=1,
+    buildLoaderThreads=4,
+    buildLoaderReadAhead=8,
 )
 
 load_global_defaults = dict(
@@ -71,6 +75,7 @@ load_global_defaults = dict(
     multiMaster=False,
     debugPassword=None,
     manhole=None,
+    masterNotifications=None,
     )
 
 
@@ -447,6 +452,28 @@ class MasterConfig_loaders(ConfigErrorsMixin, unittest.TestCase):
     def test_load_global_logMaxTailSize(self):
         self.do_test_load_global(dict(logMaxTailSize=123), logMaxTailSize=123)
 
+    def test_load_global_buildRequestDistributorBatchSize(self):
+        self.do_test_load_global(dict(buildRequestDistributorBatchSize=20),
+                                 buildRequestDistributorBatchSize=20)
+
+    def test_load_global_buildRequestDistributorBatchSize_invalid(self):
+        self.cfg.load_global(self.filename,
+                dict(buildRequestDistributorBatchSize=0))
+        self.assertConfigError(self.errors, "must be at least 1")
+
+    def test_load_global_buildLoaderThreads(self):
+        self.do_test_load_global(dict(buildLoaderThreads=10),
+                                 buildLoaderThreads=10)
+
+    def test_load_global_buildLoaderThreads_invalid(self):
+        self.cfg.load_global(self.filename,
+                dict(buildLoaderThreads=0))
+        self.assertConfigError(self.errors, "must be at least 1")
+
+    def test_load_global_buildLoaderReadAhead(self):
+        self.do_test_load_global(dict(buildLoaderReadAhead=20),
+                                 buildLoaderReadAhead=20)
+
     def test_load_global_properties(self):
         exp = properties.Properties()
         exp.setProperty('x', 10, self.filename)
@@ -501,6 +528,15 @@ class MasterConfig_loaders(ConfigErrorsMixin, unittest.TestCase):
         mh = mock.Mock(name='manhole')
         self.do_test_load_global(dict(manhole=mh), manhole=mh)
 
+    def test_load_global_masterNotifications(self):
+        transport = notifications.LocalNotificationTransport()
+        self.do_test_load_global(dict(masterNotifications=transport),
+                masterNotifications=transport)
+
+    def test_load_global_masterNotifications_invalid(self):
+        self.cfg.load_global(self.filename, dict(masterNotifications='pb'))
+        self.assertConfigError(self.errors, "must be a NotificationTransport")
+
     def test_load_global_revlink_callable(self):
         callable = lambda : None
         self.do_test_load_global(dict(revlink=callable),
@@ -560,6 +596,17 @@ class MasterConfig_loaders(ConfigErrorsMixin, unittest.TestCase):
             dict(db=dict(db_url='abcd', db_poll_interval=10, bar='bar')))
         self.assertConfigError(self.errors, "unrecognized keys in")
 
+    def test_load_db_slow_query_threshold(self):
+        self.cfg.load_db(self.filename,
+            dict(db=dict(db_url='abcd', db_slow_query_threshold=0.5)))
+        self.assertResults(db=dict(db_url='abcd', db_poll_interval=None,
+                                   db_slow_query_threshold=0.5))
+
+    def test_load_db_slow_query_threshold_not_number(self):
+        self.cfg.load_db(self.filename,
+            dict(db=dict(db_url='abcd', db_slow_query_threshold='slow')))
+        self.assertConfigError(self.errors, "must be a number")
+
     def test_load_db_not_int(self):
         self.cfg.load_db(self.filename,
             dict(db=dict(db_url='abcd', db_poll_interval='ten')))
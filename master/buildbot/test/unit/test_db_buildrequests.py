@@ -155,6 +155,24 @@ class TestBuildsetsConnectorComponent(
                 claimed=False,
                 expected=[52])
 
+    @defer.inlineCallbacks
+    def test_getUnclaimedBuildRequests(self):
+        yield self.insertTestData([
+            fakedb.BuildRequest(id=50, buildsetid=self.BSID, buildername='bb'),
+            fakedb.BuildRequestClaim(brid=50, objectid=self.MASTER_ID,
+                    claimed_at=self.CLAIMED_AT_EPOCH),
+            fakedb.BuildRequest(id=51, buildsetid=self.BSID, buildername='bb'),
+            fakedb.BuildRequest(id=52, buildsetid=self.BSID, buildername='cc'),
+            fakedb.BuildRequest(id=53, buildsetid=self.BSID, complete=1),
+        ])
+        brdicts = yield self.db.buildrequests.getUnclaimedBuildRequests()
+        self.assertEqual(brdicts, [
+            dict(brid=51, buildsetid=self.BSID, buildername='bb'),
+            dict(brid=52, buildsetid=self.BSID, buildername='cc')])
+
+        brdicts = yield self.db.buildrequests.getUnclaimedBuildRequests(greater_than=51)
+        self.assertEqual([brd['brid'] for brd in brdicts], [52])
+
     def do_test_getBuildRequests_buildername_arg(self, **kwargs):
         expected = kwargs.pop('expected')
         d = self.insertTestData([
@@ -783,6 +801,21 @@ class TestBuildsetsConnectorComponent(
         d.addCallback(check)
         return d
 
+    def test_getBuildRequestsByIds(self):
+        breqs = [fakedb.BuildRequest(id=brid, buildsetid=1, buildername="B")
+                 for brid in range(1, 151)]
+        d = self.insertTestData(breqs)
+        d.addCallback(lambda _:
+                      self.db.buildrequests.getBuildRequestsByIds(range(2, 152)))
+
+        def check(breqs):
+            self.assertEqual(sorted(breqs), range(2, 151))
+            self.assertEqual(breqs[42]['brid'], 42)
+            self.assertEqual(breqs[42]['buildername'], "B")
+
+        d.addCallback(check)
+        return d
+
     def test_getBuildRequestsTriggeredBy(self):
         breqs = [fakedb.BuildRequest(id=1, buildsetid=1, buildername="A"),
                  fakedb.BuildRequest(id=2, buildsetid=2, buildername="B", triggeredbybrid=1),
@@ -969,6 +1002,68 @@ class TestBuildsetsConnectorComponent(
         d.addCallback(checkBuildRequests, 1)
         return d
 
+    def test_claimBuildRequestGroups(self):
+        clock = task.Clock()
+        clock.advance(1300305712)
+        breqs = [fakedb.BuildRequest(id=id, buildsetid=id, buildername="builder")
+                 for id in xrange(1, 7)]
+
+        d = self.insertTestData(breqs)
+
+        d.addCallback(lambda _:
+                      self.db.buildrequests.claimBuildRequestGroups([[1, 2, 3], [4], [5, 6]],
+                                                                    _reactor=clock))
+
+        def check(_):
+            def thd(conn):
+                reqs_tbl = self.db.model.buildrequests
+                claims_tbl = self.db.model.buildrequest_claims
+                q = sa.select([reqs_tbl.outerjoin(claims_tbl,
+                                                  reqs_tbl.c.id == claims_tbl.c.brid)])
+                results = conn.execute(q).fetchall()
+                self.assertEqual(sorted([(r.id, r.mergebrid, r.claimed_at, r.objectid) for r in results]),
+                                 [(1, None, 1300305712, self.MASTER_ID),
+                                  (2, 1, 1300305712, self.MASTER_ID),
+                                  (3, 1, 1300305712, self.MASTER_ID),
+                                  (4, None, 1300305712, self.MASTER_ID),
+                                  (5, None, 1300305712, self.MASTER_ID),
+                                  (6, 5, 1300305712, self.MASTER_ID)])
+            return self.db.pool.do(thd)
+
+        d.addCallback(check)
+        return d
+
+    def test_claimBuildRequestGroups_other_master_claim(self):
+        breqs = [fakedb.BuildRequest(id=id, buildsetid=id, buildername="builder")
+                 for id in xrange(1, 5)]
+        breqs += [fakedb.BuildRequestClaim(brid=4, objectid=self.OTHER_MASTER_ID,
+                                           claimed_at=1300103810)]
+
+        d = self.insertTestData(breqs)
+
+        d.addCallback(lambda _:
+                      self.db.buildrequests.claimBuildRequestGroups([[1, 2], [3], [4]]))
+
+        def fail(_):
+            self.fail("unexpected success from claimBuildRequestGroups")
+
+        def checkNothingClaimed(f):
+            f.trap(buildrequests.AlreadyClaimedError)
+
+            def thd(conn):
+                reqs_tbl = self.db.model.buildrequests
+                claims_tbl = self.db.model.buildrequest_claims
+                q = sa.select([reqs_tbl.outerjoin(claims_tbl,
+                                                  reqs_tbl.c.id == claims_tbl.c.brid)])
+                results = conn.execute(q).fetchall()
+                self.assertEqual(sorted([(r.id, r.mergebrid, r.objectid) for r in results]),
+                                 [(1, None, None), (2, None, None), (3, None, None),
+                                  (4, None, self.OTHER_MASTER_ID)])
+            return self.db.pool.do(thd)
+
+        d.addCallbacks(fail, checkNothingClaimed)
+        return d
+
     def test_findCompatibleFinishedBuildRequest(self):
         breqs = [fakedb.BuildRequest(id=1, buildsetid=1, buildername="B", complete=1, results=0,
                                      submitted_at=1418823086, complete_at=1418823086),
@@ -1355,6 +1450,14 @@ class TestBuildsetsConnectorComponent(
         return d
 
 
+    def test_getBuildRequestsInUnclaimedQueueUnordered(self):
+        # without order, the requests come by id, whichever index is used
+        d = self.insertPrioritizedBreqs()
+        d.addCallback(lambda _: self.db.buildrequests.getBuildRequestsInQueue(queue=Queue.unclaimed,
+                                                                              order=False))
+        d.addCallback(lambda queue: self.assertEqual([br['brid'] for br in queue], [1, 2, 3, 9]))
+        return d
+
     def test_getPrioritizedBuildRequestsInResumeQueue(self):
         expectedBreqs = [self.fakePrioritzedRequest(brid=6, results=RESUME,
                                      buildername='bldr3', priority=100,
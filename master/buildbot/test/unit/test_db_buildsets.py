@@ -35,7 +35,8 @@ class TestBuildsetsConnectorComponent(
         d = self.setUpConnectorComponent(
             table_names=[ 'patches', 'changes', 'sourcestamp_changes',
                 'buildsets', 'buildset_properties', 'objects',
-                'buildrequests', 'sourcestamps', 'sourcestampsets' ])
+                'buildrequests', 'buildrequest_claims', 'builds',
+                'sourcestamps', 'sourcestampsets' ])
 
         def finish_setup(_):
             self.db.buildsets = buildsets.BuildsetsConnectorComponent(self.db)
@@ -175,6 +176,78 @@ class TestBuildsetsConnectorComponent(
         d.addCallback(check)
         return d
 
+    def test_addBuildsets(self):
+        breqs = [fakedb.Buildset(id=1, sourcestampsetid=234),
+                 fakedb.BuildRequest(id=1, buildsetid=1, buildername="builder"),
+                 fakedb.BuildRequest(id=2, buildsetid=1, buildername="a")]
+        d = self.insertTestData(breqs)
+        d.addCallback(lambda _ :
+            self.db.buildsets.addBuildsets(sourcestampsetid=234, buildsets=[
+                dict(reason='first', builderNames=['a', 'b'],
+                     properties=dict(part=(1, 'PartitionTrigger'))),
+                dict(reason='second', builderNames=['a'],
+                     properties=dict(part=(2, 'PartitionTrigger'),
+                                     priority=('75', 'Force Build Form')),
+                     brDictsToMerge=dict(a=dict(brid=2, artifactbrid=None,
+                                                build_number=7))),
+                dict(reason='third', builderNames=['b'], properties={},
+                     external_idstring='extid'),
+            ], triggeredbybrid=1, _reactor=self.clock, _master_objectid=13))
+        def check(results):
+            self.assertEqual(len(results), 3)
+            (bsid1, brids1), (bsid2, brids2), (bsid3, brids3) = results
+            self.assertEqual(sorted(brids1), ['a', 'b'])
+            self.assertEqual(brids2.keys(), ['a'])
+            self.assertEqual(brids3.keys(), ['b'])
+
+            def thd(conn):
+                bs_tbl = self.db.model.buildsets
+                r = conn.execute(bs_tbl.select().where(bs_tbl.c.id != 1)
+                                    .order_by(bs_tbl.c.id))
+                rows = [ (row.id, row.external_idstring, row.reason,
+                          row.sourcestampsetid, row.submitted_at)
+                          for row in r.fetchall() ]
+                self.assertEqual(rows, [
+                    (bsid1, None, 'first', 234, self.now),
+                    (bsid2, None, 'second', 234, self.now),
+                    (bsid3, 'extid', 'third', 234, self.now) ])
+
+                r = conn.execute(self.db.model.buildset_properties.select())
+                rows = [ (row.buildsetid, row.property_name, row.property_value)
+                          for row in r.fetchall() ]
+                self.assertEqual(sorted(rows), sorted([
+                    (bsid1, 'part', json.dumps([1, 'PartitionTrigger'])),
+                    (bsid2, 'part', json.dumps([2, 'PartitionTrigger'])),
+                    (bsid2, 'priority', json.dumps(['75', 'Force Build Form'])),
+                    ]))
+
+                reqs_tbl = self.db.model.buildrequests
+                r = conn.execute(reqs_tbl.select()
+                                    .where(reqs_tbl.c.buildsetid != 1))
+                rows = [ (row.id, row.buildsetid, row.buildername,
+                          row.priority, row.triggeredbybrid, row.startbrid,
+                          row.mergebrid, row.artifactbrid)
+                          for row in r.fetchall() ]
+                self.assertEqual(sorted(rows), sorted([
+                    (brids1['a'], bsid1, 'a', Priority.Default, 1, 1, None, None),
+                    (brids1['b'], bsid1, 'b', Priority.Default, 1, 1, None, None),
+                    (brids2['a'], bsid2, 'a', Priority.High, 1, 1, 2, 2),
+                    (brids3['b'], bsid3, 'b', Priority.Default, 1, 1, None, None),
+                    ]))
+
+                # the merged request is claimed, and shares the running build
+                r = conn.execute(self.db.model.buildrequest_claims.select())
+                rows = [ (row.brid, row.objectid, row.claimed_at)
+                          for row in r.fetchall() ]
+                self.assertEqual(rows, [ (brids2['a'], 13, self.now) ])
+
+                r = conn.execute(self.db.model.builds.select())
+                rows = [ (row.brid, row.number) for row in r.fetchall() ]
+                self.assertEqual(rows, [ (brids2['a'], 7) ])
+            return self.db.pool.do(thd)
+        d.addCallback(check)
+        return d
+
     def do_test_getBuildsetProperties(self, buildsetid, rows, expected):
         d = self.insertTestData(rows)
         d.addCallback(lambda _ :
@@ -402,6 +475,55 @@ class TestBuildsetsConnectorComponent(
                                                    _reactor=self.clock))
         return self.assertFailure(d, KeyError)
 
+    def test_getBuildsetsCompletion(self):
+        d = self.insertTestData([
+            fakedb.Buildset(id=91, sourcestampsetid=234, complete=0),
+            fakedb.Buildset(id=92, sourcestampsetid=234, complete=0),
+            fakedb.Buildset(id=93, sourcestampsetid=234, complete=1,
+                            results=2),
+            fakedb.Buildset(id=94, sourcestampsetid=234, complete=0),
+            fakedb.BuildRequest(id=11, buildsetid=91, complete=1, results=0),
+            fakedb.BuildRequest(id=12, buildsetid=91, complete=1, results=2),
+            fakedb.BuildRequest(id=13, buildsetid=92, complete=1, results=0),
+            fakedb.BuildRequest(id=14, buildsetid=92, complete=0),
+            fakedb.BuildRequest(id=15, buildsetid=93, complete=1, results=2),
+        ])
+        d.addCallback(lambda _ :
+                self.db.buildsets.getBuildsetsCompletion([91, 92, 93, 94, 95]))
+        def check(completion):
+            for bs in completion.itervalues():
+                bs['results'].sort()
+            self.assertEqual(completion, {
+                91: dict(bsid=91, complete=False, requests_complete=True,
+                         results=[0, 2]),
+                92: dict(bsid=92, complete=False, requests_complete=False,
+                         results=[0]),
+                93: dict(bsid=93, complete=True, requests_complete=True,
+                         results=[2]),
+                # no build requests at all
+                94: dict(bsid=94, complete=False, requests_complete=True,
+                         results=[]),
+            })
+        d.addCallback(check)
+        return d
+
+    def test_getBuildsetsCompletion_many(self):
+        # more buildsets than fit in a single batch
+        rows = []
+        for bsid in range(1, 251):
+            rows.append(fakedb.Buildset(id=bsid, sourcestampsetid=234))
+            rows.append(fakedb.BuildRequest(id=bsid, buildsetid=bsid,
+                                            complete=1, results=0))
+        d = self.insertTestData(rows)
+        d.addCallback(lambda _ :
+                self.db.buildsets.getBuildsetsCompletion(range(1, 251)))
+        def check(completion):
+            self.assertEqual(sorted(completion), range(1, 251))
+            self.assertTrue(all(bs['requests_complete']
+                                for bs in completion.itervalues()))
+        d.addCallback(check)
+        return d
+
     def insert_test_getRecentBuildsets_data(self):
         return self.insertTestData([
             fakedb.SourceStamp(id=91, branch='branch_a', repository='repo_a',
@@ -0,0 +1,89 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+from sqlalchemy.engine import reflection
+from twisted.trial import unittest
+from buildbot.test.util import migration
+from buildbot.db.sourcestamps import getMergeKey
+
+class Migration(migration.MigrateTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        return self.setUpMigrateTest()
+
+    def tearDown(self):
+        return self.tearDownMigrateTest()
+
+    # create tables as they are before migrating to version 034
+    def create_tables_thd(self, conn):
+        metadata = sa.MetaData()
+        metadata.bind = conn
+
+        self.sourcestamps = sa.Table('sourcestamps', metadata,
+            sa.Column('id', sa.Integer,  primary_key=True),
+            sa.Column('branch', sa.String(256)),
+            sa.Column('revision', sa.String(256)),
+            sa.Column('patchid', sa.Integer),
+            sa.Column('repository', sa.String(length=512), nullable=False, server_default=''),
+            sa.Column('codebase', sa.String(256), nullable=False, server_default=''),
+            sa.Column('project', sa.String(length=512), nullable=False, server_default=''),
+            sa.Column('sourcestampsetid', sa.Integer),
+        )
+        self.sourcestamps.create(bind=conn)
+
+        self.buildsets = sa.Table('buildsets', metadata,
+            sa.Column('id', sa.Integer,  primary_key=True),
+            sa.Column('external_idstring', sa.String(256)),
+            sa.Column('reason', sa.String(256)),
+            sa.Column('submitted_at', sa.Integer, nullable=False),
+            sa.Column('complete', sa.SmallInteger, nullable=False, server_default=sa.DefaultClause("0")),
+            sa.Column('complete_at', sa.Integer),
+            sa.Column('results', sa.SmallInteger),
+            sa.Column('sourcestampsetid', sa.Integer),
+        )
+        self.buildsets.create(bind=conn)
+
+    def insert_buildset(self, conn, bsid, sourcestamps):
+        conn.execute(self.buildsets.insert(), id=bsid, submitted_at=0, sourcestampsetid=bsid)
+        for codebase, branch, revision in sourcestamps:
+            conn.execute(self.sourcestamps.insert(), sourcestampsetid=bsid,
+                         codebase=codebase, branch=branch, revision=revision)
+
+    def test_update(self):
+        sourcestamps = [('cb1', 'master', 'abcd'), ('cb2', 'develop', None)]
+
+        def setup_thd(conn):
+            self.create_tables_thd(conn)
+            self.insert_buildset(conn, 1, sourcestamps)
+            self.insert_buildset(conn, 2, list(reversed(sourcestamps)))
+            self.insert_buildset(conn, 3, sourcestamps[:1])
+
+        def verify_thd(conn):
+            metadata = sa.MetaData()
+            metadata.bind = conn
+            buildsets = sa.Table('buildsets', metadata, autoload=True)
+
+            res = conn.execute(sa.select([buildsets.c.id, buildsets.c.merge_key])
+                               .order_by(buildsets.c.id))
+            self.assertEqual(res.fetchall(), [(1, getMergeKey(sourcestamps)),
+                                              (2, getMergeKey(sourcestamps)),
+                                              (3, getMergeKey(sourcestamps[:1]))])
+
+            insp = reflection.Inspector.from_engine(conn)
+            indexes = insp.get_indexes('buildsets')
+            self.assertIn('buildsets_merge_key', [idx['name'] for idx in indexes])
+
+        return self.do_test_migration(33, 34, setup_thd, verify_thd)
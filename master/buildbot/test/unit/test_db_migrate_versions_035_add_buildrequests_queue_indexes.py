@@ -0,0 +1,82 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+from sqlalchemy.engine import reflection
+from twisted.trial import unittest
+from buildbot.test.util import migration
+
+class Migration(migration.MigrateTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        return self.setUpMigrateTest()
+
+    def tearDown(self):
+        return self.tearDownMigrateTest()
+
+    # create tables as they are before migrating to version 035
+    def create_tables_thd(self, conn):
+        metadata = sa.MetaData()
+        metadata.bind = conn
+
+        self.buildrequests = sa.Table('buildrequests', metadata,
+            sa.Column('id', sa.Integer,  primary_key=True),
+            sa.Column('buildsetid', sa.Integer, nullable=False),
+            sa.Column('buildername', sa.String(length=255), nullable=False),
+            sa.Column('priority', sa.Integer, nullable=False,
+                server_default=sa.DefaultClause("0")),
+            sa.Column('complete', sa.Integer,
+                server_default=sa.DefaultClause("0")),
+            sa.Column('results', sa.SmallInteger),
+            sa.Column('submitted_at', sa.Integer, nullable=False),
+            sa.Column('complete_at', sa.Integer),
+            sa.Column('artifactbrid', sa.Integer, nullable=True),
+            sa.Column('triggeredbybrid', sa.Integer, nullable=True),
+            sa.Column('mergebrid', sa.Integer, nullable=True),
+            sa.Column('startbrid', sa.Integer, nullable=True),
+            sa.Column('slavepool', sa.Text, nullable=True),
+        )
+        self.buildrequests.create(bind=conn)
+
+        self.builds = sa.Table('builds', metadata,
+            sa.Column('id', sa.Integer,  primary_key=True),
+            sa.Column('number', sa.Integer, nullable=False),
+            sa.Column('brid', sa.Integer, nullable=False),
+            sa.Column('slavename', sa.String(255), nullable=True),
+            sa.Column('start_time', sa.Integer, nullable=False),
+            sa.Column('finish_time', sa.Integer),
+        )
+        self.builds.create(bind=conn)
+
+    def test_update(self):
+        def setup_thd(conn):
+            self.create_tables_thd(conn)
+
+        def verify_thd(conn):
+            insp = reflection.Inspector.from_engine(conn)
+            indexes = dict((idx['name'], idx['column_names'])
+                           for idx in insp.get_indexes('buildrequests'))
+            self.assertEqual(indexes['buildrequests_queue'],
+                             ['complete', 'mergebrid', 'buildername',
+                              'priority', 'submitted_at'])
+            self.assertEqual(indexes['buildrequests_builder_complete'],
+                             ['buildername', 'complete', 'mergebrid'])
+
+            indexes = dict((idx['name'], idx['column_names'])
+                           for idx in insp.get_indexes('builds'))
+            self.assertEqual(indexes['builds_brid_finish_time_number'],
+                             ['brid', 'finish_time', 'number'])
+
+        return self.do_test_migration(34, 35, setup_thd, verify_thd)
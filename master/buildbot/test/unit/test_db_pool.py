@@ -19,6 +19,7 @@ import sqlalchemy as sa
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
 from buildbot.db import pool
+from buildbot.process import metrics
 from buildbot.test.util import db
 
 class Basic(unittest.TestCase):
@@ -89,6 +90,43 @@ class Basic(unittest.TestCase):
         d.addCallback( lambda r : self.pool.do_with_engine(insert_into_table))
         return d
 
+    @defer.inlineCallbacks
+    def test_query_metrics(self):
+        events = []
+        self.patch(metrics.MetricDBQueryEvent, 'log',
+                   staticmethod(lambda *args, **kwargs: events.append((args, kwargs))))
+        def select(conn):
+            return conn.execute("SELECT 1").scalar()
+        yield self.pool.do(select)
+        (query, wait, elapsed), kwargs = events[0]
+        # named after the method calling do()
+        self.assertEqual(query, 'test_db_pool.test_query_metrics')
+        self.assertTrue(wait >= 0 and elapsed >= 0)
+        self.assertEqual(kwargs, dict(retries=0, pending=1, threads=1))
+        self.assertEqual(self.pool.pending, 0)
+
+    @defer.inlineCallbacks
+    def test_slow_query_log(self):
+        msgs = []
+        # metrics are logged as keyword arguments
+        self.patch(pool.log, 'msg', lambda *args, **kwargs: msgs.extend(args))
+        self.pool.slow_query_threshold = 0
+        def select(conn):
+            return conn.execute("SELECT 2").scalar()
+        yield self.pool.do(select)
+        slow = [msg for msg in msgs if 'slow query' in msg]
+        self.assertEqual(len(slow), 1)
+        self.assertIn('slow query test_db_pool.test_slow_query_log', slow[0])
+        self.assertIn('SELECT 2', slow[0])
+
+    @defer.inlineCallbacks
+    def test_slow_query_log_disabled(self):
+        msgs = []
+        self.patch(pool.log, 'msg', lambda *args, **kwargs: msgs.extend(args))
+        self.pool.slow_query_threshold = None
+        yield self.pool.do(lambda conn: conn.execute("SELECT 2").scalar())
+        self.assertEqual([msg for msg in msgs if 'slow query' in msg], [])
+
 
 class Stress(unittest.TestCase):
 
@@ -0,0 +1,200 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from buildbot.db import pruning, state
+from buildbot.test.util import connector_component
+from buildbot.test.fake import fakedb
+
+DAY = 24 * 60 * 60
+
+class TestPruningConnectorComponent(
+            connector_component.ConnectorComponentMixin,
+            unittest.TestCase):
+
+    # the clock starts 30 days after the 'old' rows were submitted
+    OLD = 1000000
+    NEW = OLD + 29 * DAY
+
+    def setUp(self):
+        d = self.setUpConnectorComponent(
+            table_names=['patches', 'changes', 'sourcestamp_changes',
+                'sourcestampsets', 'sourcestamps', 'buildsets',
+                'buildset_properties', 'buildrequests', 'objects',
+                'buildrequest_claims', 'builds', 'object_state'])
+
+        def finish_setup(_):
+            self.db.state = state.StateConnectorComponent(self.db)
+            self.db.pruning = pruning.PruningConnectorComponent(self.db)
+            self.db.pruning.batchInterval = 0
+        d.addCallback(finish_setup)
+
+        self.clock = task.Clock()
+        self.clock.advance(self.OLD + 30 * DAY)
+
+        return d
+
+    def tearDown(self):
+        return self.tearDownConnectorComponent()
+
+    def insertBuildset(self, bsid, brids, submitted_at, setid=None):
+        setid = setid or bsid
+        return [
+            fakedb.SourceStampSet(id=setid),
+            fakedb.Patch(id=setid, patch_author='me', patch_comment='c'),
+            fakedb.SourceStamp(id=setid, sourcestampsetid=setid, patchid=setid),
+            fakedb.Change(changeid=setid),
+            fakedb.SourceStampChange(sourcestampid=setid, changeid=setid),
+            fakedb.Buildset(id=bsid, sourcestampsetid=setid, submitted_at=submitted_at),
+            fakedb.BuildsetProperty(buildsetid=bsid),
+        ] + [fakedb.BuildRequest(id=brid, buildsetid=bsid, submitted_at=submitted_at)
+             for brid in brids]
+
+    def getIds(self, table_name, column='id'):
+        def thd(conn):
+            tbl = self.db.model.metadata.tables[table_name]
+            col = tbl.c[column]
+            return sorted(r[0] for r in conn.execute(tbl.select().with_only_columns([col])))
+        return self.db.pool.do(thd)
+
+    @defer.inlineCallbacks
+    def assertIds(self, table_name, expected, column='id'):
+        ids = yield self.getIds(table_name, column)
+        self.assertEqual(ids, expected)
+
+    # tests
+
+    @defer.inlineCallbacks
+    def test_pruneBuildRequests_unconfigured(self):
+        yield self.insertTestData(self.insertBuildset(1, [1], self.OLD))
+        yield self.db.pruning.pruneBuildRequests(None, _reactor=self.clock)
+        yield self.assertIds('buildrequests', [1])
+
+    @defer.inlineCallbacks
+    def test_pruneBuildRequests(self):
+        yield self.insertTestData(
+            [fakedb.Object(id=1)] +
+            self.insertBuildset(1, [1, 2], self.OLD) +
+            self.insertBuildset(2, [3], self.NEW) +
+            [fakedb.BuildRequestClaim(brid=1, objectid=1, claimed_at=self.OLD),
+             fakedb.BuildRequestClaim(brid=3, objectid=1, claimed_at=self.NEW),
+             fakedb.Build(id=1, brid=1),
+             fakedb.Build(id=2, brid=3)])
+
+        yield self.db.pruning.pruneBuildRequests(7, _reactor=self.clock)
+
+        yield self.assertIds('buildrequests', [3])
+        yield self.assertIds('buildrequest_claims', [3], column='brid')
+        yield self.assertIds('builds', [2])
+        yield self.assertIds('buildsets', [2])
+        yield self.assertIds('buildset_properties', [2], column='buildsetid')
+        yield self.assertIds('sourcestampsets', [2])
+        yield self.assertIds('sourcestamps', [2])
+        yield self.assertIds('sourcestamp_changes', [2], column='sourcestampid')
+        yield self.assertIds('patches', [2])
+
+    @defer.inlineCallbacks
+    def test_pruneBuildRequests_shared_sourcestampset(self):
+        yield self.insertTestData(
+            self.insertBuildset(1, [1], self.OLD) +
+            [fakedb.Buildset(id=2, sourcestampsetid=1, submitted_at=self.NEW),
+             fakedb.BuildRequest(id=2, buildsetid=2, submitted_at=self.NEW)])
+
+        yield self.db.pruning.pruneBuildRequests(7, _reactor=self.clock)
+
+        yield self.assertIds('buildsets', [2])
+        yield self.assertIds('sourcestampsets', [1])
+        yield self.assertIds('sourcestamps', [1])
+
+    @defer.inlineCallbacks
+    def test_pruneBuildRequests_clears_references(self):
+        yield self.insertTestData(
+            self.insertBuildset(1, [1], self.OLD) +
+            self.insertBuildset(2, [], self.NEW) +
+            [fakedb.BuildRequest(id=2, buildsetid=2, submitted_at=self.NEW,
+                                 triggeredbybrid=1, startbrid=1, mergebrid=1,
+                                 artifactbrid=1)])
+
+        yield self.db.pruning.pruneBuildRequests(7, _reactor=self.clock)
+
+        def thd(conn):
+            tbl = self.db.model.buildrequests
+            row = conn.execute(tbl.select(tbl.c.id == 2)).fetchone()
+            self.assertEqual((row.triggeredbybrid, row.startbrid, row.mergebrid,
+                              row.artifactbrid), (None, None, None, None))
+        yield self.db.pool.do(thd)
+
+    @defer.inlineCallbacks
+    def test_pruneBuildRequests_batches(self):
+        self.db.pruning.batchSize = 1
+        self.db.pruning.batchInterval = 10
+        yield self.insertTestData(
+            self.insertBuildset(1, [1], self.OLD) +
+            self.insertBuildset(2, [2], self.OLD) +
+            self.insertBuildset(3, [3], self.NEW))
+
+        d = self.db.pruning.pruneBuildRequests(7, _reactor=self.clock)
+
+        # the first transaction is done, then the pruning waits
+        ids = None
+        while ids != [2, 3]:
+            ids = yield self.getIds('buildsets')
+        for _ in range(10):
+            yield self.db.pool.do(lambda conn : None)
+        yield self.assertIds('buildsets', [2, 3])
+        self.assertFalse(d.called)
+
+        while not d.called:
+            self.clock.advance(10)
+            yield self.db.pool.do(lambda conn : None)
+
+        yield self.assertIds('buildsets', [3])
+
+    @defer.inlineCallbacks
+    def test_pruneBuildRequests_resumes(self):
+        yield self.insertTestData(
+            self.insertBuildset(1, [1], self.OLD) +
+            self.insertBuildset(2, [2], self.OLD) +
+            [fakedb.Object(id=5, name='pruning',
+                           class_name='buildbot.db.pruning.PruningConnectorComponent'),
+             fakedb.ObjectState(objectid=5, name='last_buildsetid', value_json='1')])
+
+        yield self.db.pruning.pruneBuildRequests(7, _reactor=self.clock)
+
+        # the stored cursor says buildset 1 was already handled
+        yield self.assertIds('buildsets', [1])
+        last_bsid = yield self.db.state.getState(5, 'last_buildsetid')
+        self.assertEqual(last_bsid, 2)
+
+    @defer.inlineCallbacks
+    def test_pruneBuildRequests_orphans(self):
+        yield self.insertTestData(
+            [fakedb.Object(id=1)] +
+            self.insertBuildset(2, [2], self.NEW) +
+            [fakedb.BuildRequestClaim(brid=1, objectid=1, claimed_at=self.OLD),
+             fakedb.BuildRequestClaim(brid=2, objectid=1, claimed_at=self.NEW),
+             fakedb.BuildsetProperty(buildsetid=1),
+             fakedb.Patch(id=1, patch_author='me', patch_comment='c'),
+             fakedb.SourceStamp(id=1, sourcestampsetid=1, patchid=1),
+             fakedb.SourceStampChange(sourcestampid=1, changeid=2)])
+
+        yield self.db.pruning.pruneBuildRequests(7, _reactor=self.clock)
+
+        yield self.assertIds('buildrequest_claims', [2], column='brid')
+        yield self.assertIds('buildset_properties', [2], column='buildsetid')
+        yield self.assertIds('sourcestamps', [2])
+        yield self.assertIds('sourcestamp_changes', [2], column='sourcestampid')
+        yield self.assertIds('patches', [2])
@@ -246,3 +246,35 @@ class TestSourceStampsConnectorComponent(
         d.addCallback(checkRevision, codebase='c2', revision='r2')
 
         return d
+
+    def test_updateSourceStamps_merge_key(self):
+        d = self.insertTestData([
+            fakedb.SourceStampSet(id=1),
+            fakedb.SourceStamp(id=1, sourcestampsetid=1, branch='b1', revision= None,
+                repository='rep', codebase='c1'),
+            fakedb.Buildset(id=10, sourcestampsetid=1),
+        ])
+
+        ssdicts = [{'b_codebase': 'c1', 'b_revision': 'r1', 'b_sourcestampsetid': 1}]
+
+        d.addCallback(lambda _ :
+                self.db.sourcestamps.updateSourceStamps(ssdicts))
+
+        def checkMergeKey(_):
+            def thd(conn):
+                tbl = self.db.model.buildsets
+                r = conn.execute(tbl.select(tbl.c.id == 10))
+                self.assertEqual(r.fetchone().merge_key,
+                                 sourcestamps.getMergeKey([('c1', 'b1', 'r1')]))
+            return self.db.pool.do(thd)
+        d.addCallback(checkMergeKey)
+
+        return d
+
+    def test_getMergeKey_order(self):
+        self.assertEqual(
+            sourcestamps.getMergeKey([('c1', 'b1', 'r1'), ('c2', 'b2', None)]),
+            sourcestamps.getMergeKey([('c2', 'b2', None), ('c1', 'b1', 'r1')]))
+        self.assertNotEqual(
+            sourcestamps.getMergeKey([('c1', 'b1', 'r1')]),
+            sourcestamps.getMergeKey([('c1', 'b1', 'r2')]))
@@ -205,6 +205,33 @@ class Subscriptions(dirs.DirsMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    @defer.inlineCallbacks
+    def test_addBuildsets(self):
+        self.master.db = mock.Mock()
+        self.master.buildrequest_merger = mock.Mock()
+        self.master.buildrequest_merger.addBuildsets.return_value = \
+            defer.succeed([(938593, dict(a=19)), (938594, dict(a=20))])
+
+        cb = mock.Mock()
+        self.master.subscribeToBuildsets(cb)
+
+        buildsets = [dict(reason='r', properties={}, builderNames=['a']),
+                     dict(reason='r', properties={}, builderNames=['a'],
+                          external_idstring='extid')]
+        results = yield self.master.addBuildsets(sourcestampsetid=999,
+                buildsets=buildsets, triggeredbybrid=5)
+
+        self.master.buildrequest_merger.addBuildsets.assert_called_with(
+            sourcestampsetid=999, buildsets=buildsets, triggeredbybrid=5)
+        self.assertEqual(results, [(938593, dict(a=19)), (938594, dict(a=20))])
+        self.assertEqual(cb.call_args_list, [
+            mock.call(bsid=938593, sourcestampsetid=999, reason='r',
+                      properties={}, builderNames=['a'], triggeredbybrid=5,
+                      external_idstring=None),
+            mock.call(bsid=938594, sourcestampsetid=999, reason='r',
+                      properties={}, builderNames=['a'], triggeredbybrid=5,
+                      external_idstring='extid')])
+
     def test_buildset_completion_subscription(self):
         self.master.db = mock.Mock()
 
@@ -607,6 +634,101 @@ class Polling(dirs.DirsMixin, misc.PatcherMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def setUpNotifications(self):
+        self.published = []
+        transport = mock.Mock()
+        transport.publish = lambda event, kwargs: self.published.append((event, kwargs))
+        self.master.bus.transport = transport
+
+    @defer.inlineCallbacks
+    def test_changeNotified(self):
+        self.db.insertTestData([
+            fakedb.Object(id=53, name=self.master_name,
+                          class_name='buildbot.master.BuildMaster'),
+            fakedb.ObjectState(objectid=53, name='last_processed_change',
+                               value_json='10'),
+            fakedb.Change(changeid=10),
+            fakedb.Change(changeid=11),
+            fakedb.Change(changeid=12),
+        ])
+        yield self.master.changeNotified(12)
+        # notified twice
+        yield self.master.changeNotified(12)
+        self.assertEqual([ch.number for ch in self.gotten_changes], [12])
+
+        # the poll delivers the other changes only
+        yield self.master.pollDatabaseChanges()
+        self.assertEqual([ch.number for ch in self.gotten_changes], [12, 11])
+        self.assertEqual(self.master._notified_changeids, set())
+
+        # and notifications of changes already polled are ignored
+        yield self.master.changeNotified(11)
+        self.assertEqual([ch.number for ch in self.gotten_changes], [12, 11])
+
+    def test_buildRequestAdded_notifies(self):
+        self.setUpNotifications()
+        self.master.buildRequestAdded(9, 11, 'eleventy')
+        self.master.deliverBuildRequestAdded(9, 12, 'twelve')
+        self.assertEqual(self.gotten_buildrequest_additions, [
+            dict(bsid=9, brid=11, buildername='eleventy'),
+            dict(bsid=9, brid=12, buildername='twelve')])
+        self.assertEqual(self.published, [
+            ('buildrequestAdded', dict(bsid=9, brid=11, buildername='eleventy'))])
+
+    @defer.inlineCallbacks
+    def test_maybeBuildsetComplete_notifies(self):
+        self.setUpNotifications()
+        self.db.insertTestData([
+            fakedb.SourceStampSet(id=127),
+            fakedb.Buildset(id=99, sourcestampsetid=127),
+            fakedb.BuildRequest(id=11, buildsetid=99, complete=1, results=0),
+        ])
+        yield self.master.maybeBuildsetComplete(99)
+        self.assertEqual(self.gotten_buildset_completions, [(99, 0)])
+        self.assertEqual(self.published, [
+            ('buildsetComplete', dict(bsid=99))])
+
+    @defer.inlineCallbacks
+    def test_pollDatabaseBuildsets(self):
+        self.db.insertTestData([
+            fakedb.SourceStampSet(id=127),
+            fakedb.Buildset(id=97, sourcestampsetid=127),
+            fakedb.Buildset(id=98, sourcestampsetid=127),
+            fakedb.Buildset(id=99, sourcestampsetid=127, complete=1,
+                            results=2),
+            fakedb.BuildRequest(id=11, buildsetid=97, complete=1, results=0),
+            fakedb.BuildRequest(id=12, buildsetid=97, complete=1, results=2),
+            fakedb.BuildRequest(id=13, buildsetid=98, complete=0),
+            fakedb.BuildRequest(id=14, buildsetid=99, complete=1, results=2),
+        ])
+        calls = []
+        getBuildsetsCompletion = self.db.buildsets.getBuildsetsCompletion
+        def spy(bsids):
+            calls.append(bsids)
+            return getBuildsetsCompletion(bsids)
+        self.patch(self.db.buildsets, 'getBuildsetsCompletion', spy)
+
+        # nothing watched, nothing queried
+        yield self.master.pollDatabaseBuildsets()
+        self.assertEqual(calls, [])
+
+        for bsid in (97, 98, 99, 100):
+            self.master.watchBuildsetCompletion(bsid)
+        yield self.master.pollDatabaseBuildsets()
+
+        self.assertEqual(calls, [[97, 98, 99, 100]])
+        self.assertEqual(sorted(self.gotten_buildset_completions),
+                         [(97, 2), (99, 2)])
+        self.assertEqual(self.db.buildsets.buildsets[97]['complete'], 1)
+        self.assertEqual(self.db.buildsets.buildsets[97]['results'], 2)
+        self.assertEqual(self.db.buildsets.buildsets[98]['complete'], 0)
+        # the completed buildsets are no longer watched
+        self.assertEqual(self.master._watched_buildsets, set([98, 100]))
+
+        self.master.unwatchBuildsetCompletion(100)
+        yield self.master.pollDatabaseBuildsets()
+        self.assertEqual(calls[1:], [[98]])
+
     def test_pollDatabaseBuildRequests_empty(self):
         d = self.master.pollDatabaseBuildRequests()
         def check(_):
@@ -630,7 +752,61 @@ class Polling(dirs.DirsMixin, misc.PatcherMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    @defer.inlineCallbacks
+    def test_pollDatabaseBuildRequests_high_watermark(self):
+        self.db.insertTestData([
+            fakedb.BuildRequest(id=11, buildsetid=9, buildername='eleventy'),
+        ])
+        yield self.master.pollDatabaseBuildRequests()
+        self.assertEqual(self.master._last_unclaimed_brid, 11)
+
+        self.db.insertTestData([
+            fakedb.BuildRequest(id=12, buildsetid=9, buildername='twelve'),
+        ])
+        calls = []
+        getUnclaimedBuildRequests = self.db.buildrequests.getUnclaimedBuildRequests
+        def spy(**kwargs):
+            calls.append(kwargs)
+            return getUnclaimedBuildRequests(**kwargs)
+        self.patch(self.db.buildrequests, 'getUnclaimedBuildRequests', spy)
+        yield self.master.pollDatabaseBuildRequests()
+
+        # only the requests added since the last poll are fetched
+        self.assertEqual(calls, [dict(greater_than=11)])
+        self.assertEqual(self.master._last_unclaimed_brid, 12)
+        self.assertEqual(self.master._last_unclaimed_brids_set, set([11, 12]))
+        self.assertEqual(self.gotten_buildrequest_additions, [
+            dict(bsid=9, brid=11, buildername='eleventy'),
+            dict(bsid=9, brid=12, buildername='twelve'),
+        ])
+
+    @defer.inlineCallbacks
+    def test_pollDatabaseBuildRequests_reconcile(self):
+        self.db.insertTestData([
+            fakedb.BuildRequest(id=11, buildsetid=9, buildername='eleventy'),
+            fakedb.BuildRequest(id=12, buildsetid=9, buildername='twelve'),
+        ])
+        self.db.buildrequests.fakeClaimBuildRequest(11)
+        yield self.master.pollDatabaseBuildRequests()
+        self.db.buildrequests.fakeUnclaimBuildRequest(11)
+
+        # brid 11 is below the highest brid seen, so it is only noticed by
+        # the next full poll
+        yield self.master.pollDatabaseBuildRequests()
+        self.assertEqual(self.gotten_buildrequest_additions, [
+            dict(bsid=9, brid=12, buildername='twelve'),
+        ])
+        self.master._last_unclaimed_reconcile -= self.master.UNCLAIMED_RECONCILE_INTERVAL
+        yield self.master.pollDatabaseBuildRequests()
+        self.assertEqual(self.gotten_buildrequest_additions, [
+            dict(bsid=9, brid=12, buildername='twelve'),
+            dict(bsid=9, brid=11, buildername='eleventy'),
+        ])
+
     def test_pollDatabaseBuildRequests_incremental(self):
+        # every poll is a full poll, noticing the claimed requests and those
+        # unclaimed again
+        self.master.UNCLAIMED_RECONCILE_INTERVAL = 0
         d = defer.succeed(None)
         def insert1(_):
             self.db.insertTestData([
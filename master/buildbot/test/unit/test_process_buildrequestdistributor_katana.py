@@ -85,7 +85,8 @@ class TestKatanaBuildRequestDistributorGetNextPriorityBuilder(unittest.TestCase,
         self.expectedLog =["getNextPriorityBuilder found 2 buildrequests in the 'unclaimed' Queue",
                            "BuildRequest 2 uses unknown builder bldr2"]
         def addLog(value=None, metric=None):
-            self.log.append(value)
+            if metric is None:
+                self.log.append(value)
 
         self.patch(log, 'msg', addLog)
 
@@ -112,7 +113,8 @@ class TestKatanaBuildRequestDistributorGetNextPriorityBuilder(unittest.TestCase,
         self.expectedLog =["getNextPriorityBuilder found 2 buildrequests in the 'unclaimed' Queue",
                            "BuildRequest 2 uses builder bldr2 with no configuration"]
         def addLog(value=None, metric=None):
-            self.log.append(value)
+            if metric is None:
+                self.log.append(value)
 
         self.patch(log, 'msg', addLog)
 
@@ -270,6 +272,208 @@ class TestKatanaBuildRequestDistributorGetNextPriorityBuilder(unittest.TestCase,
         self.assertEquals((breq.buildername, breq.id), ("bldr1", 2))
 
 
+class TestKatanaBuildRequestDistributorQueueIndex(unittest.TestCase, KatanaBuildRequestDistributorTestSetup):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield self.setUpComponents()
+        yield self.setUpKatanaBuildRequestDistributor()
+        self.setupBuilderInMaster(name='bldr1', slavenames={'slave-01': True}, startSlavenames={'slave-02': True})
+        self.setupBuilderInMaster(name='bldr2', slavenames={'slave-03': True}, startSlavenames={'slave-04': True})
+
+        testdata = [fakedb.BuildRequest(id=1, buildsetid=1, buildername="bldr1",
+                                        priority=20, submitted_at=1449578391),
+                    fakedb.BuildRequest(id=2, buildsetid=2, buildername="bldr2",
+                                        priority=50, submitted_at=1450171039)]
+        testdata += self.getBuildSetTestData(xrange=xrange(1, 3))
+        yield self.insertTestData(testdata)
+
+        self.queueQueries = []
+        getBuildRequestsInQueue = self.db.buildrequests.getBuildRequestsInQueue
+
+        def countQueries(queue, **kwargs):
+            self.queueQueries.append((queue, kwargs.get('brids')))
+            return getBuildRequestsInQueue(queue=queue, **kwargs)
+
+        self.patch(self.db.buildrequests, 'getBuildRequestsInQueue', countQueries)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.tearDownComponents()
+        yield self.stopKatanaBuildRequestDistributor()
+
+    @defer.inlineCallbacks
+    def insertBuildRequest(self, brid, priority):
+        yield self.insertTestData([fakedb.BuildRequest(id=brid, buildsetid=brid, buildername="bldr1",
+                                                       priority=priority, submitted_at=1449578391)]
+                                  + self.getBuildSetTestData(xrange=xrange(brid, brid + 1)))
+
+    @defer.inlineCallbacks
+    def getNextBrid(self):
+        breq = yield self.brd.katanaBuildChooser.getNextPriorityBuilder(queue=Queue.unclaimed)
+        defer.returnValue(breq.id if breq else None)
+
+    @defer.inlineCallbacks
+    def test_queueIsLoadedOnce(self):
+        brid = yield self.getNextBrid()
+        self.assertEqual(brid, 2)
+        self.brd._checkBuildRequests()
+        brid = yield self.getNextBrid()
+        self.assertEqual(brid, 2)
+        self.assertEqual(self.queueQueries, [(Queue.unclaimed, None)])
+
+    @defer.inlineCallbacks
+    def test_buildRequestAdded(self):
+        yield self.getNextBrid()
+        yield self.insertBuildRequest(brid=3, priority=100)
+
+        brid = yield self.getNextBrid()
+        self.assertEqual(brid, 2)
+
+        self.master.buildRequestAdded(3, 3, "bldr1")
+        brid = yield self.getNextBrid()
+        self.assertEqual(brid, 3)
+        self.assertEqual(self.queueQueries, [(Queue.unclaimed, None), (Queue.unclaimed, [3])])
+
+    @defer.inlineCallbacks
+    def test_buildRequestRemoved(self):
+        yield self.getNextBrid()
+        self.master.buildRequestRemoved(2, 2, "bldr2")
+        brid = yield self.getNextBrid()
+        self.assertEqual(brid, 1)
+
+    @defer.inlineCallbacks
+    def test_removeBuildRequests(self):
+        breq = yield self.brd.katanaBuildChooser.getNextPriorityBuilder(queue=Queue.unclaimed)
+        self.brd.katanaBuildChooser.removeBuildRequests([breq])
+        brid = yield self.getNextBrid()
+        self.assertEqual(brid, 1)
+
+    @defer.inlineCallbacks
+    def test_retryBuildRequestIsParkedUntilNextPass(self):
+        yield self.getNextBrid()
+        self.brd.katanaBuildChooser.nextBreq.retries = 4
+        self.brd.katanaBuildChooser.retryBuildRequest()
+
+        brid = yield self.getNextBrid()
+        self.assertEqual(brid, 1)
+
+        self.brd._checkBuildRequests()
+        brid = yield self.getNextBrid()
+        self.assertEqual(brid, 2)
+
+    @defer.inlineCallbacks
+    def test_queueIsReloadedWhenTooOld(self):
+        yield self.getNextBrid()
+        self.brd.katanaBuildChooser.buildRequestQueuesLoadedAt -= \
+            self.brd.katanaBuildChooser.BUILD_REQUEST_QUEUE_MAX_AGE + 1
+        yield self.insertBuildRequest(brid=3, priority=100)
+
+        self.brd._checkBuildRequests()
+        brid = yield self.getNextBrid()
+        self.assertEqual(brid, 3)
+        self.assertEqual(self.queueQueries, [(Queue.unclaimed, None), (Queue.unclaimed, None)])
+
+
+class TestKatanaBuildRequestDistributorBatch(unittest.TestCase, KatanaBuildRequestDistributorTestSetup):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield self.setUpComponents()
+        yield self.setUpKatanaBuildRequestDistributor()
+        self.master.config.buildRequestDistributorBatchSize = 10
+        self.initialized()
+
+        self.claimedGroups = []
+        claimBuildRequestGroups = self.db.buildrequests.claimBuildRequestGroups
+
+        def trackClaims(groups, **kwargs):
+            self.claimedGroups.append(groups)
+            return claimBuildRequestGroups(groups, **kwargs)
+
+        self.patch(self.db.buildrequests, 'claimBuildRequestGroups', trackClaims)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.tearDownComponents()
+        yield self.stopKatanaBuildRequestDistributor()
+
+    def setupBuilder(self, idleSlaves):
+        self.setupBuilderInMaster(name='bldr1', slavenames={'slave-01': True},
+                                  startSlavenames=self.createSlaveList(available=True,
+                                                                       xrange=xrange(idleSlaves)))
+
+    def checkProcessedBuilds(self, expectedBrids):
+        self.assertEqual([brids for (slave, brids) in self.processedBuilds], expectedBrids)
+        slaves = [slave for (slave, brids) in self.processedBuilds]
+        self.assertEqual(len(set(slaves)), len(slaves))
+
+    @defer.inlineCallbacks
+    def test_startsBuildsOnAllIdleSlaves(self):
+        self.setupBuilder(idleSlaves=3)
+        self.insertBuildrequests('bldr1', 50, xrange(1, 6))
+        yield self.insertTestData(self.testdata)
+
+        yield self.brd._maybeStartOrResumeBuildsOn(['bldr1'])
+
+        self.checkProcessedBuilds([[1], [2], [3]])
+        self.assertEqual(self.claimedGroups, [[[1], [2], [3]]])
+        brdicts = yield self.db.buildrequests.getBuildRequestsInQueue(queue=Queue.unclaimed)
+        self.assertEqual(sorted(br['brid'] for br in brdicts), [4, 5])
+        self.checkBRDCleanedUp()
+
+    @defer.inlineCallbacks
+    def test_batchSize(self):
+        self.master.config.buildRequestDistributorBatchSize = 2
+        self.setupBuilder(idleSlaves=5)
+        self.insertBuildrequests('bldr1', 50, xrange(1, 6))
+        yield self.insertTestData(self.testdata)
+
+        yield self.brd._maybeStartOrResumeBuildsOn(['bldr1'])
+
+        self.checkProcessedBuilds([[1], [2], [3], [4], [5]])
+        self.assertEqual(self.claimedGroups, [[[1], [2]], [[3], [4]], [[5]]])
+
+    @defer.inlineCallbacks
+    def test_claimsMergedBuildRequests(self):
+        self.setupBuilder(idleSlaves=3)
+        sources = [{'repository': 'repo1', 'codebase': 'cb1', 'branch': 'master', 'revision': 'asz3113'}]
+        self.insertBuildrequests('bldr1', 50, xrange(1, 4), sources=sources)
+        self.insertBuildrequests('bldr1', 40, xrange(1, 2))
+        yield self.insertTestData(self.testdata)
+
+        yield self.brd._maybeStartOrResumeBuildsOn(['bldr1'])
+
+        self.checkProcessedBuilds([[1, 2, 3], [4]])
+        self.assertEqual(self.claimedGroups, [[[1, 2, 3], [4]]])
+        brdicts = yield self.db.buildrequests.getBuildRequests(brids=[2, 3])
+        self.assertEqual([br['mergebrid'] for br in brdicts], [1, 1])
+
+    @compat.usesFlushLoggedErrors
+    @defer.inlineCallbacks
+    def test_claimsOneByOneWhenAlreadyClaimed(self):
+        self.setupBuilder(idleSlaves=3)
+        self.insertBuildrequests('bldr1', 50, xrange(1, 4))
+        yield self.insertTestData(self.testdata)
+
+        claimBuildRequestGroups = self.brd.katanaBuildChooser.claimBuildRequestGroups
+
+        @defer.inlineCallbacks
+        def claimedByOtherMaster(breqsGroups):
+            yield self.insertTestData([fakedb.BuildRequestClaim(brid=2, objectid=self.MASTER_ID + 1,
+                                                                claimed_at=1449578391)])
+            self.brd.katanaBuildChooser.claimBuildRequestGroups = claimBuildRequestGroups
+            yield claimBuildRequestGroups(breqsGroups)
+
+        self.brd.katanaBuildChooser.claimBuildRequestGroups = claimedByOtherMaster
+
+        yield self.brd._maybeStartOrResumeBuildsOn(['bldr1'])
+
+        self.checkProcessedBuilds([[1], [3]])
+        self.assertEqual(len(self.flushLoggedErrors(AlreadyClaimedError)), 1)
+        self.checkBRDCleanedUp()
+
+
 class TestKatanaBuildRequestDistributorMaybeStartBuildsOn(KatanaBuildRequestDistributorTestSetup, unittest.TestCase):
 
     @defer.inlineCallbacks
@@ -303,6 +507,8 @@ class TestKatanaBuildRequestDistributorMaybeStartBuildsOn(KatanaBuildRequestDist
             testdata += self.getBuildSetTestData(xrange=xrange(3, 5))
 
             yield self.insertTestData(testdata)
+            self.master.buildRequestAdded(3, 3, "bldr1")
+            self.master.buildRequestAdded(4, 4, "bldr2")
             self.brd.maybeStartBuildsOn(["bldr1", "bldr2"])
             self.insertData = False
         defer.returnValue(True)
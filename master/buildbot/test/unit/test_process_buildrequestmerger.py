@@ -0,0 +1,117 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+from twisted.trial import unittest
+from twisted.internet import defer
+from buildbot.process.buildrequestmerger import BuildRequestMerger
+
+class TestBuildRequestMerger(unittest.TestCase):
+
+    def setUp(self):
+        self.master = mock.Mock()
+        self.master.getObjectId.return_value = defer.succeed(13)
+        builder = mock.Mock()
+        builder.config.mergeProperties = ['part']
+        self.master.botmaster.builders = {'a': builder, 'b': builder}
+
+        db = self.master.db
+        db.sourcestamps.getSimpleSourceStamps.return_value = \
+                defer.succeed([dict(codebase='cb', branch='br', revision='r')])
+        # a running request of 'a', for the partition 2
+        db.buildrequests.getBuildRequests.side_effect = self.getBuildRequests
+        db.buildsets.getBuildsetsProperties.return_value = \
+                defer.succeed({7: dict(part=(2, 'PartitionTrigger'))})
+        db.builds.getBuildNumberForRequest.return_value = defer.succeed(70)
+        db.buildsets.addBuildsets.side_effect = lambda buildsets, **kwargs: \
+                defer.succeed([ (100 + i, {}) for i in range(len(buildsets)) ])
+
+        self.merger = BuildRequestMerger(self.master)
+
+    def getBuildRequests(self, buildername=None, complete=None, brids=None,
+                         **kwargs):
+        if complete:
+            # the builds to merge into are still running
+            return defer.succeed([])
+        if buildername == 'a':
+            return defer.succeed([dict(brid=71, buildsetid=7,
+                                       buildername='a', artifactbrid=None)])
+        return defer.succeed([])
+
+    @defer.inlineCallbacks
+    def test_addBuildsets(self):
+        results = yield self.merger.addBuildsets(sourcestampsetid=234,
+            buildsets=[
+                dict(reason='r', builderNames=['b', 'a'],
+                     properties=dict(part=(1, 'PartitionTrigger'))),
+                dict(reason='r', builderNames=['a'],
+                     properties=dict(part=(2, 'PartitionTrigger'))),
+                dict(reason='r', builderNames=['a'],
+                     properties=dict(part=(2, 'PartitionTrigger'),
+                                     selected_slave=('s', 'Force Build Form'))),
+            ], triggeredbybrid=5)
+
+        self.assertEqual(results, [(100, {}), (101, {}), (102, {})])
+
+        db = self.master.db
+        # the sourcestamps and the merge candidates are only read once
+        self.assertEqual(db.sourcestamps.getSimpleSourceStamps.call_count, 1)
+        self.assertEqual(
+            [ call[1]['buildername']
+              for call in db.buildrequests.getBuildRequests.call_args_list
+              if not call[1].get('complete') ],
+            ['a', 'b'])
+
+        # only the second buildset is merged into the running request
+        kwargs = db.buildsets.addBuildsets.call_args[1]
+        self.assertEqual(kwargs['triggeredbybrid'], 5)
+        self.assertEqual(kwargs['_master_objectid'], 13)
+        self.assertEqual([ (bs['builderNames'], bs['brDictsToMerge'])
+                           for bs in kwargs['buildsets'] ], [
+            (['a', 'b'], {}),
+            (['a'], {'a': dict(brid=71, buildsetid=7, buildername='a',
+                               artifactbrid=None, build_number=70)}),
+            (['a'], {}),
+        ])
+
+        # and the merging lock is released
+        self.assertFalse(self.merger.getMergingLocks([71])[0].locked)
+
+    @defer.inlineCallbacks
+    def test_addBuildsets_target_finished(self):
+        db = self.master.db
+        # the build to merge into finishes meanwhile
+        db.buildrequests.getBuildRequests.side_effect = lambda **kwargs: \
+                defer.succeed([dict(brid=71, buildsetid=7, buildername='a',
+                                    artifactbrid=None)])
+
+        yield self.merger.addBuildsets(sourcestampsetid=234,
+            buildsets=[dict(reason='r', builderNames=['a'],
+                            properties=dict(part=(2, 'PartitionTrigger')))])
+
+        kwargs = db.buildsets.addBuildsets.call_args[1]
+        self.assertEqual(kwargs['buildsets'][0]['brDictsToMerge'], {})
+        self.assertFalse(self.merger.getMergingLocks([71])[0].locked)
+
+    @defer.inlineCallbacks
+    def test_addBuildset(self):
+        result = yield self.merger.addBuildset(sourcestampsetid=234,
+                reason='r', properties={}, builderNames=['b'],
+                external_idstring='extid')
+        self.assertEqual(result, (100, {}))
+        kwargs = self.master.db.buildsets.addBuildsets.call_args[1]
+        self.assertEqual(kwargs['buildsets'], [
+            dict(reason='r', properties={}, builderNames=['b'],
+                 external_idstring='extid', brDictsToMerge={})])
@@ -0,0 +1,108 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from twisted.trial import unittest
+from buildbot.process.buildrequestqueue import BuildRequestQueue
+from buildbot.util import epoch2datetime
+
+
+def mkbrdict(brid, buildername, priority=50, submitted_at=1449578391):
+    return dict(brid=brid, buildername=buildername, priority=priority,
+                submitted_at=epoch2datetime(submitted_at), results=-1,
+                buildsetid=brid, selected_slave=None, slavepool=None, startbrid=None)
+
+
+class TestBuildRequestQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = BuildRequestQueue()
+        self.queue.load([mkbrdict(1, 'bldr1', priority=20),
+                         mkbrdict(2, 'bldr2', priority=50, submitted_at=1450171039),
+                         mkbrdict(3, 'bldr1', priority=50, submitted_at=1449578391),
+                         mkbrdict(4, 'bldr2', priority=100, submitted_at=1450171039),
+                         mkbrdict(5, 'bldr3', priority=50, submitted_at=1450171039)])
+
+    def brids(self, **kwargs):
+        return [br['brid'] for br in self.queue.iterByPriority(**kwargs)]
+
+    def test_load(self):
+        self.assertTrue(self.queue.loaded)
+        self.assertEqual(len(self.queue), 5)
+        self.assertTrue(3 in self.queue)
+        self.assertEqual(self.queue.get(3)['buildername'], 'bldr1')
+
+    def test_iterByPriority(self):
+        self.assertEqual(self.brids(), [4, 3, 2, 5, 1])
+
+    def test_iterByPrioritySkipBuilders(self):
+        skip = set()
+        brids = []
+        for br in self.queue.iterByPriority(skipBuilderNames=skip):
+            brids.append(br['brid'])
+            skip.add(br['buildername'])
+        self.assertEqual(brids, [4, 3, 5])
+
+    def test_iterByPriorityQueueModified(self):
+        brids = []
+        for br in self.queue.iterByPriority():
+            brids.append(br['brid'])
+            if br['brid'] == 3:
+                self.queue.add(mkbrdict(6, 'bldr1', priority=80))
+                self.queue.add(mkbrdict(7, 'bldr3', priority=10))
+        self.assertEqual(brids, [4, 3, 6, 2, 5, 1, 7])
+
+    def test_peek(self):
+        self.assertEqual(self.queue.peek('bldr1')['brid'], 3)
+        self.assertEqual(self.queue.peek('bldr4'), None)
+
+    def test_add_replaces(self):
+        self.queue.add(mkbrdict(1, 'bldr1', priority=100, submitted_at=1))
+        self.assertEqual(len(self.queue), 5)
+        self.assertEqual(self.brids(), [1, 4, 3, 2, 5])
+
+    def test_remove(self):
+        self.assertEqual(self.queue.remove(4)['brid'], 4)
+        self.assertEqual(self.queue.remove(4), None)
+        self.assertEqual(self.queue.remove(1)['brid'], 1)
+        self.assertEqual(len(self.queue), 3)
+        self.assertFalse(4 in self.queue)
+        self.assertEqual(self.brids(), [3, 2, 5])
+
+    def test_remove_compacts(self):
+        self.patch(BuildRequestQueue, 'COMPACT_THRESHOLD', 2)
+        self.queue.load([mkbrdict(brid, 'bldr1', priority=brid) for brid in range(10)])
+        for brid in range(1, 9):
+            self.queue.remove(brid)
+        # compacted after the 6th removal, the last 2 are still in the heap
+        self.assertEqual(len(self.queue._heaps['bldr1']), 4)
+        self.assertEqual(self.brids(), [9, 0])
+
+    def test_park_unpark(self):
+        self.queue.park(self.queue.get(4))
+        self.assertEqual(self.brids(), [3, 2, 5, 1])
+        self.queue.unpark()
+        self.assertEqual(self.brids(), [4, 3, 2, 5, 1])
+
+    def test_remove_parked(self):
+        self.queue.park(self.queue.get(4))
+        self.queue.remove(4)
+        self.queue.unpark()
+        self.assertEqual(self.brids(), [3, 2, 5, 1])
+
+    def test_clear(self):
+        self.queue.clear()
+        self.assertFalse(self.queue.loaded)
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.brids(), [])
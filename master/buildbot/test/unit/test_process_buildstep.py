@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 import re
+import zlib
 import mock
 from twisted.trial import unittest
 from twisted.internet import defer
@@ -361,7 +362,6 @@ class TestLoggingBuildStep(unittest.TestCase):
         status = lbs.evaluateCommand(cmd)
         self.assertEqual(status, WARNINGS, "evaluateCommand didn't call log_eval_func or overrode its results")
 
-
 class FailingCustomStep(buildstep.LoggingBuildStep):
 
     def __init__(self, exception=buildstep.BuildStepFailed, *args, **kwargs):
@@ -452,3 +452,22 @@ class TestRemoteShellCommand(unittest.TestCase):
         self.step.remote_complete()
         self.assertEqual(self.step.remote.broker.localObjects, expectedObjects)
         self.assertEqual(self.step.remote.broker.luids, expectedLuids)
+
+    def test_start_accepts_compressed_updates(self):
+        self.step.commandID = "1"
+        self.step.step = mock.Mock()
+        self.step._start()
+        args = self.step.remote.callRemote.call_args[0][4]
+        self.assertEqual(args['compressUpdates'], True)
+
+    def test_remote_update_compressed(self):
+        self.step.active = True
+        self.step.updates = {}
+        self.step.addStdout = mock.Mock()
+        self.step.addToLog = mock.Mock()
+        self.step.remote_update([
+            [{'compressed': {'stdout': zlib.compress('hello')}}, 0],
+            [{'compressed': {'log': ('make.log', zlib.compress('cc'))}}, 0]])
+        self.step.addStdout.assert_called_with('hello')
+        self.step.addToLog.assert_called_with('make.log', 'cc')
+        self.assertEqual(self.step.updates, {'log': [('make.log', 'cc')]})
@@ -231,3 +231,19 @@ class TestReports(unittest.TestCase):
 
         self.assertEquals("WARN alarm_foo: Uh oh", handler.report())
         self.assertEquals({"alarms": {"alarm_foo": ("WARN", "Uh oh")}}, handler.asDict())
+
+    def testMetricDBQueryReport(self):
+        handler = metrics.MetricDBQueryHandler(None)
+        handler.handle({}, metrics.MetricDBQueryEvent('builds.getBuild', 0.5, 0.002,
+                                                      retries=1, pending=3, threads=2))
+        handler.handle({}, metrics.MetricDBQueryEvent('builds.getBuild', 0, 0.02,
+                                                      pending=1, threads=2))
+
+        db = handler.asDict()['db']
+        self.assertEqual((db['threads'], db['pending'], db['max_pending'], db['saturated']),
+                         (2, 1, 3, 1))
+        query = db['queries']['builds.getBuild']
+        self.assertEqual((query['count'], query['retries']), (2, 1))
+        self.assertEqual(query['execute']['buckets'], {'<=0.0025': 1, '<=0.025': 1})
+        self.assertEqual(query['wait']['max'], 0.5)
+        self.assertIn("builds.getBuild", handler.report())
@@ -0,0 +1,138 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+from twisted.trial import unittest
+from twisted.internet import defer
+from buildbot import pbmanager
+from buildbot.process import notifications
+from buildbot.test.util import config
+
+class FakeConfig(object):
+    masterNotifications = None
+
+class TestNotificationBus(unittest.TestCase):
+
+    def makeBus(self, transport):
+        master = mock.Mock()
+        bus = notifications.NotificationBus(master)
+        bus.startService()
+        self.addCleanup(bus.stopService)
+        new_config = FakeConfig()
+        new_config.masterNotifications = transport
+        bus.reconfigService(new_config)
+        return bus
+
+    @defer.inlineCallbacks
+    def test_reconfigService(self):
+        transport = notifications.LocalNotificationTransport()
+        bus = self.makeBus(transport)
+        self.assertTrue(bus.active)
+        self.assertTrue(transport.running)
+        self.assertIdentical(transport.bus, bus)
+
+        # an identical transport is kept
+        new_config = FakeConfig()
+        new_config.masterNotifications = notifications.LocalNotificationTransport()
+        yield bus.reconfigService(new_config)
+        self.assertIdentical(bus.transport, transport)
+
+        yield bus.reconfigService(FakeConfig())
+        self.assertFalse(bus.active)
+        self.assertFalse(transport.running)
+        self.assertEqual(transport.bus, None)
+
+    def test_publish_inactive(self):
+        bus = self.makeBus(None)
+        self.successResultOf(bus.publish('change', changeid=1))
+
+    def test_local_transport(self):
+        bus1 = self.makeBus(notifications.LocalNotificationTransport())
+        bus2 = self.makeBus(notifications.LocalNotificationTransport())
+        bus3 = self.makeBus(notifications.LocalNotificationTransport('other'))
+
+        bus1.publish('buildrequestAdded', bsid=1, brid=2, buildername='bldr')
+        bus1.publish('buildrequestRemoved', bsid=1, brid=2, buildername='bldr')
+        bus2.master.maybeBuildsetsComplete.return_value = defer.succeed(None)
+        bus1.publish('buildsetComplete', bsid=1)
+
+        bus2.master.deliverBuildRequestAdded.assert_called_with(bsid=1, brid=2,
+                                                                buildername='bldr')
+        bus2.master.deliverBuildRequestRemoved.assert_called_with(bsid=1, brid=2,
+                                                                  buildername='bldr')
+        # the completion is checked in the database
+        bus2.master.maybeBuildsetsComplete.assert_called_with([1])
+        self.assertFalse(bus2.master._buildsetComplete.called)
+        self.assertFalse(bus1.master.deliverBuildRequestAdded.called)
+        self.assertFalse(bus3.master.deliverBuildRequestAdded.called)
+
+    def test_notificationReceived_change(self):
+        bus = self.makeBus(None)
+        bus.master.changeNotified.return_value = defer.succeed(None)
+        bus.notificationReceived('change', dict(changeid=13))
+        bus.master.changeNotified.assert_called_with(13)
+
+    def test_notificationReceived_unknown(self):
+        bus = self.makeBus(None)
+        bus.notificationReceived('buildStarted', dict(number=1))
+        self.assertEqual(bus.master.method_calls, [])
+
+class TestPBNotificationTransport(config.ConfigErrorsMixin, unittest.TestCase):
+
+    def makeTransport(self, peers):
+        # each master has its own PB manager
+        pbm = pbmanager.PBManager()
+        pbm.startService()
+        self.addCleanup(pbm.stopService)
+
+        transport = notifications.PBNotificationTransport(
+                'tcp:0:interface=127.0.0.1', peers, passwd='secret')
+        transport.bus = mock.Mock()
+        transport.bus.master.pbmanager = pbm
+        transport.startService()
+        self.addCleanup(transport.stopService)
+        return transport
+
+    def test_passwd_required(self):
+        self.assertRaisesConfigError("requires a passwd",
+            lambda : notifications.PBNotificationTransport('tcp:0', []))
+
+    def test_publish_not_connected(self):
+        transport = self.makeTransport(['127.0.0.1:1'])
+        transport.factories[0].stopTrying()
+        d = transport.publish('change', dict(changeid=1))
+        self.assertEqual(self.successResultOf(d), [])
+
+    @defer.inlineCallbacks
+    def test_publish(self):
+        listener = self.makeTransport([])
+        received = defer.Deferred()
+        listener.bus.notificationReceived = lambda event, kwargs: \
+                received.callback((event, kwargs))
+
+        port = listener.registration.getPort()
+        sender = self.makeTransport(['127.0.0.1:%d' % port])
+        connected = defer.Deferred()
+        factory = sender.factories[0]
+        gotPerspective = factory.gotPerspective
+        def wrap(perspective):
+            gotPerspective(perspective)
+            connected.callback(None)
+        factory.gotPerspective = wrap
+        yield connected
+
+        sender.publish('change', dict(changeid=12))
+        notification = yield received
+        self.assertEqual(notification, ('change', dict(changeid=12)))
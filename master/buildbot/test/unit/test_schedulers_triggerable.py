@@ -161,6 +161,9 @@ class TestTriggerableScheduler(scheduler.SchedulerMixin, unittest.TestCase):
         self.assertNotEqual(callbacks['buildset_completion'], None)
         self.assertFalse(self.fired)
 
+        # and that the master polls for the completion of the buildset
+        self.assertEqual(self.master.watched_bsids, set([bsid]))
+
         # pretend a non-matching buildset is complete
         callbacks['buildset_completion'](bsid+27, 3)
 
@@ -236,6 +239,67 @@ class TestTriggerableScheduler(scheduler.SchedulerMixin, unittest.TestCase):
         callbacks = self.master.getSubscriptionCallbacks()
         self.assertEqual(callbacks['buildset_completion'], None)
 
+    def test_stopService_unwatches(self):
+        sched = self.makeScheduler(codebases = {'cb':{'repository':'r'}})
+        sched.startService()
+        ss = {'revision':'myrev',
+              'branch':'br',
+              'project':'p',
+              'repository':'r',
+              'codebase':'cb' }
+        d = sched.trigger({'cb': ss})
+        self.assertEqual(len(self.master.watched_bsids), 1)
+        errors = []
+        d.addErrback(errors.append)
+
+        sched.stopService()
+
+        self.assertEqual(self.master.watched_bsids, set())
+        self.assertEqual(len(errors), 1)
+        errors[0].trap(triggerable.TriggerableSchedulerStopped)
+
+    def test_triggerMany(self):
+        sched = self.makeScheduler(codebases = {'cb':{'repository':'r'}})
+        ss = {'revision':'myrev',
+              'branch':'br',
+              'project':'p',
+              'repository':'r',
+              'codebase':'cb' }
+        props_list = []
+        for i in range(3):
+            props = properties.Properties()
+            props.setProperty('part', i, 'PartitionTrigger')
+            props_list.append(props)
+
+        dl = sched.triggerMany({'cb': ss}, set_props_list=props_list,
+                               triggeredbybrid=None)
+        self.assertEqual(len(dl), 3)
+
+        # all the buildsets share a single sourcestamp set
+        bsids = sorted(self.db.buildsets.buildsets)
+        self.assertEqual(len(bsids), 3)
+        self.assertEqual(set(self.db.buildsets.buildsets[bsid]['sourcestampsetid']
+                             for bsid in bsids), set([100]))
+        self.assertEqual([ self.db.buildsets.buildsets[bsid]['properties']['part']
+                           for bsid in bsids ],
+                         [ (i, 'PartitionTrigger') for i in range(3) ])
+        self.assertEqual(self.master.watched_bsids, set(bsids))
+
+        # the waiters fire as their buildsets complete
+        fired = []
+        for d in dl:
+            d.addCallback(lambda (result, brids): fired.append(result))
+        callbacks = self.master.getSubscriptionCallbacks()
+        callbacks['buildset_completion'](bsids[1], 11)
+        callbacks['buildset_completion'](bsids[0], 10)
+        self.assertEqual(fired, [11, 10])
+        callbacks['buildset_completion'](bsids[2], 12)
+        self.assertEqual(fired, [11, 10, 12])
+
+        # and the subscription is cancelled
+        callbacks = self.master.getSubscriptionCallbacks()
+        self.assertEqual(callbacks['buildset_completion'], None)
+
     def test_trigger_with_unknown_sourcestamp(self):
         # Test a scheduler with 2 repositories.
         # Trigger the scheduler with a sourcestamp that is unknown to the scheduler
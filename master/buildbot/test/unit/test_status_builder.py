@@ -5,7 +5,7 @@ from buildbot.status import buildrequest
 from buildbot.config import ProjectConfig
 from mock import Mock
 from buildbot.status.build import BuildStatus
-from buildbot.status.results import SUCCESS
+from buildbot.status.results import SUCCESS, FAILURE
 from buildbot.sourcestamp import SourceStamp
 from twisted.internet import defer
 from buildbot.status.master import Status
@@ -338,3 +338,59 @@ class TestBuilderStatus(unittest.TestCase):
         )
         self.assertEquals(len(cache), 2)
         self.assertEquals(cache, [{'brid': 1}, {'brid': 2}])
+
+
+class TestBuildPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = {}
+        self.builder_status = Mock()
+        def deferToThread(buildnumber):
+            d = self.loads[buildnumber] = defer.Deferred()
+            return d
+        self.builder_status.deferToThread = deferToThread
+
+    def test_window_and_order(self):
+        prefetcher = builder.BuildPrefetcher(self.builder_status, [5, 4, 3, 2], window=2)
+        self.assertEqual(sorted(self.loads), [4, 5])
+
+        results = []
+        d = prefetcher.next()
+        d.addCallback(results.append)
+        self.assertEqual(sorted(self.loads), [3, 4, 5])
+
+        # later builds finishing first don't change the order
+        self.loads[4].callback('build-4')
+        self.loads[5].callback('build-5')
+        prefetcher.next().addCallback(results.append)
+        prefetcher.next().addCallback(results.append)
+        prefetcher.next().addCallback(results.append)
+        self.loads[3].callback('build-3')
+        self.loads[2].callback('build-2')
+
+        self.assertEqual(results, ['build-5', 'build-4', 'build-3', 'build-2'])
+        self.assertEqual(prefetcher.next(), None)
+
+    def test_stopped(self):
+        stopped = defer.Deferred()
+        prefetcher = builder.BuildPrefetcher(self.builder_status, range(10, 0, -1),
+                                             window=3, stopped=stopped)
+        self.assertNotEqual(prefetcher.next(), None)
+        stopped.errback(RuntimeError('connection lost'))
+
+        self.assertEqual(prefetcher.next(), None)
+        self.assertEqual(sorted(self.loads), [7, 8, 9, 10])
+
+    @defer.inlineCallbacks
+    def test_getFinishedBuildsByNumbers(self):
+        builds = dict((n, Mock(name='build-%d' % n)) for n in range(5))
+        builds[2] = None
+        for n in (0, 1, 3, 4):
+            builds[n].getResults.return_value = SUCCESS if n != 3 else FAILURE
+
+        self.builder_status = builder.BuilderStatus('bldr', None, fakemaster.make_master())
+        self.builder_status.deferToThread = lambda n: defer.succeed(builds[n])
+
+        res = yield self.builder_status.getFinishedBuildsByNumbers([4, 3, 2, 1, 0],
+                                                                   results=[SUCCESS])
+        self.assertEqual(res, [builds[4], builds[1], builds[0]])
@@ -17,6 +17,10 @@ import os
 from mock import Mock
 from twisted.trial import unittest
 from buildbot.status import builder, master
+from buildbot.status.buildindex import BuildIndex
+from buildbot.status.results import SUCCESS, FAILURE
+from buildbot.sourcestamp import SourceStamp
+from buildbot.util.lru import LRUCache
 from buildbot.test.fake import fakemaster
 
 class TestBuildStatus(unittest.TestCase):
@@ -71,3 +75,30 @@ class TestBuildStatus(unittest.TestCase):
                              'propval%d' % build.number)
             self.assertEqual(b.buildCache.hits, hits+1)
             hits = hits + 1
+
+    def testGenerateFinishedBuildsUsesIndex(self):
+        b = self.setupBuilder('builder_1')
+        for i in xrange(5):
+            build = b.newBuild()
+            build.setSourceStamps([SourceStamp(branch='branch%d' % (i % 2), codebase='cb')])
+            build.buildStarted(build)
+            build.setResults(SUCCESS if i % 2 else FAILURE)
+            build.buildFinished()
+
+        # start from an empty cache, as after a restart
+        b.buildCache = LRUCache(b.cacheMiss)
+        b.buildIndex = BuildIndex(b)
+        loaded = []
+        loadBuildFromFile = b.loadBuildFromFile
+        def loadBuild(number):
+            loaded.append(number)
+            return loadBuildFromFile(number)
+        b.loadBuildFromFile = loadBuild
+
+        builds = list(b.generateFinishedBuilds(branches=['branch1']))
+        self.assertEqual([bs.number for bs in builds], [3, 1])
+        self.assertEqual(sorted(loaded), [1, 3])
+
+        builds = list(b.generateFinishedBuilds(codebases={'cb': 'branch0'}, results=[FAILURE]))
+        self.assertEqual([bs.number for bs in builds], [4, 2, 0])
+        self.assertEqual(sorted(loaded), [0, 1, 2, 3, 4])
@@ -0,0 +1,88 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import mock
+from twisted.trial import unittest
+from buildbot.status import buildindex
+from buildbot.status.results import SUCCESS, FAILURE
+from buildbot.sourcestamp import SourceStamp
+
+class TestBuildIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.builder_status = mock.Mock()
+        self.builder_status.name = 'bldr'
+        self.builder_status.basedir = os.path.abspath(self.mktemp())
+        os.mkdir(self.builder_status.basedir)
+        self.index = buildindex.BuildIndex(self.builder_status)
+
+    def makeBuild(self, number, results=SUCCESS, branch='master'):
+        build = mock.Mock()
+        build.number = number
+        build.getTimes.return_value = (10, 20)
+        build.getResults.return_value = results
+        build.getSlavename.return_value = 'slave'
+        build.getSourceStamps.return_value = [SourceStamp(branch=branch, codebase='cb',
+                                                          revision='abcd')]
+        return build
+
+    def reload(self):
+        return buildindex.BuildIndex(self.builder_status)
+
+    def test_addBuild(self):
+        self.index.addBuild(self.makeBuild(3))
+        self.assertEqual(self.reload().get(3),
+                         dict(number=3, results=SUCCESS, start=10, finished=20,
+                              slavename='slave', sourcestamps=[['cb', 'master', 'abcd']]))
+        self.assertEqual(self.reload().get(4), None)
+
+    def test_addBuild_again(self):
+        self.index.addBuild(self.makeBuild(3))
+        self.index.addBuild(self.makeBuild(3))
+        self.index.addBuild(self.makeBuild(3, results=FAILURE))
+
+        with open(self.index.getFilename()) as f:
+            self.assertEqual(len(f.readlines()), 2)
+        self.assertEqual(self.reload().get(3)['results'], FAILURE)
+
+    def test_corrupted_line(self):
+        self.index.addBuild(self.makeBuild(1))
+        with open(self.index.getFilename(), "a") as f:
+            f.write('{"number": 2, "res')
+        index = self.reload()
+        self.assertEqual(index.get(1)['number'], 1)
+        self.assertEqual(index.get(2), None)
+
+    def test_prune(self):
+        for number in range(5):
+            self.index.addBuild(self.makeBuild(number))
+        self.index.prune(3)
+
+        index = self.reload()
+        self.assertEqual([n for n in range(5) if index.get(n)], [3, 4])
+
+    def test_no_basedir(self):
+        self.builder_status.basedir = None
+        index = self.reload()
+        index.addBuild(self.makeBuild(1))
+        self.assertEqual(index.get(1)['number'], 1)
+
+    def test_filters(self):
+        entry = buildindex.BuildIndex.makeEntry(self.makeBuild(1, branch='b1'))
+        self.assertEqual(buildindex.getEntryBranches(entry), set(['b1']))
+        self.assertTrue(buildindex.foundCodebasesInEntry(entry, {'cb': 'b1'}))
+        self.assertFalse(buildindex.foundCodebasesInEntry(entry, {'cb': 'b2'}))
+        self.assertFalse(buildindex.foundCodebasesInEntry(entry, {'other': 'b1'}))
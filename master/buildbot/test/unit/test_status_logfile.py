@@ -20,7 +20,7 @@ import cStringIO, cPickle
 import mock
 import time
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, task
 from buildbot.status import logfile
 from buildbot.test.util import dirs
 from buildbot import config
@@ -339,3 +339,124 @@ class TestLogFile(unittest.TestCase, dirs.DirsMixin):
         self.config.logCompressionMethod = None
         return self.do_test_compressLog('', expect_comp=False)
 
+
+    # chunk index
+
+    def addLines(self, count, channel=logfile.STDOUT):
+        for i in range(count):
+            self.logfile.addEntry(channel, 'line %d\n' % i)
+        # merge the run of entries
+        self.logfile.addEntry(logfile.HEADER, 'hdr\n')
+
+    def test_finish_saves_chunkIndex(self):
+        self.logfile.chunkSize = 20
+        self.addLines(10)
+        self.logfile.finish()
+        self.assertEqual(self.logfile.chunkIndex, None)
+        records = self.logfile.getChunkIndex()
+        self.assertTrue(all(r[3] <= 20 and r[1] == -1 for r in records))
+        self.assertEqual(sum(r[3] for r in records if r[5] == 0), 70)
+        self.assertEqual(sum(r[4] for r in records if r[5] == 0), 10)
+        self.assertEqual(records[-1][3:], (4, 1, 2))
+
+    def test_getLines(self):
+        self.logfile.chunkSize = 20
+        self.addLines(10)
+        self.logfile.addStdout('line 10\nlast')
+        expected = ''.join('line %d\n' % i for i in range(11)) + 'last'
+        lines = cStringIO.StringIO(expected).readlines()
+
+        def check():
+            for first, last in [(0, None), (3, 7), (-2, None), (-5, -1),
+                                (9, 100), (11, 11), (5, 2)]:
+                self.assertEqual(self.logfile.getLines(first, last),
+                                 ''.join(lines[first:last]))
+            self.assertEqual(self.logfile.getLines(10, 11, channels=[]),
+                             'hdr\n')
+            self.assertEqual(self.logfile.getLines(-1, channels=[logfile.HEADER]),
+                             'hdr\n')
+        check()
+        self.logfile.finish()
+        check()
+        self.pickle_and_restore()
+        check()
+
+    def test_getBytes(self):
+        self.logfile.chunkSize = 20
+        self.addLines(10)
+        self.logfile.addStderr('errors')
+        self.logfile.finish()
+        text = ''.join('line %d\n' % i for i in range(10)) + 'errors'
+        for start, end in [(0, None), (15, 45), (-10, None), (70, 100), (5, 5)]:
+            self.assertEqual(self.logfile.getBytes(start, end), text[start:end])
+
+    def test_getLines_no_index(self):
+        self.addLines(10)
+        self.logfile.finish()
+        os.unlink(self.logfile.getIndexFilename())
+        self.assertEqual(self.logfile.getLines(-2), 'line 8\nline 9\n')
+        self.assertEqual(self.logfile.getBytes(0, 6), 'line 0')
+
+    @defer.inlineCallbacks
+    def test_compressLog_gz_blocks(self):
+        self.config.logCompressionMethod = 'gz'
+        self.logfile.chunkSize = 20
+        self.logfile.compressionBlockSize = 50
+        self.addLines(100)
+        self.logfile.finish()
+        yield self.logfile.compressLog()
+
+        records = self.logfile.getChunkIndex()
+        self.assertTrue(len(set(r[1] for r in records)) > 1)
+        text = ''.join('line %d\n' % i for i in range(100))
+        self.assertEqual(self.logfile.getText(), text)
+        self.assertEqual(self.logfile.getLines(42, 45),
+                         'line 42\nline 43\nline 44\n')
+        self.assertEqual(self.logfile.getBytes(-8), 'line 99\n')
+
+    @defer.inlineCallbacks
+    def test_compressLog_bz2_index(self):
+        self.config.logCompressionMethod = 'bz2'
+        self.logfile.chunkSize = 20
+        self.addLines(20)
+        self.logfile.finish()
+        yield self.logfile.compressLog()
+        self.assertEqual(self.logfile.getLines(-1), 'line 19\n')
+
+    @defer.inlineCallbacks
+    def test_compressLog_gz_unindexed_data(self):
+        self.config.logCompressionMethod = 'gz'
+        self.addLines(3)
+        self.logfile.openfile.write('xyz')
+        self.logfile.finish()
+        yield self.logfile.compressLog()
+        self.assertFalse(os.path.exists(self.logfile.getIndexFilename()))
+
+    def test_subscribe_batched(self):
+        self.patch(logfile, 'reactor', task.Clock())
+        self.logfile.addStdout('early\n')
+        watcher = mock.Mock(name='watcher')
+        self.logfile.subscribe(watcher, True, batched=True)
+        watcher.logChunks.assert_called_with(self.build_step_status.build,
+                self.build_step_status, self.logfile, [(0, 'early\n')])
+
+        self.logfile.addStdout('a')
+        self.logfile.addStdout('b')
+        self.logfile.addStderr('c')
+        self.assertEqual(watcher.logChunks.call_count, 1)
+        logfile.reactor.advance(self.logfile.watcherBatchDelay)
+        watcher.logChunks.assert_called_with(self.build_step_status.build,
+                self.build_step_status, self.logfile, [(0, 'ab'), (1, 'c')])
+
+        self.logfile.addStdout('d')
+        self.logfile.finish()
+        self.assertEqual(watcher.logChunks.call_args[0][3], [(0, 'd')])
+        self.assertFalse(watcher.logChunk.called)
+
+    def test_timestamps_multiline(self):
+        self.logfile.setTimestampsMode(prepend_timestamps=True)
+        self.patch(time, "strftime", mock.Mock(return_value="12:01:29"))
+        self.logfile.addStdout("a\nb\n")
+        self.logfile.addStdout("c")
+        self.assertEqual(self.logfile.getText(),
+                         "[12:01:29]   a\n[12:01:29]   b\n[12:01:29]   c\n")
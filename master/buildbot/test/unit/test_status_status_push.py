@@ -0,0 +1,138 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+from twisted.trial import unittest
+from twisted.internet import task
+from buildbot.status import status_push
+
+class TestStatusPushCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(status_push, 'reactor', self.clock)
+        self.push = status_push.StatusPush(serverPushCb=lambda sp: None,
+                                           coalesceDelay=2)
+        self.push.status = mock.Mock()
+        self.push.status.getTitle.return_value = 'katana'
+        self.builds = {}
+
+    def makeStep(self, number, name):
+        build = mock.Mock()
+        build.getBuilder.return_value.getName.return_value = 'bldr'
+        build.getNumber.return_value = number
+        step = mock.Mock()
+        step.getBuild.return_value = build
+        step.getName.return_value = name
+        step.asDict.return_value = dict(name=name, text=step.text)
+        return step
+
+    def queuedEvents(self):
+        return [(p['event'], p['payload'].get('text')) for p in self.push.queue.items()]
+
+    def test_coalesce(self):
+        compile, test = self.makeStep(1, 'compile'), self.makeStep(1, 'test')
+        self.push.push('stepTextChanged', step=compile, text=['a'])
+        self.push.push('stepTextChanged', step=test, text=['b'])
+        self.push.push('stepTextChanged', step=compile, text=['c'])
+        self.push.push('stepStarted', step=test)
+        self.assertEqual(self.queuedEvents(), [('stepStarted', None)])
+
+        self.clock.advance(2)
+        self.assertEqual(self.queuedEvents(), [('stepStarted', None),
+                                               ('stepTextChanged', ['c']),
+                                               ('stepTextChanged', ['b'])])
+
+        self.assertEqual(self.push.eventStats['stepTextChanged'],
+                         dict(received=3, coalesced=1, dropped=0, queued=2))
+        self.assertEqual(self.push.getEventRates()['stepTextChanged']['received'], 1.5)
+
+    def test_drop_stale(self):
+        compile, test = self.makeStep(1, 'compile'), self.makeStep(1, 'test')
+        self.push.push('stepETAUpdate', step=compile, ETA=10, expectations=None)
+        self.push.push('stepETAUpdate', step=test, ETA=10, expectations=None)
+        self.push.push('buildETAUpdate', build=compile.getBuild(), ETA=20)
+        self.push.push('stepFinished', step=compile)
+        self.assertEqual(self.push.eventStats['stepETAUpdate']['dropped'], 1)
+
+        self.push.push('buildFinished', build=compile.getBuild())
+        self.clock.advance(2)
+        self.assertEqual(self.queuedEvents(), [('stepFinished', None),
+                                               ('buildFinished', None)])
+
+    def test_coalesce_disabled(self):
+        self.push.coalesceDelay = 0
+        step = self.makeStep(1, 'compile')
+        self.push.push('stepTextChanged', step=step, text=['a'])
+        self.push.push('stepTextChanged', step=step, text=['b'])
+        self.assertEqual(len(self.queuedEvents()), 2)
+
+    def test_stopService_flushes(self):
+        self.push.parent = mock.Mock()
+        self.push.running = True
+        self.push.push('stepTextChanged', step=self.makeStep(1, 'compile'), text=['a'])
+        self.push.stopService()
+        self.assertEqual([e for e, _ in self.queuedEvents()],
+                         ['stepTextChanged', 'shutdown'])
+        self.assertFalse(self.clock.getDelayedCalls())
+
+class TestAutobahnStatusPushCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(status_push, 'reactor', self.clock)
+        self.patch(status_push.AutobahnStatusPush, 'connectToAutobahn',
+                   lambda self: None)
+        self.push = status_push.AutobahnStatusPush('localhost', 9000,
+                                                   maxDiskItems=0,
+                                                   coalesceDelay=2)
+        self.push.status = mock.Mock()
+        self.push.status.getTitle.return_value = 'katana'
+        self.push.status.getBuildbotURL.return_value = 'http://katana/'
+
+    def makeBuild(self, number):
+        build = mock.Mock()
+        build.number = number
+        build.builder.name = 'bldr'
+        build.builder.project = 'proj'
+        build.sources = []
+        build.slavename = 'slave1'
+        return build
+
+    def queuedEvents(self):
+        return [(p['event'], p['payload'].get('number'))
+                for p in self.push.queue.items()]
+
+    def test_coalesce_without_build(self):
+        # the Autobahn events carry the builder name and build number, not
+        # the build
+        build = self.makeBuild(1)
+        self.push.buildETAUpdate(build, 10)
+        self.push.buildETAUpdate(build, 5)
+        self.push.buildETAUpdate(self.makeBuild(2), 5)
+        self.clock.advance(2)
+        self.assertEqual(self.queuedEvents(), [('buildETAUpdate', 1),
+                                               ('buildETAUpdate', 2)])
+        self.assertEqual(self.push.eventStats['buildETAUpdate']['coalesced'], 1)
+
+    def test_drop_stale_without_build(self):
+        build = self.makeBuild(1)
+        self.push.buildETAUpdate(build, 10)
+        self.push.stepFinished(build, mock.Mock(), 0)
+        self.push.buildFinished('bldr', build, 0)
+        self.clock.advance(2)
+        self.assertEqual(self.queuedEvents(), [('stepFinished', 1),
+                                               ('buildFinished', 1)])
+        self.assertEqual(self.push.eventStats['buildETAUpdate']['dropped'], 1)
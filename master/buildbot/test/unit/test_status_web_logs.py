@@ -114,3 +114,36 @@ class TestLogsResource(unittest.TestCase):
         htmllog = HTMLLogFile(step, "example", "test file", "test html")
 
         self.assertEquals(htmllog.content_type, "")
+
+    def test_text_log_ranges(self):
+        log = mock.Mock(LogFile)
+        log.getText.return_value = "all"
+        textlog = TextLog(log)
+        textlog.newWindow = True
+        req = mock.Mock()
+
+        req.args = {}
+        self.assertEqual(textlog.getText(req), "all")
+
+        req.args = {"tail": ["10"]}
+        textlog.getText(req)
+        log.getLines.assert_called_with(-10, channels=[0, 1])
+
+        req.args = {"lines": ["5:"]}
+        textlog.getText(req)
+        log.getLines.assert_called_with(5, None, channels=[0, 1])
+
+        req.args = {"bytes": ["-100:-1"]}
+        textlog.getText(req)
+        log.getBytes.assert_called_with(-100, -1, channels=[0, 1])
+
+        req.args = {"tail": ["0"]}
+        self.assertEqual(textlog.getText(req), "")
+
+        # malformed selections are refused, not answered with the whole log
+        for args in ({"tail": ["-5"]}, {"tail": ["x"]}, {"lines": ["x"]},
+                     {"bytes": ["1:x"]}):
+            req.reset_mock()
+            req.args = args
+            self.assertNotEqual(textlog.getText(req), "all")
+            req.setResponseCode.assert_called_with(400)
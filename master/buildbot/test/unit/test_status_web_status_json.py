@@ -13,7 +13,9 @@
 #
 # Copyright Buildbot Team Members
 
+import json
 import mock
+import weakref
 
 from twisted.trial import unittest
 from twisted.web import resource
@@ -22,10 +24,11 @@ from buildbot.status.web import status_json
 from buildbot.config import ProjectConfig
 from buildbot.status import master
 from buildbot.test.fake import fakemaster, fakedb
+from buildbot.test.fake.web import FakeRequest
 from buildbot.status.builder import BuilderStatus, PendingBuildsCache
 from buildbot.status.build import BuildStatus
 from buildbot.status.slave import SlaveStatus
-from twisted.internet import defer
+from twisted.internet import defer, task
 from buildbot.status.results import SUCCESS
 from buildbot.config import BuilderConfig
 from buildbot.process.factory import BuildFactory
@@ -47,7 +50,8 @@ class PastBuildsJsonResource(unittest.TestCase):
 
         self.builder_status = mock.Mock()
         self.builder_status.generateFinishedBuildsAsync = \
-            lambda branches=[], codebases={}, num_builds=None, results=None: defer.succeed([build])
+            lambda branches=[], codebases={}, num_builds=None, results=None, stopped=None: \
+                defer.succeed([build])
 
         # set-up the resource object that will be used
         # by the tests with our mocked objects
@@ -268,7 +272,8 @@ class TestPastBuildsJsonResource(unittest.TestCase):
                                finished_before=None,
                                results=None,
                                max_search=2000,
-                               useCache=False):
+                               useCache=False,
+                               stopped=None):
 
 
             finished_builds = []
@@ -763,3 +768,148 @@ class TestBuildNumberForRequestJsonResource(unittest.TestCase):
             build_number = yield build_number_resource.asDict(request=self.request)
 
         self.assertEqual(build_number, request_build_number)
+
+
+class CountingJsonResource(status_json.JsonResource):
+    cacheResponses = True
+
+    def __init__(self, status):
+        status_json.JsonResource.__init__(self, status)
+        self.rendered = 0
+
+    def asDict(self, request):
+        self.rendered += 1
+        return {'rendered': self.rendered}
+
+
+class TestJsonResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.status = mock.Mock()
+        self.clock = task.Clock()
+        self.cache = status_json.JsonResponseCache(self.status, _reactor=self.clock)
+        self.patch(status_json, '_responseCaches',
+                   weakref.WeakKeyDictionary({self.status: self.cache}))
+        self.resource = CountingJsonResource(self.status)
+
+    @defer.inlineCallbacks
+    def render(self, args=None, headers=None):
+        request = FakeRequest(args=args or {})
+        request.path = '/json/builders'
+        headers = dict(headers or {}, host='katana')
+        request.getHeader = lambda name: headers.get(name.lower())
+        request.setResponseCode = mock.Mock()
+        self.resource.render_GET(request)
+        yield request.deferred
+        defer.returnValue(request)
+
+    @defer.inlineCallbacks
+    def test_cached(self):
+        self.status.subscribe.assert_called_with(self.cache)
+        first = yield self.render()
+        second = yield self.render()
+        self.assertEqual(first.written, '{"rendered":1}')
+        self.assertEqual(second.written, '{"rendered":1}')
+        # other arguments are another response
+        other = yield self.render(args={'as_text': ['1']})
+        self.assertIn('"rendered": 2', other.written)
+
+    @defer.inlineCallbacks
+    def test_invalidated_by_events(self):
+        yield self.render()
+        self.cache.buildFinished('bldr', mock.Mock(), 0)
+        request = yield self.render()
+        self.assertEqual(request.written, '{"rendered":2}')
+        self.cache.slaveConnected('slave')
+        request = yield self.render()
+        self.assertEqual(request.written, '{"rendered":3}')
+
+    @defer.inlineCallbacks
+    def test_expires(self):
+        yield self.render()
+        self.clock.advance(self.cache.maxAge)
+        request = yield self.render()
+        self.assertEqual(request.written, '{"rendered":2}')
+
+    @defer.inlineCallbacks
+    def test_event_while_rendering(self):
+        d = defer.Deferred()
+        self.resource.asDict = lambda request: d
+        rendering = self.render()
+        self.cache.buildStarted('bldr', mock.Mock())
+        d.callback({'stale': True})
+        yield rendering
+        self.assertEqual(self.cache.entries, {})
+
+    @defer.inlineCallbacks
+    def test_etag(self):
+        first = yield self.render()
+        etag = [v for k, v in (c[0] for c in first.setHeader.call_args_list)
+                if k == 'ETag'][0]
+        request = yield self.render(headers={'if-none-match': '"other", %s' % etag})
+        request.setResponseCode.assert_called_with(304)
+        self.assertEqual(request.written, '')
+        self.assertEqual(self.resource.rendered, 1)
+
+
+class TestJsonResourceSelect(unittest.TestCase):
+
+    def setUp(self):
+        self.root = status_json.JsonResource(mock.Mock())
+        self.pending = []
+        self.rendered = []
+        for name in ('a', 'b', 'c'):
+            child = status_json.JsonResource(None)
+            child.asDict = self.makeAsDict(name)
+            self.root.putChild(name, child)
+
+    def makeAsDict(self, name):
+        def asDict(request):
+            self.rendered.append((name, request.prepath))
+            d = defer.Deferred()
+            self.pending.append((d, {'name': name}))
+            return d
+        return asDict
+
+    def content(self, select):
+        request = FakeRequest(args={'select': select})
+        request.prepath = ['json']
+        request.postpath = []
+        return self.root.content(request)
+
+    def test_concurrent(self):
+        self.root.maxConcurrentSelects = 2
+        d = self.content(['a', 'b/', '/c', 'a'])
+        # duplicates are rendered once, two at a time, each with its path
+        self.assertEqual(sorted(self.rendered), [('a', ['json', 'a']),
+                                                 ('b', ['json', 'b'])])
+        while self.pending:
+            pending, result = self.pending.pop(0)
+            pending.callback(result)
+        self.assertEqual(len(self.rendered), 3)
+        self.assertEqual(json.loads(self.successResultOf(d)),
+                         {'a': {'name': 'a'}, 'b': {'name': 'b'}, 'c': {'name': 'c'}})
+
+    def test_failure(self):
+        d = self.content(['a', 'b'])
+        self.pending[0][0].errback(RuntimeError('broken'))
+        self.pending[1][0].callback({})
+        self.failureResultOf(d, RuntimeError)
+
+    def test_not_available(self):
+        self.root.putChild('static', resource.Resource())
+        d = self.content(['static'])
+        self.assertEqual(json.loads(self.successResultOf(d)),
+                         {'static': {'error': 'Not available'}})
+
+    def test_shared_prefix(self):
+        parent = status_json.JsonResource(None)
+        for name in ('x', 'y'):
+            child = status_json.JsonResource(None)
+            child.asDict = lambda request, name=name: {'name': name}
+            parent.putChild(name, child)
+        self.root.putChild('p', parent)
+        d = self.content(['p/x', 'p/y'])
+        # each path resets the shared prefix, so only the last one is kept
+        self.assertEqual(json.loads(self.successResultOf(d)),
+                         {'p': {'y': {'name': 'y'}}})
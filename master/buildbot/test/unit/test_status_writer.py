@@ -0,0 +1,115 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import cPickle
+from twisted.trial import unittest
+from twisted.internet import defer, task, reactor
+from buildbot.status import writer
+
+class TestStatusWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath(self.mktemp())
+        os.makedirs(self.basedir)
+        self.filename = os.path.join(self.basedir, 'builder')
+        self.clock = task.Clock()
+        # the written pickles are delivered through the real reactor
+        self.clock.callFromThread = reactor.callFromThread
+        self.writer = writer.StatusWriter(_reactor=self.clock)
+
+    def tearDown(self):
+        return self.writer.stop()
+
+    def load(self):
+        with open(self.filename, 'rb') as f:
+            return cPickle.load(f)
+
+    def test_save_not_started(self):
+        d = self.writer.save(self.filename, dict(n=1))
+        self.assertEqual(self.load(), dict(n=1))
+        # no temporary file is left behind
+        self.assertEqual(os.listdir(self.basedir), ['builder'])
+        d.addCallback(self.assertTrue)
+        return d
+
+    def test_save_not_picklable(self):
+        d = self.writer.save(self.filename, lambda : None)
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+        d.addCallback(self.assertFalse)
+        return d
+
+    @defer.inlineCallbacks
+    def test_save_coalesced(self):
+        self.writer.start()
+        self.patch(self.writer, '_writeSnapshots',
+                   self.recordWrites(self.writer._writeSnapshots))
+        first = dict(n=1)
+        d1 = self.writer.save(self.filename, first)
+        second = dict(n=2)
+        d2 = self.writer.save(self.filename, second)
+
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertIdentical(self.writer.getPending(self.filename), second)
+
+        # nothing is pickled before the delay
+        second['n'] = 3
+        self.clock.advance(self.writer.delay)
+        second['n'] = 4
+        results = yield defer.gatherResults([d1, d2])
+
+        self.assertEqual(results, [True, True])
+        self.assertEqual(self.writes, [[self.filename]])
+        self.assertEqual(self.load(), dict(n=3))
+        self.assertEqual(self.writer.getPending(self.filename), None)
+
+    @defer.inlineCallbacks
+    def test_stop_flushes(self):
+        self.writer.start()
+        d = self.writer.save(self.filename, dict(n=1))
+        yield self.writer.stop()
+        saved = yield d
+        self.assertTrue(saved)
+        self.assertEqual(self.load(), dict(n=1))
+        self.assertEqual(self.writer.pool, None)
+
+        # saves are synchronous again
+        self.writer.save(self.filename, dict(n=2))
+        self.assertEqual(self.load(), dict(n=2))
+
+    def test_writePickle_concurrent(self):
+        # the saves of the build loader threads do not share the temporary
+        # file of the worker thread
+        tmpfiles = []
+        mkstemp = writer.tempfile.mkstemp
+        def record(**kwargs):
+            fd, name = mkstemp(**kwargs)
+            tmpfiles.append(name)
+            return fd, name
+        self.patch(writer.tempfile, 'mkstemp', record)
+        writer.writePickle(self.filename, 'one')
+        writer.writePickle(self.filename, 'two')
+        self.assertNotEqual(tmpfiles[0], tmpfiles[1])
+        self.assertEqual(os.path.dirname(tmpfiles[0]), self.basedir)
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), 'two')
+
+    def recordWrites(self, writeSnapshots):
+        self.writes = []
+        def record(snapshots):
+            self.writes.append([ s[0] for s in snapshots ])
+            return writeSnapshots(snapshots)
+        return record
@@ -1,13 +1,13 @@
 from twisted.trial import unittest
-from buildbot.test.util import steps
+from buildbot.test.util import steps, config
 
 from buildbot.steps import artifact
-from buildbot.status.results import SUCCESS
-from buildbot.test.fake.remotecommand import ExpectShell
+from buildbot.status.results import SUCCESS, FAILURE
+from buildbot.test.fake.remotecommand import ExpectShell, Expect
 from buildbot.test.fake import fakemaster, fakedb
 
 
-class TestArtifactSteps(steps.BuildStepMixin, unittest.TestCase):
+class TestArtifactSteps(steps.BuildStepMixin, config.ConfigErrorsMixin, unittest.TestCase):
     def setUp(self):
         return self.setUpBuildStep()
 
@@ -430,4 +430,122 @@ class TestArtifactSteps(steps.BuildStepMixin, unittest.TestCase):
         )
 
         self.expectOutcome(result=SUCCESS, status_text=['Downloaded artifacts from 1 partitions'])
-        return self.runStep()
\ No newline at end of file
+        return self.runStep()
+    def test_download_artifact_fromchildren_concurrent_failure(self):
+        br2 = fakedb.BuildRequest(id=2, buildsetid=2, buildername="B", triggeredbybrid=1)
+        br3 = fakedb.BuildRequest(id=3, buildsetid=3, buildername="B", triggeredbybrid=1)
+        br4 = fakedb.BuildRequest(id=4, buildsetid=4, buildername="B", triggeredbybrid=1)
+
+        self.setupStep(
+            artifact.DownloadArtifactsFromChildren(
+                workdir='build',
+                artifactServer='usr@srv.com',
+                artifactServerDir='/artifacts',
+                artifactBuilderName='B',
+                maxConcurrentDownloads=2,
+        ), [br2, br3, br4])
+
+        def rsync(brid):
+            return ('for i in 1 2 3 4 5; do rsync -var --progress --partial '
+                    "'usr@srv.com:/artifacts/B/%d_01_01_1970_00_00_00_+0000/' '%d'"
+                    '; if [ $? -eq 0 ]; then exit 0; else sleep 5; fi; done; exit -1' % (brid, brid))
+
+        # once a partition failed, the remaining ones are not started
+        self.expectCommands(
+            ExpectShell(workdir='build', usePTY='slave-config',
+                        command=['mkdir', '-p', '2']) + 0,
+            ExpectShell(workdir='build', usePTY='slave-config',
+                        command=rsync(2)) + 0,
+            ExpectShell(workdir='build', usePTY='slave-config',
+                        command=['mkdir', '-p', '3']) + 0,
+            ExpectShell(workdir='build', usePTY='slave-config',
+                        command=rsync(3)) + 1,
+        )
+
+        self.expectOutcome(result=FAILURE, status_text=['Downloading artifacts from 3 triggered partitions'])
+        d = self.runStep()
+        def check(_):
+            headers = self.step_status.logs['stdio'].header
+            self.assertIn('Downloaded artifacts of build request 2 in', headers)
+            self.assertIn('Downloading artifacts of build request 3 failed after', headers)
+            self.assertNotIn('build request 4', headers)
+        d.addCallback(check)
+        return d
+
+    def test_download_artifact_fromchildren_bad_concurrency(self):
+        self.assertRaisesConfigError("maxConcurrentDownloads must be at least 1",
+            lambda: artifact.DownloadArtifactsFromChildren(
+                artifactServer='usr@srv.com', artifactServerDir='/artifacts',
+                artifactBuilderName='B', maxConcurrentDownloads=0))
+
+    def test_download_artifact_cached(self):
+        fake_br2 = fakedb.BuildRequest(id=2, buildsetid=2, buildername="B", complete=1,
+                                       results=0, triggeredbybrid=1, startbrid=1)
+        self.setupStep(artifact.DownloadArtifact(artifactBuilderName="B", artifact="myartifact.py",
+                                                 artifactDirectory="mydir",
+                                                 artifactServer='usr@srv.com',
+                                                 artifactServerDir='/home/srv/web/dir',
+                                                 artifactCacheSize=10 * 1024 * 1024), [fake_br2])
+        self.expectCommands(
+            Expect('downloadArtifact', dict(
+                workdir='wkdir',
+                key=['B', 2, 'B_2_01_01_1970_00_00_00_+0000/mydir/myartifact.py'],
+                source='usr@srv.com:/home/srv/web/dir/B_2_01_01_1970_00_00_00_+0000/mydir/myartifact.py',
+                destination='myartifact.py',
+                port=None, maxCacheSize=10 * 1024 * 1024, hardlink=False))
+            + Expect.update('header', 'using cached artifact\n')
+            + 0
+        )
+        self.expectOutcome(result=SUCCESS, status_text=["Downloaded 'B'."])
+        return self.runStep()
+
+    def test_download_artifact_cache_old_slave(self):
+        fake_br2 = fakedb.BuildRequest(id=2, buildsetid=2, buildername="B", complete=1,
+                                       results=0, triggeredbybrid=1, startbrid=1)
+        self.setupStep(artifact.DownloadArtifact(artifactBuilderName="B", artifact="myartifact.py",
+                                                 artifactDirectory="mydir",
+                                                 artifactServer='usr@srv.com',
+                                                 artifactServerDir='/home/srv/web/dir',
+                                                 artifactCacheSize=10 * 1024 * 1024), [fake_br2])
+        self.build.getSlaveCommandVersion = lambda cmd, oldversion: None if cmd == 'downloadArtifact' else '2.17'
+        self.expectCommands(
+            ExpectShell(workdir='wkdir', usePTY='slave-config',
+                        command='for i in 1 2 3 4 5; do rsync -var --progress --partial ' +
+                                self.remote_2 + ' ' +
+                                self.local + '; if [ $? -eq 0 ]; then exit 0; else sleep 5; fi; done; exit -1')
+            + 0
+        )
+        self.expectOutcome(result=SUCCESS, status_text=["Downloaded 'B'."])
+        return self.runStep()
+
+    def test_download_artifact_fromchildren_cached(self):
+        br2 = fakedb.BuildRequest(id=2, buildsetid=2, buildername="B", triggeredbybrid=1)
+
+        self.setupStep(
+            artifact.DownloadArtifactsFromChildren(
+                workdir='build',
+                artifactServer='usr@srv.com',
+                artifactServerDir='/artifacts',
+                artifactServerPort=22,
+                artifactDirectory='mydir',
+                artifactBuilderName='B',
+                artifactDestination='./base/local',
+                artifactCacheSize=1024,
+                artifactCacheHardlinks=True,
+        ), [br2])
+
+        self.expectCommands(
+            Expect('downloadArtifact', dict(
+                workdir='build',
+                key=['B', 2, 'B/2_01_01_1970_00_00_00_+0000/mydir/'],
+                source='usr@srv.com:/artifacts/B/2_01_01_1970_00_00_00_+0000/mydir/',
+                destination='./base/local/2/',
+                port=22, maxCacheSize=1024, hardlink=True))
+            + 0
+        )
+
+        self.expectOutcome(result=SUCCESS, status_text=['Downloaded artifacts from 1 partitions'])
+        d = self.runStep()
+        d.addCallback(lambda _: self.assertEqual(self.build.getProperty('artifactsMap'),
+                                                 {'./base/local/2': 'B/2_01_01_1970_00_00_00_+0000/mydir/'}))
+        return d
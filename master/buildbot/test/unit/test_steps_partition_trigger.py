@@ -48,6 +48,18 @@ class FakeTriggerable():
             reactor.callLater(0, d.callback, (self.result, self.brids))
         return d
 
+class FakeBulkTriggerable(FakeTriggerable):
+    implements(interfaces.IBulkTriggerableScheduler)
+
+    def __init__(self, name):
+        FakeTriggerable.__init__(self, name)
+        self.bulk_triggers = 0
+
+    def triggerMany(self, sourcestamps = None, set_props_list=(), triggeredbybrid=None, reason=None):
+        self.bulk_triggers += 1
+        return [ self.trigger(sourcestamps, set_props=set_props, triggeredbybrid=triggeredbybrid, reason=reason)
+                 for set_props in set_props_list ]
+
 class TestPartitionTrigger(steps.BuildStepMixin, unittest.TestCase):
     def setUp(self):
         return self.setUpBuildStep()
@@ -203,3 +215,21 @@ class TestPartitionTrigger(steps.BuildStepMixin, unittest.TestCase):
             ({}, {'partition-index': (1, 'PartitionTrigger'), 'foo': ('baz', 'PartitionTrigger')}, 1)
         ])
         return self.runStep()
+
+    def test_runStep_whenSchedulerIsBulkTriggerable_thenPartitionsAreTriggeredAtOnce(self):
+        def yieldPartitions(buildStep, scheduler):
+            yield {'partition-index': 0}
+            yield {'partition-index': 1}
+
+        self.setupStep(partition_trigger.PartitionTrigger(partitionFunction=yieldPartitions, schedulerNames=['a'], sourceStamps = {}))
+        self.scheduler_a = FakeBulkTriggerable(name='a')
+        self.scheduler_a.brids = {'A': 11}
+
+        self.expectOutcome(result=SUCCESS, status_text=["Triggered:", "'a' (split into 2 partitions)"])
+        self.aExpectTriggeredWith([
+            ({}, {'partition-index': (0, 'PartitionTrigger')}, 1),
+            ({}, {'partition-index': (1, 'PartitionTrigger')}, 1)
+        ])
+        d = self.runStep()
+        d.addCallback(lambda _: self.assertEqual(self.scheduler_a.bulk_triggers, 1))
+        return d
@@ -19,6 +19,7 @@ import tempfile, os
 import shutil
 import tarfile
 from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
 import ast
 
 from mock import Mock
@@ -26,7 +27,7 @@ from mock import Mock
 from buildbot.process.properties import Properties
 from buildbot.util import json
 from buildbot.steps import transfer
-from buildbot.status.results import SUCCESS
+from buildbot.status.results import SUCCESS, FAILURE
 from buildbot import config
 from buildbot.test.util import steps
 from buildbot.test.fake.remotecommand import Expect, ExpectRemoteRef
@@ -49,7 +50,7 @@ class TestFileUpload(unittest.TestCase):
         s = transfer.FileUpload(slavesrc=__file__, masterdest=self.destfile)
         s.build = Mock()
         s.build.getProperties.return_value = Properties()
-        s.build.getSlaveCommandVersion.return_value = 1
+        s.build.getSlaveCommandVersion.return_value = "2.2"
 
         s.step_status = Mock()
         s.buildslave = Mock()
@@ -158,29 +159,186 @@ class TestDirectoryUpload(steps.BuildStepMixin, unittest.TestCase):
 
         return self.tearDownBuildStep()
 
+    def makeArchive(self, mode='w'):
+        from cStringIO import StringIO
+        f = StringIO()
+        archive = tarfile.open(fileobj=f, name='fake.tar', mode=mode)
+        info = tarfile.TarInfo("test")
+        info.size = len("Hello World!")
+        archive.addfile(info, StringIO("Hello World!"))
+        archive.close()
+        return f.getvalue()
+
+    def checkUnpacked(self, _=None):
+        with open(os.path.join(self.destdir, "test")) as f:
+            self.assertEqual(f.read(), "Hello World!")
+
     def testBasic(self):
         self.setupStep(
             transfer.DirectoryUpload(slavesrc="srcdir", masterdest=self.destdir))
 
         def upload_behavior(command):
-            from cStringIO import StringIO
-            f = StringIO()
-            archive = tarfile.TarFile(fileobj=f, name='fake.tar', mode='w')
-            archive.addfile(tarfile.TarInfo("test"), StringIO("Hello World!"))
+            data = self.makeArchive()
             writer = command.args['writer']
-            writer.remote_write(f.getvalue())
+            # blocks are unpacked as they come
+            for i in range(0, len(data), 1000):
+                writer.remote_write(data[i:i + 1000])
+            return writer.remote_unpack()
+
+        self.expectCommands(
+            Expect('uploadDirectory', dict(
+                slavesrc="srcdir", workdir='wkdir',
+                blocksize=16384, compress=None, maxsize=None,
+                window=8, maxblocksize=256*1024,
+                writer=ExpectRemoteRef(transfer._DirectoryStreamWriter)))
+            + Expect.behavior(upload_behavior)
+            + 0)
+
+        self.expectOutcome(result=SUCCESS, status_text=["uploading", "srcdir"])
+        d = self.runStep()
+        d.addCallback(self.checkUnpacked)
+        return d
+
+    def testNoStream(self):
+        self.setupStep(
+            transfer.DirectoryUpload(slavesrc="srcdir", masterdest=self.destdir,
+                                     stream=False))
+
+        def upload_behavior(command):
+            writer = command.args['writer']
+            writer.remote_write(self.makeArchive())
             writer.remote_unpack()
 
         self.expectCommands(
             Expect('uploadDirectory', dict(
                 slavesrc="srcdir", workdir='wkdir',
                 blocksize=16384, compress=None, maxsize=None,
+                window=8, maxblocksize=256*1024,
                 writer=ExpectRemoteRef(transfer._DirectoryWriter)))
             + Expect.behavior(upload_behavior)
             + 0)
 
         self.expectOutcome(result=SUCCESS, status_text=["uploading", "srcdir"])
         d = self.runStep()
+        d.addCallback(self.checkUnpacked)
+        return d
+
+    def testSlaveFailure(self):
+        self.setupStep(
+            transfer.DirectoryUpload(slavesrc="srcdir", masterdest=self.destdir))
+
+        writers = []
+        def upload_behavior(command):
+            # the slave cannot read a file, and stops without unpacking
+            writer = command.args['writer']
+            writers.append(writer)
+            writer.remote_write(self.makeArchive()[:1000])
+
+        self.expectCommands(
+            Expect('uploadDirectory', dict(
+                slavesrc="srcdir", workdir='wkdir',
+                blocksize=16384, compress=None, maxsize=None,
+                window=8, maxblocksize=256*1024,
+                writer=ExpectRemoteRef(transfer._DirectoryStreamWriter)))
+            + Expect.behavior(upload_behavior)
+            + 1)
+
+        self.expectOutcome(result=FAILURE, status_text=["uploading", "srcdir"])
+        d = self.runStep()
+        def check(_):
+            # the unpacking thread is stopped
+            writers[0].thread.join(10)
+            self.assertFalse(writers[0].thread.isAlive())
+        d.addCallback(check)
+        # it reports back through the reactor
+        d.addCallback(lambda _: task.deferLater(reactor, 0, lambda: None))
+        d.addCallback(lambda _: self.assertTrue(writers[0].finished))
+        return d
+
+    def testOldSlave(self):
+        # slaves before 2.17 get one block at a time
+        self.setupStep(
+            transfer.DirectoryUpload(slavesrc="srcdir", masterdest=self.destdir),
+            slave_version={'*': "2.16"})
+
+        def upload_behavior(command):
+            writer = command.args['writer']
+            writer.remote_write(self.makeArchive())
+            return writer.remote_unpack()
+
+        self.expectCommands(
+            Expect('uploadDirectory', dict(
+                slavesrc="srcdir", workdir='wkdir',
+                blocksize=16384, compress=None, maxsize=None,
+                writer=ExpectRemoteRef(transfer._DirectoryStreamWriter)))
+            + Expect.behavior(upload_behavior)
+            + 0)
+
+        self.expectOutcome(result=SUCCESS, status_text=["uploading", "srcdir"])
+        return self.runStep()
+
+class TestDirectoryStreamWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.destdir = os.path.abspath('streamdest')
+        if os.path.exists(self.destdir):
+            shutil.rmtree(self.destdir)
+
+    def tearDown(self):
+        if os.path.exists(self.destdir):
+            shutil.rmtree(self.destdir)
+
+    def makeArchive(self, mode):
+        from cStringIO import StringIO
+        f = StringIO()
+        archive = tarfile.open(fileobj=f, name='fake.tar', mode=mode)
+        for name, contents in [('a', 'a' * 50000), ('sub/b', 'b' * 10)]:
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            archive.addfile(info, StringIO(contents))
+        archive.close()
+        return f.getvalue()
+
+    def test_unpack_gz(self):
+        writer = transfer._DirectoryStreamWriter(self.destdir, None, 'gz')
+        data = self.makeArchive('w:gz')
+        writes = [writer.remote_write(data[i:i + 512])
+                  for i in range(0, len(data), 512)]
+        d = defer.DeferredList(writes, fireOnOneErrback=True)
+        d.addCallback(lambda _: writer.remote_unpack())
+        def check(_):
+            with open(os.path.join(self.destdir, 'a')) as f:
+                self.assertEqual(f.read(), 'a' * 50000)
+            with open(os.path.join(self.destdir, 'sub', 'b')) as f:
+                self.assertEqual(f.read(), 'b' * 10)
+        d.addCallback(check)
+        return d
+
+    def test_unpack_corrupted(self):
+        writer = transfer._DirectoryStreamWriter(self.destdir, None, None)
+        writer.remote_write('this is not a tar archive' * 100)
+        d = writer.remote_unpack()
+        return self.assertFailure(d, tarfile.ReadError)
+
+    def test_maxsize(self):
+        writer = transfer._DirectoryStreamWriter(self.destdir, 1000, None)
+        data = self.makeArchive('w')
+        writer.remote_write(data[:800])
+        writer.remote_write(data[800:])
+        d = writer.remote_unpack()
+        return self.assertFailure(d, tarfile.ReadError)
+
+    def test_cancel(self):
+        writer = transfer._DirectoryStreamWriter(self.destdir, None, None)
+        writer.remote_write(self.makeArchive('w')[:5000])
+        writer.cancel()
+        writer.thread.join()
+        # the thread reports back through the reactor
+        d = task.deferLater(reactor, 0, lambda: None)
+        def check(_):
+            self.assertTrue(writer.finished)
+            self.assertTrue(writer.failure.check(IOError))
+        d.addCallback(check)
         return d
 
 class TestStringDownload(unittest.TestCase):
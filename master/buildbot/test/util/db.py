@@ -20,6 +20,7 @@ from twisted.python import log
 from twisted.trial import unittest
 from twisted.internet import defer
 from buildbot.db import model, pool, enginestrategy
+from buildbot.db.sourcestamps import updateMergeKeys
 
 def skip_for_dialect(dialect):
     """Decorator to skip a test for a particular SQLAlchemy dialect."""
@@ -94,6 +95,7 @@ class RealDatabaseMixin(object):
         @returns: Deferred
         """
         self.__want_pool = want_pool
+        self.__table_names = set(table_names)
 
         default = 'sqlite://'
         if not sqlite_memory:
@@ -145,5 +147,12 @@ class RealDatabaseMixin(object):
                     except:
                         log.msg("while inserting %s - %s" % (row, row.values))
                         raise
+
+            # fill the buildsets merge key, like adding a buildset does
+            if set(['buildsets', 'sourcestamps']) <= self.__table_names:
+                sourcestampsetids = [r.values['sourcestampsetid'] for r in rows
+                                     if r.table in ('buildsets', 'sourcestamps')]
+                updateMergeKeys(conn, model.Model.buildsets, model.Model.sourcestamps,
+                                sourcestampsetids)
         return self.db_pool.do(thd)
 
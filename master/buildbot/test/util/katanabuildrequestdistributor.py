@@ -10,6 +10,7 @@ from buildbot.test.fake import fakedb
 from buildbot.status.results import RESUME, BEGINNING
 import cProfile, pstats
 from buildbot.test.util import compat
+from buildbot.util import subscription
 
 
 class KatanaBuildRequestDistributorTestSetup(connector_component.ConnectorComponentMixin, object):
@@ -34,11 +35,24 @@ class KatanaBuildRequestDistributorTestSetup(connector_component.ConnectorCompon
         self.master.db = self.db
         self.master.caches = cache.CacheManager()
         self.master.config.mergeRequests = None
+        self.master.config.buildRequestDistributorBatchSize = 1
+        self.setUpBuildRequestSubscriptions()
         self.processedBuilds = []
         self.mergedBuilds = []
         self.addRunningBuilds = False
         self.slaves = {}
 
+    def setUpBuildRequestSubscriptions(self):
+        # deliver the buildrequest notifications like the master does
+        new_buildrequest_subs = subscription.SubscriptionPoint("buildrequest_additions")
+        cancelled_buildrequest_subs = subscription.SubscriptionPoint("buildrequest_cancelled")
+        self.master.subscribeToBuildRequests = new_buildrequest_subs.subscribe
+        self.master.subscribeToCancelledBuildRequests = cancelled_buildrequest_subs.subscribe
+        self.master.buildRequestAdded = lambda bsid, brid, buildername: \
+            new_buildrequest_subs.deliver(dict(bsid=bsid, brid=brid, buildername=buildername))
+        self.master.buildRequestRemoved = lambda bsid, brid, buildername: \
+            cancelled_buildrequest_subs.deliver(dict(bsid=bsid, brid=brid, buildername=buildername))
+
     def setUpQuietDeferred(self):
         # Detects the "end" of the test
         self.quiet_deferred = defer.Deferred()
@@ -110,7 +124,7 @@ class KatanaBuildRequestDistributorTestSetup(connector_component.ConnectorCompon
         build.build_status.number = len(bldr.building)
 
     def addProcessedBuilds(self, slavebuilder, breqs):
-        bldr = self.brd.katanaBuildChooser.bldr
+        bldr = self.botmaster.builders[breqs[0].buildername]
         if self.addRunningBuilds:
             self.mockRunningBuilds(bldr, breqs)
         self.slaves[slavebuilder.name].isAvailable.return_value = False
@@ -34,11 +34,15 @@ class FakeMaster(object):
         self.caches = mock.Mock(name="caches")
         self.caches.get_cache = self.get_cache
         self.configured_poll_interval = None
+        self.watched_bsids = set()
         self.status = FakeStatus()
 
     def addBuildset(self, **kwargs):
         return self.db.buildsets.addBuildset(**kwargs)
 
+    def addBuildsets(self, **kwargs):
+        return self.db.buildsets.addBuildsets(**kwargs)
+
     # subscriptions
     # note that only one subscription of each type is supported
 
@@ -64,6 +68,12 @@ class FakeMaster(object):
         self.bset_completion_subscr_cb = callback
         return self._makeSubscription('bset_completion_subscr_cb')
 
+    def watchBuildsetCompletion(self, bsid):
+        self.watched_bsids.add(bsid)
+
+    def unwatchBuildsetCompletion(self, bsid):
+        self.watched_bsids.discard(bsid)
+
     def getStatus(self):
         return self.status
 
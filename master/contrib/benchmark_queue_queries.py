@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""
+Measure the Katana queue queries on a large SQLite database, without and with
+the indexes added by the database migration 035.
+
+The script seeds a database with build requests (a million by default), then
+runs getBuildRequestsInQueue and getLastBuildsNumbers through the connector
+components, printing the query plan SQLite picks for each of them and the
+best time of a few runs, first without the indexes and then with them.
+
+    python contrib/benchmark_queue_queries.py --requests 1000000 bench.sqlite
+
+The seeded database is kept, so it can be benchmarked again with --no-seed.
+"""
+
+import os
+import sys
+import time
+import random
+import optparse
+
+import sqlalchemy as sa
+from twisted.internet import defer, task
+
+from buildbot.db import model, pool, buildrequests, builds
+
+# the indexes of migration 035, as (name, table, columns)
+INDEXES = [
+    ('buildrequests_queue', 'buildrequests',
+     ['complete', 'mergebrid', 'buildername', 'priority', 'submitted_at']),
+    ('buildrequests_builder_complete', 'buildrequests',
+     ['buildername', 'complete', 'mergebrid']),
+    ('builds_brid_finish_time_number', 'builds',
+     ['brid', 'finish_time', 'number']),
+]
+
+class FakeMaster(object):
+
+    def getObjectId(self):
+        return defer.succeed(1)
+
+class BenchmarkDB(object):
+    """
+    Just enough of a DBConnector to run the connector components.
+    """
+
+    def __init__(self, engine):
+        self.master = FakeMaster()
+        self.pool = pool.DBThreadPool(engine)
+        self.model = model.Model(self)
+        self.buildrequests = buildrequests.BuildRequestsConnectorComponent(self)
+        self.builds = builds.BuildsConnectorComponent(self)
+
+        # the statements of the last query, to explain them
+        self.statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            self.statements.append((statement, parameters))
+        sa.event.listen(engine, 'before_cursor_execute', record)
+
+def seed(engine, nrequests, nbuilders, pending):
+    """
+    Create the schema and insert C{nrequests} build requests spread over
+    C{nbuilders} builders; a C{pending} fraction of them is not complete yet,
+    and a tenth of the completed ones were merged into another one.
+    """
+    model.Model.metadata.create_all(bind=engine)
+    tbls = model.Model
+    now = int(time.time())
+    rnd = random.Random(0)
+
+    conn = engine.connect()
+    batch = 10000
+    for first in xrange(1, nrequests + 1, batch):
+        brows, rrows = [], []
+        for brid in xrange(first, min(first + batch, nrequests + 1)):
+            submitted_at = now - (nrequests - brid) * 10
+            if rnd.random() < pending:
+                rrows.append(dict(id=brid, buildsetid=brid, complete=0,
+                                  buildername='builder-%d' % rnd.randrange(nbuilders),
+                                  priority=rnd.randrange(100), results=-1,
+                                  submitted_at=submitted_at, complete_at=None,
+                                  mergebrid=None))
+                continue
+            merged = brid > 1 and rnd.random() < 0.1
+            rrows.append(dict(id=brid, buildsetid=brid, complete=1,
+                              buildername='builder-%d' % rnd.randrange(nbuilders),
+                              priority=rnd.randrange(100), results=rnd.randrange(3),
+                              submitted_at=submitted_at, complete_at=submitted_at + 600,
+                              mergebrid=brid - 1 if merged else None))
+            brows.append(dict(id=brid, number=brid, brid=brid, slavename='slave',
+                              start_time=submitted_at + 5, finish_time=submitted_at + 600))
+        trans = conn.begin()
+        conn.execute(tbls.buildrequests.insert(), rrows)
+        if brows:
+            conn.execute(tbls.builds.insert(), brows)
+        trans.commit()
+        sys.stdout.write("\rseeded %d build requests" % (first + len(rrows) - 1))
+        sys.stdout.flush()
+    sys.stdout.write("\n")
+    conn.close()
+
+def dropIndexes(engine):
+    for name, _, _ in INDEXES:
+        engine.execute("DROP INDEX IF EXISTS %s" % name)
+    engine.execute("ANALYZE")
+
+def createIndexes(engine):
+    for name, table, columns in INDEXES:
+        engine.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)"
+                       % (name, table, ", ".join(columns)))
+    engine.execute("ANALYZE")
+
+def explain(engine, statements):
+    # through the DBAPI, so that the statements are not recorded again
+    conn = engine.raw_connection()
+    try:
+        for statement, parameters in statements:
+            print "   ", " ".join(statement.split())[:200]
+            cursor = conn.cursor()
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            for row in cursor.fetchall():
+                print "      ", row[-1]
+            cursor.close()
+    finally:
+        conn.close()
+
+@defer.inlineCallbacks
+def measure(db, name, fn, runs):
+    best = None
+    for _ in range(runs):
+        db.statements = []
+        start = time.time()
+        yield fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print "%s: %.3f ms" % (name, best * 1000)
+    explain(db.pool.engine, db.statements)
+
+@defer.inlineCallbacks
+def benchmark(db, options):
+    queries = [
+        ('getBuildRequestsInQueue()',
+         lambda: db.buildrequests.getBuildRequestsInQueue(queue=buildrequests.Queue.unclaimed)),
+        ('getBuildRequestsInQueue(buildername)',
+         lambda: db.buildrequests.getBuildRequestsInQueue(queue=buildrequests.Queue.unclaimed,
+                                                          buildername='builder-1')),
+        ('getLastBuildsNumbers(buildername)',
+         lambda: db.builds.getLastBuildsNumbers(buildername='builder-1')),
+    ]
+    for title, prepare in [("without the indexes", dropIndexes),
+                           ("with the indexes", createIndexes)]:
+        print "==", title
+        prepare(db.pool.engine)
+        for name, fn in queries:
+            yield measure(db, name, fn, options.runs)
+
+def main(reactor, options, dbfile):
+    engine = sa.create_engine('sqlite:///' + os.path.abspath(dbfile))
+    if options.seed:
+        seed(engine, options.requests, options.builders, options.pending)
+    db = BenchmarkDB(engine)
+    d = benchmark(db, options)
+    d.addBoth(lambda r: (db.pool.shutdown(), r)[1])
+    return d
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options] database-file")
+    parser.add_option("--requests", type="int", default=1000000,
+                      help="number of build requests to seed")
+    parser.add_option("--builders", type="int", default=500,
+                      help="number of builders the requests are spread over")
+    parser.add_option("--pending", type="float", default=0.01,
+                      help="fraction of the requests still pending")
+    parser.add_option("--runs", type="int", default=5,
+                      help="runs of each query, the best one is reported")
+    parser.add_option("--no-seed", dest="seed", action="store_false", default=True,
+                      help="benchmark an already seeded database")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("a database file is required")
+    if options.seed and os.path.exists(args[0]):
+        parser.error("%s exists, use --no-seed to benchmark it again" % args[0])
+    task.react(main, (options, args[0]))
@@ -177,10 +177,6 @@ try:
 except ImportError:
     pass
 else:
-    # external dependencies
-    setup_args['dependency_links'] = [
-        'git+https://github.com/mcuadros/pynats@v0.1.0#egg=pynats-0.0.1',
-    ]
     # dependencies
     setup_args['install_requires'] = [
         'twisted == 17.5.0',
@@ -198,7 +194,6 @@ else:
         # alternative MySQL driver, that works under pypy
         'pymysql == 0.7.1',
         'PyJWT == 1.4.0',
-        'pynats == 0.0.1',
         'www',
         'psutil == 4.3.0',
     ]
@@ -63,6 +63,9 @@ class SlaveBuilder(pb.Referenceable, service.Service):
     # if it missed a completedStep during an interrupt.
     prevStep = None
 
+    # whether the master of the current command accepts compressed updates
+    compressUpdates = False
+
     def __init__(self, name):
         #service.Service.__init__(self) # Service has no __init__ method
         self.setName(name)
@@ -150,6 +153,7 @@ class SlaveBuilder(pb.Referenceable, service.Service):
             raise UnknownCommand, "unrecognized SlaveCommand '%s'" % command
 
         self.manifest = args.pop('manifest', {})
+        self.compressUpdates = args.pop('compressUpdates', False)
         self.command = factory(self, stepId, args)
 
         log.msg(" startCommand:%s [id %s]" % (command, stepId))
@@ -0,0 +1,313 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import json
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from twisted.internet import defer, threads, task
+from twisted.python import log
+
+from buildslave import runprocess
+from buildslave.commands import base
+
+
+class ArtifactCache(object):
+    """
+    I keep the artifacts downloaded by a slave, so that builds depending on
+    the same artifact do not download it again.
+
+    Each entry is a directory named after the hash of its key, holding the
+    downloaded tree in C{data}, the key in C{key} and the size of the tree
+    in C{size}.  The modification time of C{size} is the time the entry was
+    last used, and the least recently used entries are evicted once the
+    cache grows over its size.  Entries are downloaded next to the cache
+    and renamed into it once complete.
+
+    Entries are materialized and evicted from threads, so an entry in use
+    is never evicted.  The downloads and evictions interrupted by a crash
+    are removed before the first download.
+    """
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.lock = threading.Lock()
+        self.inuse = {}
+        self.cleaned = False
+
+    def getEntryDir(self, key):
+        return os.path.join(self.cachedir, hashlib.sha1(json.dumps(key)).hexdigest())
+
+    def has(self, key):
+        return os.path.exists(os.path.join(self.getEntryDir(key), 'size'))
+
+    def makeTempDir(self):
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        with self.lock:
+            if not self.cleaned:
+                self.removeLeftovers()
+                self.cleaned = True
+        return tempfile.mkdtemp(prefix='.tmp-', dir=self.cachedir)
+
+    def removeLeftovers(self):
+        """
+        Remove the downloads and evictions left behind by a previous run of
+        the slave; nothing else may be downloading to the cache.
+        """
+        for name in os.listdir(self.cachedir):
+            if name.startswith('.tmp-') or '.evicted-' in name:
+                shutil.rmtree(os.path.join(self.cachedir, name), ignore_errors=True)
+
+    def acquire(self, key):
+        with self.lock:
+            self.inuse[key] = self.inuse.get(key, 0) + 1
+
+    def release(self, key):
+        with self.lock:
+            self.inuse[key] -= 1
+            if not self.inuse[key]:
+                del self.inuse[key]
+
+    def add(self, key, tmpdir):
+        """
+        Make the tree downloaded in C{tmpdir}/data the entry of C{key}.
+        """
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(os.path.join(tmpdir, 'data')):
+            for name in filenames:
+                size += os.lstat(os.path.join(dirpath, name)).st_size
+        with open(os.path.join(tmpdir, 'key'), 'w') as f:
+            f.write(json.dumps(key))
+        with open(os.path.join(tmpdir, 'size'), 'w') as f:
+            f.write(str(size))
+
+        entrydir = self.getEntryDir(key)
+        try:
+            os.rename(tmpdir, entrydir)
+        except OSError:
+            # another build downloaded it in the meantime
+            if not self.has(key):
+                raise
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def touch(self, key):
+        os.utime(os.path.join(self.getEntryDir(key), 'size'), None)
+
+    def materialize(self, key, destination, hardlink=False):
+        """
+        Put the tree of C{key} at C{destination}, the way rsync would have:
+        a single file is copied to C{destination} unless it is a directory or
+        ends with a slash, anything else is copied into the C{destination}
+        directory.  With C{hardlink}, the files are hard links to the cache,
+        so a build modifying them in place corrupts the cached artifact.
+        """
+        datadir = os.path.join(self.getEntryDir(key), 'data')
+        names = os.listdir(datadir)
+        if (len(names) == 1 and os.path.isfile(os.path.join(datadir, names[0]))
+            and not os.path.isdir(destination) and not destination.endswith('/')):
+            self._materializeFile(os.path.join(datadir, names[0]), destination, hardlink)
+            return
+
+        for dirpath, dirnames, filenames in os.walk(datadir):
+            targetdir = os.path.join(destination, os.path.relpath(dirpath, datadir))
+            if not os.path.isdir(targetdir):
+                os.makedirs(targetdir)
+            for name in filenames:
+                self._materializeFile(os.path.join(dirpath, name),
+                                      os.path.join(targetdir, name), hardlink)
+            # os.walk does not follow symlinked directories, but lists them
+            for name in dirnames:
+                if os.path.islink(os.path.join(dirpath, name)):
+                    self._materializeFile(os.path.join(dirpath, name),
+                                          os.path.join(targetdir, name), hardlink)
+
+    def _materializeFile(self, source, target, hardlink):
+        dirname = os.path.dirname(target)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if os.path.lexists(target):
+            os.unlink(target)
+        if os.path.islink(source):
+            os.symlink(os.readlink(source), target)
+            return
+        if hardlink:
+            try:
+                os.link(source, target)
+                return
+            except (OSError, AttributeError):
+                # another filesystem, or no hard links on this platform
+                pass
+        shutil.copy2(source, target)
+
+    def evict(self, maxsize):
+        """
+        Remove the least recently used entries until the cache is not larger
+        than C{maxsize} bytes, and return the number of entries removed.
+        """
+        entries = []
+        for name in os.listdir(self.cachedir):
+            sizefile = os.path.join(self.cachedir, name, 'size')
+            try:
+                with open(sizefile) as f:
+                    size = int(f.read())
+                entries.append((os.stat(sizefile).st_mtime, name, size))
+            except (IOError, OSError, ValueError):
+                # downloads in progress, and entries being evicted
+                continue
+
+        total = sum(size for _, _, size in entries)
+        removed = 0
+        for _, name, size in sorted(entries):
+            if total <= maxsize:
+                break
+            entrydir = os.path.join(self.cachedir, name)
+            with self.lock:
+                inuse = [k for k in self.inuse if self.getEntryDir(k) == entrydir]
+                if inuse:
+                    continue
+                # once renamed, the entry is no longer found
+                evicted = '%s.evicted-%s' % (entrydir, threading.current_thread().ident)
+                try:
+                    os.rename(entrydir, evicted)
+                except OSError as e:
+                    if e.errno == errno.ENOENT:
+                        continue
+                    raise
+            shutil.rmtree(evicted, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+_caches = {}
+
+def getArtifactCache(cachedir):
+    if cachedir not in _caches:
+        _caches[cachedir] = ArtifactCache(cachedir)
+    return _caches[cachedir]
+
+
+class DownloadArtifact(base.Command):
+    """
+    Download an artifact from the artifact server with rsync, through the
+    slave's artifact cache.
+    Arguments:
+
+        - ['workdir']:      base directory to use
+        - ['key']:          list identifying the artifact in the cache, e.g.
+                            the artifact builder, the brid and the path
+        - ['source']:       rsync location of the artifact
+        - ['destination']:  where to put the artifact, relative to workdir;
+                            with a trailing slash, it is always a directory
+        - ['port']:         ssh port of the artifact server (optional)
+        - ['maxCacheSize']: size in bytes the cache is trimmed to
+        - ['hardlink']:     hard link files from the cache instead of copying
+                            them, defaults to False; only safe if the builds
+                            never modify the artifact files in place
+        - ['timeout']:      seconds of silence tolerated from rsync
+        - ['maxTime']:      seconds before rsync is killed
+    """
+
+    header = "downloadArtifact"
+    cachedirname = "artifact_cache"
+
+    # like the retry loop of the shell commands used without the cache
+    retries = 5
+    retryDelay = 5
+
+    def setup(self, args):
+        self.workdir = args['workdir']
+        self.key = tuple(args['key'])
+        self.source = args['source']
+        self.destination = args['destination']
+        self.port = args.get('port')
+        self.maxCacheSize = args['maxCacheSize']
+        self.hardlink = args.get('hardlink', False)
+        self.timeout = args.get('timeout', 1200)
+        self.maxTime = args.get('maxTime', None)
+        self.command = None
+
+    def getCacheDir(self):
+        return os.path.join(self.builder.bot.basedir, self.cachedirname)
+
+    @defer.inlineCallbacks
+    def start(self):
+        cache = getArtifactCache(self.getCacheDir())
+        destination = os.path.join(self.builder.basedir, self.workdir, self.destination)
+
+        # the entry may not be evicted from now on
+        cache.acquire(self.key)
+        try:
+            if cache.has(self.key):
+                self.sendStatus({'header': "using cached artifact %s\n" % self.source})
+                cache.touch(self.key)
+            else:
+                tmpdir = yield threads.deferToThread(cache.makeTempDir)
+                rc = yield self._download(os.path.join(tmpdir, 'data'))
+                if rc != 0:
+                    shutil.rmtree(tmpdir, ignore_errors=True)
+                    self.sendStatus({'rc': rc})
+                    return
+                yield threads.deferToThread(cache.add, self.key, tmpdir)
+
+            try:
+                yield threads.deferToThread(cache.materialize, self.key,
+                                            destination, self.hardlink)
+            except Exception as e:
+                self.sendStatus({'header': "could not copy the artifact from the cache: %s\n" % e})
+                self.sendStatus({'rc': 1})
+                return
+        finally:
+            cache.release(self.key)
+
+        try:
+            removed = yield threads.deferToThread(cache.evict, self.maxCacheSize)
+            if removed:
+                self.sendStatus({'header': "evicted %d artifacts from the cache\n" % removed})
+        except Exception:
+            # the artifact is in place, the next download will try again
+            log.err(None, "while evicting artifacts from %s" % cache.cachedir)
+
+        self.sendStatus({'rc': 0})
+
+    @defer.inlineCallbacks
+    def _download(self, datadir):
+        command = ['rsync', '-var', '--progress', '--partial', self.source, datadir + '/']
+        if self.port:
+            command.append('--rsh=ssh -p %s' % self.port)
+
+        rc = -1
+        for attempt in range(self.retries):
+            if self.interrupted:
+                break
+            if attempt:
+                yield task.deferLater(self._reactor, self.retryDelay, lambda: None)
+            self.command = runprocess.RunProcess(self.builder, command,
+                                                 self.builder.basedir, sendRC=False,
+                                                 timeout=self.timeout, maxTime=self.maxTime,
+                                                 logEnviron=False, usePTY=False)
+            rc = yield self.command.start()
+            if rc == 0:
+                break
+        defer.returnValue(rc)
+
+    def interrupt(self):
+        self.interrupted = True
+        if self.command:
+            self.command.kill("command interrupted")
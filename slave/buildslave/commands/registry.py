@@ -37,6 +37,7 @@ commandRegistry = {
     "stat" : "buildslave.commands.fs.StatFile",
     "lstree": "buildslave.commands.fs.ListTree",
     "checksums" : "buildslave.commands.checksum.CheckSums",
+    "downloadArtifact" : "buildslave.commands.artifact.DownloadArtifact",
 }
 
 def getFactory(command):
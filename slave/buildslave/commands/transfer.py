@@ -13,15 +13,111 @@
 #
 # Copyright Buildbot Team Members
 
-import os, tarfile, tempfile
+import os, tarfile
 
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.internet import defer
 
 from buildslave.commands.base import Command
 
+class TransferWindow(object):
+    """
+    Keep up to C{size} blocks of a transfer in flight.  C{nextBlock} starts
+    transferring the next block and returns a Deferred firing once it is
+    acknowledged, or None when there is nothing left to transfer.
+    L{start} returns a Deferred firing once every block is acknowledged, or
+    failing with the first error.
+    """
+
+    def __init__(self, size, nextBlock):
+        self.size = size
+        self.nextBlock = nextBlock
+        self.inflight = 0
+        self.exhausted = False
+        self.filling = False
+        self.done = defer.Deferred()
+
+    def start(self):
+        self._fill()
+        return self.done
+
+    def _fill(self):
+        # blocks acknowledged right away call back into here; the loop
+        # below will pick up the room they leave
+        if self.filling:
+            return
+        self.filling = True
+        try:
+            while not self.exhausted and self.inflight < self.size:
+                d = self.nextBlock()
+                if d is None:
+                    self.exhausted = True
+                    break
+                self.inflight += 1
+                d.addCallbacks(self._blockDone, self._failed)
+        except:
+            self._failed(Failure())
+        finally:
+            self.filling = False
+        if self.exhausted and not self.inflight and not self.done.called:
+            self.done.callback(None)
+
+    def _blockDone(self, _):
+        self.inflight -= 1
+        if not self.done.called:
+            self._fill()
+
+    def _failed(self, why):
+        self.exhausted = True
+        if not self.done.called:
+            self.done.errback(why)
+
+
 class TransferCommand(Command):
 
+    # blocks acknowledged within that many seconds make the transfer use
+    # bigger ones, and blocks taking twice as long make it use smaller ones
+    targetRtt = 1.0
+
+    def setupWindow(self, args):
+        # Masters that know about pipelined transfers send the number of
+        # blocks to keep in flight and how big blocks may grow; others
+        # expect one block at a time, of the given size.
+        self.window = args.get('window', 1)
+        self.maxblocksize = args.get('maxblocksize')
+        self.minblocksize = self.blocksize
+        self.sendStats = 'window' in args
+        self.transferred = 0
+        self.blocks = 0
+
+    def runWindow(self, nextBlock):
+        self.transferStart = self._reactor.seconds()
+        d = TransferWindow(self.window, nextBlock).start()
+        if self.sendStats:
+            d.addCallback(self._sendTransferStats)
+        return d
+
+    def blockAcknowledged(self, size, sent):
+        self.transferred += size
+        self.blocks += 1
+        if not self.maxblocksize:
+            return
+        rtt = self._reactor.seconds() - sent
+        if rtt < self.targetRtt:
+            self.blocksize = min(self.blocksize * 2, self.maxblocksize)
+        elif rtt > 2 * self.targetRtt:
+            self.blocksize = max(self.blocksize / 2, self.minblocksize)
+
+    def _sendTransferStats(self, res):
+        if not self.interrupted:
+            elapsed = max(self._reactor.seconds() - self.transferStart, 0.001)
+            self.sendStatus({'header':
+                "transferred %d bytes in %d blocks in %.2f seconds (%.1f KB/s)\n"
+                % (self.transferred, self.blocks, elapsed,
+                   self.transferred / elapsed / 1024)})
+        return res
+
     def finished(self, res):
         if self.debug:
             log.msg('finished: stderr=%r, rc=%r' % (self.stderr, self.rc))
@@ -56,6 +152,8 @@ class SlaveFileUploadCommand(TransferCommand):
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
         - ['keepstamp']: whether to preserve file modified and accessed times
+        - ['window']: number of blocks to keep in flight (optional)
+        - ['maxblocksize']: max size blocks may grow to (optional)
     """
     debug = False
 
@@ -68,6 +166,7 @@ class SlaveFileUploadCommand(TransferCommand):
         self.keepstamp = args.get('keepstamp', False)
         self.stderr = None
         self.rc = 0
+        self.setupWindow(args)
 
     def start(self):
         if self.debug:
@@ -122,24 +221,16 @@ class SlaveFileUploadCommand(TransferCommand):
         return d
 
     def _loop(self, fire_when_done):
-        d = defer.maybeDeferred(self._writeBlock)
-        def _done(finished):
-            if finished:
-                fire_when_done.callback(None)
-            else:
-                self._loop(fire_when_done)
-        def _err(why):
-            fire_when_done.errback(why)
-        d.addCallbacks(_done, _err)
-        return None
+        self.runWindow(self._writeBlock).chainDeferred(fire_when_done)
 
     def _writeBlock(self):
-        """Write a block of data to the remote writer"""
+        """Write a block of data to the remote writer, and return the
+        Deferred of the write, or None at the end of the file"""
 
         if self.interrupted or self.fp is None:
             if self.debug:
                 log.msg('SlaveFileUploadCommand._writeBlock(): end')
-            return True
+            return None
 
         length = self.blocksize
         if self.remaining is not None and length > self.remaining:
@@ -159,17 +250,122 @@ class SlaveFileUploadCommand(TransferCommand):
                     'allowed=%d readlen=%d' % (length, len(data)))
         if len(data) == 0:
             log.msg("EOF: callRemote(close)")
-            return True
+            return None
 
         if self.remaining is not None:
             self.remaining = self.remaining - len(data)
             assert self.remaining >= 0
+        sent = self._reactor.seconds()
         d = self.writer.callRemote('write', data)
-        d.addCallback(lambda res: False)
+        d.addCallback(lambda res: self.blockAcknowledged(len(data), sent))
         return d
 
 
+class TarStream(object):
+    """
+    A file-like object reading a tar archive of C{path} while it is being
+    produced, so that a directory can be sent without writing the archive
+    to disk first.  Files are added C{chunksize} bytes at a time, so no
+    more than a block and a chunk are ever held in memory.
+    """
+
+    chunksize = 64 * 1024
+
+    def __init__(self, path, compress=None):
+        if compress == 'bz2':
+            mode = 'w|bz2'
+        elif compress == 'gz':
+            mode = 'w|gz'
+        else:
+            mode = 'w|'
+        self.buffer = []
+        self.buffered = 0
+        self.archive = tarfile.open(mode=mode, fileobj=self)
+        self.chunks = self._addMembers(path, '')
+
+    def write(self, data):
+        # called by the archive with what it produced
+        if data:
+            self.buffer.append(data)
+            self.buffered += len(data)
+
+    def read(self, size):
+        while self.buffered < size and self.chunks is not None:
+            try:
+                self.chunks.next()
+            except StopIteration:
+                self.chunks = None
+                self.archive.close()
+
+        data = ''.join(self.buffer)
+        self.buffer = [data[size:]]
+        self.buffered = len(self.buffer[0])
+        return data[:size]
+
+    def close(self):
+        if self.chunks is not None:
+            self.chunks.close()
+            self.chunks = None
+        self.buffer = []
+        self.buffered = 0
+
+    def _addMembers(self, path, arcname):
+        # the streaming counterpart of TarFile.add, yielding whenever it
+        # added some data to the archive
+        archive = self.archive
+        tarinfo = archive.gettarinfo(path, arcname)
+        if tarinfo is None:
+            log.msg("tarfile: unsupported type %r" % path)
+            return
+
+        buf = tarinfo.tobuf(archive.format, archive.encoding, archive.errors)
+        archive.fileobj.write(buf)
+        archive.offset += len(buf)
+
+        if tarinfo.isreg():
+            f = open(path, 'rb')
+            try:
+                # the header has the size already, so a file changing
+                # while it is read is cut or padded to that size
+                remaining = tarinfo.size
+                while remaining > 0:
+                    data = f.read(min(self.chunksize, remaining))
+                    if not data:
+                        data = tarfile.NUL * min(self.chunksize, remaining)
+                    archive.fileobj.write(data)
+                    remaining -= len(data)
+                    yield
+            finally:
+                f.close()
+            blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+            if remainder > 0:
+                archive.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                blocks += 1
+            archive.offset += blocks * tarfile.BLOCKSIZE
+        yield
+
+        if tarinfo.isdir():
+            for name in sorted(os.listdir(path)):
+                for _ in self._addMembers(os.path.join(path, name),
+                                          os.path.join(arcname, name)):
+                    yield
+
+
 class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
+    """
+    Upload a directory from slave to build master, as a tar archive which
+    is produced while it is sent
+    Arguments:
+
+        - ['workdir']:   base directory to use
+        - ['slavesrc']:  name of the slave-side directory to read from
+        - ['writer']:    RemoteReference to a transfer._DirectoryWriter object
+        - ['maxsize']:   max size (in bytes) of the archive to write
+        - ['blocksize']: max size for each data block
+        - ['compress']:  None, 'gz' or 'bz2'
+        - ['window']: number of blocks to keep in flight (optional)
+        - ['maxblocksize']: max size blocks may grow to (optional)
+    """
     debug = False
 
     def setup(self, args):
@@ -181,6 +377,8 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         self.compress = args['compress']
         self.stderr = None
         self.rc = 0
+        self.fp = None
+        self.setupWindow(args)
 
     def start(self):
         if self.debug:
@@ -192,22 +390,7 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         if self.debug:
             log.msg("path: %r" % self.path)
 
-        # Create temporary archive
-        fd, self.tarname = tempfile.mkstemp()
-        fileobj = os.fdopen(fd, 'w')
-        if self.compress == 'bz2':
-            mode='w|bz2'
-        elif self.compress == 'gz':
-            mode='w|gz'
-        else:
-            mode = 'w'
-        archive = tarfile.open(name=self.tarname, mode=mode, fileobj=fileobj)
-        archive.add(self.path, '')
-        archive.close()
-        fileobj.close()
-
-        # Transfer it
-        self.fp = open(self.tarname, 'rb')
+        self.fp = TarStream(self.path, self.compress)
 
         self.sendStatus({'header': "sending %s" % self.path})
 
@@ -221,13 +404,17 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
             d1.addErrback(unpack_err)
             d1.addCallback(lambda ignored: res)
             return d1
-        d.addCallback(unpack)
+        def archive_err(f):
+            # most likely a file which could not be read
+            self.rc = 1
+            return f
+        d.addCallbacks(unpack, archive_err)
         d.addBoth(self.finished)
         return d
 
     def finished(self, res):
-        self.fp.close()
-        os.remove(self.tarname)
+        if self.fp is not None:
+            self.fp.close()
         return TransferCommand.finished(self, res)
 
 
@@ -242,6 +429,8 @@ class SlaveFileDownloadCommand(TransferCommand):
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
         - ['mode']:      access mode for the new file
+        - ['window']: number of blocks to keep in flight (optional)
+        - ['maxblocksize']: max size blocks may grow to (optional)
     """
     debug = False
 
@@ -254,6 +443,8 @@ class SlaveFileDownloadCommand(TransferCommand):
         self.mode = args['mode']
         self.stderr = None
         self.rc = 0
+        self.eof = False
+        self.setupWindow(args)
 
     def start(self):
         if self.debug:
@@ -302,52 +493,59 @@ class SlaveFileDownloadCommand(TransferCommand):
         return d
 
     def _loop(self, fire_when_done):
-        d = defer.maybeDeferred(self._readBlock)
-        def _done(finished):
-            if finished:
-                fire_when_done.callback(None)
-            else:
-                self._loop(fire_when_done)
-        def _err(why):
-            fire_when_done.errback(why)
-        d.addCallbacks(_done, _err)
-        return None
+        d = self.runWindow(self._readBlock)
+        d.addCallback(self._checkTruncated)
+        d.chainDeferred(fire_when_done)
 
     def _readBlock(self):
-        """Read a block of data from the remote reader."""
+        """Request a block of data from the remote reader, and return the
+        Deferred of the request, or None when nothing more is wanted."""
 
-        if self.interrupted or self.fp is None:
+        if self.interrupted or self.fp is None or self.eof:
             if self.debug:
                 log.msg('SlaveFileDownloadCommand._readBlock(): end')
-            return True
+            return None
 
         length = self.blocksize
         if self.bytes_remaining is not None and length > self.bytes_remaining:
             length = self.bytes_remaining
 
         if length <= 0:
-            if self.stderr is None:
-                self.stderr = "Maximum filesize reached, truncating file '%s'" \
-                                % self.path
-                self.rc = 1
-            return True
-        else:
-            d = self.reader.callRemote('read', length)
-            d.addCallback(self._writeData)
-            return d
+            return None
 
-    def _writeData(self, data):
+        # the requested bytes are accounted for right away, and the part
+        # that did not come back is given back when the reply arrives
+        if self.bytes_remaining is not None:
+            self.bytes_remaining -= length
+        sent = self._reactor.seconds()
+        d = self.reader.callRemote('read', length)
+        d.addCallback(self._writeData, length, sent)
+        return d
+
+    def _writeData(self, data, length, sent):
         if self.debug:
             log.msg('SlaveFileDownloadCommand._readBlock(): readlen=%d' %
                     len(data))
-        if len(data) == 0:
-            return True
-
         if self.bytes_remaining is not None:
-            self.bytes_remaining = self.bytes_remaining - len(data)
+            self.bytes_remaining += length - len(data)
             assert self.bytes_remaining >= 0
-        self.fp.write(data)
-        return False
+        if len(data) == 0:
+            self.eof = True
+            return
+
+        # replies come back in the order of the requests
+        if self.fp is not None:
+            self.fp.write(data)
+        self.blockAcknowledged(len(data), sent)
+
+    def _checkTruncated(self, res):
+        if (not self.interrupted and self.fp is not None and not self.eof
+            and self.bytes_remaining is not None and self.bytes_remaining <= 0):
+            if self.stderr is None:
+                self.stderr = "Maximum filesize reached, truncating file '%s'" \
+                                % self.path
+                self.rc = 1
+        return res
 
     def finished(self, res):
         if self.fp is not None:
@@ -25,6 +25,7 @@ import re
 import subprocess
 import traceback
 import stat
+import zlib
 from collections import deque
 from tempfile import NamedTemporaryFile
 
@@ -39,6 +40,12 @@ from datetime import datetime
 if runtime.platformType == 'posix':
     from twisted.internet.process import Process
 
+try:
+    from twisted.internet import inotify
+    from twisted.python import filepath
+except ImportError:
+    inotify = None
+
 def shell_quote(cmd_list):
     # attempt to quote cmd_list such that a shell will properly re-interpret
     # it.  The pipes module is only available on UNIX, and Windows "shell"
@@ -82,8 +89,80 @@ def quoteArguments(arguments):
     return ' '.join([cmdLineQuote(a) for a in arguments])
 
 
+class LogFileNotifier:
+    """
+    I share one inotify instance between the L{LogFileWatcher}s, watching
+    the directories of their logfiles (which may not exist yet, or be
+    replaced) and telling the watchers when their file changed.
+    """
+
+    mask = 0
+
+    def __init__(self):
+        self.notifier = None
+        self.watchers = {}
+        if inotify is not None:
+            self.mask = (inotify.IN_MODIFY | inotify.IN_CREATE |
+                         inotify.IN_MOVED_TO | inotify.IN_CLOSE_WRITE)
+
+    def add(self, watcher):
+        directory = os.path.dirname(os.path.abspath(watcher.logfile))
+        if self.notifier is None:
+            notifier = inotify.INotify()
+            notifier.startReading()
+            self.notifier = notifier
+        if directory not in self.watchers:
+            try:
+                self.notifier.watch(filepath.FilePath(directory), mask=self.mask,
+                                    callbacks=[self._changed])
+            except:
+                self._closeIfUnused()
+                raise
+            self.watchers[directory] = []
+        self.watchers[directory].append(watcher)
+
+    def remove(self, watcher):
+        directory = os.path.dirname(os.path.abspath(watcher.logfile))
+        watchers = self.watchers.get(directory, [])
+        if watcher not in watchers:
+            return
+        watchers.remove(watcher)
+        if not watchers:
+            del self.watchers[directory]
+            try:
+                self.notifier.ignore(filepath.FilePath(directory))
+            except KeyError:
+                # the directory was removed, and the watch with it
+                pass
+        self._closeIfUnused()
+
+    def _closeIfUnused(self):
+        if not self.watchers and self.notifier is not None:
+            self.notifier.loseConnection()
+            self.notifier = None
+
+    def _changed(self, ignored, path, mask):
+        for watcher in self.watchers.get(path.dirname(), []):
+            if os.path.abspath(watcher.logfile) == path.path:
+                watcher.changed()
+
+_logFileNotifier = None
+
+def getLogFileNotifier():
+    global _logFileNotifier
+    if _logFileNotifier is None:
+        _logFileNotifier = LogFileNotifier()
+    return _logFileNotifier
+
+
 class LogFileWatcher:
     POLL_INTERVAL = 2
+    # when inotify tells about the changes, polling is only a safety net
+    # for the filesystems it does not see changes on, such as NFS
+    NOTIFIED_POLL_INTERVAL = 30
+    READ_SIZE = 128 * 1024
+
+    _reactor = reactor
 
     def __init__(self, command, name, logfile, follow=False):
         self.command = command
@@ -101,17 +180,48 @@ class LogFileWatcher:
         # added since we started watching
         self.follow = follow
 
-        # every 2 seconds we check on the file again
+        # every 2 seconds we check on the file again, unless inotify
+        # tells us when it changes
         self.poller = task.LoopingCall(self.poll)
+        self.notified = False
+        self.pendingPoll = None
 
     def start(self):
-        self.poller.start(self.POLL_INTERVAL).addErrback(self._cleanupPoll)
+        interval = self.POLL_INTERVAL
+        if inotify is not None and runtime.platform.isLinux():
+            try:
+                getLogFileNotifier().add(self)
+                self.notified = True
+                interval = self.NOTIFIED_POLL_INTERVAL
+            except:
+                log.err(failure.Failure(),
+                        "cannot watch %s with inotify, polling it" % self.logfile)
+        self.poller.start(interval).addErrback(self._cleanupPoll)
 
     def _cleanupPoll(self, err):
         log.err(err, msg="Polling error")
         self.poller = None
 
+    def changed(self):
+        # inotify reports every write, read them once per reactor turn
+        if self.pendingPoll is None:
+            self.pendingPoll = self._reactor.callLater(0, self._pollChanged)
+
+    def _pollChanged(self):
+        self.pendingPoll = None
+        try:
+            self.poll()
+        except:
+            log.err(failure.Failure(), "while reading %s" % self.logfile)
+
     def stop(self):
+        if self.pendingPoll is not None:
+            self.pendingPoll.cancel()
+            self.pendingPoll = None
+        if self.notified:
+            getLogFileNotifier().remove(self)
+            self.notified = False
+
         try:
             self.poll()
             if self.poller is not None:
@@ -148,7 +258,7 @@ class LogFileWatcher:
             self.started = True
         self.f.seek(self.f.tell(), 0)
         while True:
-            data = self.f.read(10000)
+            data = self.f.read(self.READ_SIZE)
             if not data:
                 return
             self.command.addLogfile(self.name, data)
@@ -240,10 +350,21 @@ class RunProcess:
     interruptSignal = "KILL"
     CHUNK_LIMIT = 128*1024
 
-    # Don't send any data until at least BUFFER_SIZE bytes have been collected
-    # or BUFFER_TIMEOUT elapsed
+    # Don't send any data until at least bufferSize bytes have been collected
+    # or BUFFER_TIMEOUT elapsed. bufferSize starts at BUFFER_SIZE and follows
+    # the output rate, up to MAX_BUFFER_SIZE, so that chatty commands send
+    # about one batch every BUFFER_FLUSH_INTERVAL seconds
     BUFFER_SIZE = 64*1024
+    MAX_BUFFER_SIZE = 1024*1024
     BUFFER_TIMEOUT = 5
+    BUFFER_FLUSH_INTERVAL = 1
+
+    # When the master accepts compressed updates, messages of at least
+    # COMPRESS_MIN_SIZE bytes are zlib-compressed, and may carry up to
+    # COMPRESSED_CHUNK_LIMIT bytes of output
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESSED_CHUNK_LIMIT = 512*1024
+    COMPRESSION_LEVEL = 6
 
     # For sending elapsed time:
     startTime = None
@@ -355,6 +476,9 @@ class RunProcess:
         self.buffered = deque()
         self.buflen = 0
         self.buftimer = None
+        self.bufferSize = self.BUFFER_SIZE
+        self.lastBufferFlush = None
+        self.compressUpdates = self.builder.compressUpdates
 
         if usePTY == "slave-config":
             self.usePTY = self.builder.usePTY
@@ -606,12 +730,17 @@ class RunProcess:
         return reactor.spawnProcess(processProtocol, executable, argv, env,
                                     path, usePTY=usePTY)
 
+    def _getChunkLimit(self):
+        if self.compressUpdates:
+            return self.COMPRESSED_CHUNK_LIMIT
+        return self.CHUNK_LIMIT
+
     def _chunkForSend(self, data):
         """
-        limit the chunks that we send over PB to 128k, since it has a hardwired
-        string-size limit of 640k.
+        limit the chunks that we send over PB to 128k (512k before
+        compression), since it has a hardwired string-size limit of 640k.
         """
-        LIMIT = self.CHUNK_LIMIT
+        LIMIT = self._getChunkLimit()
         for i in range(0, len(data), LIMIT):
             yield data[i:i+LIMIT]
 
@@ -621,12 +750,12 @@ class RunProcess:
         concatentate all the chunks into a single string
         """
         retval = {}
-        for log in msg:
-            data = "".join(msg[log])
-            if isinstance(log, tuple) and log[0] == 'log':
-                retval['log'] = (log[1], data)
+        for name in msg:
+            data = "".join(msg[name])
+            if isinstance(name, tuple) and name[0] == 'log':
+                retval['log'] = (name[1], data)
             else:
-                retval[log] = data
+                retval[name] = data
         return retval
 
     def _sendMessage(self, msg):
@@ -636,8 +765,72 @@ class RunProcess:
         if not msg:
             return
         msg = self._collapseMsg(msg)
+        if self.compressUpdates:
+            compressed = self._compressMsg(msg)
+            if compressed is None:
+                # the raw output may be up to COMPRESSED_CHUNK_LIMIT bytes,
+                # too large for PB, so it goes in CHUNK_LIMIT pieces
+                for piece in self._splitMsg(msg):
+                    self.sendStatus(piece)
+                return
+            msg = compressed
         self.sendStatus(msg)
 
+    def _compressMsg(self, msg):
+        """
+        Compress the output in msg, a collapsed message, if it is large
+        enough and compresses well enough to be worth it; returns None
+        otherwise
+        """
+        compressed = {}
+        for name, value in msg.items():
+            if name == 'log':
+                logname, data = value
+            else:
+                data = value
+            if len(data) < self.COMPRESS_MIN_SIZE:
+                return None
+            zdata = zlib.compress(data, self.COMPRESSION_LEVEL)
+            if len(zdata) >= len(data) or len(zdata) > self.CHUNK_LIMIT:
+                return None
+            if name == 'log':
+                compressed[name] = (logname, zdata)
+            else:
+                compressed[name] = zdata
+        return {'compressed': compressed}
+
+    def _splitMsg(self, msg):
+        """
+        Split the output in msg, a collapsed message, into messages of at
+        most CHUNK_LIMIT bytes of output each
+        """
+        if all(len(value[1] if name == 'log' else value) <= self.CHUNK_LIMIT
+               for name, value in msg.items()):
+            yield msg
+            return
+        for name, value in msg.items():
+            if name == 'log':
+                logname, data = value
+            else:
+                data = value
+            for i in range(0, len(data), self.CHUNK_LIMIT):
+                chunk = data[i:i+self.CHUNK_LIMIT]
+                if name == 'log':
+                    yield {name: (logname, chunk)}
+                else:
+                    yield {name: chunk}
+
+    def _adaptBufferSize(self):
+        """
+        Size the buffer after the output rate since the last flush
+        """
+        now = util.now(self._reactor)
+        if self.lastBufferFlush is not None and now > self.lastBufferFlush:
+            rate = self.buflen / (now - self.lastBufferFlush)
+            self.bufferSize = int(max(self.BUFFER_SIZE,
+                min(self.MAX_BUFFER_SIZE, rate * self.BUFFER_FLUSH_INTERVAL)))
+        self.lastBufferFlush = now
+
     def _bufferTimeout(self):
         self.buftimer = None
         self._sendBuffers()
@@ -646,6 +839,8 @@ class RunProcess:
         """
         Send all the content in our buffers.
         """
+        self._adaptBufferSize()
+        chunkLimit = self._getChunkLimit()
         msg = {}
         msg_size = 0
         lastlog = None
@@ -678,15 +873,15 @@ class RunProcess:
             logdata = msg.setdefault(logname, [])
 
             # Chunkify the log data to make sure we're not sending more than
-            # CHUNK_LIMIT at a time
+            # the chunk limit at a time
             for chunk in self._chunkForSend(data):
                 if len(chunk) == 0: continue
                 logdata.append(chunk)
                 msg_size += len(chunk)
-                if msg_size >= self.CHUNK_LIMIT:
+                if msg_size >= chunkLimit:
                     # We've gone beyond the chunk limit, so send out our
                     # message.  At worst this results in a message slightly
-                    # larger than (2*CHUNK_LIMIT)-1
+                    # larger than (2*chunkLimit)-1
                     self._sendMessage(msg)
                     msg = {}
                     logdata = msg.setdefault(logname, [])
@@ -703,7 +898,7 @@ class RunProcess:
         """
         Add data to the buffer for logname
         Start a timer to send the buffers if BUFFER_TIMEOUT elapses.
-        If adding data causes the buffer size to grow beyond BUFFER_SIZE, then
+        If adding data causes the buffer size to grow beyond bufferSize, then
         the buffers will be sent.
         """
         n = len(data)
@@ -718,7 +913,7 @@ class RunProcess:
             )
         )
 
-        if self.buflen > self.BUFFER_SIZE:
+        if self.buflen > self.bufferSize:
             self._sendBuffers()
         elif not self.buftimer:
             self.buftimer = self._reactor.callLater(self.BUFFER_TIMEOUT, self._bufferTimeout)
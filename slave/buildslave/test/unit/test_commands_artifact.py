@@ -0,0 +1,181 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import mock
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from buildslave.test.fake.runprocess import Expect
+from buildslave.test.util.command import CommandTestMixin
+from buildslave.commands import artifact
+
+class TestDownloadArtifact(CommandTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpCommand()
+        self.cachedir = os.path.join(self.basedir, 'artifact_cache')
+        self.downloads = []
+        self.patch(artifact, '_caches', {})
+
+    def tearDown(self):
+        self.tearDownCommand()
+
+    def make_download(self, key=('B', 2, 'mydir'), files=None, **kwargs):
+        args = dict(workdir='workdir', key=list(key),
+                    source='usr@srv.com:/artifacts/B/2/mydir/',
+                    destination='local/2', maxCacheSize=1000)
+        args.update(kwargs)
+        # keep the cache of the previous commands
+        cmd = self.make_command(artifact.DownloadArtifact, args,
+                                makedirs=not os.path.isdir(self.basedir))
+        self.builder.bot = mock.Mock()
+        self.builder.bot.basedir = self.basedir
+
+        def fakeDownload(datadir):
+            self.downloads.append(datadir)
+            for name, contents in (files or {'a/file': 'contents'}).items():
+                path = os.path.join(datadir, name)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'w') as f:
+                    f.write(contents)
+            return defer.succeed(0)
+        cmd._download = fakeDownload
+        return cmd
+
+    def localPath(self, *path):
+        return os.path.join(self.basedir, 'workdir', *path)
+
+    @defer.inlineCallbacks
+    def test_download_then_cached(self):
+        self.make_download(hardlink=True)
+        yield self.run_command()
+        self.assertUpdates([{'rc': 0}])
+        self.assertEqual(len(self.downloads), 1)
+        with open(self.localPath('local', '2', 'a', 'file')) as f:
+            self.assertEqual(f.read(), 'contents')
+
+        self.make_download(hardlink=True)
+        yield self.run_command()
+        self.assertUpdates([
+            {'header': 'using cached artifact usr@srv.com:/artifacts/B/2/mydir/\n'},
+            {'rc': 0}])
+        self.assertEqual(len(self.downloads), 1)
+
+        # the files are hard links to the cache
+        cached = artifact.getArtifactCache(self.cachedir).getEntryDir(('B', 2, 'mydir'))
+        self.assertEqual(os.stat(self.localPath('local', '2', 'a', 'file')).st_ino,
+                         os.stat(os.path.join(cached, 'data', 'a', 'file')).st_ino)
+
+    @defer.inlineCallbacks
+    def test_copy(self):
+        # by default, the files are copied from the cache
+        self.make_download()
+        yield self.run_command()
+        cached = artifact.getArtifactCache(self.cachedir).getEntryDir(('B', 2, 'mydir'))
+        self.assertNotEqual(os.stat(self.localPath('local', '2', 'a', 'file')).st_ino,
+                            os.stat(os.path.join(cached, 'data', 'a', 'file')).st_ino)
+
+    @defer.inlineCallbacks
+    def test_single_file(self):
+        self.make_download(files={'myartifact.py': 'print 1'},
+                           destination='myartifact.py')
+        yield self.run_command()
+        self.assertUpdates([{'rc': 0}])
+        with open(self.localPath('myartifact.py')) as f:
+            self.assertEqual(f.read(), 'print 1')
+
+    @defer.inlineCallbacks
+    def test_single_file_into_directory(self):
+        self.make_download(files={'myartifact.py': 'print 1'},
+                           destination='local/2/')
+        yield self.run_command()
+        with open(self.localPath('local', '2', 'myartifact.py')) as f:
+            self.assertEqual(f.read(), 'print 1')
+
+    @defer.inlineCallbacks
+    def test_evict(self):
+        for brid in range(3):
+            self.make_download(key=('B', brid, ''), files={'f': 'x' * 10},
+                               maxCacheSize=25)
+            yield self.run_command()
+            # make the entries look used one after the other
+            cache = artifact.getArtifactCache(self.cachedir)
+            os.utime(os.path.join(cache.getEntryDir(('B', brid, '')), 'size'),
+                     (1000 + brid, 1000 + brid))
+
+        self.assertIn({'header': 'evicted 1 artifacts from the cache\n'}, self.get_updates())
+        self.assertEqual([cache.has(('B', brid, '')) for brid in range(3)],
+                         [False, True, True])
+
+    def test_evict_inuse(self):
+        cache = artifact.ArtifactCache(self.cachedir)
+        for brid in range(2):
+            tmpdir = cache.makeTempDir()
+            os.makedirs(os.path.join(tmpdir, 'data'))
+            with open(os.path.join(tmpdir, 'data', 'f'), 'w') as f:
+                f.write('x' * 10)
+            cache.add(('B', brid, ''), tmpdir)
+
+        cache.acquire(('B', 0, ''))
+        self.assertEqual(cache.evict(0), 1)
+        self.assertTrue(cache.has(('B', 0, '')))
+        cache.release(('B', 0, ''))
+        self.assertEqual(cache.evict(0), 1)
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+    def test_remove_leftovers(self):
+        # a download and an eviction interrupted by a crash
+        for name in ('.tmp-abc', '0123.evicted-42'):
+            os.makedirs(os.path.join(self.cachedir, name, 'data'))
+        cache = artifact.ArtifactCache(self.cachedir)
+        tmpdir = cache.makeTempDir()
+        self.assertEqual(os.listdir(self.cachedir), [os.path.basename(tmpdir)])
+        # the downloads in progress are kept
+        cache.makeTempDir()
+        self.assertEqual(len(os.listdir(self.cachedir)), 2)
+
+    @defer.inlineCallbacks
+    def test_download_failure(self):
+        cmd = self.make_download()
+        cmd._download = lambda datadir: defer.succeed(255)
+        yield self.run_command()
+        self.assertUpdates([{'rc': 255}])
+        # the partial download is not kept
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+    @defer.inlineCallbacks
+    def test_rsync_retries(self):
+        cmd = self.make_download(port=222)
+        del cmd._download
+        cmd.retryDelay = 0
+        rsync = ['rsync', '-var', '--progress', '--partial',
+                 'usr@srv.com:/artifacts/B/2/mydir/', '/tmp/data/',
+                 '--rsh=ssh -p 222']
+        self.patch_runprocess(
+            Expect(rsync, self.basedir, sendRC=False, timeout=1200,
+                   logEnviron=False, usePTY=False)
+            + {'stderr': 'connection refused\n'}
+            + 12,
+            Expect(rsync, self.basedir, sendRC=False, timeout=1200,
+                   logEnviron=False, usePTY=False)
+            + 0,
+        )
+        cmd.running = True
+        rc = yield cmd._download('/tmp/data')
+        self.assertEqual(rc, 0)
+        self.assertUpdates([{'stderr': 'connection refused\n'}])
@@ -273,6 +273,54 @@ class TestUploadFile(CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_window(self):
+        self.fakemaster.count_writes = True    # get actual byte counts
+        self.fakemaster.delay_write = True
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=1000,
+            blocksize=32,
+            keepstamp=False,
+            window=3,
+            maxblocksize=64,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            updates = [u for u in self.get_updates()
+                       if not (isinstance(u, dict) and 'elapsed' in u)]
+            # three blocks are sent before the first one is acknowledged,
+            # and the next ones are bigger
+            self.assertEqual(updates[1:6],
+                    ['write 32', 'write 32', 'write 32', 'write 64', 'write 20'])
+            self.assertTrue(updates[6]['header'].startswith(
+                    'transferred 180 bytes in 5 blocks in '))
+            self.assertEqual(updates[7:], ['close', {'rc': 0}])
+        d.addCallback(check)
+        return d
+
+class TestTransferWindow(unittest.TestCase):
+
+    def test_failure(self):
+        blocks = [defer.Deferred() for _ in range(3)]
+        started = []
+        def nextBlock():
+            if len(started) == len(blocks):
+                return None
+            started.append(blocks[len(started)])
+            return started[-1]
+
+        d = transfer.TransferWindow(2, nextBlock).start()
+        self.assertEqual(len(started), 2)
+        blocks[1].errback(RuntimeError('oops'))
+        blocks[0].callback(None)
+        self.assertEqual(len(started), 2)
+        return self.assertFailure(d, RuntimeError)
+
 class TestSlaveDirectoryUpload(CommandTestMixin, unittest.TestCase):
 
     def setUp(self):
@@ -365,9 +413,72 @@ class TestSlaveDirectoryUpload(CommandTestMixin, unittest.TestCase):
 
         return d
 
+    def test_missing(self):
+        self.make_command(transfer.SlaveDirectoryUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data-nosuch',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=512,
+            compress=None
+        ))
+
+        d = self.run_command()
+        self.assertFailure(d, OSError)
+
+        def check(_):
+            self.assertIn({'rc': 1}, self.get_updates())
+        d.addCallback(check)
+        return d
+
     # this is just a subclass of SlaveUpload, so the remaining permutations
     # are already tested
 
+class TestTarStream(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = os.path.abspath('tarstream')
+        if os.path.exists(self.datadir):
+            shutil.rmtree(self.datadir)
+        os.makedirs(os.path.join(self.datadir, 'sub'))
+        open(os.path.join(self.datadir, 'big'), 'wb').write('x' * 300000)
+        open(os.path.join(self.datadir, 'sub', 'small'), 'wb').write('y' * 10)
+
+    def tearDown(self):
+        if os.path.exists(self.datadir):
+            shutil.rmtree(self.datadir)
+
+    def test_stream(self, compress=None):
+        stream = transfer.TarStream(self.datadir, compress)
+        stream.chunksize = 1000
+        data = []
+        while True:
+            block = stream.read(4096)
+            # the stream never holds much more than a block and a chunk
+            self.assertTrue(stream.buffered <= 4096 + 1000 + 10240)
+            if not block:
+                break
+            data.append(block)
+        stream.close()
+
+        archive = tarfile.open(fileobj=StringIO.StringIO(''.join(data)),
+                               mode='r|*')
+        contents = {}
+        for member in archive:
+            if member.isreg():
+                contents[member.name] = archive.extractfile(member).read()
+        self.assertEqual(contents, {'big': 'x' * 300000, 'sub/small': 'y' * 10})
+
+    def test_stream_gz(self):
+        return self.test_stream('gz')
+
+    def test_close_early(self):
+        stream = transfer.TarStream(self.datadir)
+        stream.chunksize = 1000
+        self.assertEqual(len(stream.read(4096)), 4096)
+        stream.close()
+        self.assertEqual(stream.read(4096), '')
+
 class TestDownloadFile(CommandTestMixin, unittest.TestCase):
 
     def setUp(self):
@@ -415,6 +526,62 @@ class TestDownloadFile(CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_window(self):
+        self.fakemaster.count_reads = True    # get actual byte counts
+        self.fakemaster.delay_read = True
+        self.fakemaster.data = test_data = '1234' * 25
+
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=32,
+            mode=0777,
+            window=2,
+            maxblocksize=128,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            updates = [u for u in self.get_updates()
+                       if not (isinstance(u, dict) and 'elapsed' in u)]
+            self.assertEqual(updates[:4],
+                    ['read 32', 'read 32', 'read 64', 'read 128'])
+            self.assertTrue(updates[-3]['header'].startswith(
+                    'transferred 100 bytes in 3 blocks in '))
+            self.assertEqual(updates[-2:], ['close', {'rc': 0}])
+            datafile = os.path.join(self.basedir, 'data')
+            self.assertEqual(open(datafile).read(), test_data)
+        d.addCallback(check)
+        return d
+
+    def test_window_truncated(self):
+        self.fakemaster.data = 'tenchars--' * 10
+
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=50,
+            blocksize=16,
+            mode=0777,
+            window=4,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.get_updates()[-2],
+                    {'rc': 1,
+                     'stderr': "Maximum filesize reached, truncating file '%s'"
+                                % os.path.join(self.basedir, '.', 'data')})
+            datafile = os.path.join(self.basedir, 'data')
+            self.assertEqual(open(datafile).read(), 'tenchars--' * 5)
+        d.addCallback(check)
+        return d
+
     def test_mkdir(self):
         self.fakemaster.data = test_data = 'hi'
 
@@ -18,6 +18,7 @@ import re
 import os
 import time
 import signal
+import zlib
 
 from twisted.trial import unittest
 from twisted.internet import task, defer, reactor
@@ -695,6 +696,67 @@ class TestLogging(BasedirMixin, unittest.TestCase):
         s._addToBuffers('stdout', data)
         self.failUnlessEqual(len(b.updates), 1)
 
+    def testSendCompressed(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        b.compressUpdates = True
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        s._addToBuffers('stdout', 'hello ')
+        s._addToBuffers('stdout', 'world')
+        data = 'compile.c\n' * 1000
+        s._addToBuffers(('log', 'make.log'), data)
+        s._sendBuffers()
+        # small messages are not worth compressing
+        self.failUnlessEqual(b.updates[0], {'stdout': 'hello world'})
+        logname, zdata = b.updates[1]['compressed']['log']
+        self.failUnlessEqual(logname, 'make.log')
+        self.failUnlessEqual(zlib.decompress(zdata), data)
+
+    def testSendCompressedChunked(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        b.compressUpdates = True
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        data = "x" * (runprocess.RunProcess.COMPRESSED_CHUNK_LIMIT * 3 / 2)
+        s._addToBuffers('stdout', data)
+        s._sendBuffers()
+        self.failUnlessEqual(len(b.updates), 2)
+        self.failUnlessEqual(''.join(zlib.decompress(u['compressed']['stdout'])
+                                     for u in b.updates), data)
+
+    def testSendCompressedIncompressible(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        b.compressUpdates = True
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        data = os.urandom(500 * 1024)
+        s._addToBuffers('stdout', data)
+        s._addToBuffers('stdout', data)
+        s._sendBuffers()
+        # the raw output is sent in pieces PB accepts
+        for update in b.updates:
+            self.failIf('compressed' in update)
+            self.failUnless(len(update['stdout']) <= s.CHUNK_LIMIT)
+        self.failUnlessEqual(''.join(u['stdout'] for u in b.updates),
+                             data + data)
+
+    def testAdaptiveBufferSize(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        s._reactor = clock = task.Clock()
+        s._sendBuffers()
+        # 512KB of output in the last second
+        clock.advance(1)
+        s._addToBuffers('stdout', 'x' * 512 * 1024)
+        self.failUnlessEqual(s.bufferSize, 512 * 1024)
+        # the next 500KB are buffered
+        s._addToBuffers('stdout', 'x' * 500 * 1024)
+        self.failUnlessEqual(len(b.updates), 4)
+        # a quiet command goes back to the default
+        clock.advance(s.BUFFER_TIMEOUT)
+        self.failUnlessEqual(len(b.updates), 8)
+        clock.advance(60)
+        s._addToBuffers('stdout', 'x')
+        s._sendBuffers()
+        self.failUnlessEqual(s.bufferSize, s.BUFFER_SIZE)
+
 class TestLogFileWatcher(BasedirMixin, unittest.TestCase):
     def setUp(self):
         self.setUpBasedir()
@@ -721,3 +783,69 @@ class TestLogFileWatcher(BasedirMixin, unittest.TestCase):
         st = lf.statFile()
         self.assertEqual(st and st[2], 2, "statfile.log exists and size is correct")
         os.remove('statfile.log')
+
+    def makeWatcher(self, filename):
+        rp = self.makeRP()
+        logfile = os.path.join(self.basedir, filename)
+        rp.addLogfile = lambda name, data: added.append((name, data))
+        added = []
+        lf = runprocess.LogFileWatcher(rp, filename, logfile, False)
+        return lf, logfile, added
+
+    def waitFor(self, condition, timeout=5):
+        d = defer.Deferred()
+        deadline = time.time() + timeout
+        def check():
+            if condition() or time.time() > deadline:
+                d.callback(None)
+            else:
+                reactor.callLater(0.01, check)
+        check()
+        return d
+
+    @defer.inlineCallbacks
+    def test_inotify(self):
+        if runprocess.inotify is None or not runtime.platform.isLinux():
+            raise unittest.SkipTest("inotify is not available")
+        lf1, logfile1, added1 = self.makeWatcher('one.log')
+        lf2, logfile2, added2 = self.makeWatcher('two.log')
+        lf1.start()
+        lf2.start()
+        try:
+            self.assertTrue(lf1.notified)
+            self.assertEqual(lf1.poller.interval, lf1.NOTIFIED_POLL_INTERVAL)
+            # both are told about the changes of their own file, long before
+            # the safety poll
+            with open(logfile1, 'w') as f:
+                f.write('one')
+            with open(logfile2, 'w') as f:
+                f.write('two')
+            yield self.waitFor(lambda: added1 and added2)
+            self.assertEqual(added1, [('one.log', 'one')])
+            self.assertEqual(added2, [('two.log', 'two')])
+        finally:
+            lf1.stop()
+            lf2.stop()
+        self.assertEqual(runprocess.getLogFileNotifier().watchers, {})
+        self.assertEqual(runprocess.getLogFileNotifier().notifier, None)
+
+    def test_polling_without_inotify(self):
+        self.patch(runprocess, 'inotify', None)
+        lf, logfile, added = self.makeWatcher('poll.log')
+        lf.start()
+        self.assertFalse(lf.notified)
+        self.assertEqual(lf.poller.interval, lf.POLL_INTERVAL)
+        with open(logfile, 'w') as f:
+            f.write('x' * (lf.READ_SIZE + 10))
+        lf.stop()
+        self.assertEqual(''.join(data for _, data in added), 'x' * (lf.READ_SIZE + 10))
+
+    def test_polling_missing_directory(self):
+        if runprocess.inotify is None or not runtime.platform.isLinux():
+            raise unittest.SkipTest("inotify is not available")
+        lf, logfile, added = self.makeWatcher(os.path.join('missing', 'x.log'))
+        lf.start()
+        self.flushLoggedErrors()
+        self.assertFalse(lf.notified)
+        self.assertEqual(lf.poller.interval, lf.POLL_INTERVAL)
+        lf.stop()